@@ -2996,8 +2996,8 @@ class Stream_Video(QtWidgets.QDialog):
         super(Stream_Video, self).__init__(*args, **kwargs)
 
         self.writer = None # type: typing.Optional['Video_Writer']
-        self.writer_q = mp.Queue()
         self.writer_file = ""
+        self.writer_fps = 30
         self.writing = threading.Event()
         self.writing.clear()
 
@@ -3179,10 +3179,6 @@ class Stream_Video(QtWidgets.QDialog):
 
 
     def write_video(self):
-        # import here so only import when this particular widget is used.
-        # (until we refactor GUI objects)
-        from autopilot.hardware.cameras import Video_Writer
-
         if self.buttons['write'].isChecked():
             if self.writer is None:
                 self.writer_file, _ = QtWidgets.QFileDialog.getSaveFileName(
@@ -3191,35 +3187,25 @@ class Stream_Video(QtWidgets.QDialog):
                     "Video File (*.mp4)"
                 )
 
-                # remake queue just in case
-                self.writer_q = mp.Queue()
-
                 # try to get fps
                 try:
-                    fps = int(self.cameras[self.current_pilot][self.current_camera]['fps'])
+                    self.writer_fps = int(self.cameras[self.current_pilot][self.current_camera]['fps'])
                 except KeyError:
                     self.logger.warning('Camera does not have an "fps" parameter, using 30')
-                    fps = 30
+                    self.writer_fps = 30
 
-                self.writer = Video_Writer(
-                    q = self.writer_q,
-                    path = self.writer_file,
-                    fps=fps,
-                    timestamps=True,
-                    blosc=False
-                )
-                self.writer.start()
+                # the writer is started by the first frame, once we know its shape
                 self.writing.set()
                 self.buttons['write'].setText('Writing')
         else:
+            self.writing.clear()
             if self.writer is not None:
-                self.writing.clear()
-                self.writer_q.put('END')
+                self.writer.end()
 
                 self.logger.info('Waiting for writer to finish...')
                 self.buttons['write'].setDisabled(True)
-                while not self.writer_q.empty():
-                    self.buttons['write'].setText(f'Writer finishing {self.writer_q.qsize()} frames')
+                while self.writer.qsize() > 0 and self.writer.is_alive():
+                    self.buttons['write'].setText(f'Writer finishing {self.writer.qsize()} frames')
                     time.sleep(0.2)
 
                 # give the writer an additional second if it needs it
@@ -3246,6 +3232,7 @@ class Stream_Video(QtWidgets.QDialog):
                         self.logger.exception("Had to terminate Video Writer!")
                         self.writer.terminate()
 
+                self.writer.close()
                 self.writer = None
 
                 self.buttons['write'].setText("Write Video...")
@@ -3262,8 +3249,23 @@ class Stream_Video(QtWidgets.QDialog):
     def l_frame(self, value):
         self.video.update_frame('stream', value[self._streaming_cam_id])
         if self.writing.is_set():
-            self.writer_q.put_nowait((value['timestamp'],
-                                      value[self._streaming_cam_id]))
+            frame = value[self._streaming_cam_id]
+            if self.writer is None:
+                # import here so only import when this particular widget is used.
+                # (until we refactor GUI objects)
+                from autopilot.hardware.cameras import Video_Writer
+                self.writer = Video_Writer(
+                    path = self.writer_file,
+                    fps=self.writer_fps,
+                    shape=frame.shape,
+                    dtype=frame.dtype,
+                    timestamps=True,
+                    encoder='x264'
+                )
+                self.writer.start()
+            # don't hold up the GUI, drop frames if the writer is behind
+            if not self.writer.write(value['timestamp'], frame, timeout=0):
+                self.logger.warning('Video writer is behind, dropped {} frames'.format(self.writer.dropped))
 
     def closeEvent(self, arg__1:QtGui.QCloseEvent):
 
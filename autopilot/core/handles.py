@@ -0,0 +1,225 @@
+"""
+Share open hdf5 files within a process rather than opening and closing them for every operation.
+
+:class:`.Subject` methods each open their file at the start and close it at the end.
+Opening an hdf5 file means reading its metadata and object tree, so when many methods
+are called in a row, or many :class:`.Subject` s are made for the same file, most of the
+time is spent opening and closing files.
+
+Instead, :data:`.POOL` keeps one handle per file, counts who is using it, and keeps
+recently used files open (up to :attr:`.Handle_Pool.max_idle` of them) after they're released.
+
+* Files opened read-only ( ``'r'`` ) can be shared by any number of readers, and readers
+  share a writable handle if one is already open.
+* Opening a file for writing while a read-only handle to it is in use waits for the readers to release it,
+  since hdf5 can't have the same file open read-only and writable at once.
+* Since a handle is shared, only one thread can use it at a time: a thread that opens a file
+  holds its lock until it releases it. Threads that keep a file open for a long time, like
+  :meth:`.Subject.data_thread` , let others use it while they're waiting (see :meth:`.Handle_Pool.unlocked` ).
+"""
+
+import atexit
+import os
+import threading
+import typing
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import tables
+
+
+class _Handle(object):
+    __slots__ = ('path', 'h5f', 'refs', 'lock')
+
+    def __init__(self, path:str, h5f:tables.File):
+        self.path = path
+        self.h5f = h5f
+        self.refs = 0
+        self.lock = threading.RLock()
+
+    @property
+    def writable(self) -> bool:
+        return self.h5f.mode != 'r'
+
+
+class Handle_Pool(object):
+    """
+    Reference-counted cache of open :class:`tables.File` s.
+
+    Thread-safe. Each file is locked from when a thread opens it until that thread releases it,
+    so handles must be released by the thread that opened them.
+
+    Args:
+        max_idle (int): number of files to keep open after they're released
+        timeout (float): seconds to wait for readers to release a file before opening it for writing
+
+    Attributes:
+        handles (dict): ``path -> _Handle`` , in order of when they were last released
+        on_close (list): callables called with ``(path, stat)`` after a writable file is closed,
+            where ``stat`` is the :func:`os.stat` of the file from just before it was closed
+            (closing a file writes to it).
+    """
+
+    def __init__(self, max_idle:int=32, timeout:float=30.0):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.handles = OrderedDict() # type: typing.OrderedDict[str, _Handle]
+        self._by_file = {} # type: typing.Dict[int, _Handle]
+        self.on_close = [] # type: typing.List[typing.Callable[[str, os.stat_result], typing.Any]]
+        self._cond = threading.Condition()
+
+    def open(self, path:str, mode:str='r+') -> tables.File:
+        """
+        Get an open handle to a file, opening it if it isn't already.
+
+        Every handle must be returned with :meth:`.release` by the same thread,
+        and other threads that open the file wait until then.
+
+        Args:
+            path (str): path to the .h5 file
+            mode (str): ``'r'`` to only read, ``'r+'`` to read and write, or ``'a'`` / ``'w'`` to
+                (re)create the file (see :func:`tables.open_file` ). ``'w'`` closes any open handle first.
+
+        Returns:
+            :class:`tables.File`
+
+        Raises:
+            TimeoutError: if the file is open read-only, in use for longer than :attr:`.timeout` ,
+                and a writable handle was requested
+        """
+        path = os.path.abspath(path)
+        with self._cond:
+            handle = self.handles.get(path)
+            if handle is not None and not handle.h5f.isopen:
+                # closed by someone else
+                self._forget(handle)
+                handle = None
+
+            if handle is not None and (mode == 'w' or (mode != 'r' and not handle.writable)):
+                # need to reopen, wait until nobody is using it
+                if not self._cond.wait_for(lambda: handle.refs == 0, timeout=self.timeout):
+                    raise TimeoutError('{} is open read-only and in use, cannot open it with mode {}'.format(path, mode))
+                self._close(handle)
+                handle = None
+
+            if handle is None:
+                handle = _Handle(path, tables.open_file(path, mode=mode))
+                self.handles[path] = handle
+                self._by_file[id(handle.h5f)] = handle
+
+            handle.refs += 1
+            # in use, not idle
+            self.handles.move_to_end(path)
+
+        # wait for other threads outside the pool's lock, our reference keeps the handle open
+        handle.lock.acquire()
+        return handle.h5f
+
+    def release(self, h5f:tables.File):
+        """
+        Flush and give back a handle from :meth:`.open` . The file stays open
+        unless more than :attr:`.max_idle` files aren't being used.
+
+        Args:
+            h5f (:class:`tables.File`): handle from :meth:`.open`
+        """
+        with self._cond:
+            handle = self._by_file.get(id(h5f))
+            if handle is None or handle.h5f is not h5f:
+                # not ours
+                if h5f.isopen:
+                    h5f.close()
+                return
+
+            if h5f.isopen and handle.writable:
+                h5f.flush()
+            handle.refs = max(handle.refs - 1, 0)
+            handle.lock.release()
+            if handle.refs == 0:
+                self.handles.move_to_end(handle.path)
+                self._cond.notify_all()
+                self._evict()
+
+    @contextmanager
+    def unlocked(self, h5f:tables.File):
+        """
+        Let other threads use a file that this thread has open while it isn't using it,
+        eg. while waiting for data to write::
+
+            with POOL.unlocked(h5f):
+                data = queue.get()
+
+        The file stays open, and is locked again before the block exits.
+
+        Args:
+            h5f (:class:`tables.File`): handle from :meth:`.open` , opened once by this thread
+        """
+        with self._cond:
+            handle = self._by_file.get(id(h5f))
+        if handle is None or handle.h5f is not h5f:
+            # not ours
+            yield
+            return
+
+        handle.lock.release()
+        try:
+            yield
+        finally:
+            handle.lock.acquire()
+
+    def close(self, path:typing.Optional[str]=None):
+        """
+        Close idle files
+
+        Args:
+            path (str): only close this file, otherwise close every idle file
+        """
+        with self._cond:
+            if path is not None:
+                handle = self.handles.get(os.path.abspath(path))
+                handles = [handle] if handle is not None else []
+            else:
+                handles = list(self.handles.values())
+            for handle in handles:
+                if handle.refs == 0:
+                    self._close(handle)
+
+    def _evict(self):
+        # call with lock held
+        idle = [handle for handle in self.handles.values() if handle.refs == 0]
+        for handle in idle[:max(len(idle) - self.max_idle, 0)]:
+            self._close(handle)
+
+    def _close(self, handle:_Handle):
+        # call with lock held
+        self._forget(handle)
+        if not handle.h5f.isopen:
+            return
+        if not handle.writable:
+            handle.h5f.close()
+            return
+
+        handle.h5f.flush()
+        stat = os.stat(handle.path)
+        handle.h5f.close()
+        for callback in self.on_close:
+            callback(handle.path, stat)
+
+    def _forget(self, handle:_Handle):
+        # call with lock held
+        self.handles.pop(handle.path, None)
+        self._by_file.pop(id(handle.h5f), None)
+
+    def __contains__(self, path:str) -> bool:
+        return os.path.abspath(path) in self.handles
+
+
+POOL = Handle_Pool()
+"""
+The process-wide :class:`.Handle_Pool` used by :class:`.Subject`
+"""
+
+
+@atexit.register
+def _close_pool():
+    POOL.close()
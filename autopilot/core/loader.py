@@ -0,0 +1,196 @@
+"""
+Load trial data from many subjects at once, eg. for lab-wide summaries.
+
+:func:`.load_trial_data` reads each subject's file in a separate process, reading only
+the requested columns (see :meth:`.Subject.get_trial_data` ), and returns one :class:`pandas.DataFrame`
+with categorical ``subject`` and ``step_name`` columns.
+
+Files that are open for writing in this process (eg. subjects that are running)
+can't be read by the other processes, and are skipped with a warning.
+
+Each subject's data is cached on disk (as a pickle, in ``cache_dir`` ) along with the modification time
+and number of trials of its file when it was loaded, so subjects that haven't run since the last time
+they were loaded aren't read again.
+"""
+
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import pickle
+import typing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from autopilot import prefs
+from autopilot.core.handles import POOL
+from autopilot.core.loggers import init_logger
+from autopilot.core.subject_index import INDEX
+
+CACHE_DIRNAME = 'trial_cache'
+"""
+Name of the default cache directory, in ``prefs.get('BASEDIR')``
+"""
+
+_Step = typing.Union[int, list, str]
+
+
+def load_trial_data(subjects: typing.Optional[typing.Iterable[str]] = None,
+                    dir: typing.Optional[str] = None,
+                    step: typing.Union[_Step, typing.Dict[str, _Step]] = 'all',
+                    columns: typing.Optional[typing.List[str]] = None,
+                    sessions: typing.Union[int, typing.Tuple[int, int], None] = None,
+                    processes: typing.Optional[int] = None,
+                    cache: bool = True,
+                    cache_dir: typing.Optional[str] = None) -> pd.DataFrame:
+    """
+    Load trial data from many subjects in parallel.
+
+    Args:
+        subjects (list): names of subjects in ``dir`` , or paths to their .h5 files. If ``None`` , every
+            .h5 file in ``dir`` .
+        dir (str): directory of subject files, default ``prefs.get('DATADIR')``
+        step (int, list, str, dict): step(s) to load from each subject (see :meth:`.Subject.get_trial_data` ),
+            or a dict mapping subject names to steps
+        columns (list): only load these columns (plus ``step`` and ``step_name`` )
+        sessions (int, tuple): only load this session or ``(first, last)`` range of sessions
+        processes (int): number of processes to read files with, default one per CPU.
+            If ``1`` , files are read in this process.
+        cache (bool): whether to read and write cached data
+        cache_dir (str): where to cache data, default :data:`.CACHE_DIRNAME` in ``prefs.get('BASEDIR')``
+
+    Returns:
+        :class:`pandas.DataFrame` : every subject's trials, with a ``subject`` column
+    """
+    logger = init_logger(module_name='core.loader')
+
+    if dir is None:
+        dir = prefs.get('DATADIR')
+    if subjects is None:
+        subjects = sorted(fn for fn in os.listdir(dir) if fn.endswith('.h5'))
+    # in order, without duplicates
+    files = list(dict.fromkeys(_subject_file(subject, dir) for subject in subjects))
+    names = [os.path.splitext(os.path.basename(file))[0] for file in files]
+
+    # hdf5 locks files that are open in this process (eg. idle in the handle pool),
+    # and closing a writable file changes it, so close them before checking the cache
+    for file in files:
+        POOL.close(file)
+
+    if cache and cache_dir is None:
+        cache_dir = os.path.join(prefs.get('BASEDIR'), CACHE_DIRNAME)
+    if cache:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    frames = {} # type: typing.Dict[str, pd.DataFrame]
+    jobs = []
+    for name, file in zip(names, files):
+        query = {
+            'step': step.get(name, 'all') if isinstance(step, dict) else step,
+            'columns': columns,
+            'sessions': sessions
+        }
+        cache_file, state = None, None
+        if cache:
+            cache_file = _cache_file(cache_dir, name, file, query)
+            state = _file_state(file)
+            cached = _read_cache(cache_file, state)
+            if cached is not None:
+                frames[name] = cached
+                continue
+        jobs.append((name, file, query, cache_file, state))
+
+    if len(jobs) > 0:
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(jobs))
+
+        args = [(file, query) for _, file, query, _, _ in jobs]
+        if processes <= 1:
+            results = [_load_subject(arg) for arg in args]
+        else:
+            # don't fork processes with hdf5 files open
+            with ProcessPoolExecutor(max_workers=processes, mp_context=mp.get_context('spawn')) as executor:
+                results = list(executor.map(_load_subject, args))
+
+        for (name, file, query, cache_file, state), (df, error) in zip(jobs, results):
+            if error is not None:
+                logger.warning('Could not load trial data for {}, got exception {}'.format(name, error))
+                continue
+            frames[name] = df
+            if cache:
+                _write_cache(cache_file, state, df)
+
+    frames = [frames[name] for name in names if name in frames]
+    if len(frames) == 0:
+        return pd.DataFrame()
+
+    data = pd.concat(frames, ignore_index=True)
+    data['subject'] = pd.Categorical(data['subject'], categories=list(dict.fromkeys(names)))
+    if 'step_name' in data.columns:
+        data['step_name'] = data['step_name'].astype('category')
+    return data
+
+
+def _subject_file(subject:str, dir:str) -> str:
+    if subject.endswith('.h5') and os.path.exists(subject):
+        return os.path.abspath(subject)
+    if not subject.endswith('.h5'):
+        subject = subject + '.h5'
+    return os.path.abspath(os.path.join(dir, subject))
+
+
+def _load_subject(args:tuple) -> typing.Tuple[typing.Optional[pd.DataFrame], typing.Optional[str]]:
+    """
+    Load one subject's trial data, in a worker process.
+
+    Returns:
+        tuple: ``(dataframe, None)`` , or ``(None, error)`` if it couldn't be loaded
+    """
+    from autopilot.core.subject import Subject
+    file, query = args
+    try:
+        sub = Subject(file=file)
+        df = sub.get_trial_data(**query)
+        df['subject'] = sub.name
+        return df, None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def _file_state(file:str) -> dict:
+    """
+    Modification time of a subject's file and its number of trials, if the :data:`.INDEX` knows it
+    """
+    stat = os.stat(file)
+    entry = INDEX.get(file)
+    return {
+        'mtime_ns': stat.st_mtime_ns,
+        'n_trials': entry['n_trials'] if entry is not None else None
+    }
+
+
+def _cache_file(cache_dir:str, name:str, file:str, query:dict) -> str:
+    key = hashlib.sha1(json.dumps([file, query], sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}-{}.pkl'.format(name, key))
+
+
+def _read_cache(cache_file:str, state:dict) -> typing.Optional[pd.DataFrame]:
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        return None
+    if cached.get('state') != state:
+        return None
+    return cached['data']
+
+
+def _write_cache(cache_file:str, state:dict, df:pd.DataFrame):
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({'state': state, 'data': df}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
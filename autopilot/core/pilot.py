@@ -25,6 +25,7 @@ warnings.simplefilter('ignore', category=tables.NaturalNameWarning)
 import autopilot
 from autopilot import prefs
 from autopilot.core.loggers import init_logger
+from autopilot.core.segments import Segment_Store
 
 if __name__ == '__main__':
     # Parse arguments - this should have been called with a .json prefs file passed
@@ -119,6 +120,7 @@ class Pilot:
         ip (str): Our IPv4 address
         listens (dict): Dictionary mapping message keys to methods used to process them.
         logger (:class:`logging.Logger`): Used to log messages and network events.
+        segments (:class:`.Segment_Store`): Local store of trial data
     """
 
     logger = None
@@ -180,6 +182,9 @@ class Pilot:
         if prefs.get('AUDIOSERVER') or 'AUDIO' in prefs.get('CONFIG'):
             self.init_audio()
 
+        # local store of trial data
+        self.segments = Segment_Store()
+
         # Init Station
         # Listen dictionary - what do we do when we receive different messages?
         self.listens = {
@@ -189,7 +194,8 @@ class Pilot:
             'CALIBRATE_PORT': self.l_cal_port, # Calibrate a water port
             'CALIBRATE_RESULT': self.l_cal_result, # Compute curve and store result
             'BANDWIDTH': self.l_bandwidth, # test our bandwidth
-            'STREAM_VIDEO': self.l_stream_video
+            'STREAM_VIDEO': self.l_stream_video,
+            'ROWS': self.l_rows # The terminal is asking for rows of trial data it missed
         }
 
         # spawn_network gives us the independent message-handling process
@@ -512,6 +518,26 @@ class Pilot:
         #self.networking.set_logging(True)
         #self.node.do_logging.set()
 
+    def l_rows(self, value):
+        """
+        Send the terminal rows of trial data from :attr:`.segments` that it missed,
+        eg. during a network outage.
+
+        Replies with a ``ROWS`` message with our ``pilot`` name, a list of ``rows``
+        (see :meth:`.Segment_Store.since` ), and whether there are ``more`` to ask for.
+
+        Args:
+            value (dict): ``{'since': seq}`` , send rows after this sequence number,
+                and optionally ``limit`` , the most rows to send at once (default 256)
+        """
+        limit = int(value.get('limit', 256))
+        rows = self.segments.since(int(value.get('since', -1)), limit=limit + 1)
+        self.node.send('T', 'ROWS', {
+            'pilot': self.name,
+            'rows': rows[:limit],
+            'more': len(rows) > limit
+        })
+
     def l_stream_video(self, value):
         """
         Start or stop video streaming
@@ -663,71 +689,16 @@ class Pilot:
     #################################################################
     # Trial Running and Management
     #################################################################
-    def open_file(self):
-        """
-        Setup a table to store data locally.
-
-        Opens `prefs.get('DATADIR')/local.h5`, creates a group for the current subject,
-        a new table for the current day.
-
-        .. todo::
-
-            This needs to be unified with a general file constructor abstracted from :class:`.Subject` so it doesn't reimplement file creation!!
-
-        Returns:
-            (:class:`tables.File`, :class:`tables.Table`,
-            :class:`tables.tableextension.Row`): The file, table, and row for the local data table
-        """
-        local_file = os.path.join(prefs.get('DATADIR'), 'local.h5')
-        try:
-            h5f = tables.open_file(local_file, mode='a')
-        except (IOError, tables.HDF5ExtError) as e:
-            self.logger.warning("local file was broken, making new")
-            self.logger.warning(e)
-            os.remove(local_file)
-            h5f = tables.open_file(local_file, mode='w')
-            os.chmod(local_file, 0o777)
-
-
-        try:
-            h5f.create_group("/", self.subject, "Local Data for {}".format(self.subject))
-        except tables.NodeError:
-            # already made it
-            pass
-        subject_group = h5f.get_node('/', self.subject)
-
-        # Make a table for today's data, appending a conflict-avoidance int if one already exists
-        datestring = datetime.date.today().isoformat()
-        conflict_avoid = 0
-        while datestring in subject_group:
-            conflict_avoid += 1
-            datestring = datetime.date.today().isoformat() + '-' + str(conflict_avoid)
-
-
-        # Get data table descriptor
-        if hasattr(self.task, 'TrialData'):
-            table_descriptor = self.task.TrialData
-
-
-
-            table = h5f.create_table(subject_group, datestring, table_descriptor,
-                                               "Subject {} on {}".format(self.subject, datestring))
-
-            # The Row object is what we write data into as it comes in
-            row = table.row
-            return h5f, table, row
-
-        else:
-            return h5f, None, None
-
     def run_task(self, task_class, task_params):
         """
         Called in a new thread, run the task.
 
-        Opens a file with :meth:`~.autopilot.open_file` , then
-        continually calls `task.stages.next` to process stages.
+        Continually calls `task.stages.next` to process stages.
 
-        Sends data back to the terminal between every stage.
+        Sends data back to the terminal between every stage, and stores each
+        trial's data in :attr:`.Pilot.segments` when it ends. Data for each trial is sent with the ``seq``
+        it will be stored with, so the terminal can notice rows it missed and ask for them
+        (see :meth:`.l_rows` ).
 
         Waits for the task to clear `stage_block` between stages.
         """
@@ -739,11 +710,12 @@ class Pilot:
 
         # do we expect TrialData?
         trial_data = False
+        trial_row = {}
         if hasattr(self.task, 'TrialData'):
             trial_data = True
-
-        # Open local file for saving
-        h5f, table, row = self.open_file()
+            trial_columns = tuple(self.task.TrialData.columns.keys())
+            self.segments.open(self.subject, task_params.get('task_type', task_class.__name__),
+                               self.task.TrialData)
 
         # TODO: Init sending continuous data here
         self.logger.debug('Starting task loop')
@@ -756,21 +728,23 @@ class Pilot:
                 if data:
                     data['pilot'] = self.name
                     data['subject'] = self.subject
+                    if trial_data:
+                        # the row this trial will be stored as
+                        data['seq'] = self.segments.next_seq
 
-                    # Send data back to terminal (subject is identified by the networking object)
-                    self.node.send('T', 'DATA', data)
+                    # Send data back to terminal through our station, which keeps it
+                    # until the terminal confirms it (see Pilot_Station.l_data)
+                    self.node.send(self.name, 'DATA', data)
 
                     # Store a local copy
                     # the task class has a class variable DATA that lets us know which data the row is expecting
                     if trial_data:
-                        for k, v in data.items():
-                            if k in self.task.TrialData.columns.keys():
-                                row[k] = v
-
-                    # If the trial is over (either completed or bailed), flush the row
-                    if 'TRIAL_END' in data.keys():
-                        row.append()
-                        table.flush()
+                        trial_row.update({k: v for k, v in data.items() if k in trial_columns})
+
+                        # If the trial is over (either completed or bailed), store the row
+                        if 'TRIAL_END' in data.keys():
+                            self.segments.append(trial_row)
+                            trial_row = {}
                     self.logger.debug('sent data')
 
 
@@ -793,14 +767,14 @@ class Pilot:
                 self.logger.exception(f'got exception while stopping task: {e}')
             del self.task
             self.task = None
-            row.append()
-            table.flush()
+            if trial_data:
+                # keep the unfinished trial too
+                if trial_row:
+                    self.segments.append(trial_row, finished=False)
+                self.segments.close()
             gpio.clear_scripts()
             self.logger.debug('stopped task and cleared scripts')
 
-        h5f.flush()
-        h5f.close()
-
 
 if __name__ == "__main__":
 
@@ -810,6 +784,7 @@ if __name__ == "__main__":
         a.quitting.wait()
     except KeyboardInterrupt:
         a.quitting.set()
+        a.segments.stop()
         sys.exit()
 
 
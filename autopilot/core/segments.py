@@ -0,0 +1,488 @@
+"""
+Store trial data on a :class:`.Pilot` in append-only segment files rather than one hdf5 file.
+
+Each row of trial data gets a sequence number (``seq`` ) that increases across runs and
+subjects, and is appended to the current segment, a text file with one line per row: a CRC32
+checksum of the line followed by the row as JSON. Rows are buffered and written
+together, either when :attr:`.Segment_Store.batch_size` rows are waiting or after
+:attr:`.Segment_Store.batch_interval` seconds.
+
+A segment is sealed (renamed from ``.part`` to ``.seg`` ) when its run ends, when it gets
+older than :attr:`.Segment_Store.rotate_interval` , or larger than :attr:`.Segment_Store.max_segment_bytes` .
+Sealed segments are compacted in the background into an hdf5 file per subject,
+with a table for each task and day, and then removed.
+
+Nothing is ever deleted because it can't be read: lines with bad checksums (eg. the last line
+of a segment that was being written when the pilot lost power) are skipped, and an hdf5 file that can't
+be opened is moved aside and a new one started.
+
+Since rows stay in the store, the :class:`.Terminal` can ask for every row after the last one it
+received with a ``ROWS`` message (see :meth:`.Segment_Store.since` ) rather than
+depending on every ``DATA`` message arriving.
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+import typing
+import zlib
+
+import numpy as np
+import tables
+
+from autopilot import prefs
+from autopilot.core.handles import POOL
+from autopilot.core.loggers import init_logger
+from autopilot.core.writers import _json_default
+from autopilot.utils import timestamps
+
+_META_COLS = ('seq', 'stored', 'finished')
+
+LOCAL_DIRNAME = 'local'
+"""
+Name of the default store directory, in ``prefs.get('DATADIR')``
+"""
+
+
+def _encode(obj:dict) -> str:
+    payload = json.dumps(obj, default=_json_default)
+    return '{:08x}\t{}\n'.format(zlib.crc32(payload.encode('utf-8')), payload)
+
+
+def _decode(line:str) -> typing.Optional[dict]:
+    """
+    A line written by :func:`._encode` , or ``None`` if it's incomplete or its checksum doesn't match
+    """
+    try:
+        crc, payload = line.rstrip('\n').split('\t', 1)
+        if int(crc, 16) != zlib.crc32(payload.encode('utf-8')):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def _to_python(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class _Segment(object):
+    """
+    An open segment file
+    """
+    __slots__ = ('path', 'first_seq', 'file', 'started', 'nbytes')
+
+    def __init__(self, path:str, first_seq:int, header:dict):
+        self.path = path
+        self.first_seq = first_seq
+        self.file = open(path, 'w')
+        self.file.write(_encode({'header': header}))
+        self.file.flush()
+        self.started = time.monotonic()
+        self.nbytes = self.file.tell()
+
+
+class Segment_Store(object):
+    """
+    Append-only, checksummed local store of trial data.
+
+    Rows are added by :meth:`.append` after :meth:`.open` starts a segment for a run,
+    and :meth:`.close` seals it at the end of the run.
+
+    Thread-safe. If ``background`` , a thread writes waiting rows, rotates segments,
+    and compacts sealed segments, otherwise call :meth:`.tick` to do that.
+
+    Args:
+        path (str): directory to keep the store in, default :data:`.LOCAL_DIRNAME` in ``prefs.get('DATADIR')``
+        background (bool): start the background thread
+
+    Attributes:
+        next_seq (int): sequence number the next row will get
+    """
+
+    batch_size = 16 # rows to buffer before they're written
+    batch_interval = 2.0 # longest seconds a row is buffered before it's written
+    rotate_interval = 3600.0 # seconds before a segment is sealed and a new one started
+    max_segment_bytes = 16 * 2**20 # size before a segment is sealed and a new one started
+    compact_interval = 60.0 # seconds between compacting sealed segments
+    compact_filters = tables.Filters(complevel=5, complib='blosc') # compression of compacted tables
+
+    def __init__(self, path:typing.Optional[str]=None, background:bool=True):
+        if path is None:
+            path = os.path.join(prefs.get('DATADIR'), LOCAL_DIRNAME)
+        self.path = path
+        self.segment_dir = os.path.join(path, 'segments')
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.logger = init_logger(self)
+
+        self._segment = None # type: typing.Optional[_Segment]
+        self._header = None # type: typing.Optional[dict]
+        self._pending = [] # type: typing.List[dict]
+        self._last_write = time.monotonic()
+        self._last_compact = time.monotonic()
+        # lock order is always _files_lock then _lock.
+        # _lock guards the open segment and buffered rows, _files_lock guards sealed segments and hdf5 files
+        self._lock = threading.RLock()
+        self._files_lock = threading.RLock()
+
+        self._recover()
+
+        self._quitting = threading.Event()
+        self._thread = None # type: typing.Optional[threading.Thread]
+        if background:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def open(self, subject:str, task:str, columns:typing.Union[dict, typing.Type[tables.IsDescription]]):
+        """
+        Start a segment for a run, sealing the current one if there is one.
+
+        Args:
+            subject (str): subject being run
+            task (str): name of the task
+            columns (dict, :class:`tables.IsDescription`): the task's ``TrialData`` ,
+                the columns rows are compacted into
+        """
+        dtype = tables.description.dtype_from_descr(columns)
+        header = {
+            'subject': subject,
+            'task': task,
+            'dtype': [[name, dtype.fields[name][0].base.str, list(dtype.fields[name][0].shape)]
+                      for name in dtype.names if name not in _META_COLS],
+            'started': timestamps.timestamp('ns')
+        }
+        with self._files_lock, self._lock:
+            self._seal()
+            self._header = header
+
+    def append(self, row:dict, finished:bool=True) -> int:
+        """
+        Add a row of trial data to the current segment
+
+        Args:
+            row (dict): trial data
+            finished (bool): whether the trial ended, or was cut off by the run stopping
+
+        Returns:
+            int: the row's sequence number
+        """
+        with self._lock:
+            if self._header is None:
+                raise RuntimeError('No segment is open, call open first')
+            seq = self.next_seq
+            self.next_seq += 1
+            record = {'seq': seq, 'time': timestamps.timestamp('ns'), 'data': row}
+            if not finished:
+                record['finished'] = False
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._write()
+            return seq
+
+    def flush(self):
+        """
+        Write buffered rows to the current segment
+        """
+        with self._lock:
+            self._write()
+
+    def close(self):
+        """
+        Write buffered rows and seal the current segment, at the end of a run
+        """
+        with self._files_lock, self._lock:
+            self._seal()
+            self._header = None
+
+    def tick(self):
+        """
+        Write rows that have been buffered for :attr:`.batch_interval` , rotate the current segment
+        if it's too old or large, and compact sealed segments every :attr:`.compact_interval` .
+        Called periodically by the background thread.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._pending and now - self._last_write >= self.batch_interval:
+                self._write()
+            segment = self._segment
+        if segment is not None and (now - segment.started >= self.rotate_interval or
+                                    segment.nbytes >= self.max_segment_bytes):
+            with self._files_lock, self._lock:
+                if self._segment is segment:
+                    self._seal()
+        if now - self._last_compact >= self.compact_interval:
+            self.compact()
+
+    def compact(self) -> int:
+        """
+        Move rows from sealed segments into each subject's hdf5 file, and remove the segments.
+
+        Rows are appended to a table ``/{task}/{date}`` named for the day the segment was started,
+        with their ``seq`` and the time they were ``stored`` in nanoseconds.
+        Rows already in the table (eg. if compaction was interrupted before the segment was removed)
+        aren't added again.
+
+        Returns:
+            int: number of rows compacted
+        """
+        n_rows = 0
+        with self._files_lock:
+            self._last_compact = time.monotonic()
+            for path in self._sealed():
+                header, records = self._read_segment(path)
+                if header is not None and records:
+                    try:
+                        self._compact_segment(header, records)
+                    except Exception as e:
+                        self.logger.exception('Could not compact segment {}, keeping it: {}'.format(path, e))
+                        continue
+                    n_rows += len(records)
+                os.remove(path)
+        return n_rows
+
+    def since(self, seq:int, limit:typing.Optional[int]=None) -> typing.List[dict]:
+        """
+        Rows after a sequence number, eg. to send to a terminal that missed them.
+
+        Args:
+            seq (int): get rows with a greater sequence number than this
+            limit (int): at most this many rows
+
+        Returns:
+            list: dicts with ``seq`` , ``time`` , ``subject`` , ``task`` , the row's ``data`` ,
+            and whether the trial ``finished`` , in order of ``seq``
+        """
+        rows = {} # type: typing.Dict[int, dict]
+        with self._files_lock:
+            for subject_file in self._subject_files():
+                rows.update(self._read_compacted(subject_file, seq))
+
+            with self._lock:
+                segments = self._sealed()
+                if self._segment is not None:
+                    self._segment.file.flush()
+                    segments.append(self._segment.path)
+                pending = [dict(record, **self._header) for record in self._pending]
+
+            first_seqs = [self._first_seq(path) for path in segments]
+            for i, path in enumerate(segments):
+                if i + 1 < len(segments) and first_seqs[i + 1] <= seq + 1:
+                    # every row in this segment is older than seq
+                    continue
+                header, records = self._read_segment(path)
+                for record in records:
+                    if record['seq'] > seq:
+                        rows[record['seq']] = dict(record, **header)
+
+        for record in pending:
+            if record['seq'] > seq:
+                rows[record['seq']] = record
+
+        out = [{'seq': record['seq'], 'time': record['time'], 'subject': record['subject'],
+                'task': record['task'], 'data': record['data'], 'finished': record.get('finished', True)}
+               for _, record in sorted(rows.items())]
+        if limit is not None:
+            out = out[:limit]
+        return out
+
+    def stop(self):
+        """
+        Seal the current segment and stop the background thread
+        """
+        self._quitting.set()
+        if self._thread is not None:
+            self._thread.join(self.batch_interval + 5)
+        self.close()
+
+    def _run(self):
+        while not self._quitting.wait(min(self.batch_interval, 1.0)):
+            try:
+                self.tick()
+            except Exception as e:
+                # keep storing data even if something goes wrong
+                self.logger.exception('Exception in segment store thread: {}'.format(e))
+
+    def _write(self):
+        # call with _lock held
+        if not self._pending:
+            return
+        if self._segment is None:
+            first_seq = self._pending[0]['seq']
+            path = os.path.join(self.segment_dir, '{:012d}.part'.format(first_seq))
+            self._segment = _Segment(path, first_seq, self._header)
+        self._segment.file.write(''.join(_encode(record) for record in self._pending))
+        self._segment.file.flush()
+        os.fsync(self._segment.file.fileno())
+        self._segment.nbytes = self._segment.file.tell()
+        self._pending = []
+        self._last_write = time.monotonic()
+
+    def _seal(self):
+        # call with _files_lock and _lock held
+        self._write()
+        if self._segment is None:
+            return
+        self._segment.file.close()
+        os.replace(self._segment.path, os.path.splitext(self._segment.path)[0] + '.seg')
+        self._segment = None
+
+    def _sealed(self) -> typing.List[str]:
+        return [os.path.join(self.segment_dir, fn) for fn in sorted(os.listdir(self.segment_dir))
+                if fn.endswith('.seg')]
+
+    def _first_seq(self, path:str) -> int:
+        return int(os.path.splitext(os.path.basename(path))[0])
+
+    def _read_segment(self, path:str) -> typing.Tuple[typing.Optional[dict], typing.List[dict]]:
+        """
+        Header and valid records of a segment, skipping lines that fail their checksum
+        """
+        header, records, bad = None, [], 0
+        with open(path, 'r') as f:
+            for line in f:
+                record = _decode(line)
+                if record is None:
+                    bad += 1
+                elif 'header' in record:
+                    header = record['header']
+                else:
+                    records.append(record)
+        if bad:
+            self.logger.warning('Skipped {} corrupt lines in segment {}'.format(bad, path))
+        if header is None:
+            if records:
+                self.logger.warning('Segment {} has no header, its rows can only be compacted as unknown data'.format(path))
+            header = {'subject': 'unknown', 'task': 'unknown', 'dtype': [], 'started': 0}
+        return header, records
+
+    def _recover(self):
+        """
+        Seal segments left open by a crash and find the next sequence number
+        """
+        last_seq = -1
+        for fn in sorted(os.listdir(self.segment_dir)):
+            path = os.path.join(self.segment_dir, fn)
+            if fn.endswith('.part'):
+                header, records = self._read_segment(path)
+                if not records:
+                    os.remove(path)
+                    continue
+                self.logger.info('Recovered {} rows from unsealed segment {}'.format(len(records), path))
+                os.replace(path, os.path.splitext(path)[0] + '.seg')
+                last_seq = max(last_seq, max(record['seq'] for record in records))
+            elif fn.endswith('.seg'):
+                _, records = self._read_segment(path)
+                if records:
+                    last_seq = max(last_seq, max(record['seq'] for record in records))
+                else:
+                    last_seq = max(last_seq, self._first_seq(path) - 1)
+
+        for subject_file in self._subject_files():
+            h5f = self._open_compacted(subject_file, 'r')
+            if h5f is None:
+                continue
+            try:
+                last_seq = max(last_seq, int(getattr(h5f.root._v_attrs, 'last_seq', -1)))
+            finally:
+                POOL.release(h5f)
+
+        self.next_seq = last_seq + 1
+
+    def _subject_files(self) -> typing.List[str]:
+        return [os.path.join(self.path, fn) for fn in sorted(os.listdir(self.path)) if fn.endswith('.h5')]
+
+    def _open_compacted(self, path:str, mode:str) -> typing.Optional[tables.File]:
+        """
+        Open a subject's compacted file. If it's broken, move it aside rather than deleting it,
+        and start a new one if it's being written to.
+        """
+        try:
+            return POOL.open(path, mode)
+        except (IOError, tables.HDF5ExtError) as e:
+            if not os.path.exists(path):
+                return None
+            broken = '{}.broken-{}'.format(path, datetime.datetime.now().strftime('%y%m%d-%H%M%S'))
+            self.logger.warning('Compacted file {} is broken, moved to {}: {}'.format(path, broken, e))
+            os.replace(path, broken)
+            if mode == 'r':
+                return None
+            return POOL.open(path, mode)
+
+    def _compact_segment(self, header:dict, records:typing.List[dict]):
+        dtype = np.dtype([(name, np.dtype((typestr, tuple(shape)))) for name, typestr, shape in header['dtype']] +
+                         [('seq', np.int64), ('stored', np.int64), ('finished', np.bool_)])
+        subject_file = os.path.join(self.path, '{}.h5'.format(header['subject']))
+        h5f = self._open_compacted(subject_file, 'a')
+        try:
+            group = '/' + header['task']
+            table_name = datetime.datetime.fromtimestamp(header['started'] / 1e9).date().isoformat()
+            if group not in h5f:
+                h5f.create_group('/', header['task'], createparents=True)
+            # if the task's columns changed, start another table
+            conflict_avoid = 0
+            name = table_name
+            while name in h5f.get_node(group) and h5f.get_node(group, name).dtype != dtype:
+                conflict_avoid += 1
+                name = '{}-{}'.format(table_name, conflict_avoid)
+            if name in h5f.get_node(group):
+                table = h5f.get_node(group, name)
+            else:
+                table = h5f.create_table(group, name, description=dtype, filters=self.compact_filters,
+                                         title='Subject {} on {}'.format(header['subject'], table_name))
+                table.attrs['last_seq'] = -1
+
+            records = [record for record in records if record['seq'] > table.attrs['last_seq']]
+            if not records:
+                return
+
+            rows = np.zeros(len(records), dtype=dtype)
+            ts_cols = [name for name in dtype.names if 'timestamp' in name]
+            for i, record in enumerate(records):
+                rows['seq'][i] = record['seq']
+                rows['stored'][i] = record['time']
+                rows['finished'][i] = record.get('finished', True)
+                for k, v in record['data'].items():
+                    if k not in dtype.names or k in _META_COLS:
+                        continue
+                    try:
+                        if k in ts_cols:
+                            v = timestamps.to_column(v, dtype[k])
+                        rows[k][i] = v
+                    except (KeyError, ValueError, TypeError):
+                        self.logger.warning('Data dropped: key: {}, value: {}'.format(k, v))
+            table.append(rows)
+            last_seq = int(rows['seq'].max())
+            table.attrs['last_seq'] = max(last_seq, table.attrs['last_seq'])
+            h5f.root._v_attrs.last_seq = max(last_seq, int(getattr(h5f.root._v_attrs, 'last_seq', -1)))
+            h5f.root._v_attrs.subject = header['subject']
+        finally:
+            POOL.release(h5f)
+
+    def _read_compacted(self, path:str, seq:int) -> typing.Dict[int, dict]:
+        rows = {}
+        h5f = self._open_compacted(path, 'r')
+        if h5f is None:
+            return rows
+        try:
+            subject = getattr(h5f.root._v_attrs, 'subject', os.path.splitext(os.path.basename(path))[0])
+            for table in h5f.walk_nodes('/', 'Table'):
+                if table.attrs['last_seq'] <= seq:
+                    continue
+                task = table._v_parent._v_name
+                for row in table.read_where('seq > {}'.format(int(seq))):
+                    data = {name: _to_python(row[name]) for name in table.colnames if name not in _META_COLS}
+                    finished = bool(row['finished']) if 'finished' in table.colnames else True
+                    rows[int(row['seq'])] = {'seq': int(row['seq']), 'time': int(row['stored']),
+                                             'subject': subject, 'task': task, 'data': data,
+                                             'finished': finished}
+        finally:
+            POOL.release(h5f)
+        return rows
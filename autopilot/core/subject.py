@@ -23,8 +23,14 @@ import autopilot
 from autopilot import prefs
 from autopilot.stim.sound.sounds import STRING_PARAMS
 from autopilot.core.loggers import init_logger
+from autopilot.core.writers import Trial_Writer, Continuous_Writer
+from autopilot.core.handles import POOL
+from autopilot.core.subject_index import INDEX
+from autopilot.networking.backlog import Seen_Ids
+from autopilot.utils import timestamps
 
 import queue
+from queue import Empty
 
 
 # suppress pytables natural name warnings
@@ -32,6 +38,14 @@ warnings.simplefilter('ignore', category=tables.NaturalNameWarning)
 
 import pdb
 import numpy as np
+from numpy.lib.recfunctions import repack_fields
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    ARROW = True
+except ImportError:
+    ARROW = False
 
 
 class Subject(object):
@@ -58,7 +72,6 @@ class Subject(object):
         |--- info - group with biographical information as attributes
 
     Attributes:
-        lock (:class:`threading.Lock`): manages access to the hdf5 file
         name (str): Subject ID
         file (str): Path to hdf5 file - usually `{prefs.get('DATADIR')}/{self.name}.h5`
         current (dict): current task parameters. loaded from
@@ -70,6 +83,8 @@ class Subject(object):
         data_queue (:class:`queue.Queue`): Queue to dump data while running task
         thread (:class:`threading.Thread`): thread used to keep file open while running task
         did_graduate (:class:`threading.Event`): Event used to signal if the subject has graduated the current step
+        journal (str): Path to the journal of trial data that hasn't been flushed to the hdf5 file yet,
+            see :class:`.Trial_Writer`
         STRUCTURE (list): list of tuples with order:
 
             * full path, eg. '/history/weights'
@@ -81,6 +96,10 @@ class Subject(object):
             :class:`tables.IsDescriptor` for tables.
     """
 
+    trial_flush_rows = 64 # write trials to the file once this many are finished
+    trial_flush_interval = 5.0 # or once any have been waiting this many seconds
+    continuous_flush_interval = 1.0 # longest seconds continuous data is buffered before being written
+    read_chunk_rows = 65536 # rows of trial data read at a time by iter_trial_data
 
 
     def __init__(self, name: str=None, dir: str=None, file: str=None,
@@ -110,7 +129,12 @@ class Subject(object):
         # use a filter to compress continuous data
         self.continuous_filter = tables.Filters(complib='blosc', complevel=6)
 
-        self.lock = threading.Lock()
+        self._current = None
+        self._step = None
+        self._protocol_name = None
+        self._session = None
+        self._metadata_lock = threading.RLock()
+        self._metadata_loaded = False
 
         if not dir:
             try:
@@ -135,41 +159,24 @@ class Subject(object):
                 new = True
                 self.new_subject_file(biography)
 
-        # before we open, make sure we have the stuff we need
-        self.ensure_structure()
+        self.journal = self.file + '.journal'
 
-        h5f = self.open_hdf()
+        # The protocol, step, and session are read from the file the first time
+        # they're needed (see _load_metadata), so making a Subject doesn't open its file.
+        # A new file has nothing to read.
+        self._metadata_loaded = new
+        if new:
+            self._session = 0
+            self._update_index()
 
         if not name:
+            h5f = self.open_hdf(mode='r')
             try:
                 self.name = h5f.root.info._v_attrs['name']
             except KeyError:
                 self.logger.warning('No Name attribute saved, trying to recover from filename')
                 self.name = os.path.splitext(os.path.split(file)[-1])[0]
-
-
-
-        # If subject has a protocol, load it to a dict
-        self.current = None
-        self.step    = None
-        self.protocol_name = None
-        if "/current" in h5f:
-            # We load the info from 'current' but don't keep the node open
-            # Stash it as a dict so better access from Python
-            current_node = filenode.open_node(h5f.root.current)
-            protocol_string = current_node.readall()
-            self.current = json.loads(protocol_string)
-            self.step = int(current_node.attrs['step'])
-            self.protocol_name = current_node.attrs['protocol_name']
-        elif not new:
-            # if we're not being created for the first time, warn that there is no protocol assigned to the subject
-            self.logger.warning('Subject has no protocol assigned!')
-
-        # get last session number if we have it
-        try:
-            self.session = int(h5f.root.info._v_attrs['session'])
-        except KeyError:
-            self.session = None
+            self.close_hdf(h5f)
 
         # We will get handles to trial and continuous data when we start running
         self.current_trial  = None
@@ -182,19 +189,125 @@ class Subject(object):
         self.data_queue = None
         self.thread = None
         self.did_graduate = threading.Event()
+        self.graduation = None
+        self._graduation_key = None
 
-        # Every time we are initialized we stash the git hash
-        history_row = h5f.root.history.hashes.row
-        history_row['time'] = self.get_timestamp()
+    def _load_metadata(self):
+        """
+        Read the current protocol, step, and session, if they haven't been already.
+
+        They're read from the :data:`.subject_index.INDEX` if it's up to date with the file,
+        and otherwise from the file, which also makes sure it has the structure
+        in :attr:`.STRUCTURE` and updates the index.
+        """
+        if self._metadata_loaded:
+            return
+
+        entry = INDEX.get(self.file)
+        if entry is not None:
+            with self._metadata_lock:
+                if not self._metadata_loaded:
+                    self._current = entry['current']
+                    self._step = entry['step']
+                    self._protocol_name = entry['protocol_name']
+                    self._session = entry['session']
+                    self._metadata_loaded = True
+            return
+
+        # make sure we have the stuff we need
+        self.ensure_structure()
+
+        # the file is opened before taking the lock, like every other method that
+        # uses the file and then our metadata, so threads can't wait on each other
+        h5f = self.open_hdf(mode='r')
         try:
-            history_row['hash'] = prefs.get('HASH')
-            # FIXME: less implicit way of getting hash plz
-        except AttributeError:
-            history_row['hash'] = ''
-        history_row.append()
+            with self._metadata_lock:
+                if self._metadata_loaded:
+                    return
+
+                if "/current" in h5f:
+                    # We load the info from 'current' but don't keep the node open
+                    # Stash it as a dict so better access from Python
+                    current_node = filenode.open_node(h5f.root.current)
+                    protocol_string = current_node.readall()
+                    self._current = json.loads(protocol_string)
+                    self._step = int(current_node.attrs['step'])
+                    self._protocol_name = current_node.attrs['protocol_name']
+                else:
+                    self.logger.warning('Subject has no protocol assigned!')
 
-        # we have to always open and close the h5f
-        self.close_hdf(h5f)
+                # get last session number if we have it
+                try:
+                    self._session = int(h5f.root.info._v_attrs['session'])
+                except KeyError:
+                    self._session = None
+
+                n_trials = self._n_trials(h5f)
+                self._metadata_loaded = True
+        finally:
+            self.close_hdf(h5f)
+        self._update_index(n_trials)
+
+    def _n_trials(self, h5f:tables.File) -> typing.Optional[int]:
+        """
+        Number of trials in the current step's trial table
+        """
+        if self._current is None or self._step is None or self._protocol_name is None:
+            return None
+        try:
+            step_name = self._current[self._step]['step_name']
+            return int(h5f.get_node(
+                f"/data/{self._protocol_name}/S{self._step:02d}_{step_name}", 'trial_data').nrows)
+        except (tables.NoSuchNodeError, IndexError, KeyError):
+            return None
+
+    def _update_index(self, n_trials:typing.Optional[int]=None):
+        """
+        Record our metadata in the :data:`.subject_index.INDEX` , after the file has been flushed
+        """
+        INDEX.update(self.file, name=self.name, protocol_name=self._protocol_name,
+                     step=self._step, session=self._session, n_trials=n_trials,
+                     current=self._current)
+
+    @property
+    def current(self) -> typing.Optional[list]:
+        self._load_metadata()
+        return self._current
+
+    @current.setter
+    def current(self, current:typing.Optional[list]):
+        self._load_metadata()
+        self._current = current
+
+    @property
+    def step(self) -> typing.Optional[int]:
+        self._load_metadata()
+        return self._step
+
+    @step.setter
+    def step(self, step:typing.Optional[int]):
+        self._load_metadata()
+        self._step = step
+
+    @property
+    def protocol_name(self) -> typing.Optional[str]:
+        self._load_metadata()
+        return self._protocol_name
+
+    @protocol_name.setter
+    def protocol_name(self, protocol_name:typing.Optional[str]):
+        self._load_metadata()
+        self._protocol_name = protocol_name
+
+    @property
+    def session(self) -> typing.Optional[int]:
+        self._load_metadata()
+        return self._session
+
+    @session.setter
+    def session(self, session:typing.Optional[int]):
+        self._load_metadata()
+        self._session = session
 
     def open_hdf(self, mode='r+'):
         """
@@ -204,6 +317,11 @@ class Subject(object):
         and :meth:`~.Subject.close_hdf` should be called at the end. Otherwise
         the file will close and we risk file corruption.
 
+        Handles are shared and kept open between calls by :data:`.handles.POOL` ,
+        so this is cheap if the file was used recently. Methods that only read should
+        use ``mode='r'`` . Other threads can't use the file until it's closed
+        with :meth:`~.Subject.close_hdf` from the same thread.
+
         See the pytables docs
         `here <https://www.pytables.org/cookbook/threading.html>`_ and
         `here <https://www.pytables.org/FAQ.html#can-pytables-be-used-in-concurrent-access-scenarios>`_
@@ -220,21 +338,29 @@ class Subject(object):
             :class:`tables.File`: Opened hdf file.
         """
         # TODO: Use a decorator around methods instead of explicitly calling
-        with self.lock:
-            return tables.open_file(self.file, mode=mode)
+        return POOL.open(self.file, mode=mode)
 
     def close_hdf(self, h5f):
         # type: (tables.file.File) -> None
         """
-        Flushes & closes the open hdf file.
+        Flushes & releases the open hdf file.
         Must be called whenever :meth:`~.Subject.open_hdf` is used.
 
+        The file is only actually closed once nothing else is using it and
+        it hasn't been used recently, see :class:`.Handle_Pool` .
+
+        If the file was writable, the :data:`.subject_index.INDEX` is updated
+        so it stays current with the file.
+
         Args:
             h5f (:class:`tables.File`): the hdf file opened by :meth:`~.Subject.open_hdf`
         """
-        with self.lock:
-            h5f.flush()
-            h5f.close()
+        index = self._metadata_loaded and h5f.isopen and h5f.mode != 'r'
+        if index:
+            n_trials = self._n_trials(h5f)
+        POOL.release(h5f)
+        if index:
+            self._update_index(n_trials)
 
     def new_subject_file(self, biography):
         """
@@ -291,11 +417,18 @@ class Subject(object):
         """
         Ensure that our h5f has the appropriate baseline structure as defined in `self.STRUCTURE`
 
-        Checks that all groups and tables are made, makes them if not
+        Checks that all groups and tables are made, makes them if not.
+        The file is only opened for writing if something is missing.
         """
+        h5f = self.open_hdf(mode='r')
+        missing = [node for node in self.STRUCTURE if node[0] not in h5f]
+        self.close_hdf(h5f)
+        if len(missing) == 0:
+            return
+
         h5f = self.open_hdf()
 
-        for node in self.STRUCTURE:
+        for node in missing:
             try:
                 node = h5f.get_node(node[0])
             except tables.exceptions.NoSuchNodeError:
@@ -379,8 +512,144 @@ class Subject(object):
         history_row['value'] = value
         history_row.append()
 
+        if type == 'step':
+            self._mark_step_start(h5f)
+
         _ = self.close_hdf(h5f)
 
+    def _mark_step_start(self, h5f:tables.File):
+        """
+        Record that trials for the current step start at the end of its trial table,
+        and forget its graduation state (see :meth:`.prepare_run` )
+        """
+        group_name = "/data/{}/S{:02d}_{}".format(self.protocol_name, self.step,
+                                                 self.current[self.step]['step_name'])
+        try:
+            trial_table = h5f.get_node(group_name, 'trial_data')
+        except tables.NoSuchNodeError:
+            return
+        trial_table.attrs['step_start'] = int(trial_table.nrows)
+        if 'graduation' in trial_table.attrs._v_attrnames:
+            del trial_table.attrs['graduation']
+
+    def _step_start(self, trial_table:tables.Table) -> int:
+        """
+        First row of the trial table since the subject was last moved to its step.
+
+        Stored by :meth:`._mark_step_start` , or for files from before it was, found
+        by comparing the table's first timestamp column to the last step change
+        in the history table and then stored.
+        """
+        if 'step_start' in trial_table.attrs._v_attrnames:
+            return int(trial_table.attrs['step_start'])
+
+        ##################################3
+        # first try and find some timestamp column to filter past data we give to the graduation object
+        # in case the subject has been stepped back down to a previous stage, for example
+        # FIXME: Hardcoding parameter names, should have a guaranteed 'trial_timestamp' column for each trial
+        slice_start = 0
+        try:
+            step_df = self.get_step_history(use_history=True)
+        except Exception as e:
+            self.logger.exception(f"Couldnt get step history to trim data given to graduation objects, got exception {e}")
+            step_df = None
+
+        try:
+            ts_cols = [col for col in trial_table.colnames if 'timestamp' in col]
+            # just use the first timestamp column
+            if len(ts_cols) > 0:
+                trial_ts = pd.DataFrame({'timestamp': timestamps.to_datetime(trial_table.col(ts_cols[0]))})
+            else:
+                self.logger.warning(
+                    'No timestamp column could be found in trial data, cannot trim data given to graduation objects')
+                trial_ts = None
+
+            if trial_ts is not None and step_df is not None:
+                # see where, if any, the timestamp column is older than the last time the step was changed
+                good_rows = np.where(trial_ts['timestamp'] >= step_df['timestamp'].iloc[-1])[0]
+                if len(good_rows) > 0:
+                    slice_start = np.min(good_rows)
+                # otherwise if it's because we found no good rows but have trials,
+                # we will say not to use them, otherwise we say not to use them by
+                # slicing at the end of the table
+                else:
+                    slice_start = trial_table.nrows
+
+        except Exception as e:
+            self.logger.exception(
+                f"Couldnt trim data given to graduation objects with step change history, got exception {e}")
+
+        trial_table.attrs['step_start'] = int(slice_start)
+        return int(slice_start)
+
+    def _save_graduation(self, trial_table:tables.Table):
+        """
+        Store the state of :attr:`.graduation` in the trial table, along with the
+        number of rows it has seen, so :meth:`.prepare_run` can restore it.
+        """
+        if self.graduation is None or self._graduation_key is None:
+            return
+        try:
+            trial_table.attrs['graduation'] = json.dumps(dict(
+                self._graduation_key,
+                rows=int(trial_table.nrows),
+                state=self.graduation.state()))
+        except Exception as e:
+            self.logger.exception(f'Couldnt save graduation state, got exception {e}')
+
+    def _load_seen(self, trial_table:tables.Table) -> Seen_Ids:
+        """
+        Get the ids of received data saved by :meth:`._save_seen`
+        """
+        return Seen_Ids(trial_table.attrs['data_ids'] if 'data_ids' in trial_table.attrs._v_attrnames else None)
+
+    def _is_new(self, data:dict, seen_ids:Seen_Ids) -> bool:
+        """
+        Check whether data hasn't been received before, and remember it if it hasn't.
+
+        Pilots resend data we may have already received (see :meth:`.Pilot_Station.l_data` ),
+        identified by its ``data_id`` , and the terminal recovers trials from their stored rows
+        (see :meth:`.Terminal.l_rows` ), identified by the ``pilot`` and ``seq`` of the row,
+        which is remembered once its trial has ended.
+        """
+        if 'data_id' in data.keys() and not seen_ids.add(data['data_id']):
+            return False
+        if 'seq' in data.keys() and 'pilot' in data.keys():
+            row_id = 'seq:{}_{}'.format(data['pilot'], data['seq'])
+            if row_id in seen_ids:
+                return False
+            if 'TRIAL_END' in data.keys():
+                seen_ids.add(row_id)
+        return True
+
+    def _save_seen(self, trial_table:tables.Table, seen_ids:Seen_Ids):
+        """
+        Store the ids of data that's been received in the trial table, so data that a pilot
+        sends again after we've been restarted isn't stored twice.
+        """
+        try:
+            trial_table.attrs['data_ids'] = seen_ids.to_json()
+        except Exception as e:
+            self.logger.exception(f'Couldnt save received data ids, got exception {e}')
+
+    def _load_graduation(self, trial_table:tables.Table) -> typing.Optional[dict]:
+        """
+        Get the state saved by :meth:`._save_graduation` , if it's for the same
+        graduation type and parameters and every row in the table has been given to it.
+        """
+        if 'graduation' not in trial_table.attrs._v_attrnames:
+            return None
+        try:
+            saved = json.loads(trial_table.attrs['graduation'])
+        except Exception as e:
+            self.logger.warning(f'Couldnt load saved graduation state, got exception {e}')
+            return None
+        if saved.get('type') != self._graduation_key['type'] or \
+                saved.get('params') != self._graduation_key['params'] or \
+                saved.get('rows') != trial_table.nrows:
+            return None
+        return saved.get('state', {})
+
 
     # def update_params(self, param, value):
     #     """
@@ -501,6 +770,12 @@ class Subject(object):
                     # same thing with trial_num
                     if 'trial_num' not in trial_descriptor.columns.keys():
                         trial_descriptor.columns.update({'trial_num': tables.Int32Col()})
+                    # store timestamps in the format we're set to use
+                    # (copying the columns so the task class is unchanged)
+                    trial_descriptor = dict(trial_descriptor.columns)
+                    for col_name, col in trial_descriptor.items():
+                        if 'timestamp' in col_name and isinstance(col, tables.StringCol):
+                            trial_descriptor[col_name] = timestamps.column()
                     # if this task has sounds, make columns for them
                     # TODO: Make stim managers return a list of properties for their sounds
                     if 'stim' in step.keys():
@@ -515,7 +790,7 @@ class Subject(object):
                                                 sound_params[k] = tables.StringCol(1024)
                                             else:
                                                 sound_params[k] = tables.Float64Col()
-                            trial_descriptor.columns.update(sound_params)
+                            trial_descriptor.update(sound_params)
 
                         elif 'sounds' in step['stim'].keys():
                             # for now we just assume they're floats
@@ -528,15 +803,16 @@ class Subject(object):
                                             sound_params[k] = tables.StringCol(1024)
                                         else:
                                             sound_params[k] = tables.Float64Col()
-                            trial_descriptor.columns.update(sound_params)
+                            trial_descriptor.update(sound_params)
 
-                    h5f.create_table(step_group, "trial_data", trial_descriptor)
+                    trial_table = h5f.create_table(step_group, "trial_data", trial_descriptor)
                 else:
                     self.logger.warning('No trial data descriptor found, making default table with session and trial_num')
-                    h5f.create_table(step_group, "trial_data", {'session': tables.Int32Col(), 'trial_num': tables.Int32Col()})
+                    trial_table = h5f.create_table(step_group, "trial_data", {'session': tables.Int32Col(), 'trial_num': tables.Int32Col()})
             except tables.NodeError:
                 # we already have made this table, that's fine
-                pass
+                trial_table = step_group._f_get_child('trial_data')
+            self._index_trial_table(trial_table)
             try:
                 # if we have continuous data, make a folder for each data stream.
                 # each session will make its own subfolder,
@@ -563,6 +839,20 @@ class Subject(object):
                             name=self.current[self.step]['step_name'],
                             value=self.step)
 
+    @staticmethod
+    def _index_trial_table(trial_table:tables.Table):
+        """
+        Index a trial table's ``session`` and timestamp columns, if they aren't already,
+        so selecting by them (eg. :meth:`.iter_trial_data` ) doesn't need to read the whole table
+        """
+        for col_name in trial_table.colnames:
+            if col_name != 'session' and 'timestamp' not in col_name:
+                continue
+            col = trial_table.cols._f_col(col_name)
+            if col.is_indexed or len(col.shape) > 1:
+                continue
+            col.create_index()
+
     def flush_current(self):
         """
         Flushes the 'current' attribute in the subject object to the current filenode
@@ -629,15 +919,18 @@ class Subject(object):
         trial_table = None
         cont_table = None
 
-        # get step history
-        try:
-            step_df = self.get_step_history(use_history=True)
-        except Exception as e:
-            self.logger.exception(f"Couldnt get step history to trim data given to graduation objects, got exception {e}")
-            step_df = None
-
         h5f = self.open_hdf()
 
+        # stash the git hash every time we run
+        history_row = h5f.root.history.hashes.row
+        history_row['time'] = self.get_timestamp()
+        try:
+            history_row['hash'] = prefs.get('HASH')
+            # FIXME: less implicit way of getting hash plz
+        except AttributeError:
+            history_row['hash'] = ''
+        history_row.append()
+
         # Get current task parameters and handles to tables
         task_params = self.current[self.step]
         step_name = task_params['step_name']
@@ -649,38 +942,25 @@ class Subject(object):
         # tasks without TrialData will have some default table, so this should always be present
         trial_table = h5f.get_node(group_name, 'trial_data')
 
-        ##################################3
-        # first try and find some timestamp column to filter past data we give to the graduation object
-        # in case the subject has been stepped back down to a previous stage, for example
-        # FIXME: Hardcoding parameter names, should have a guaranteed 'trial_timestamp' column for each trial
-        slice_start = 0
-        try:
-            ts_cols = [col for col in trial_table.colnames if 'timestamp' in col]
-            # just use the first timestamp column
-            if len(ts_cols) > 0:
-                trial_ts = pd.DataFrame({'timestamp': trial_table.col(ts_cols[0])})
-                trial_ts['timestamp'] = pd.to_datetime(trial_ts['timestamp'].str.decode('utf-8'))
-            else:
-                self.logger.warning(
-                    'No timestamp column could be found in trial data, cannot trim data given to graduation objects')
-                trial_ts = None
-
-            if trial_ts is not None and step_df is not None:
-                # see where, if any, the timestamp column is older than the last time the step was changed
-                good_rows = np.where(trial_ts['timestamp'] >= step_df['timestamp'].iloc[-1])[0]
-                if len(good_rows) > 0:
-                    slice_start = np.min(good_rows)
-                # otherwise if it's because we found no good rows but have trials,
-                # we will say not to use them, otherwise we say not to use them by
-                # slicing at the end of the table
-                else:
-                    slice_start = trial_table.nrows
-
-        except Exception as e:
-            self.logger.exception(
-                f"Couldnt trim data given to graduation objects with step change history, got exception {e}")
+        # recover trials that weren't written the last time we ran before reading them
+        if os.path.exists(self.journal):
+            try:
+                recovered = Trial_Writer(trial_table, self.session or 0, journal=self.journal)
+                recovered.close()
+                # the ids of recovered data may not have been saved before the crash
+                if recovered.replayed:
+                    seen_ids = self._load_seen(trial_table)
+                    for entry in recovered.replayed:
+                        self._is_new(entry, seen_ids)
+                    self._save_seen(trial_table, seen_ids)
+            except Exception as e:
+                self.logger.exception(f"Couldn't recover trial data from journal {self.journal}, got exception {e}")
 
-        trial_tab = trial_table.read(start=slice_start)
+        # only trials since the subject was moved to this step count,
+        # in case the subject has been stepped back down to a previous stage, for example
+        step_start = self._step_start(trial_table)
+        n_rows = trial_table.nrows
+        trial_tab = trial_table.read(start=max(step_start, n_rows-1))
         trial_tab_keys = tuple(trial_tab.dtype.fields.keys())
 
         ##############################
@@ -724,10 +1004,13 @@ class Subject(object):
 
         # TODO: Spawn graduation checking object!
         self.graduation = None
+        self._graduation_key = None
         if 'graduation' in task_params.keys():
             try:
                 grad_type = task_params['graduation']['type']
                 grad_params = task_params['graduation']['value'].copy()
+                self._graduation_key = {'type': grad_type,
+                                        'params': json.loads(json.dumps(task_params['graduation']['value']))}
 
                 # add other params asked for by the task class
                 grad_obj = autopilot.get('graduation', grad_type)
@@ -743,13 +1026,23 @@ class Subject(object):
                         if hasattr(self, param) and param not in grad_params.keys():
                             grad_params.update({param:getattr(self, param)})
 
-                if grad_obj.COLS:
+                saved_state = self._load_graduation(trial_table)
+                if saved_state is not None:
+                    # pick up where the last session left off
+                    grad_params.update(saved_state)
+
+                elif grad_obj.COLS:
                     # these are columns in our trial table
+                    # read only as many trials as the graduation object needs
+                    rows_needed = grad_obj.rows_needed(**grad_params)
+                    grad_start = step_start
+                    if rows_needed is not None:
+                        grad_start = max(step_start, n_rows - int(rows_needed))
 
                     # then give the data to the graduation object
                     for col in grad_obj.COLS:
                         try:
-                            grad_params.update({col: trial_tab[col]})
+                            grad_params.update({col: trial_table.read(start=grad_start, field=col)})
                         except KeyError:
                             self.logger.warning('Graduation object requested column {}, but it was not found in the trial table'.format(col))
 
@@ -789,7 +1082,17 @@ class Subject(object):
         each dict given to the queue should have the `trial_num`, and this method can
         properly store data without passing `TRIAL_END` if so. I recommend being explicit, however.
 
-        Checks graduation state at the end of each trial.
+        Checks graduation state at the end of each trial, and saves it
+        whenever trials are written (see :meth:`.Graduation.state` ).
+
+        Data with a ``data_id`` that has already been received (eg. replayed from a pilot's
+        :class:`.Backlog` after the terminal restarted), or for a ``seq`` from a ``pilot`` whose
+        trial has already ended (eg. recovered by :meth:`.Terminal.l_rows` as well), is dropped. The ids are stored with the trial table
+        whenever trials are written (see :class:`.Seen_Ids` ).
+
+        Trials are written by a :class:`.Trial_Writer` in batches of :attr:`.trial_flush_rows` ,
+        or after :attr:`.trial_flush_interval` seconds, and journaled in the meantime.
+        Continuous data is written a chunk at a time by a :class:`.Continuous_Writer` .
 
         Args:
             queue (:class:`queue.Queue`): passed by :meth:`~.Subject.prepare_run` and used by other
@@ -804,137 +1107,92 @@ class Subject(object):
         group_name = f"/data/{self.protocol_name}/S{self.step:02d}_{step_name}"
         #try:
         trial_table = h5f.get_node(group_name, 'trial_data')
-        trial_keys = trial_table.colnames
-        trial_row = trial_table.row
+        trial_writer = Trial_Writer(trial_table, self.session, journal=self.journal,
+                                    flush_rows=self.trial_flush_rows,
+                                    flush_interval=self.trial_flush_interval)
+
+        # ids of data received from pilots, kept across sessions
+        seen_ids = self._load_seen(trial_table)
 
         # try to get continuous data table if any
-        cont_data = tuple()
-        cont_tables = {}
-        cont_rows = {}
+        cont_writer = None
         try:
             continuous_group = h5f.get_node(group_name, 'continuous_data')
             session_group = h5f.get_node(continuous_group, 'session_{}'.format(self.session))
-            cont_data = continuous_group._v_attrs['data']
-
-            cont_tables = {}
-            cont_rows = {}
+            cont_writer = Continuous_Writer(session_group, continuous_group._v_attrs['data'],
+                                            filters=self.continuous_filter,
+                                            flush_interval=self.continuous_flush_interval)
         except AttributeError:
-            continuous_table = False
+            pass
 
         # start getting data
         # stop when 'END' gets put in the queue
-        for data in iter(queue.get, 'END'):
+        while True:
+            timeouts = [trial_writer.time_to_flush()]
+            if cont_writer is not None:
+                timeouts.append(cont_writer.time_to_flush())
+            timeouts = [timeout for timeout in timeouts if timeout is not None]
+
+            # let other threads read the file while we wait
+            with POOL.unlocked(h5f):
+                try:
+                    data = queue.get(timeout=min(timeouts) if timeouts else None)
+                except Empty:
+                    data = None
+            if data == 'END':
+                break
+
             # wrap everything in try because this thread shouldn't crash
             try:
+                if data is None:
+                    # no data for a while, write what we have
+                    if trial_writer.due:
+                        self._save_seen(trial_table, seen_ids)
+                        trial_writer.flush()
+                        self._save_graduation(trial_table)
+                    if cont_writer is not None:
+                        cont_writer.flush()
+                    continue
+
                 # if we get continuous data, this should be simple because we always get a whole row
-                # there must be a more elegant way to check if something is a key and it is true...
-                # yet here we are
                 if 'continuous' in data.keys():
-                    for k, v in data.items():
-                        # if this isn't data that we're expecting, ignore it
-                        if k not in cont_data:
-                            continue
-
-                        # if we haven't made a table yet, do it
-                        if k not in cont_tables.keys():
-                            # make atom for this data
-                            try:
-                                # if it's a numpy array...
-                                col_atom = tables.Atom.from_type(v.dtype.name, v.shape)
-                            except AttributeError:
-                                temp_array = np.array(v)
-                                col_atom = tables.Atom.from_type(temp_array.dtype.name, temp_array.shape)
-                            # should have come in with a timestamp
-                            # TODO: Log if no timestamp is received
-                            try:
-                                temp_timestamp_arr = np.array(data['timestamp'])
-                                timestamp_atom = tables.Atom.from_type(temp_timestamp_arr.dtype.name,
-                                                                       temp_timestamp_arr.shape)
-
-                            except KeyError:
-                                self.logger.warning('no timestamp sent with continuous data')
-                                continue
-
-
-                            cont_tables[k] = h5f.create_table(session_group, k, description={
-                                k: tables.Col.from_atom(col_atom),
-                                'timestamp': tables.Col.from_atom(timestamp_atom)
-                            }, filters=self.continuous_filter)
-
-                            cont_rows[k] = cont_tables[k].row
-
-                        cont_rows[k][k] = v
-                        cont_rows[k]['timestamp'] = data['timestamp']
-                        cont_rows[k].append()
+                    if cont_writer is not None:
+                        cont_writer.add(data)
+                        if cont_writer.time_to_flush() == 0:
+                            cont_writer.flush()
 
                     # continue, the rest is for handling trial data
                     continue
 
+                if not self._is_new(data, seen_ids):
+                    continue
 
+                # trial data is merged by trial_num and written in batches
+                trial_row = trial_writer.add(data)
 
-                # Check if this is the same
-                # if we've already recorded a trial number for this row,
-                # and the trial number we just got is not the same,
-                # we edit that row if we already have some data on it or else start a new row
-                if 'trial_num' in data.keys():
-                    if (trial_row['trial_num']) and (trial_row['trial_num'] is None):
-                        trial_row['trial_num'] = data['trial_num']
-
-                    if (trial_row['trial_num']) and (trial_row['trial_num'] != data['trial_num']):
-
-                        # find row with this trial number if it exists
-                        # this will return a list of rows with matching trial_num.
-                        # if it's empty, we didn't receive a TRIAL_END and should create a new row
-                        other_row = [r for r in trial_table.where("trial_num == {}".format(data['trial_num']))]
-
-                        if len(other_row) == 0:
-                            # proceed to fill the row below
-                            trial_row.append()
+                if trial_row is not None and self.graduation:
+                    # set our graduation flag, the terminal will get the rest rolling
+                    did_graduate = self.graduation.update(trial_row)
+                    if did_graduate is True:
+                        self.did_graduate.set()
 
-                        elif len(other_row) == 1:
-                            # update the row and continue so we don't double write
-                            # have to be in the middle of iteration to use update()
-                            for row in trial_table.where("trial_num == {}".format(data['trial_num'])):
-                                for k, v in data.items():
-                                    if k in trial_keys:
-                                        row[k] = v
-                                row.update()
-                            continue
-
-                        else:
-                            # we have more than one row with this trial_num.
-                            # shouldn't happen, but we dont' want to throw any data away
-                            self.logger.warning('Found multiple rows with same trial_num: {}'.format(data['trial_num']))
-                            # continue just for data conservancy's sake
-                            trial_row.append()
-
-                for k, v in data.items():
-                    # some bug where some columns are not always detected,
-                    # rather than failing out here, just log error
-                    if k in trial_keys:
-                        try:
-                            trial_row[k] = v
-                        except KeyError:
-                            # TODO: Logging here
-                            self.logger.warning("Data dropped: key: {}, value: {}".format(k, v))
-
-                # TODO: Or if all the values have been filled, shouldn't need explicit TRIAL_END flags
-                if 'TRIAL_END' in data.keys():
-                    trial_row['session'] = self.session
-                    if self.graduation:
-                        # set our graduation flag, the terminal will get the rest rolling
-                        did_graduate = self.graduation.update(trial_row)
-                        if did_graduate is True:
-                            self.did_graduate.set()
-                    trial_row.append()
-                    trial_table.flush()
-
-                # always flush so that our row iteration routines above will find what they're looking for
-                trial_table.flush()
+                if trial_writer.due:
+                    # ids are saved before their rows are, and until then they're in the journal
+                    self._save_seen(trial_table, seen_ids)
+                    trial_writer.flush()
+                    self._save_graduation(trial_table)
             except Exception as e:
                 # we shouldn't throw any exception in this thread, just log it and move on
                 self.logger.exception(f'exception in data thread: {e}')
 
+        try:
+            self._save_seen(trial_table, seen_ids)
+            trial_writer.close()
+            self._save_graduation(trial_table)
+            if cont_writer is not None:
+                cont_writer.close()
+        except Exception as e:
+            self.logger.exception(f'exception writing data: {e}')
         self.close_hdf(h5f)
 
     def save_data(self, data):
@@ -947,6 +1205,57 @@ class Subject(object):
         """
         self.data_queue.put(data)
 
+    def save_backlog(self, batch:typing.List[dict]):
+        """
+        Save trial data that a pilot sent after the subject's run was stopped
+        (eg. stored while the terminal couldn't be reached, see :meth:`.Terminal.l_data` )
+        without starting a new run.
+
+        Data that has already been received is dropped like it is by :meth:`.data_thread` ,
+        and the rest is added to the current step's trial table in the last session,
+        updating the rows of trials that were already written.
+        Continuous data isn't saved, since its session's arrays may not exist.
+
+        Args:
+            batch (list): dicts of trial data
+        """
+        if self.running:
+            for data in batch:
+                self.save_data(data)
+            return
+
+        h5f = self.open_hdf()
+        try:
+            task_params = self.current[self.step]
+            group_name = f"/data/{self.protocol_name}/S{self.step:02d}_{task_params['step_name']}"
+            trial_table = h5f.get_node(group_name, 'trial_data')
+            trial_writer = Trial_Writer(trial_table, self.session or 0)
+            trial_writer.index_rows()
+            seen_ids = self._load_seen(trial_table)
+
+            n_dropped = 0
+            for data in batch:
+                if 'continuous' in data.keys():
+                    n_dropped += 1
+                    continue
+                if self._is_new(data, seen_ids):
+                    trial_writer.add(data)
+
+            self._save_seen(trial_table, seen_ids)
+            trial_writer.close()
+            if n_dropped:
+                self.logger.warning(f'Dropped {n_dropped} continuous data values received while not running')
+        finally:
+            self.close_hdf(h5f)
+
+    @property
+    def was_running(self) -> bool:
+        """
+        Whether the subject's last run never ended with :meth:`.stop_run` ,
+        eg. because the terminal crashed, which leaves its trial journal behind.
+        """
+        return not self.running and os.path.exists(self.journal)
+
     def stop_run(self):
         """
         puts 'END' in the data_queue, which causes :meth:`~.Subject.data_thread` to end.
@@ -978,36 +1287,15 @@ N Sessions: {}""".format(self.name, path, df.shape[0], len(df.session.unique()))
 
 
 
-    def get_trial_data(self,
-                       step: typing.Union[int, list, str] = -1,
-                       what: str ="data"):
+    def _select_steps(self, group:tables.Group, step: typing.Union[int, list, str] = -1) -> typing.List[str]:
         """
-        Get trial data from the current task.
-
-        Args:
-            step (int, list, 'all'): Step that should be returned, can be one of
-
-                * -1: most recent step
-                * int: a single step
-                * list of two integers eg. [0, 5], an inclusive range of steps.
-                * string: the name of a step (excluding S##_)
-                * 'all': all steps.
-
-            what (str): What should be returned?
-
-                * 'data' : Dataframe of requested steps' trial data
-                * 'variables': dict of variables *without* loading data into memory
-
-        Returns:
-            :class:`pandas.DataFrame`: DataFrame of requested steps' trial data.
+        Names of a protocol's step groups ( ``S##_step_name`` ) selected by ``step`` ,
+        see :meth:`.get_trial_data`
         """
         # step= -1 is just most recent step,
         # step= int is an integer specified step
         # step= [n1, n2] is from step n1 to n2 inclusive
         # step= 'all' or anything that isn't an int or a list is all steps
-        h5f = self.open_hdf()
-        group_name = "/data/{}".format(self.protocol_name)
-        group = h5f.get_node(group_name)
         step_groups = sorted(group._v_children.keys())
 
         if step == -1:
@@ -1043,34 +1331,314 @@ N Sessions: {}""".format(self.name, path, df.shape[0], len(df.session.unique()))
                     _step_groups.extend(step_name)
 
                 step_groups = _step_groups
-        print('step groups:')
-        print(step_groups)
 
+        return step_groups
+
+    def iter_trial_data(self,
+                        step: typing.Union[int, list, str] = -1,
+                        columns: typing.Optional[typing.List[str]] = None,
+                        sessions: typing.Union[int, typing.Tuple[int, int], None] = None,
+                        rows: typing.Optional[typing.Tuple[int, int]] = None,
+                        times: typing.Optional[tuple] = None,
+                        time_col: typing.Optional[str] = None,
+                        chunk_rows: typing.Optional[int] = None) -> typing.Generator[typing.Tuple[str, np.ndarray], None, None]:
+        """
+        Read trial data a chunk at a time, without loading whole tables into memory.
+
+        The file is held open (read-only) until the generator is exhausted or closed.
+
+        Args:
+            step (int, list, 'all'): Step(s) to read, see :meth:`.get_trial_data`
+            columns (list): Names of columns to read, or ``None`` for all. Columns that
+                a step doesn't have are left out of its batches.
+            sessions (int, tuple): A single session, or an inclusive ``(first, last)`` range
+                of sessions, either of which can be ``None`` . Selected with
+                :meth:`tables.Table.read_where` , so uses the ``session`` column's index if it has one.
+            rows (tuple): ``(start, stop)`` range of rows to read from each step's table,
+                as in :func:`range`
+            times (tuple): ``(start, stop)`` range of times, either of which can be ``None`` ,
+                as anything :func:`.timestamps.to_ns` accepts. Trials with ``start <= time < stop``
+                are read, using the index of the time column.
+            time_col (str): column to select ``times`` from, default the first column with ``timestamp``
+                in its name. Steps without it are skipped.
+            chunk_rows (int): Number of table rows to read at a time, default :attr:`.read_chunk_rows`
+
+        Yields:
+            tuple: ``(step_name, records)`` , the name of the step group ( ``S##_step_name`` )
+            and a :class:`numpy.ndarray` structured array with one record per trial
+        """
+        if chunk_rows is None:
+            chunk_rows = self.read_chunk_rows
+        chunk_rows = max(int(chunk_rows), 1)
+
+        if sessions is not None and isinstance(sessions, (int, np.integer)):
+            sessions = (sessions, sessions)
+
+        h5f = self.open_hdf(mode='r')
+        try:
+            group = h5f.get_node("/data/{}".format(self.protocol_name))
+            for step_key in self._select_steps(group, step):
+                step_tab = group._v_children[step_key]._v_children['trial_data']
+
+                names = step_tab.colnames
+                if columns is not None:
+                    names = [name for name in columns if name in step_tab.colnames]
+                    if len(names) == 0:
+                        continue
+
+                start, stop = 0, step_tab.nrows
+                if rows is not None:
+                    start, stop, _ = slice(*rows).indices(step_tab.nrows)
+
+                conditions, condvars = [], {}
+                if sessions is not None:
+                    conditions, condvars = _range_condition('session', sessions, np.dtype(np.int64))
+                if times is not None:
+                    step_time_col = time_col
+                    if step_time_col is None:
+                        step_time_col = next((col for col in step_tab.colnames if 'timestamp' in col), None)
+                    if step_time_col not in step_tab.colnames:
+                        self.logger.warning('No time column {} in {}, skipping'.format(step_time_col, step_key))
+                        continue
+                    time_conds, time_vars = _range_condition(
+                        step_time_col, times, step_tab.coldtypes[step_time_col], timestamps.to_column)
+                    conditions.extend(time_conds)
+                    condvars.update(time_vars)
+                condition = ' & '.join(conditions) if len(conditions) > 0 else None
+
+                for chunk_start in range(start, stop, chunk_rows):
+                    chunk_stop = min(chunk_start + chunk_rows, stop)
+                    if condition is None:
+                        records = step_tab.read(chunk_start, chunk_stop)
+                    else:
+                        records = step_tab.read_where(condition, condvars=condvars, start=chunk_start, stop=chunk_stop)
+                    if records.shape[0] == 0:
+                        continue
+                    if columns is not None:
+                        records = repack_fields(records[names])
+                    with POOL.unlocked(h5f):
+                        yield step_key, records
+        finally:
+            self.close_hdf(h5f)
+
+    def get_continuous_data(self,
+                            streams: typing.Optional[typing.List[str]] = None,
+                            times: typing.Optional[tuple] = None,
+                            step: typing.Union[int, list, str] = 'all',
+                            sessions: typing.Union[int, typing.Tuple[int, int], None] = None) -> typing.Dict[str, np.ndarray]:
+        """
+        Get continuous data recorded within a range of times, eg. to align it to trials::
+
+            trials = subject.get_trial_data(columns=['trial_num', 'DC_timestamp'])
+            start, stop = trials['DC_timestamp'].iloc[[0, 1]]
+            samples = subject.get_continuous_data(['wheel'], times=(start, stop))
+
+        Samples are selected with :meth:`tables.Table.read_where` , using the index of each stream's
+        ``timestamp`` column (see :class:`.Continuous_Writer` ). Times can be given in any format
+        :func:`.timestamps.to_ns` accepts, and are converted to the format of each stream's timestamps.
+
+        Args:
+            streams (list): names of the data streams to get, default all
+            times (tuple): ``(start, stop)`` , get samples with ``start <= timestamp < stop`` ,
+                either can be ``None`` . Default all samples.
+            step (int, list, 'all'): Step(s) to get data from, see :meth:`.get_trial_data` . Default all,
+                since ``-1`` is the most recent step with *trial* data.
+            sessions (int, tuple): A single session, or an inclusive ``(first, last)`` range of sessions
+
+        Returns:
+            dict: ``{stream_name: records}`` , structured arrays with a column named for the stream
+            and a ``timestamp`` column, concatenated across sessions and steps in order.
+        """
+        if sessions is not None and isinstance(sessions, (int, np.integer)):
+            sessions = (sessions, sessions)
+
+        data = {}
+        h5f = self.open_hdf(mode='r')
+        try:
+            group = h5f.get_node("/data/{}".format(self.protocol_name))
+            for step_key in self._select_steps(group, step):
+                step_group = group._v_children[step_key]
+                if 'continuous_data' not in step_group:
+                    continue
+
+                session_groups = []
+                for session_key, session_group in step_group.continuous_data._v_children.items():
+                    try:
+                        session_n = int(session_key.split('_')[-1])
+                    except ValueError:
+                        continue
+                    if sessions is not None and (
+                            (sessions[0] is not None and session_n < sessions[0]) or
+                            (sessions[1] is not None and session_n > sessions[1])):
+                        continue
+                    session_groups.append((session_n, session_group))
+
+                for _, session_group in sorted(session_groups, key=lambda session: session[0]):
+                    for stream_name, stream in session_group._v_children.items():
+                        if streams is not None and stream_name not in streams:
+                            continue
+                        conditions, condvars = [], {}
+                        if times is not None:
+                            conditions, condvars = _range_condition(
+                                'timestamp', times, stream.coldtypes['timestamp'], timestamps.to_column)
+                        if len(conditions) > 0:
+                            records = stream.read_where(' & '.join(conditions), condvars=condvars)
+                        else:
+                            records = stream.read()
+                        data.setdefault(stream_name, []).append(records)
+        finally:
+            self.close_hdf(h5f)
+
+        for stream_name, records in data.items():
+            try:
+                data[stream_name] = np.concatenate(records)
+            except (ValueError, TypeError):
+                # the stream's shape or type changed between sessions, give them separately
+                self.logger.warning('Could not concatenate {} across sessions, returning a list'.format(stream_name))
+        return data
+
+    def get_trial_data(self,
+                       step: typing.Union[int, list, str] = -1,
+                       what: str ="data",
+                       columns: typing.Optional[typing.List[str]] = None,
+                       sessions: typing.Union[int, typing.Tuple[int, int], None] = None,
+                       rows: typing.Optional[typing.Tuple[int, int]] = None,
+                       times: typing.Optional[tuple] = None,
+                       time_col: typing.Optional[str] = None):
+        """
+        Get trial data from the current task.
+
+        To process more data than fits in memory, use :meth:`.iter_trial_data` ,
+        and to export it, :meth:`.to_parquet`
+
+        Args:
+            step (int, list, 'all'): Step that should be returned, can be one of
+
+                * -1: most recent step
+                * int: a single step
+                * list of two integers eg. [0, 5], an inclusive range of steps.
+                * string: the name of a step (excluding S##_)
+                * 'all': all steps.
+
+            what (str): What should be returned?
+
+                * 'data' : Dataframe of requested steps' trial data
+                * 'variables': dict of variables *without* loading data into memory
+
+            columns (list): Only these columns, see :meth:`.iter_trial_data`
+            sessions (int, tuple): Only this session or ``(first, last)`` range of sessions
+            rows (tuple): Only this ``(start, stop)`` range of rows from each step
+            times (tuple): Only trials from this ``(start, stop)`` range of times
+            time_col (str): Column to select ``times`` from
+
+        Returns:
+            :class:`pandas.DataFrame`: DataFrame of requested steps' trial data.
+        """
         if what == "variables":
+            h5f = self.open_hdf(mode='r')
+            group = h5f.get_node("/data/{}".format(self.protocol_name))
             return_data = {}
+            for step_key in self._select_steps(group, step):
+                step_tab = group._v_children[step_key]._v_children['trial_data']
+                return_data[step_key] = step_tab.coldescrs
+            self.close_hdf(h5f)
+            return return_data
+
+        step_dfs = []
+        for step_key, records in self.iter_trial_data(step=step, columns=columns, sessions=sessions, rows=rows,
+                                                      times=times, time_col=time_col):
+            step_df = pd.DataFrame(records)
+            step_df['step'] = int(step_key[1:3]) # beginning of keys will be 'S##'
+            step_df['step_name'] = step_key
+            step_dfs.append(step_df)
+
+        if len(step_dfs) == 0:
+            return pd.DataFrame()
+        return pd.concat(step_dfs, ignore_index=True)
+
+    def to_arrow(self, step: typing.Union[int, list, str] = 'all', **kwargs) -> 'pa.Table':
+        """
+        Get trial data as a :class:`pyarrow.Table` , with ``step`` and ``step_name`` columns like
+        :meth:`.get_trial_data` . Steps that don't have a column have nulls in it.
 
-        for step_key in step_groups:
-            step_n = int(step_key[1:3]) # beginning of keys will be 'S##'
-            step_tab = group._v_children[step_key]._v_children['trial_data']
-            if what == "data":
-                step_df = pd.DataFrame(step_tab.read())
-                step_df['step'] = step_n
-                step_df['step_name'] = step_key
-                try:
-                    return_data = return_data.append(step_df, ignore_index=True)
-                except NameError:
-                    return_data = step_df
+        Args:
+            step (int, list, 'all'): Step(s) to get, see :meth:`.get_trial_data`
+            **kwargs: passed to :meth:`.iter_trial_data`
 
-            elif what == "variables":
-                return_data[step_key] = step_tab.coldescrs
+        Returns:
+            :class:`pyarrow.Table`
+        """
+        schema = self._arrow_schema(step, kwargs.get('columns'))
+        return pa.Table.from_batches(list(self.iter_arrow(step=step, schema=schema, **kwargs)), schema=schema)
 
+    def to_parquet(self, path:str, step: typing.Union[int, list, str] = 'all', **kwargs):
+        """
+        Export trial data to a parquet file, a chunk at a time.
 
-        self.close_hdf(h5f)
+        Args:
+            path (str): output path of .parquet file
+            step (int, list, 'all'): Step(s) to export, see :meth:`.get_trial_data`
+            **kwargs: passed to :meth:`.iter_trial_data`
+        """
+        schema = self._arrow_schema(step, kwargs.get('columns'))
+        with pq.ParquetWriter(path, schema) as writer:
+            for batch in self.iter_arrow(step=step, schema=schema, **kwargs):
+                writer.write_batch(batch)
+
+    def iter_arrow(self, step: typing.Union[int, list, str] = 'all',
+                   schema: typing.Optional['pa.Schema'] = None,
+                   **kwargs) -> typing.Generator['pa.RecordBatch', None, None]:
+        """
+        :meth:`.iter_trial_data` as :class:`pyarrow.RecordBatch` es
 
-        return return_data
+        Numeric columns are handed to arrow as they are, string columns are decoded
+        as utf-8, and array columns become fixed-size lists.
+
+        Args:
+            step (int, list, 'all'): Step(s) to read, see :meth:`.get_trial_data`
+            schema (:class:`pyarrow.Schema`): Schema to conform batches to (filling missing columns with nulls),
+                otherwise each batch has the columns of its step.
+            **kwargs: passed to :meth:`.iter_trial_data`
+        """
+        for step_key, records in self.iter_trial_data(step=step, **kwargs):
+            batch = _records_to_arrow(records, step_key)
+            if schema is not None:
+                batch = pa.RecordBatch.from_arrays(
+                    [batch.column(field.name) if field.name in batch.schema.names
+                     else pa.nulls(batch.num_rows, type=field.type)
+                     for field in schema],
+                    schema=schema)
+            yield batch
+
+    def _arrow_schema(self, step: typing.Union[int, list, str] = 'all',
+                      columns: typing.Optional[typing.List[str]] = None) -> 'pa.Schema':
+        """
+        Union of the arrow schemas of the selected steps' trial tables
+        """
+        if not ARROW:
+            raise ImportError('pyarrow must be installed to export trial data to arrow or parquet')
+
+        h5f = self.open_hdf(mode='r')
+        try:
+            group = h5f.get_node("/data/{}".format(self.protocol_name))
+            schemas = []
+            for step_key in self._select_steps(group, step):
+                empty = group._v_children[step_key]._v_children['trial_data'].read(0, 0)
+                if columns is not None:
+                    names = [name for name in columns if name in empty.dtype.names]
+                    if len(names) == 0:
+                        continue
+                    empty = repack_fields(empty[names])
+                schemas.append(_records_to_arrow(empty, step_key).schema)
+        finally:
+            self.close_hdf(h5f)
+
+        if len(schemas) == 0:
+            return pa.schema([('step', pa.int32()), ('step_name', pa.string())])
+        return pa.unify_schemas(schemas)
 
     def apply_along(self, along='session', step=-1):
-        h5f = self.open_hdf()
+        h5f = self.open_hdf(mode='r')
         group_name = "/data/{}".format(self.protocol_name)
         group = h5f.get_node(group_name)
         step_groups = sorted(group._v_children.keys())
@@ -1094,7 +1662,10 @@ N Sessions: {}""".format(self.name, path, df.shape[0], len(df.session.unique()))
                 step_tab = group._v_children[step_key]._v_children['trial_data']
                 step_df = pd.DataFrame(step_tab.read())
                 step_df['step'] = step_n
-                yield step_df
+                with POOL.unlocked(h5f):
+                    yield step_df
+
+        self.close_hdf(h5f)
 
 
 
@@ -1113,16 +1684,17 @@ N Sessions: {}""".format(self.name, path, df.shape[0], len(df.session.unique()))
             :class:`pandas.DataFrame`
 
         """
-        h5f = self.open_hdf()
+        h5f = self.open_hdf(mode='r')
         if use_history:
             history = h5f.root.history.history
             step_df = pd.DataFrame(history.read())
             if step_df.shape[0] == 0:
+                self.close_hdf(h5f)
                 return None
             # encode as unicode
             # https://stackoverflow.com/a/63028569/13113166
             for col, dtype in step_df.dtypes.items():
-                if dtype == np.object:  # Only process byte object columns.
+                if dtype == object:  # Only process byte object columns.
                     step_df[col] = step_df[col].apply(lambda x: x.decode("utf-8"))
 
             # filter to step only
@@ -1220,7 +1792,7 @@ N Sessions: {}""".format(self.name, path, df.shape[0], len(df.session.unique()))
         # TODO: Get by session
         weights = {}
 
-        h5f = self.open_hdf()
+        h5f = self.open_hdf(mode='r')
         weight_table = h5f.root.history.weights
         if which == 'last':
             for column in weight_table.colnames:
@@ -1351,3 +1923,59 @@ N Sessions: {}""".format(self.name, path, df.shape[0], len(df.session.unique()))
         time = tables.StringCol(256)
         hash = tables.StringCol(40)
 
+
+def _range_condition(col_name:str, bounds:tuple, dtype:np.dtype,
+                     convert:typing.Optional[typing.Callable]=None) -> typing.Tuple[typing.List[str], dict]:
+    """
+    Conditions and condvars for :meth:`tables.Table.read_where` selecting
+    ``bounds[0] <= col < bounds[1]`` , or ``<=`` for both if the column is ``session``
+    (sessions are given as inclusive ranges).
+
+    Args:
+        col_name (str): column to select by
+        bounds (tuple): ``(start, stop)`` , either can be ``None``
+        dtype (:class:`numpy.dtype`): dtype of the column
+        convert (callable): called with ``(bound, dtype)`` to convert bounds to the column's type
+
+    Returns:
+        tuple: list of condition strings and dict of condvars
+    """
+    conditions, condvars = [], {}
+    upper = '<=' if col_name == 'session' else '<'
+    for bound, op, var in zip(bounds, ('>=', upper), ('lower', 'upper')):
+        if bound is None:
+            continue
+        var = '{}_{}'.format(col_name, var)
+        condvars[var] = convert(bound, dtype) if convert is not None else int(bound)
+        conditions.append('({} {} {})'.format(col_name, op, var))
+    return conditions, condvars
+
+
+def _records_to_arrow(records:np.ndarray, step_key:str) -> 'pa.RecordBatch':
+    """
+    Convert a structured array of trial data from :meth:`.Subject.iter_trial_data` to a
+    :class:`pyarrow.RecordBatch` , adding ``step`` and ``step_name`` columns.
+
+    Numeric columns are passed to arrow without conversion (copied only if the
+    field isn't contiguous in the array), bytes columns are decoded as utf-8,
+    and multidimensional columns become fixed-size lists.
+    """
+    arrays, names = [], []
+    for name in records.dtype.names:
+        col = records[name]
+        if col.ndim > 1:
+            flat = pa.array(np.ascontiguousarray(col).reshape(-1))
+            array = pa.FixedSizeListArray.from_arrays(flat, int(np.prod(col.shape[1:])))
+        elif col.dtype.kind == 'S':
+            array = pa.array(col, type=pa.binary()).cast(pa.string())
+        else:
+            array = pa.array(col)
+        arrays.append(array)
+        names.append(name)
+
+    n_rows = records.shape[0]
+    arrays.append(pa.array(np.full(n_rows, int(step_key[1:3]), dtype=np.int32)))
+    names.append('step')
+    arrays.append(pa.array([step_key] * n_rows, type=pa.string()))
+    names.append('step_name')
+    return pa.RecordBatch.from_arrays(arrays, names=names)
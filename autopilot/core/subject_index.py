@@ -0,0 +1,229 @@
+"""
+An index of every :class:`.Subject` 's protocol, step, session, and number of trials,
+so they can be listed without opening each subject's hdf5 file.
+
+The index is a small sqlite database next to ``prefs.get('PILOT_DB')`` . :class:`.Subject`
+updates it whenever it changes any of these (assigning a protocol, changing step or params,
+starting a session, writing trials) and reads from it before falling back to the hdf5 file.
+
+Entries record the modification time and size of the subject's file when they were written,
+and entries for files that have changed since (eg. copied from elsewhere or written
+by an older version) are ignored.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import typing
+
+from autopilot import prefs
+from autopilot.core.handles import POOL
+from autopilot.core.loggers import init_logger
+
+INDEX_FN = 'subject_index.sqlite3'
+"""
+Filename of the index, in the same directory as ``prefs.get('PILOT_DB')``
+"""
+
+_COLUMNS = ('name', 'protocol_name', 'step', 'session', 'n_trials', 'current')
+
+
+class Subject_Index(object):
+    """
+    sqlite index of subject metadata, keyed by the absolute path of each subject's file.
+
+    Every method opens its own connection and commits before returning, so the index
+    can be used from any thread or process.
+
+    Args:
+        path (str): path to the database. If ``None`` , :data:`.INDEX_FN` in
+            the directory of ``prefs.get('PILOT_DB')`` , resolved when first used.
+    """
+
+    def __init__(self, path:typing.Optional[str]=None):
+        self._path = path
+        self._made = False
+        self._lock = threading.Lock()
+        self.logger = init_logger(self)
+
+    @property
+    def path(self) -> str:
+        if self._path is None:
+            self._path = os.path.join(os.path.dirname(prefs.get('PILOT_DB')), INDEX_FN)
+        return self._path
+
+    @path.setter
+    def path(self, path:str):
+        with self._lock:
+            self._path = path
+            self._made = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        if not self._made:
+            with self._lock, conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS subjects (
+                    file TEXT PRIMARY KEY,
+                    name TEXT,
+                    protocol_name TEXT,
+                    step INTEGER,
+                    session INTEGER,
+                    n_trials INTEGER,
+                    current TEXT,
+                    mtime_ns INTEGER,
+                    size INTEGER
+                )""")
+                self._made = True
+        return conn
+
+    @staticmethod
+    def _stat(file:str) -> typing.Tuple[int, int]:
+        stat = os.stat(file)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, file:str) -> typing.Optional[dict]:
+        """
+        Get a subject's metadata, if it's in the index and its file hasn't changed since.
+
+        Args:
+            file (str): path to the subject's .h5 file
+
+        Returns:
+            dict: with ``name`` , ``protocol_name`` , ``step`` , ``session`` , ``n_trials`` ,
+            and ``current`` (the protocol as a list of dicts), or ``None``
+        """
+        file = os.path.abspath(file)
+        try:
+            conn = self._connect()
+            try:
+                row = conn.execute('SELECT {}, mtime_ns, size FROM subjects WHERE file = ?'.format(
+                    ', '.join(_COLUMNS)), (file,)).fetchone()
+            finally:
+                conn.close()
+            if row is None or tuple(row[-2:]) != self._stat(file):
+                return None
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning('Could not read subject index {}, got exception {}'.format(self.path, e))
+            return None
+
+        entry = dict(zip(_COLUMNS, row[:-2]))
+        if entry['current'] is not None:
+            entry['current'] = json.loads(entry['current'])
+        return entry
+
+    def update(self, file:str, **fields):
+        """
+        Update (or add) a subject's entry, recording the current state of its file.
+
+        The file should be flushed before calling, so its modification time is final.
+
+        Args:
+            file (str): path to the subject's .h5 file
+            **fields: any of ``name`` , ``protocol_name`` , ``step`` , ``session`` , ``n_trials`` , or ``current``
+        """
+        file = os.path.abspath(file)
+        fields = {k: v for k, v in fields.items() if k in _COLUMNS}
+        if 'current' in fields.keys() and fields['current'] is not None:
+            fields['current'] = json.dumps(fields['current'])
+        for k in ('step', 'session', 'n_trials'):
+            if fields.get(k) is not None:
+                fields[k] = int(fields[k])
+
+        try:
+            fields['mtime_ns'], fields['size'] = self._stat(file)
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('INSERT OR IGNORE INTO subjects (file) VALUES (?)', (file,))
+                    conn.execute('UPDATE subjects SET {} WHERE file = ?'.format(
+                        ', '.join('{} = ?'.format(k) for k in fields.keys())),
+                        (*fields.values(), file))
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning('Could not update subject index {}, got exception {}'.format(self.path, e))
+
+    def closed(self, file:str, stat:os.stat_result):
+        """
+        Keep an entry current when its file is closed, since closing an hdf5 file writes to it.
+        Only entries that were current just before the file was closed are updated.
+
+        Args:
+            file (str): path to the subject's .h5 file
+            stat (:class:`os.stat_result`): stat of the file from before it was closed
+        """
+        try:
+            mtime_ns, size = self._stat(file)
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('UPDATE subjects SET mtime_ns = ?, size = ? '
+                                 'WHERE file = ? AND mtime_ns = ? AND size = ?',
+                                 (mtime_ns, size, os.path.abspath(file), stat.st_mtime_ns, stat.st_size))
+            finally:
+                conn.close()
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning('Could not update subject index {}, got exception {}'.format(self.path, e))
+
+    def remove(self, file:str):
+        """
+        Remove a subject's entry
+
+        Args:
+            file (str): path to the subject's .h5 file
+        """
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute('DELETE FROM subjects WHERE file = ?', (os.path.abspath(file),))
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self.logger.warning('Could not update subject index {}, got exception {}'.format(self.path, e))
+
+    def subjects(self, dir:typing.Optional[str]=None) -> typing.Dict[str, dict]:
+        """
+        Every subject in the index whose entry is current, without their protocols
+
+        Args:
+            dir (str): only subjects with files in this directory
+
+        Returns:
+            dict: ``{file: {'name', 'protocol_name', 'step', 'session', 'n_trials'}}``
+        """
+        try:
+            conn = self._connect()
+            try:
+                rows = conn.execute('SELECT file, {}, mtime_ns, size FROM subjects'.format(
+                    ', '.join(_COLUMNS[:-1]))).fetchall()
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self.logger.warning('Could not read subject index {}, got exception {}'.format(self.path, e))
+            return {}
+
+        if dir is not None:
+            dir = os.path.abspath(dir)
+
+        subjects = {}
+        for row in rows:
+            file = row[0]
+            if dir is not None and os.path.dirname(file) != dir:
+                continue
+            try:
+                if tuple(row[-2:]) != self._stat(file):
+                    continue
+            except OSError:
+                continue
+            subjects[file] = dict(zip(_COLUMNS[:-1], row[1:-2]))
+        return subjects
+
+
+INDEX = Subject_Index()
+"""
+The :class:`.Subject_Index` used by :class:`.Subject`
+"""
+
+POOL.on_close.append(INDEX.closed)
@@ -44,6 +44,7 @@ if __name__ == '__main__':
 from autopilot.core.subject import Subject
 from autopilot.core.plots import Plot_Widget
 from autopilot.networking import Net_Node, Terminal_Station
+from autopilot.networking.backlog import Seen_Ids
 from autopilot.utils.invoker import get_invoker
 from autopilot.core.gui import Control_Panel, Protocol_Wizard, Weights, Reassign, Calibrate_Water, Bandwidth_Test, pop_dialog, Stream_Video, Plugins
 from autopilot.core.loggers import init_logger
@@ -133,6 +134,9 @@ class Terminal(QtWidgets.QMainWindow):
 
         # data
         self.subjects = {}  # Dict of our open subject objects
+        self.pilot_seq = {} # seq of the last row of trial data received from each pilot
+        self.pilot_rows = Seen_Ids() # seqs of finished rows received from each pilot, as '{pilot}_{seq}'
+        self._data_lock = threading.Lock()
 
         # gui
         self.layout = None
@@ -157,7 +161,8 @@ class Terminal(QtWidgets.QMainWindow):
             'DATA' : self.l_data,
             'CONTINUOUS': self.l_data, # handle continuous data same way as other data
             'STREAM': self.l_data,
-            'HANDSHAKE': self.l_handshake # a pi is making first contact, telling us its IP
+            'HANDSHAKE': self.l_handshake, # a pi is making first contact, telling us its IP
+            'ROWS': self.l_rows # a pi is sending rows of trial data we missed
         }
 
         # Make invoker object to send GUI events back to the main thread
@@ -584,9 +589,39 @@ class Terminal(QtWidgets.QMainWindow):
         If the subject graduates after receiving this piece of data, stop the current
         task running on the Pilot and send the new one.
 
+        Data that the pilot couldn't send while we were unreachable is sent later as a list
+        of values in ``batch`` (see :meth:`.Pilot_Station.replay` ).
+
+        Trial data has the ``seq`` of the row the pilot stores it as, and if rows were skipped
+        (eg. during a network outage) we ask the pilot for them (see :meth:`.l_rows` ).
+
         Args:
             value (dict): A dict of field-value pairs to save
         """
+        # data a pilot stored while we were unreachable comes as a batch
+        if 'batch' in value.keys():
+            stopped = {}
+            for data in value['batch']:
+                if 'subject' in data.keys() and not self._resume_subject(data['subject']):
+                    stopped.setdefault(data['subject'], []).append(data)
+                    continue
+                self.l_data(data)
+            # data for subjects that were stopped is saved without starting them again
+            for subject_name, batch in stopped.items():
+                self.subjects[subject_name].save_backlog(batch)
+            return
+
+        if 'seq' in value.keys():
+            if not self._check_seq(value['pilot'], int(value['seq']), 'TRIAL_END' in value.keys()):
+                # the row was already recovered with ROWS
+                return
+
+        self._save_data(value)
+
+    def _save_data(self, value:dict):
+        """
+        Save data in its subject's file, and if the subject graduated, start its next step
+        """
         # A Pi has sent us data, let's save it huh?
         subject_name = value['subject']
         self.subjects[subject_name].save_data(value)
@@ -602,6 +637,104 @@ class Terminal(QtWidgets.QMainWindow):
 
             self.node.send(to=value['pilot'], key="START", value=task)
 
+    def l_rows(self, value):
+        """
+        A Pilot has sent rows of trial data from its :class:`.Segment_Store` that we missed
+        (see :meth:`.Pilot.l_rows` ).
+
+        Each row that we haven't already received is saved as if it had been sent as ``DATA`` ,
+        ending its trial unless the run was stopped before the trial finished.
+        Rows for subjects that aren't running are left in the pilot's store.
+        If the pilot has more rows, ask for them.
+
+        Args:
+            value (dict): ``pilot`` , list of ``rows`` , and whether there are ``more``
+        """
+        pilot = value['pilot']
+        rows = value.get('rows', [])
+        n_saved = 0
+        for row in rows:
+            subject = self.subjects.get(row['subject'])
+            if subject is None or not subject.running:
+                self.logger.warning('Got missed rows for {}, which is not running, not saving them'.format(row['subject']))
+                continue
+            with self._data_lock:
+                if not self.pilot_rows.add('{}_{}'.format(pilot, row['seq'])):
+                    # received live after all
+                    continue
+            data = dict(row['data'], pilot=pilot, subject=row['subject'], seq=row['seq'])
+            if row.get('finished', True):
+                data['TRIAL_END'] = True
+            self._save_data(data)
+            n_saved += 1
+
+        self.logger.info('Recovered {} rows of trial data from {}'.format(n_saved, pilot))
+        if value.get('more') and len(rows) > 0:
+            self.node.send(to=pilot, key='ROWS', value={'since': rows[-1]['seq']})
+
+    def _resume_subject(self, subject_name:str) -> bool:
+        """
+        Start storing data for a subject whose pilot kept running while we couldn't be reached
+        (eg. because the terminal crashed), as a new session.
+
+        Only subjects whose last run was never stopped (see :attr:`.Subject.was_running` )
+        are resumed, the run of a subject that was stopped isn't started again.
+
+        Args:
+            subject_name (str): the subject's name
+
+        Returns:
+            bool: whether the subject is running
+        """
+        with self._data_lock:
+            if subject_name not in self.subjects.keys():
+                self.subjects[subject_name] = Subject(subject_name)
+            subject = self.subjects[subject_name]
+            if subject.running:
+                return True
+            if not subject.was_running:
+                return False
+            self.logger.info('Got data for {}, whose run was never stopped, resuming its run'.format(subject_name))
+            subject.prepare_run()
+            return True
+
+    def _check_seq(self, pilot:str, seq:int, trial_end:bool) -> bool:
+        """
+        Ask a pilot for rows of trial data we missed if ``seq`` skips any,
+        and keep track of the rows we've received.
+
+        Args:
+            pilot (str): the pilot that sent data
+            seq (int): the row the data is for
+            trial_end (bool): whether the data finishes the row
+
+        Returns:
+            bool: ``False`` if the row was already received, and the data shouldn't be saved
+        """
+        row_id = '{}_{}'.format(pilot, seq)
+        with self._data_lock:
+            if row_id in self.pilot_rows:
+                return False
+            last = self.pilot_seq.get(pilot, seq - 1)
+            if seq > last + 1:
+                self.logger.warning('Missed rows {} to {} from {}, asking for them'.format(last + 1, seq - 1, pilot))
+                self.node.send(to=pilot, key='ROWS', value={'since': self._received_through(pilot, last)})
+                last = seq - 1
+            if trial_end:
+                last = max(last, seq)
+                self.pilot_rows.add(row_id)
+            self.pilot_seq[pilot] = last
+        return True
+
+    def _received_through(self, pilot:str, default:int) -> int:
+        """
+        The last seq from a pilot that every row up to has been received, call with ``_data_lock`` held
+        """
+        ranges = self.pilot_rows.ranges.get(pilot)
+        if not ranges:
+            return default
+        return ranges[0][1]
+
     def l_ping(self, value):
         """
         TODO:
@@ -669,6 +802,14 @@ class Terminal(QtWidgets.QMainWindow):
 
         self.control_panel.update_db()
 
+        # if the pilot restarted, get any rows it stored that we didn't receive
+        with self._data_lock:
+            last = self.pilot_seq.get(value['pilot'])
+            if last is not None:
+                last = self._received_through(value['pilot'], last)
+        if last is not None:
+            self.node.send(to=value['pilot'], key='ROWS', value={'since': last})
+
     #############################
     # GUI & etc. methods
 
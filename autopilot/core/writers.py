@@ -0,0 +1,498 @@
+"""
+Write data to a :class:`.Subject` 's hdf5 file in batches rather than a row at a time.
+
+* :class:`.Trial_Writer` collects trial data until each trial is finished and
+  appends finished trials to the trial table together, flushing the table
+  once enough trials have accumulated or enough time has passed. Everything it's given
+  is first written to a journal, so nothing is lost if the terminal dies between flushes.
+* :class:`.Continuous_Writer` copies samples of continuous data into preallocated
+  arrays and appends them to their tables a chunk at a time.
+
+Timestamps are stored in whatever format they're given in (see :mod:`.timestamps` ),
+except that isoformatted timestamps given for an integer timestamp column are converted
+to nanoseconds (and vice versa), so a terminal and pilot set to different formats still agree.
+"""
+
+import json
+import os
+import time
+import typing
+
+import numpy as np
+import tables
+
+from autopilot.core.loggers import init_logger
+from autopilot.utils import timestamps
+
+
+def _json_default(obj):
+    # numpy scalars and arrays in trial data
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    return str(obj)
+
+
+class Trial_Writer(object):
+    """
+    Write-behind buffer for a trial table.
+
+    Data for each trial is given as one or more dicts (see :meth:`.Subject.data_thread` ).
+    Dicts are merged by their ``trial_num`` until one with ``TRIAL_END`` finishes the trial,
+    and finished trials are appended to the table by :meth:`.flush` , either when
+    ``flush_rows`` trials are waiting or ``flush_interval`` seconds have passed.
+
+    Rows are found by an in-memory ``trial_num -> row`` index rather than searching
+    the table, so data for a trial that has already been written updates its row in place.
+
+    Each dict is also appended to a journal file (as a line of JSON) before it's buffered.
+    The journal is emptied whenever the table is flushed, and if one is left behind
+    by a crash it's replayed the next time a writer is made for the same file.
+
+    Not thread-safe, use from the thread that has the hdf5 file open.
+
+    Args:
+        table (:class:`tables.Table`): trial table to write to
+        session (int): session number to write in each row
+        journal (str): path to the journal file, or ``None`` to not keep one
+        flush_rows (int): flush once this many trials are finished
+        flush_interval (float): flush if any trials have been waiting this many seconds
+
+    Attributes:
+        index (dict): ``trial_num -> row number`` of rows written by this writer
+        pending (dict): ``trial_num -> row dict`` of trials that haven't been written yet
+        replayed (list): dicts recovered from a journal left by a crash, as they were given to :meth:`.add`
+    """
+
+    def __init__(self, table:tables.Table, session:int, journal:typing.Optional[str]=None,
+                 flush_rows:int=64, flush_interval:float=5.0):
+        self.table = table
+        self.session = int(session)
+        self.journal_path = journal
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.logger = init_logger(self)
+
+        self.colnames = set(table.colnames)
+        self._ts_cols = {name: table.coldtypes[name] for name in table.colnames if 'timestamp' in name}
+        self.index = {} # type: typing.Dict[int, int]
+        self.pending = {} # type: typing.Dict[int, dict]
+        self._finished = set()
+        self._current = None # trial_num of the most recent data
+        self._last_flush = time.monotonic()
+        self._journal = None
+        self.replayed = [] # type: typing.List[dict]
+
+        if journal is not None:
+            if os.path.exists(journal):
+                self._replay_journal()
+            self._reset_journal()
+
+    def add(self, data:dict) -> typing.Optional[dict]:
+        """
+        Add (partial) data for a trial.
+
+        Data without a ``trial_num`` is added to the most recent trial.
+        Keys that aren't columns in the table are ignored.
+
+        Args:
+            data (dict): trial data
+
+        Returns:
+            dict: the trial's row, if ``data`` had ``TRIAL_END`` , otherwise ``None``
+        """
+        if self._journal is not None:
+            self._journal.write(json.dumps(data, default=_json_default) + '\n')
+            self._journal.flush()
+        return self._add(data)
+
+    def _add(self, data:dict) -> typing.Optional[dict]:
+        trial_num = data.get('trial_num', self._current)
+        if trial_num is None:
+            trial_num = 0
+        trial_num = int(trial_num)
+        self._current = trial_num
+
+        values = {k: v for k, v in data.items() if k in self.colnames}
+        values['trial_num'] = trial_num
+        for k in self._ts_cols.keys() & values.keys():
+            try:
+                values[k] = timestamps.to_column(values[k], self._ts_cols[k])
+            except (ValueError, TypeError):
+                pass
+
+        if trial_num in self.index:
+            # already written, update the row where it is
+            self._update_row(self.index[trial_num], values)
+            row = values
+        else:
+            row = self.pending.setdefault(trial_num, {})
+            row.update(values)
+
+        if 'TRIAL_END' in data.keys():
+            row['session'] = self.session
+            self._finished.add(trial_num)
+            return row
+        return None
+
+    def index_rows(self, start:int=0):
+        """
+        Add rows already in the table (eg. written before a crash) to the :attr:`.index` ,
+        so data for their trials updates them rather than adding them again.
+
+        Args:
+            start (int): first row to index
+        """
+        trial_nums = self.table.col('trial_num')[start:]
+        for i, trial_num in enumerate(trial_nums):
+            self.index[int(trial_num)] = start + i
+
+    def _update_row(self, row_n:int, values:dict):
+        row = self.table.read(start=row_n, stop=row_n + 1)
+        for k, v in values.items():
+            try:
+                row[k] = v
+            except (KeyError, ValueError, TypeError):
+                self.logger.warning('Data dropped: key: {}, value: {}'.format(k, v))
+        self.table.modify_rows(start=row_n, stop=row_n + 1, rows=row)
+
+    @property
+    def due(self) -> bool:
+        """
+        Returns:
+            bool: whether :meth:`.flush` should be called
+        """
+        if len(self._finished) >= self.flush_rows:
+            return True
+        return bool(self.pending) and self.time_to_flush() == 0
+
+    def time_to_flush(self) -> typing.Optional[float]:
+        """
+        Returns:
+            float: seconds until waiting trials should be flushed, or ``None`` if there are none
+        """
+        if not self.pending:
+            return None
+        return max(self.flush_interval - (time.monotonic() - self._last_flush), 0.0)
+
+    def flush(self, all:bool=False):
+        """
+        Append waiting trials to the table and flush it.
+
+        Finished trials are always written. Unfinished trials are written if a later trial
+        has already started (they won't get a ``TRIAL_END`` , but later data for them
+        still updates their row) or if ``all`` is ``True`` .
+
+        Args:
+            all (bool): also write the most recent trial even if it isn't finished
+        """
+        write = [trial_num for trial_num in self.pending.keys()
+                 if all or trial_num in self._finished or trial_num != self._current]
+
+        if write:
+            rows = np.zeros(len(write), dtype=self.table.dtype)
+            for name, default in self.table.coldflts.items():
+                if name in rows.dtype.names:
+                    rows[name] = default
+
+            for i, trial_num in enumerate(write):
+                row = self.pending.pop(trial_num)
+                row.setdefault('session', self.session)
+                for k, v in row.items():
+                    try:
+                        rows[k][i] = v
+                    except (KeyError, ValueError, TypeError):
+                        self.logger.warning('Data dropped: key: {}, value: {}'.format(k, v))
+                self.index[trial_num] = self.table.nrows + i
+                self._finished.discard(trial_num)
+
+            self.table.append(rows)
+
+        self.table.flush()
+        self._last_flush = time.monotonic()
+        self._reset_journal()
+
+    def close(self):
+        """
+        Write everything that's waiting and remove the journal.
+        """
+        self.flush(all=True)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            os.remove(self.journal_path)
+
+    def _reset_journal(self):
+        """
+        Start the journal over, after everything in it has been flushed to the table.
+
+        The first line records which table and row the journal starts at,
+        so rows flushed after it was started can be found when replaying,
+        followed by any trials that are still waiting to be written.
+        """
+        if self.journal_path is None:
+            return
+        if self._journal is not None:
+            self._journal.close()
+
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as journal:
+            journal.write(json.dumps({
+                'table': self.table._v_pathname,
+                'session': self.session,
+                'start_row': int(self.table.nrows)
+            }) + '\n')
+            for row in self.pending.values():
+                journal.write(json.dumps(row, default=_json_default) + '\n')
+        os.replace(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'a')
+
+    def _replay_journal(self):
+        with open(self.journal_path, 'r') as journal:
+            lines = journal.read().splitlines()
+        if not lines:
+            return
+
+        try:
+            header = json.loads(lines[0])
+            entries = []
+            for line in lines[1:]:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line may have been cut off
+                    self.logger.warning('Skipping incomplete line in trial journal: {}'.format(line))
+        except (json.JSONDecodeError, KeyError) as e:
+            self.logger.exception('Could not read trial journal {}, got exception {}'.format(self.journal_path, e))
+            return
+
+        if not entries:
+            return
+
+        if header['table'] == self.table._v_pathname:
+            writer = self
+        else:
+            # left over from a different step
+            writer = Trial_Writer(self.table._v_file.get_node(header['table']), header['session'])
+
+        # rows that were flushed after the journal was started are updated rather than added again
+        writer.index_rows(header['start_row'])
+
+        writer.session, session = header['session'], writer.session
+        for entry in entries:
+            writer._add(entry)
+        writer.flush(all=True)
+        writer.session = session
+        self.replayed = entries
+
+        self.logger.info('Recovered {} entries from trial journal {}'.format(len(entries), self.journal_path))
+
+
+def _col_dtype(value) -> np.dtype:
+    """
+    dtype of a column that can hold ``value`` , with str stored as bytes
+    """
+    arr = np.asarray(value)
+    if arr.dtype.kind == 'U':
+        # tables stores bytes, and give strings some room to vary in length
+        return np.dtype((np.dtype('S{}'.format(max(arr.dtype.itemsize // 4, 32))), arr.shape))
+    if arr.dtype.kind == 'O':
+        raise ValueError('Cannot store value {} of type {} as continuous data'.format(value, type(value)))
+    return np.dtype((arr.dtype, arr.shape))
+
+
+class _Continuous_Buffer(object):
+    """
+    Samples of one continuous data stream waiting to be appended to its table.
+    """
+    __slots__ = ('name', 'table', 'buffer', 'n', 'oldest', 'started', 'early')
+
+    def __init__(self, name):
+        self.name = name
+        self.table = None # type: typing.Optional[tables.Table]
+        self.buffer = None # type: typing.Optional[np.ndarray]
+        self.n = 0
+        self.oldest = None # monotonic time of the oldest sample in the buffer
+        self.started = time.monotonic()
+        self.early = [] # (value, timestamp) received before the table was made
+
+
+class Continuous_Writer(object):
+    """
+    Write continuous data to a session's group a chunk at a time.
+
+    Each stream of continuous data gets its own table with a column for the data and
+    a column for its ``timestamp`` (as in :meth:`.Subject.data_thread` ). Rather than
+    appending each sample as a row, samples are copied into a preallocated
+    numpy buffer and the buffer is appended with one :meth:`tables.Table.append`
+    when it's full.
+
+    The size of the buffer (and the chunk shape of the table) is chosen from the rate of each stream:
+    samples are held for ``flush_interval`` seconds before the table is made, and the buffer
+    holds as many samples as arrive in ``flush_interval`` seconds at that rate, between ``min_rows``
+    and ``max_chunk_bytes`` . No sample waits in a buffer longer than ``flush_interval`` seconds.
+
+    Not thread-safe, use from the thread that has the hdf5 file open.
+
+    Args:
+        group (:class:`tables.Group`): session group to make tables in
+        names (tuple): names of continuous data streams to write, others are ignored
+        filters (:class:`tables.Filters`): compression filters for the tables
+        flush_interval (float): longest time (s) samples are buffered before being written
+        min_rows (int): smallest buffer size
+        max_chunk_bytes (int): largest buffer size, in bytes
+        index (bool): index the ``timestamp`` column of each table, so
+            :meth:`.Subject.get_continuous_data` can select by time without reading it all
+
+    Attributes:
+        buffers (dict): ``name -> _Continuous_Buffer``
+        rejected (set): names of streams whose values can't be stored in a table, which are dropped
+    """
+
+    def __init__(self, group:tables.Group, names:typing.Iterable[str],
+                 filters:typing.Optional[tables.Filters]=None,
+                 flush_interval:float=1.0, min_rows:int=64, max_chunk_bytes:int=2**20,
+                 index:bool=True):
+        self.group = group
+        self.names = set(names)
+        self.filters = filters
+        self.flush_interval = flush_interval
+        self.min_rows = min_rows
+        self.max_chunk_bytes = max_chunk_bytes
+        self.index = index
+        self.logger = init_logger(self)
+
+        self.buffers = {} # type: typing.Dict[str, _Continuous_Buffer]
+        self.rejected = set() # type: typing.Set[str]
+
+        # continue tables made earlier in the session
+        for table in group._f_iter_nodes('Table'):
+            if table.name in self.names:
+                buf = _Continuous_Buffer(table.name)
+                buf.table = table
+                buf.buffer = np.zeros(table.chunkshape[0], dtype=table.dtype)
+                self.buffers[table.name] = buf
+
+    def add(self, data:dict):
+        """
+        Add a sample of each stream in ``data`` , which should have a ``timestamp``
+
+        Args:
+            data (dict): continuous data, eg. ``{'continuous': True, 'timestamp': ..., 'wheel': ...}``
+        """
+        try:
+            timestamp = data['timestamp']
+        except KeyError:
+            self.logger.warning('no timestamp sent with continuous data')
+            return
+
+        now = time.monotonic()
+        for name, value in data.items():
+            if name not in self.names or name == 'timestamp' or name in self.rejected:
+                # every stream stores the timestamp with its samples
+                continue
+
+            buf = self.buffers.get(name)
+            if buf is None:
+                buf = _Continuous_Buffer(name)
+                self.buffers[name] = buf
+
+            if buf.oldest is None:
+                buf.oldest = now
+
+            if buf.table is None:
+                buf.early.append((value, timestamp))
+                if now - buf.started >= self.flush_interval:
+                    self._make_table(buf)
+                continue
+
+            row = buf.buffer[buf.n]
+            try:
+                row[name] = value
+                row['timestamp'] = timestamp
+            except (ValueError, TypeError):
+                self.logger.warning('Data dropped: key: {}, value: {}'.format(name, value))
+                continue
+            buf.n += 1
+            if buf.n == len(buf.buffer):
+                self._write(buf)
+
+    def _make_table(self, buf:_Continuous_Buffer):
+        """
+        Make a buffer's table, sized from the rate its early samples arrived at, and write them.
+        """
+        value, timestamp = buf.early[0]
+        try:
+            dtype = np.dtype([(buf.name, _col_dtype(value)), ('timestamp', _col_dtype(timestamp))])
+        except ValueError as e:
+            # drop the stream rather than try to make its table again with every flush
+            self.logger.exception('Dropping continuous data {}, got exception {}'.format(buf.name, e))
+            self.rejected.add(buf.name)
+            buf.early = []
+            buf.oldest = None
+            return
+
+        rate = len(buf.early) / max(time.monotonic() - buf.started, 1e-3)
+        rows = int(np.clip(rate * self.flush_interval, self.min_rows,
+                           max(self.max_chunk_bytes // dtype.itemsize, 1)))
+
+        buf.table = self.group._v_file.create_table(
+            self.group, buf.name, description=dtype, filters=self.filters,
+            chunkshape=(rows,), expectedrows=int(rate * 3600))
+        if self.index:
+            buf.table.cols.timestamp.create_index()
+        buf.buffer = np.zeros(rows, dtype=dtype)
+
+        early, buf.early = buf.early, []
+        for i in range(0, len(early), rows):
+            block = early[i:i + rows]
+            for j, (value, timestamp) in enumerate(block):
+                try:
+                    buf.buffer[j] = (value, timestamp)
+                except (ValueError, TypeError):
+                    self.logger.warning('Data dropped: key: {}, value: {}'.format(buf.name, value))
+            buf.n = len(block)
+            if buf.n == rows:
+                self._write(buf)
+
+    def _write(self, buf:_Continuous_Buffer):
+        if buf.n > 0:
+            buf.table.append(buf.buffer[:buf.n])
+        buf.n = 0
+        buf.oldest = None
+
+    def time_to_flush(self) -> typing.Optional[float]:
+        """
+        Returns:
+            float: seconds until the oldest buffered sample should be written, or ``None`` if nothing is buffered
+        """
+        oldest = [buf.oldest for buf in self.buffers.values() if buf.oldest is not None]
+        if not oldest:
+            return None
+        return max(self.flush_interval - (time.monotonic() - min(oldest)), 0.0)
+
+    def flush(self, all:bool=False):
+        """
+        Write buffers whose oldest sample has waited ``flush_interval`` seconds
+
+        Args:
+            all (bool): write every buffer, even if it hasn't waited long enough
+        """
+        now = time.monotonic()
+        for buf in self.buffers.values():
+            if buf.oldest is None:
+                continue
+            if all or now - buf.oldest >= self.flush_interval:
+                if buf.table is None:
+                    self._make_table(buf)
+                    if buf.table is None:
+                        continue
+                self._write(buf)
+                buf.table.flush()
+
+    def close(self):
+        """
+        Write everything that's buffered
+        """
+        self.flush(all=True)
@@ -43,6 +43,10 @@ except:
 
 from autopilot import prefs
 from autopilot.hardware import Hardware
+from autopilot.hardware.encoders import check_encoder, get_encoder, select_encoder
+from autopilot.hardware.frame_store import Frame_Store_Writer, Transcoder
+from autopilot.hardware.frames import Frame, Frame_Ring, Shared_Frame_Ring
+from autopilot.utils import timestamps
 
 OPENCV_LAST_INIT_TIME = mp.Value('d', 0.0)
 """
@@ -101,6 +105,7 @@ class Camera(Hardware):
         timed (bool, int, float): If False (default), camera captures indefinitely. If int or float, captures for this many seconds
         q (Queue): Queue that allows frames to be pulled by other objects
         queue_size (int): How many frames should be buffered in the queue.
+        dropped (dict): Number of frames dropped by each consumer, see :attr:`.Camera.dropped`
         initialized (threading.Event): Called in :meth:`~.init_cam` to indicate the camera has been initialized
         stopping (threading.Event): Called to signal that capturing should stop. when set, ends the threaded capture loop
         capturing (threading.Event): Set when camera is actively capturing
@@ -114,6 +119,7 @@ class Camera(Hardware):
     input = True #: test documenting input
     type = "CAMERA" #: (str): what are we anyway?
     trigger = False
+    ring_size = 32 #: (int): number of frames preallocated in the :class:`.Frame_Ring` shared by streaming, writing, and queueing
 
     def __init__(self, fps=None, timed=False, crop=None, rotate:int=0, **kwargs):
         """
@@ -132,9 +138,18 @@ class Camera(Hardware):
         self._output_filename = None
         self._capture_thread = None
         self._writer = None
-        self._write_q = None
+        self._write_timestamps = True
+        self._write_encoder = 'auto'
+        self._write_encoder_kwargs = None
+        self._write_transcode = None
+        self.transcoder = None
         self._stream_q = None
         self._indicator = None
+        self._ring = Frame_Ring(self.ring_size)
+        self._stream_frames = None
+        self._write_frames = None
+        self._pumps = {} # type: typing.Dict[str, threading.Thread]
+        self._pumps_lock = threading.Lock()
         self._resolution = None
 
         self.frame = None
@@ -222,10 +237,13 @@ class Camera(Hardware):
         * :meth:`~.Camera.capture_deinit` - any required routine to stop acquisition but not release the camera instance.
         """
 
+        # open the ring before capturing is set, so consumers added meanwhile start their pumps on an open ring
+        self._ring.open()
         self.capturing.set()
         self.stopping.clear()
 
         self.capture_init()
+        self._start_pumps()
 
         if self.streaming.is_set():
             self.node.send(key='STATE', value='CAPTURING')
@@ -249,6 +267,14 @@ class Camera(Hardware):
         finally:
             self.logger.info('Capture Ending')
 
+            # consumers finish the frames they have, then stop
+            self._ring.close()
+            self._stop_pumps()
+
+            dropped = {name: n for name, n in self.dropped.items() if n > 0}
+            if dropped:
+                self.logger.warning('Dropped frames while capturing: {}'.format(dropped))
+
             try:
                 if self.streaming.is_set():
                     self.node.send(key='STATE', value='STOPPING')
@@ -278,8 +304,10 @@ class Camera(Hardware):
         """
         A full frame capture cycle.
 
-        :meth:`~Camera._grab`s the :attr:`.frame`, then handles streaming, writing, queueing, and indicating
-        according to :meth:`~Camera.stream`, :meth:`~Camera.write`, :meth:`~Camera.queue`, and :attr:`~Camera.indicating`, respectively.
+        :meth:`~Camera._grab`s the :attr:`.frame`, then puts it in the :class:`.Frame_Ring` once, from which
+        it is streamed, written, and queued according to :meth:`~Camera.stream`, :meth:`~Camera.write`,
+        and :meth:`~Camera.queue` by their own threads (see :meth:`._start_pumps` ), and handles
+        indicating according to :attr:`~Camera.indicating`.
 
         """
 
@@ -287,26 +315,17 @@ class Camera(Hardware):
             self.frame = self._grab()
         except Exception as e:
             self.logger.exception(e)
+            return
 
-        if self.streaming.is_set():
-            try:
-                self._stream_q.append({'timestamp': self.frame[0],
-                                           self.name  : self.frame[1]})
-            except Full:
-                self.logger.exception(f"queue was full for frame captured at {self.frame[0]}")
-
-        if self.writing.is_set():
-            self._write_frame()
-
-        if self.queueing.is_set():
-            self.q.put_nowait(self.frame)
+        self._ring.put(self.frame[0], self.frame[1])
 
         if self.indicating.is_set():
             if not self._indicator:
                 self._indicator = tqdm()
             self._indicator.update()
 
-    def stream(self, to='T', ip=None, port=None, min_size=5, **kwargs):
+    def stream(self, to='T', ip=None, port=None, min_size=5, batch_bytes=None, max_latency=None,
+               policy='latest', **kwargs):
         """
         Enable streaming frames on capture.
 
@@ -321,6 +340,10 @@ class Camera(Hardware):
             port (int, str): Port of recipient socket. If None (default), ``prefs.get('MSGPORT')``. If None and ``to`` is 'T', ``prefs.get('TERMINALPORT')``.
             min_size (int): Number of frames to collect before sending (default: 5). use 1 to send frames as soon as they are available,
                 sacrificing the efficiency from compressing multiple frames together
+            batch_bytes (int): Send frames once they are at least this many bytes, even if fewer than ``min_size``
+            max_latency (float): Send frames once the first has waited this many seconds, even if fewer than ``min_size``
+            policy (str): What to do with frames when streaming falls behind capture, one of :data:`.frames.POLICIES`.
+                Default ``'latest'`` -- only stream the most recent frame.
             **kwargs: passed to :meth:`.Hardware.init_networking` and thus to :class:`.Net_Node`
 
         """
@@ -358,10 +381,15 @@ class Camera(Hardware):
         self._stream_q = self.node.get_stream(
             'stream', 'CONTINUOUS', upstream=to,
             ip=ip, port=port, subject=subject,
-            min_size=min_size
+            min_size=min_size, batch_bytes=batch_bytes,
+            max_latency=max_latency
         )
+        self._stream_frames = self._ring.subscribe('stream', policy=policy)
 
         self.streaming.set()
+        if self.capturing.is_set():
+            # nothing would take frames from the ring otherwise
+            self._start_pump('stream')
 
     def l_start(self, val):
         """
@@ -383,74 +411,217 @@ class Camera(Hardware):
 
 
 
-    def write(self, output_filename = None, timestamps=True, blosc=True):
+    def write(self, output_filename = None, timestamps=True, blosc=True, policy='block',
+              encoder='auto', encoder_kwargs=None, transcode=None):
         """
         Enable writing frames locally on capture
 
-        Spawns a :class:`.Video_Writer` to encode video, sets :attr:`.writing`
+        Sets :attr:`.writing` , and a :class:`.Video_Writer` is spawned to encode video
+        when the first frame is captured (once the shape of frames is known).
+
+        With ``encoder='auto'`` , the encoder is picked by measuring which can keep up with :attr:`.fps`
+        (see :func:`.encoders.select_encoder` ), which takes a few seconds the first time
+        a camera's frames are written, while frames wait according to ``policy`` .
+
+        With ``encoder='raw'`` (or if ``'auto'`` picks it), frames aren't encoded, but copied into a
+        :class:`.frame_store.Frame_Store_Writer` by the writing thread, and if ``transcode`` is given,
+        encoded by a :class:`.frame_store.Transcoder` in the background after capture ends
+        (see :attr:`.transcoder` ).
 
         Args:
-            output_filename (str): path and filename of the output video. extension should be ``.mp4``,
-                as videos are encoded with libx264 by default.
-            timestamps (bool): if True, (timestamp, frame) tuples will be put in the :attr:`._write_q`.
+            output_filename (str): path and filename of the output video. its extension
+                is replaced with the encoder's, eg. ``.mp4`` for ``'x264'`` and ``.mkv`` for ``'ffv1'``
+            timestamps (bool): if True, frames are written with the timestamps from :meth:`._timestamp` .
                 if False, timestamps will be generated by :class:`.Video_Writer` (not recommended at all).
-            blosc (bool): if true, compress frames with :func:`blosc.pack_array` before putting in :attr:`._write_q`.
-        """
+            blosc (bool): Not used, frames are passed to the :class:`.Video_Writer` through shared memory.
+            policy (str): What to do with frames when writing falls behind capture, one of :data:`.frames.POLICIES`.
+                Default ``'block'`` -- make capture wait rather than drop frames from the video.
+            encoder (str): name of an encoder in :data:`.encoders.ENCODERS` , or ``'auto'`` (default)
+            encoder_kwargs (dict): keyword arguments for encoders, by name, eg. ``{'x264': {'preset': 'fast'}}``
+            transcode (str): name of an encoder to encode raw frames with after capture
+        """
+        if encoder != 'auto':
+            # raise now rather than when capturing
+            check_encoder(encoder)
+        if transcode is not None:
+            check_encoder(transcode)
+
         if output_filename is None:
             output_filename = self.output_filename
         else:
             self._output_filename = output_filename
 
         self.blosc = blosc
-        self._write_q = mp.Queue()
-        self.writer = Video_Writer(self._write_q, output_filename, self.fps, timestamps=timestamps, blosc=blosc)
-        self.writer.start()
+        self._write_timestamps = timestamps
+        self._write_encoder = encoder
+        self._write_encoder_kwargs = encoder_kwargs
+        self._write_transcode = transcode
+        self.writer = None
+        self._write_frames = self._ring.subscribe('write', policy=policy)
         self.writing.set()
+        if self.capturing.is_set():
+            # nothing would take frames from the ring otherwise
+            self._start_pump('write')
         self.logger.info('Writing initialized, writing to {}'.format(output_filename))
 
-    def _write_frame(self):
+    def _write_frame(self, frame:Frame):
         """
-        Put :attr:`.frame` into the :attr:`._write_q`, optionally compressing it with :func:`blosc.pack_array`
+        Copy a frame into the :class:`.Video_Writer` 's shared memory (or the :class:`.Frame_Store_Writer` ),
+        starting the writer with the first frame.
+
+        Called by the writing thread started in :meth:`._start_pumps` for each frame from the :class:`.Frame_Ring` ,
+        and blocks while the writer is behind, so frames back up in the ring according to the ``policy``
+        given to :meth:`.write` .
+
+        Args:
+            frame (:class:`.Frame`): the frame to write, released by the caller
         """
-        try:
-            if self.blosc:
-                self._write_q.put_nowait((self.frame[0], blosc.pack_array(self.frame[1])))
-            else:
-                self._write_q.put_nowait(self.frame)
-        except Full:
-            self.logger.exception('Frame {} could not be written, queue full'.format(self.frame_n))
+        if self.writer is None:
+            self.writer = self._init_writer(frame.array.shape, frame.array.dtype)
 
+        if self._write_timestamps:
+            self.writer.write(frame.timestamp, frame.array)
+        elif isinstance(self.writer, Frame_Store_Writer):
+            self.writer.write(timestamps.timestamp(), frame.array)
+        else:
+            # the Video_Writer makes its own
+            self.writer.write(None, frame.array)
 
+    def _init_writer(self, shape:tuple, dtype:np.dtype) -> typing.Union['Video_Writer', Frame_Store_Writer]:
+        """
+        Make the writer for frames of a shape and dtype, picking the encoder if ``'auto'``
+        """
+        encoder = self._write_encoder
+        encoder_kwargs = self._write_encoder_kwargs or {}
+        if encoder == 'auto':
+            encoder = select_encoder(self.fps if self.fps else 30, shape, dtype, encoder_kwargs=encoder_kwargs)
+
+        if encoder == 'raw':
+            # nothing to encode, so no need for another process
+            writer = Frame_Store_Writer(self.output_filename, shape, dtype, fps=self.fps)
+        else:
+            writer = Video_Writer(self.output_filename, self.fps,
+                                  shape=shape, dtype=dtype,
+                                  timestamps=self._write_timestamps,
+                                  encoder=encoder,
+                                  encoder_kwargs=encoder_kwargs)
+            writer.start()
+        self.logger.info('Writing with encoder {} to {}'.format(encoder, writer.path))
+        return writer
 
     def _write_deinit(self):
         """
         End the :class:`.Video_Writer`.
 
-        Blocks until the :attr:`._write_q` is empty, holding the release of the object.
+        Blocks until it has encoded the frames it has, holding the release of the object.
+        Raw frames are then transcoded in the background, if ``transcode`` was given to :meth:`.write`
         """
-        self._write_q.put_nowait('END')
-        checked_empty = False
-        while not self._write_q.empty():
-            if not checked_empty:
-                self.logger.warning(
-                    'Writer still has ~{} frames, waiting on it to finish'.format(self._write_q.qsize()))
-                checked_empty = True
-            time.sleep(0.1)
+        if self.writer is None:
+            return
+        if isinstance(self.writer, Video_Writer) and self.writer.qsize() > 0:
+            self.logger.warning(
+                'Writer still has ~{} frames, waiting on it to finish'.format(self.writer.qsize()))
+        self.writer.close()
         self.logger.info('Writer finished, closing')
 
-    def queue(self, queue_size = 128):
+        if isinstance(self.writer, Frame_Store_Writer) and self._write_transcode is not None:
+            self.logger.info('Transcoding {} with {}'.format(self.writer.path, self._write_transcode))
+            self.transcoder = Transcoder(self.writer.path, self._write_transcode,
+                                         **(self._write_encoder_kwargs or {}).get(self._write_transcode, {}))
+            self.transcoder.encode()
+        self.writer = None
+
+    def queue(self, queue_size = 128, policy='drop_oldest', copy=True):
         """
         Enable stashing frames in a queue for a local consumer.
 
-        Other objects can get frames as they are acquired from :attr:`.q`
+        Other objects can get frames as they are acquired from :attr:`.q` , a :class:`.frames.Frame_Consumer`
+        that is gotten from like a :class:`queue.Queue` .
+
+        Frames are held in the camera's :class:`.Frame_Ring` until they're gotten, so at most
+        :attr:`.ring_size` frames are kept, whatever the ``queue_size`` .
 
         Args:
             queue_size (int): max number of frames that can be held in :attr:`~Camera.q`
+            policy (str): What to do with frames when the queue is full, one of :data:`.frames.POLICIES`.
+                Default ``'drop_oldest'``.
+            copy (bool): If True (default), :attr:`.q` gives ``(timestamp, frame)`` tuples with a copy of the frame.
+                If False, it gives :class:`.frames.Frame` s that must be :meth:`~.frames.Frame.release` d
         """
         self.queue_size = queue_size
-        self.q = Queue(maxsize=self.queue_size)
+        self.q = self._ring.subscribe('queue', policy=policy, maxlen=queue_size, copy=copy)
         self.queueing.set()
-        self.logger.info('Queueing initialized, queue size {}'.format(queue_size))
+        self.logger.info('Queueing initialized, queue size {}, policy {}'.format(queue_size, policy))
+
+    @property
+    def dropped(self) -> typing.Dict[str, int]:
+        """
+        Number of frames dropped because a consumer fell behind capture,
+        by consumer (``'stream'`` , ``'write'`` , and ``'queue'`` ), and by the :class:`.Frame_Ring` itself
+        (``'ring'`` ) when every frame was held. Frames dropped by the network stream after they
+        were taken from the ring are counted in ``'stream_queue'`` (its queue was full)
+        and ``'stream_send'`` (the recipient wasn't receiving).
+
+        Returns:
+            dict
+        """
+        dropped = self._ring.dropped_counts()
+        if self._stream_q is not None:
+            dropped['stream_queue'] = self._stream_q.dropped
+            dropped['stream_send'] = self._stream_q.send_dropped
+        return dropped
+
+    def _start_pumps(self):
+        """
+        Start threads that take frames from the :class:`.Frame_Ring` for streaming and writing,
+        so capture doesn't wait on them (unless their policy is ``'block'`` )
+        """
+        self._ring.open()
+        if self._stream_frames is not None and self.streaming.is_set():
+            self._start_pump('stream')
+        if self._write_frames is not None and self.writing.is_set():
+            self._start_pump('write')
+
+    def _start_pump(self, name:str):
+        """
+        Start the ``'stream'`` or ``'write'`` thread if it isn't running already, eg. when :meth:`.stream`
+        or :meth:`.write` are called while capturing
+        """
+        with self._pumps_lock:
+            pump = self._pumps.get(name)
+            if pump is not None and pump.is_alive():
+                return
+            if name == 'stream':
+                pump = threading.Thread(target=self._stream_pump, args=(self._stream_frames,), daemon=True)
+            else:
+                pump = threading.Thread(target=self._write_pump, args=(self._write_frames,), daemon=True)
+            self._pumps[name] = pump
+            pump.start()
+
+    def _stop_pumps(self):
+        """
+        Wait for the threads started by :meth:`._start_pumps` to finish the frames they have,
+        after the :class:`.Frame_Ring` is closed
+        """
+        with self._pumps_lock:
+            pumps, self._pumps = list(self._pumps.values()), {}
+        for pump in pumps:
+            pump.join()
+
+    def _stream_pump(self, frames):
+        for frame in frames:
+            with frame:
+                # the stream serializes frames in its own thread, after the slot may be reused
+                self._stream_q.append({'timestamp': frame.timestamp,
+                                       self.name  : frame.array.copy()})
+
+    def _write_pump(self, frames):
+        for frame in frames:
+            with frame:
+                try:
+                    self._write_frame(frame)
+                except Exception as e:
+                    self.logger.exception('Frame {} could not be written, got exception {}'.format(frame.frame_n, e))
 
 
     @property
@@ -878,7 +1049,7 @@ class PiCamera(Camera):
                     buf, dtype=np.uint8,
                     count=self.resolution[0]*self.resolution[1]*3
                 ).reshape((self.resolution[1], self.resolution[0], 3))
-            self.timestamp = datetime.now().isoformat()
+            self.timestamp = timestamps.timestamp()
             self.grab_event.set()
 
 
@@ -1299,29 +1470,17 @@ class Camera_Spinnaker(Camera):
         Because the objects returned from the :meth:`~Camera_Spinnaker._grab` method are image *pointers*
         rather than :class:`numpy.ndarray`s, they need to be handled differently.
 
-        More details on the differences are given in the :meth:`_write_frame`,
+        The image is rotated once (as a view) and copied into the :class:`.Frame_Ring` for streaming, writing,
+        and queueing, so it can be released back to the camera before they use it.
         """
-        frame_array = None
         try:
             self.frame = self._grab()
         except Exception as e:
             self.logger.exception(e)
+            return
 
-        #self._frame[:] = self.frame[1].GetNDArray()
-
-        if self.writing.is_set():
-            self._write_frame()
-
-        if self.streaming.is_set():
-            if not frame_array:
-                frame_array = np.rot90(self.frame[1].GetNDArray(), axes=(1,0), k=self.rotate)
-            self._stream_q.append({'timestamp': self.frame[0],
-                                       self.name  : frame_array})
-
-        if self.queueing.is_set():
-            if not frame_array:
-                frame_array = np.rot90(self.frame[1].GetNDArray(), axes=(1,0), k=self.rotate)
-            self.q.put_nowait((self.frame[0], frame_array))
+        if self.streaming.is_set() or self.writing.is_set() or self.queueing.is_set():
+            self._ring.put(self.frame[0], np.rot90(self.frame[1].GetNDArray(), axes=(1,0), k=self.rotate))
 
         if self.indicating.is_set():
             if self._indicator is None:
@@ -1354,57 +1513,28 @@ class Camera_Spinnaker(Camera):
         return frame.GetTimeStamp()
 
 
-    def write(self, output_filename = None, timestamps=True, blosc=True):
+    def write(self, output_filename = None, timestamps=True, blosc=True, policy='block', transcode='x264', **kwargs):
         """
-        Sets camera to save acquired images to a directory for later encoding.
+        Sets camera to save acquired images to a :class:`.frame_store.Frame_Store_Writer` for later encoding.
 
-        For performance, rather than encoding during acquisition, save each image as
-        a (lossless) .png image in a directory generated by :attr:`.output_filename`.
+        For performance, rather than encoding during acquisition, frames are copied as they are
+        into a memory-mapped file by the writing thread (see :meth:`.Camera.write` with ``encoder='raw'`` ).
 
-        After capturing is complete, a :class:`.Directory_Writer` encodes the images to an
-        x264 encoded .mp4 video.
+        After capturing is complete, a :class:`.frame_store.Transcoder` encodes the frames to a video
+        in the background (an x264 encoded .mp4, by default).
 
         Args:
-            output_filename (str): Directory to write images to. If None (default), generated by :attr:`.output_filename`
-            timestamps (bool): Not used, timestamps are always appended to filenames.
-            blosc (bool): Not used, images are directly saved.
-        """
-        if not output_filename:
-            output_filename = self.output_filename
-        else:
-            self.output_filename = output_filename
-
-
-        # PNG images are losslessly compressed
-        self.img_opts = PySpin.PNGOption()
-        self.img_opts.compressionLevel = 1
-
-        # make directory
-        output_dir = os.path.splitext(self.output_filename)[0]
-        os.makedirs(output_dir)
-
-        # create base_path for output images
-        self.base_path = os.path.join(output_dir, "capture_{}__".format(self.name))
-
-        self.writing.set()
-
-
-    def _write_frame(self):
-        """
-        Write frame to :attr:`.base_path` + timestamp + '.png' with :meth:`PySpin.Image.Save`
-        """
-        self.frame[1].Save(self.base_path+str(self.frame[0])+'.png', self.img_opts)
-
-
-    def _write_deinit(self):
-        """
-        After capture, write images in :attr:`.base_path` to video with :class:`.Directory_Writer`
-
-        Camera object will remain open until writer has finished.
-        """
-        self.logger.info('Writing images in {} to {}'.format(self.base_path, self.base_path + '.mp4'))
-        self.writer = Directory_Writer(self.base_path, fps=self.fps)
-        self.writer.encode()
+            output_filename (str): Path to write frames to, its extension is replaced by the frame store's.
+                If None (default), generated by :attr:`.output_filename`
+            timestamps (bool): if True (default), frames are stored with the camera's timestamps
+            blosc (bool): Not used, frames are stored uncompressed.
+            policy (str): What to do with frames when writing falls behind capture, see :meth:`.Camera.write`
+            transcode (str): name of the encoder to encode frames with after capture, or ``None`` to keep
+                only the frame store
+            **kwargs: passed to :meth:`.Camera.write`
+        """
+        super(Camera_Spinnaker, self).write(output_filename, timestamps=timestamps, blosc=blosc, policy=policy,
+                                            encoder='raw', transcode=transcode, **kwargs)
 
     @property
     def bin(self):
@@ -1736,7 +1866,7 @@ class Camera_Spinnaker(Camera):
 
     def release(self):
         """
-        Release all PySpin objects and wait on writer, if still active.
+        Release all PySpin objects and wait on the transcoder, if still active.
         """
 
         super(Camera_Spinnaker, self).release()
@@ -1790,8 +1920,8 @@ class Camera_Spinnaker(Camera):
         except Exception as e:
             self.logger.exception(e)
 
-        if self.writing.is_set():
-            self.writer.wait()
+        if self.transcoder is not None:
+            self.transcoder.wait()
 
 
 
@@ -1907,100 +2037,149 @@ class Directory_Writer(object):
 
 
 class Video_Writer(mp.Process):
-    def __init__(self, q, path, fps=None, timestamps=True, blosc=True):
+    n_slots = 16 #: (int): number of frames that can be waiting in shared memory for the writer
+
+    def __init__(self, path, fps=None, shape=None, dtype=np.uint8, timestamps=True, n_slots=None,
+                 encoder='auto', encoder_kwargs=None):
         """
         Encode frames as they are acquired in a separate process.
 
-        Must call :meth:`~Video_Writer.start` after initialization to begin encoding.
+        Frames are passed to the process through a :class:`.frames.Shared_Frame_Ring` , so
+        they aren't pickled or copied again on the way, and are given to an :class:`.encoders.Encoder`
+        (by default, selected by :func:`.encoders.select_encoder` ). Frames are :meth:`.write` n with their timestamp,
+        and once :attr:`.n_slots` frames are waiting to be encoded, :meth:`.write`
+        blocks (or drops frames, if given a ``timeout`` ).
 
-        Encoding continues until 'END' is put in :attr:`~Video_Writer.q`.
+        Must call :meth:`~Video_Writer.start` after initialization to begin encoding, and
+        :meth:`~Video_Writer.close` to finish.
 
         Timestamps are saved in a .csv file with the same path as the video.
 
         Args:
-            q (:class:`~queue.Queue`): Queue into which frames will be dumped
-            path (str): output path of video
+            path (str): output path of video. Its extension is replaced with the encoder's, eg. ``.mkv`` for ``'ffv1'``
             fps (int): framerate of output video
-            timestamps (bool): if True (default), input will be of form (timestamp, frame). if False,
-                input will just be frames and timestamps will be generated as the frame is encoded (**not recommended**)
-            blosc (bool): if True, frames in the :attr:`~Video_Writer.q` will be compresed with blosc. if False, uncompressed
+            shape (tuple): shape of frames, ``(height, width)`` or ``(height, width, channels)``
+            dtype (:class:`numpy.dtype`): dtype of frames, ``uint8`` (default) or ``uint16``
+            timestamps (bool): if True (default), use the timestamps given to :meth:`.write` . if False,
+                timestamps will be generated as the frame is encoded (**not recommended**)
+            n_slots (int): number of frames that can be waiting to be encoded, default :attr:`.n_slots`
+            encoder (str): name of the encoder in :data:`.encoders.ENCODERS` , or ``'auto'`` (default)
+                to pick the first that can keep up with ``fps``
+            encoder_kwargs (dict): keyword arguments for encoders, by name, eg. ``{'x264': {'crf': 18}}``
 
         Attributes:
+            frames (:class:`.frames.Shared_Frame_Ring`): frames waiting to be encoded
+            encoder (str): name of the encoder
             timestamps (list): Timestamps for frames, written to .csv on completion of encoding
 
         """
 
         super(Video_Writer, self).__init__()
 
-        _check_ffmpeg()
+        if shape is None:
+            raise ValueError('Video_Writer needs the shape of frames to allocate shared memory for them')
 
+        if fps is None:
+            warnings.warn('No FPS given, using 30fps by default')
+            fps = 30
 
-        self.q = q
-        self.path = path
         self.fps = fps
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
         self.given_timestamps = timestamps
         self.timestamps = []
-        self.blosc = blosc
+        self.encoder_kwargs = encoder_kwargs or {}
 
+        if encoder == 'auto':
+            encoder = select_encoder(self.fps, self.shape, self.dtype, encoder_kwargs=self.encoder_kwargs)
+        encoder_cls = check_encoder(encoder)
+        self.encoder = encoder
+        self.path = os.path.splitext(path)[0] + encoder_cls.ext
 
-        if fps is None:
-            warnings.warn('No FPS given, using 30fps by default')
-            self.fps = 30
+        if n_slots is not None:
+            self.n_slots = n_slots
+        self.frames = Shared_Frame_Ring(self.shape, self.dtype, self.n_slots)
+
+    def write(self, timestamp, frame:np.ndarray, timeout:typing.Optional[float]=None) -> bool:
+        """
+        Send a frame to be encoded, waiting for room if :attr:`.n_slots` frames are already waiting.
+
+        Args:
+            timestamp: timestamp of the frame
+            frame (:class:`numpy.ndarray`): the frame, with :attr:`.shape` and :attr:`.dtype`
+            timeout (float): seconds to wait for room, default forever. ``0`` drops the frame rather than wait.
+
+        Returns:
+            bool: ``False`` if the frame was dropped, counted in :attr:`.dropped`
+        """
+        return self.frames.put(timestamp, frame, timeout=timeout)
+
+    @property
+    def dropped(self) -> int:
+        """
+        Number of frames dropped by :meth:`.write` because the writer fell behind
+        """
+        return self.frames.dropped
+
+    def qsize(self) -> int:
+        """
+        Approximate number of frames waiting to be encoded
+        """
+        return self.frames.qsize()
+
+    def end(self):
+        """
+        Encode the frames already written, then stop
+        """
+        self.frames.end()
+
+    def close(self, timeout:typing.Optional[float]=None):
+        """
+        :meth:`.end` , wait for the process to finish encoding, and remove the shared memory
+
+        Args:
+            timeout (float): seconds to wait for the process, default forever
+        """
+        self.end()
+        self.join(timeout)
+        self.frames.close()
 
     def run(self):
         """
-        Open a :class:`skvideo.io.FFmpegWriter` and begin processing frames from :attr:`~Video_Writer.q`
+        Open the :attr:`.encoder` and give it each frame from :attr:`~Video_Writer.frames`
 
         Should not be called by itself, overwrites the :meth:`multiprocessing.Process.run` method,
         so should call :meth:`Video_Writer.start`
 
-        Continue encoding until 'END' put in queue.
+        Continue encoding until :meth:`.end` is called.
         """
 
         self.timestamps = []
+        failed = False
 
-
-        out_vid_fn = self.path
-        vid_out = io.FFmpegWriter(out_vid_fn,
-        #vid_out = FastWriter(out_vid_fn,
-            inputdict={
-                '-r': str(self.fps),
-        },
-            outputdict={
-                '-vcodec': 'libx264',
-                '-pix_fmt': 'yuv420p',
-                '-r': str(self.fps),
-                '-preset': 'ultrafast',
-            },
-            verbosity=1
-        )
-
+        encoder = get_encoder(self.encoder)(self.path, self.fps, self.shape, self.dtype,
+                                            **self.encoder_kwargs.get(self.encoder, {}))
+        encoder.open()
         try:
-
-            for input in iter(self.q.get, 'END'):
+            for slot, timestamp, frame in self.frames:
                 try:
-
-                    if self.given_timestamps:
-                        self.timestamps.append(input[0])
-                        if self.blosc:
-                            vid_out.writeFrame(blosc.unpack_array(input[1]))
-                        else:
-                            vid_out.writeFrame(input[1])
-                    else:
-                        self.timestamps.append(datetime.now().isoformat())
-                        if self.blosc:
-                            vid_out.writeFrame(blosc.unpack_array(input))
+                    # keep taking frames after the encoder fails so the camera isn't blocked
+                    if not failed:
+                        encoder.write(frame, timestamp if self.given_timestamps else None)
+                        if self.given_timestamps:
+                            self.timestamps.append(timestamp)
                         else:
-                            vid_out.writeFrame(input)
-
-                except Exception as e:
-                    print(e)
-                    traceback.print_tb()
-                    # TODO: Too general
-                    break
+                            self.timestamps.append(timestamps.timestamp())
+                except (BrokenPipeError, OSError) as e:
+                    print('Video_Writer: encoder {} stopped accepting frames, got exception {}'.format(self.encoder, e))
+                    failed = True
+                finally:
+                    del frame
+                    self.frames.release(slot)
 
         finally:
-            vid_out.close()
+            encoder.close()
+            self.frames.close()
 
             # save timestamps as .csv
             ts_path = os.path.splitext(self.path)[0] + '.csv'
@@ -2010,7 +2189,6 @@ class Video_Writer(mp.Process):
                     csv_writer.writerow([ts])
 
 
-
 def list_spinnaker_cameras():
     """
     List all available Spinnaker cameras and their ``DeviceInformation``
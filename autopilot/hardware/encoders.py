@@ -0,0 +1,419 @@
+"""
+Encoders used by the :class:`.Video_Writer` to turn raw frames into video files.
+
+* :class:`.Raw_Encoder` (``'raw'`` ) - append frames, unencoded, to a :mod:`.frame_store` , to be encoded later
+  with :func:`.frame_store.transcode` . Needs no ffmpeg, and keeps up with anything the disk can.
+* :class:`.FFV1_Encoder` (``'ffv1'`` ) - lossless FFV1 in a .mkv
+* :class:`.X264_Encoder` (``'x264'`` ) - libx264, with a tunable ``preset`` , ``crf`` , and ``threads``
+* :class:`.V4L2M2M_Encoder` (``'v4l2m2m'`` ) - the hardware h264 encoder of eg. the Raspberry Pi,
+  where ffmpeg has ``h264_v4l2m2m``
+
+With ``encoder='auto'`` , :func:`.select_encoder` picks the first of :data:`.AUTO_ORDER` that can
+encode frames like the camera's faster than its fps (with some :data:`.HEADROOM` ), measured once
+for each shape and dtype of frame with :func:`.benchmark` , and falls back to ``'raw'`` .
+
+Encoders are made and used in the :class:`.Video_Writer` 's process, so are given to it by name
+and keyword arguments.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import typing
+from subprocess import PIPE, Popen
+
+import numpy as np
+
+from autopilot import prefs
+from autopilot.core.loggers import init_logger
+from autopilot.hardware.frame_store import Frame_Store_Writer
+from autopilot.utils import timestamps
+
+BENCHMARK_FN = 'encoder_benchmarks.json'
+"""
+Filename that :func:`.benchmark` results are saved in, in ``prefs.get('BASEDIR')``
+"""
+
+AUTO_ORDER = ('v4l2m2m', 'x264', 'ffv1', 'raw')
+"""
+Encoders tried by :func:`.select_encoder` , in order of preference
+"""
+
+HEADROOM = 1.5
+"""
+How much faster than the camera's fps an encoder has to be for :func:`.select_encoder` to pick it,
+since the benchmark doesn't compete with capture for the CPU
+"""
+
+
+class Encoder(object):
+    """
+    Metaclass for encoders, which :meth:`.write` raw frames to a video file.
+
+    Subclasses need to override :meth:`.open` , :meth:`.write` , and :meth:`.close` .
+    Frames are given to :meth:`.write` with their timestamp, for encoders that store them.
+
+    Args:
+        path (str): output path. Its extension is replaced with :attr:`.ext` .
+        fps (int): framerate of the video
+        shape (tuple): shape of frames, ``(height, width)`` or ``(height, width, channels)``
+        dtype (:class:`numpy.dtype`): dtype of frames
+    """
+
+    name = None # type: str
+    ext = '.mp4' # extension of files made by this encoder
+
+    def __init__(self, path:str, fps:int, shape:tuple, dtype:typing.Union[np.dtype, str]):
+        self.path = os.path.splitext(path)[0] + self.ext
+        self.fps = fps
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    @classmethod
+    def available(cls) -> bool:
+        """
+        Whether this encoder can be used on this computer
+        """
+        return True
+
+    def open(self):
+        raise NotImplementedError('open must be overwritten by encoder subclass!!')
+
+    def write(self, frame:np.ndarray, timestamp=None):
+        raise NotImplementedError('write must be overwritten by encoder subclass!!')
+
+    def close(self):
+        raise NotImplementedError('close must be overwritten by encoder subclass!!')
+
+
+class Raw_Encoder(Encoder):
+    """
+    Append frames as they are to a :class:`.Frame_Store_Writer` , read with :class:`.frame_store.Frame_Store`
+    """
+
+    name = 'raw'
+    ext = '.frames'
+
+    def open(self):
+        self._store = Frame_Store_Writer(self.path, self.shape, self.dtype, fps=self.fps)
+
+    def write(self, frame:np.ndarray, timestamp=None):
+        if timestamp is None:
+            timestamp = timestamps.timestamp('ns')
+        self._store.write(timestamp, frame)
+
+    def close(self):
+        self._store.close()
+
+
+class FFmpeg_Encoder(Encoder):
+    """
+    Metaclass for encoders that pipe raw frames to ffmpeg's stdin
+
+    Subclasses set :attr:`.codec` and override :meth:`.output_args` .
+    """
+
+    codec = None # type: str
+    _encoders = None # type: typing.Optional[str]
+
+    @classmethod
+    def available(cls) -> bool:
+        if shutil.which('ffmpeg') is None:
+            return False
+        if FFmpeg_Encoder._encoders is None:
+            try:
+                FFmpeg_Encoder._encoders = subprocess.run(
+                    ['ffmpeg', '-hide_banner', '-encoders'],
+                    stdout=PIPE, stderr=subprocess.DEVNULL, timeout=10).stdout.decode('utf-8', 'replace')
+            except (OSError, subprocess.SubprocessError):
+                FFmpeg_Encoder._encoders = ''
+        return ' {} '.format(cls.codec) in FFmpeg_Encoder._encoders
+
+    def input_args(self) -> typing.List[str]:
+        height, width = self.shape[:2]
+        return ['-f', 'rawvideo', '-pix_fmt', pix_fmt(self.shape, self.dtype),
+                '-s', '{}x{}'.format(width, height), '-r', str(self.fps),
+                '-i', '-']
+
+    def output_args(self) -> typing.List[str]:
+        return ['-vcodec', self.codec]
+
+    def command(self) -> typing.List[str]:
+        """
+        The ffmpeg command to encode with
+        """
+        return ['ffmpeg', '-y', '-loglevel', 'error'] + self.input_args() + \
+               self.output_args() + ['-r', str(self.fps), self.path]
+
+    def open(self):
+        if shutil.which('ffmpeg') is None:
+            raise ImportError(
+                'ffmpeg could not be found on the system, and it is needed in order to write videos. install it with apt (sudo apt update && sudo apt install ffmpeg)')
+        self._proc = Popen(self.command(), stdin=PIPE)
+
+    def write(self, frame:np.ndarray, timestamp=None):
+        self._proc.stdin.write(frame)
+
+    def close(self):
+        try:
+            self._proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        self._proc.wait()
+
+
+class X264_Encoder(FFmpeg_Encoder):
+    """
+    h264 with libx264
+
+    Args:
+        preset (str): x264 preset, from ``'ultrafast'`` to ``'veryslow'``
+        crf (int): constant rate factor, 0 (lossless) to 51. lower is better quality and larger files.
+        threads (int): encoding threads, 0 (default) lets x264 decide
+        tune (str): x264 tune, eg. ``'zerolatency'`` or ``'fastdecode'``
+    """
+
+    name = 'x264'
+    codec = 'libx264'
+
+    def __init__(self, *args, preset:str='ultrafast', crf:int=23, threads:int=0,
+                 tune:typing.Optional[str]=None, **kwargs):
+        super(X264_Encoder, self).__init__(*args, **kwargs)
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+        self.tune = tune
+
+    def output_args(self) -> typing.List[str]:
+        args = ['-vcodec', self.codec, '-pix_fmt', 'yuv420p',
+                '-preset', self.preset, '-crf', str(self.crf), '-threads', str(self.threads)]
+        if self.tune is not None:
+            args.extend(['-tune', self.tune])
+        return args
+
+
+class FFV1_Encoder(FFmpeg_Encoder):
+    """
+    Lossless FFV1 (version 3) in a .mkv
+
+    Args:
+        slices (int): slices each frame is split into and encoded in parallel
+    """
+
+    name = 'ffv1'
+    codec = 'ffv1'
+    ext = '.mkv'
+
+    def __init__(self, *args, slices:int=4, **kwargs):
+        super(FFV1_Encoder, self).__init__(*args, **kwargs)
+        self.slices = slices
+
+    def output_args(self) -> typing.List[str]:
+        return ['-vcodec', self.codec, '-level', '3', '-g', '1', '-slices', str(self.slices)]
+
+
+class V4L2M2M_Encoder(FFmpeg_Encoder):
+    """
+    Hardware h264 encoding with ``h264_v4l2m2m`` , eg. on a Raspberry Pi
+
+    Args:
+        bitrate (str): target bitrate, eg. ``'8M'``
+    """
+
+    name = 'v4l2m2m'
+    codec = 'h264_v4l2m2m'
+
+    def __init__(self, *args, bitrate:str='8M', **kwargs):
+        super(V4L2M2M_Encoder, self).__init__(*args, **kwargs)
+        self.bitrate = bitrate
+
+    def output_args(self) -> typing.List[str]:
+        return ['-vcodec', self.codec, '-pix_fmt', 'yuv420p', '-b:v', self.bitrate]
+
+
+ENCODERS = {
+    encoder.name: encoder for encoder in (Raw_Encoder, FFV1_Encoder, X264_Encoder, V4L2M2M_Encoder)
+} # type: typing.Dict[str, typing.Type[Encoder]]
+"""
+Encoders by :attr:`.Encoder.name`
+"""
+
+
+def get_encoder(name:str) -> typing.Type[Encoder]:
+    """
+    Get an encoder class by its name
+
+    Raises:
+        ValueError: if there isn't one
+    """
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError('No encoder named {}, must be one of {} or "auto"'.format(name, list(ENCODERS.keys())))
+
+
+def check_encoder(name:str) -> typing.Type[Encoder]:
+    """
+    Get an encoder class by its name, making sure it can be used
+
+    Raises:
+        ValueError: if there isn't one
+        ImportError: if it needs ffmpeg, and ffmpeg isn't installed
+        RuntimeError: if it isn't available otherwise
+    """
+    encoder_cls = get_encoder(name)
+    if not encoder_cls.available():
+        if issubclass(encoder_cls, FFmpeg_Encoder) and shutil.which('ffmpeg') is None:
+            raise ImportError(
+                'ffmpeg could not be found on the system, and it is needed in order to write videos. install it with apt (sudo apt update && sudo apt install ffmpeg)')
+        raise RuntimeError('Encoder {} is not available on this computer'.format(name))
+    return encoder_cls
+
+
+def pix_fmt(shape:tuple, dtype:typing.Union[np.dtype, str]) -> str:
+    """
+    ffmpeg ``-pix_fmt`` of raw frames with a given shape and dtype
+    """
+    channels = shape[2] if len(shape) == 3 else 1
+    formats = {
+        (1, 'uint8'): 'gray',
+        (1, 'uint16'): 'gray16le',
+        (3, 'uint8'): 'rgb24',
+        (4, 'uint8'): 'rgba',
+        (3, 'uint16'): 'rgb48le',
+    }
+    try:
+        return formats[(channels, np.dtype(dtype).name)]
+    except KeyError:
+        raise ValueError('Cant write frames with shape {} and dtype {} to video'.format(shape, dtype))
+
+
+_BENCHMARKS = {} # type: typing.Dict[str, float]
+_BENCHMARKS_LOCK = threading.Lock()
+
+
+def benchmark(name:str, shape:tuple, dtype:typing.Union[np.dtype, str], seconds:float=1.0,
+              encoder_kwargs:typing.Optional[dict]=None, cache:bool=True) -> float:
+    """
+    Measure how many frames per second an encoder can encode.
+
+    Encodes noisy frames to a temporary file for about ``seconds`` . Results are kept
+    for each encoder, shape, dtype, and ``encoder_kwargs`` , and saved in :data:`.BENCHMARK_FN`
+    if ``prefs.get('BASEDIR')`` is set, so each is only measured once.
+
+    Args:
+        name (str): name of the encoder
+        shape (tuple): shape of frames
+        dtype (:class:`numpy.dtype`): dtype of frames
+        seconds (float): how long to encode for
+        encoder_kwargs (dict): passed to the encoder
+        cache (bool): use and save results from before
+
+    Returns:
+        float: frames per second, or 0 if the encoder isn't available or failed
+    """
+    encoder_kwargs = encoder_kwargs or {}
+    dtype = np.dtype(dtype)
+    key = json.dumps([name, list(shape), dtype.str, encoder_kwargs], sort_keys=True)
+    if cache:
+        with _BENCHMARKS_LOCK:
+            if not _BENCHMARKS:
+                _BENCHMARKS.update(_load_benchmarks())
+            if key in _BENCHMARKS:
+                return _BENCHMARKS[key]
+
+    encoder_cls = get_encoder(name)
+    if not encoder_cls.available():
+        return 0.0
+
+    # a gradient with noise, so it's neither trivially nor impossibly compressible
+    rng = np.random.default_rng(0)
+    info = np.iinfo(dtype) if dtype.kind in 'iu' else None
+    top = info.max if info is not None else 1.0
+    gradient = np.linspace(0, top / 2, int(np.prod(shape))).reshape(shape)
+    frames = [(gradient + rng.uniform(0, top / 4, shape)).astype(dtype) for _ in range(4)]
+
+    n_frames = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        encoder = encoder_cls(os.path.join(tmp_dir, 'benchmark'), fps=30, shape=shape, dtype=dtype, **encoder_kwargs)
+        try:
+            start = time.perf_counter()
+            encoder.open()
+            # count the time to finish encoding too, pipes buffer frames that haven't been encoded yet
+            while time.perf_counter() - start < seconds:
+                encoder.write(frames[n_frames % len(frames)])
+                n_frames += 1
+            encoder.close()
+            fps = n_frames / (time.perf_counter() - start)
+        except Exception as e:
+            init_logger(module_name='hardware.encoders').warning(
+                'Encoder {} failed its benchmark, got exception {}'.format(name, e))
+            fps = 0.0
+
+    if cache:
+        with _BENCHMARKS_LOCK:
+            _BENCHMARKS[key] = fps
+            _save_benchmarks(_BENCHMARKS)
+    return fps
+
+
+def select_encoder(fps:float, shape:tuple, dtype:typing.Union[np.dtype, str],
+                   candidates:typing.Sequence[str]=AUTO_ORDER,
+                   encoder_kwargs:typing.Optional[typing.Dict[str, dict]]=None) -> str:
+    """
+    Pick the first encoder that can keep up with a camera, measured with :func:`.benchmark`
+
+    Args:
+        fps (float): the camera's framerate
+        shape (tuple): shape of its frames
+        dtype (:class:`numpy.dtype`): dtype of its frames
+        candidates (list): names of encoders to try, in order
+        encoder_kwargs (dict): keyword arguments for each encoder, by name
+
+    Returns:
+        str: name of the encoder, ``'raw'`` if none can keep up
+    """
+    encoder_kwargs = encoder_kwargs or {}
+    logger = init_logger(module_name='hardware.encoders')
+    for name in candidates:
+        if name == 'raw':
+            break
+        measured = benchmark(name, shape, dtype, encoder_kwargs=encoder_kwargs.get(name))
+        logger.debug('Encoder {} encodes {:.1f} frames/s with shape {}'.format(name, measured, shape))
+        if measured >= fps * HEADROOM:
+            logger.info('Selected encoder {}, {:.1f} frames/s for a {} fps camera'.format(name, measured, fps))
+            return name
+    logger.info('No encoder can keep up with a {} fps camera with frames of shape {}, writing raw frames'.format(fps, shape))
+    return 'raw'
+
+
+def _benchmark_file() -> typing.Optional[str]:
+    basedir = prefs.get('BASEDIR')
+    if not basedir or not os.path.isdir(basedir):
+        return None
+    return os.path.join(basedir, BENCHMARK_FN)
+
+
+def _load_benchmarks() -> typing.Dict[str, float]:
+    path = _benchmark_file()
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_benchmarks(benchmarks:typing.Dict[str, float]):
+    path = _benchmark_file()
+    if path is None:
+        return
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(benchmarks, f)
+    os.replace(tmp_path, path)
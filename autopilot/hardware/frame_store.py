@@ -0,0 +1,285 @@
+"""
+Append-only files of raw frames, for writing frames as fast as they can be copied and encoding them later.
+
+A frame store is three files with the same name:
+
+* ``.frames`` - the frames, one after another, so frame ``n`` starts at byte ``n * frame_nbytes`` .
+  The file is grown :attr:`.Frame_Store_Writer.chunk_frames` frames at a time and written through a memory map.
+* ``.index`` - an int64 nanosecond timestamp (see :func:`.timestamps.to_ns` ) for each frame, appended
+  after the frame is written, so the number of timestamps is the number of complete frames,
+  even if writing was interrupted.
+* ``.json`` - the shape and dtype of frames, and the fps they were captured at
+
+:class:`.Frame_Store_Writer` writes them (eg. from a :class:`.Camera` 's writing thread when
+:meth:`.Camera.write` is given ``encoder='raw'`` ), :class:`.Frame_Store` reads them, and
+:class:`.Transcoder` encodes them to a video in the background with one of the :mod:`.encoders` .
+"""
+
+import csv
+import json
+import os
+import threading
+import typing
+
+import numpy as np
+
+from autopilot.utils import timestamps
+
+EXTS = ('.frames', '.index', '.json')
+"""
+Extensions of the files of a frame store
+"""
+
+
+def _base(path:str) -> str:
+    return os.path.splitext(path)[0]
+
+
+class Frame_Store_Writer(object):
+    """
+    Write frames of a fixed shape and dtype to a frame store.
+
+    Not thread-safe, frames should be written from one thread.
+
+    Args:
+        path (str): path of the store, its extension is replaced with ``.frames`` , ``.index`` , and ``.json``
+        shape (tuple): shape of frames
+        dtype (:class:`numpy.dtype`): dtype of frames
+        fps (int): framerate frames were captured at, stored in the header
+
+    Attributes:
+        path (str): path of the ``.frames`` file
+        n_frames (int): number of frames written
+    """
+
+    chunk_frames = 256 # frames the .frames file is grown by at a time
+
+    def __init__(self, path:str, shape:tuple, dtype:typing.Union[np.dtype, str], fps:typing.Optional[int]=None):
+        base = _base(path)
+        self.path = base + '.frames'
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.fps = fps
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.n_frames = 0
+
+        with open(base + '.json', 'w') as header:
+            json.dump({'shape': self.shape, 'dtype': self.dtype.str, 'fps': fps}, header)
+        self._data = open(self.path, 'w+b')
+        self._index = open(base + '.index', 'wb')
+        self._chunk = None # type: typing.Optional[np.memmap]
+        self._chunk_start = 0
+
+    def write(self, timestamp, frame:np.ndarray):
+        """
+        Append a frame
+
+        Args:
+            timestamp: timestamp of the frame, anything :func:`.timestamps.to_ns` can convert
+            frame (:class:`numpy.ndarray`): the frame
+        """
+        ts = timestamps.to_ns(timestamp)
+        i = self.n_frames - self._chunk_start
+        if self._chunk is None or i >= len(self._chunk):
+            self._next_chunk()
+            i = 0
+        self._chunk[i] = frame
+        self._index.write(np.int64(ts).tobytes())
+        self.n_frames += 1
+
+    def flush(self):
+        """
+        Flush frames and timestamps to disk
+        """
+        if self._chunk is not None:
+            self._chunk.flush()
+        self._index.flush()
+
+    def close(self):
+        """
+        Flush, and trim the ``.frames`` file to the frames that were written
+        """
+        self.flush()
+        self._chunk = None
+        self._data.truncate(self.n_frames * self.frame_nbytes)
+        self._data.close()
+        self._index.close()
+
+    def _next_chunk(self):
+        """
+        Grow the .frames file by a chunk and map it
+        """
+        if self._chunk is not None:
+            self._chunk.flush()
+        self._chunk_start = self.n_frames
+        self._data.truncate((self._chunk_start + self.chunk_frames) * self.frame_nbytes)
+        # only map the new chunk, so growing the file doesn't remap what's already written
+        self._chunk = np.memmap(self._data, dtype=self.dtype, mode='r+',
+                                offset=self._chunk_start * self.frame_nbytes,
+                                shape=(self.chunk_frames,) + self.shape)
+
+    def __enter__(self) -> 'Frame_Store_Writer':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Frame_Store(object):
+    """
+    Read frames from a frame store, including one that's still being written
+    (with the frames that were complete when it was opened).
+
+    Indexing or slicing gives frames as arrays, read from a memory map, so only the
+    frames that are used are read from disk::
+
+        store = Frame_Store('capture.frames')
+        first = store[0]
+        around = store[store.index_of(event_time) - 5:store.index_of(event_time) + 5]
+
+    Args:
+        path (str): path of the store, any of its files
+
+    Attributes:
+        path (str): path of the ``.frames`` file
+        shape (tuple): shape of frames
+        dtype (:class:`numpy.dtype`): dtype of frames
+        fps (int): framerate frames were captured at
+        timestamps (:class:`numpy.ndarray`): int64 nanosecond timestamp of each frame
+        frames (:class:`numpy.memmap`): frames, ``(n_frames,) + shape``
+    """
+
+    def __init__(self, path:str):
+        base = _base(path)
+        self.path = base + '.frames'
+        with open(base + '.json', 'r') as header_file:
+            header = json.load(header_file)
+        self.shape = tuple(header['shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.fps = header.get('fps')
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        self.timestamps = np.fromfile(base + '.index', dtype='<i8')
+        # frames are written before their timestamps, but check anyway
+        n_frames = min(len(self.timestamps), os.path.getsize(self.path) // max(self.frame_nbytes, 1))
+        self.timestamps = self.timestamps[:n_frames]
+        if n_frames > 0:
+            self.frames = np.memmap(self.path, dtype=self.dtype, mode='r', shape=(n_frames,) + self.shape)
+        else:
+            self.frames = np.empty((0,) + self.shape, dtype=self.dtype)
+
+    def index_of(self, timestamp) -> int:
+        """
+        Index of the last frame at or before a timestamp (or the first frame, if it's before every frame)
+
+        Args:
+            timestamp: anything :func:`.timestamps.to_ns` can convert
+
+        Returns:
+            int
+        """
+        i = int(np.searchsorted(self.timestamps, timestamps.to_ns(timestamp), side='right')) - 1
+        return max(i, 0)
+
+    def __getitem__(self, item) -> np.ndarray:
+        return self.frames[item]
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[int, np.ndarray]]:
+        """
+        Iterate ``(timestamp, frame)``
+        """
+        for i in range(len(self)):
+            yield int(self.timestamps[i]), self.frames[i]
+
+
+def transcode(path:str, encoder:str='x264', output:typing.Optional[str]=None,
+              fps:typing.Optional[int]=None, remove:bool=False, **kwargs) -> str:
+    """
+    Encode a frame store to video, with a .csv of its timestamps as :class:`.Video_Writer` makes
+
+    Args:
+        path (str): path of the store
+        encoder (str): name of the encoder to use, see :data:`.encoders.ENCODERS`
+        output (str): path of the video, default the store's path (with the encoder's extension)
+        fps (int): framerate of the video, default the one in the store's header
+        remove (bool): delete the store once it's encoded
+        **kwargs: passed to the encoder
+
+    Returns:
+        str: path of the video
+    """
+    from autopilot.hardware.encoders import check_encoder
+
+    store = Frame_Store(path)
+    if fps is None:
+        fps = store.fps if store.fps else 30
+    enc = check_encoder(encoder)(output if output is not None else _base(path), fps=fps,
+                                 shape=store.shape, dtype=store.dtype, **kwargs)
+    if os.path.splitext(enc.path)[1] in EXTS:
+        raise ValueError('Encoding {} with {} would overwrite it'.format(path, encoder))
+
+    enc.open()
+    try:
+        for timestamp, frame in store:
+            enc.write(np.ascontiguousarray(frame), timestamp)
+    finally:
+        enc.close()
+
+    with open(os.path.splitext(enc.path)[0] + '.csv', 'w') as ts_file:
+        csv_writer = csv.writer(ts_file)
+        for ts in store.timestamps:
+            csv_writer.writerow([int(ts)])
+
+    if remove:
+        del store
+        base = _base(path)
+        for ext in EXTS:
+            if os.path.exists(base + ext):
+                os.remove(base + ext)
+    return enc.path
+
+
+class Transcoder(object):
+    """
+    Encode a frame store to video in a background thread, with :func:`.transcode`
+
+    Args:
+        path (str): path of the store
+        encoder (str): name of the encoder to use
+        **kwargs: passed to :func:`.transcode`
+
+    Attributes:
+        output (str): path of the video, once encoded
+        error (Exception): the exception raised while encoding, if any
+    """
+
+    def __init__(self, path:str, encoder:str='x264', **kwargs):
+        self.path = path
+        self.encoder = encoder
+        self.kwargs = kwargs
+        self.output = None # type: typing.Optional[str]
+        self.error = None # type: typing.Optional[Exception]
+        self.encode_thread = None # type: typing.Optional[threading.Thread]
+
+    def encode(self):
+        """
+        Begin encoding.
+        """
+        self.encode_thread = threading.Thread(target=self._encode, daemon=True)
+        self.encode_thread.start()
+
+    def _encode(self):
+        try:
+            self.output = transcode(self.path, self.encoder, **self.kwargs)
+        except Exception as e:
+            self.error = e
+
+    def wait(self, timeout:typing.Optional[float]=None):
+        """
+        ``.join`` the encoding thread.
+        """
+        if self.encode_thread:
+            self.encode_thread.join(timeout)
@@ -0,0 +1,579 @@
+"""
+A ring of preallocated frames that a :class:`.Camera` fills once per grab and
+shares between everything that consumes them (streaming, writing, :attr:`.Camera.q` ).
+
+Each consumer is a :class:`.Frame_Consumer` made with :meth:`.Frame_Ring.subscribe` ,
+which gets :class:`.Frame` s -- read-only views of the ring's slots rather than copies.
+A slot is reused once every consumer it was given to has released it (or dropped it),
+so consumers should :meth:`.Frame.release` frames as soon as they're done with them::
+
+    consumer = ring.subscribe('display', policy='latest')
+    for frame in consumer:
+        with frame:
+            show(frame.timestamp, frame.array)
+
+What happens when a consumer falls behind is set by its ``policy`` :
+
+* ``'latest'`` - only the newest frame is kept, a waiting frame is dropped when a new one arrives
+* ``'drop_oldest'`` - up to ``maxlen`` frames are kept, dropping the oldest when full,
+  or when the ring needs its slot for a new frame
+* ``'block'`` - the camera waits for the consumer to make room rather than dropping frames
+  (up to the ring's :attr:`~.Frame_Ring.block_timeout` )
+
+Frames dropped by each consumer are counted in :attr:`.Frame_Consumer.dropped` ,
+and frames that couldn't be put in the ring at all in :attr:`.Frame_Ring.dropped` .
+
+To pass frames to another process (eg. the :class:`.Video_Writer` ), a :class:`.Shared_Frame_Ring`
+holds them in shared memory, sending only the index of each slot, rather than pickling them.
+"""
+
+import multiprocessing as mp
+import threading
+import time
+import typing
+from collections import deque
+from queue import Empty
+
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+    SHARED_MEMORY = True
+except ImportError:
+    SHARED_MEMORY = False
+
+POLICIES = ('latest', 'drop_oldest', 'block')
+"""
+Possible ``policy`` s of a :class:`.Frame_Consumer`
+"""
+
+
+class Frame(object):
+    """
+    A frame in a :class:`.Frame_Ring` , held by one consumer until :meth:`.release` d.
+
+    Can be used as a context manager, releasing the frame on exit.
+
+    Attributes:
+        timestamp: timestamp of the frame
+        array (:class:`numpy.ndarray`): read-only view of the frame's slot,
+            which may be overwritten after the frame is released
+        frame_n (int): number of the frame since the ring was made
+    """
+
+    __slots__ = ('timestamp', 'array', 'frame_n', '_ring', '_slot', '_gen', '_released')
+
+    def __init__(self, ring:'Frame_Ring', slot:int, gen:int, timestamp, array:np.ndarray, frame_n:int):
+        self.timestamp = timestamp
+        self.array = array
+        self.frame_n = frame_n
+        self._ring = ring
+        self._slot = slot
+        self._gen = gen
+        self._released = False
+
+    def release(self):
+        """
+        Give the frame's slot back to the ring. Calling more than once does nothing.
+        """
+        if not self._released:
+            self._released = True
+            self._ring._release(self._slot, self._gen)
+
+    def __enter__(self) -> 'Frame':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __del__(self):
+        # don't leak the slot if a consumer forgets
+        try:
+            self.release()
+        except Exception:
+            pass
+
+
+class Frame_Consumer(object):
+    """
+    Frames from a :class:`.Frame_Ring` for one consumer, made by :meth:`.Frame_Ring.subscribe` .
+
+    Gotten like a :class:`queue.Queue` with :meth:`.get` / :meth:`.get_nowait` ,
+    or by iterating, which ends once the ring is :meth:`~.Frame_Ring.close` d and
+    the consumer is empty.
+
+    Args:
+        ring (:class:`.Frame_Ring`): the ring
+        name (str): name of the consumer, used in :meth:`.Frame_Ring.dropped_counts`
+        policy (str): one of :data:`.POLICIES`
+        maxlen (int): maximum number of frames waiting to be gotten. ``'latest'`` is always 1,
+            ``None`` is limited only by the number of slots in the ring.
+        copy (bool): if ``True`` , :meth:`.get` returns ``(timestamp, array)`` tuples with a copy
+            of the frame and releases its slot, for consumers that keep frames or hand them on.
+            if ``False`` (default), it returns :class:`.Frame` s that must be released.
+
+    Attributes:
+        received (int): frames given to this consumer
+        dropped (int): frames dropped because this consumer fell behind
+    """
+
+    def __init__(self, ring:'Frame_Ring', name:str, policy:str='drop_oldest',
+                 maxlen:typing.Optional[int]=None, copy:bool=False):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of {}, got {}'.format(POLICIES, policy))
+        if policy == 'latest':
+            maxlen = 1
+        self.ring = ring
+        self.name = name
+        self.policy = policy
+        self.maxlen = maxlen
+        self.copy = copy
+        self.received = 0
+        self.dropped = 0
+        self._pending = deque() # type: typing.Deque[Frame]
+
+    def get(self, block:bool=True, timeout:typing.Optional[float]=None) -> typing.Union[Frame, tuple]:
+        """
+        Get the next frame
+
+        Args:
+            block (bool): wait for a frame if there isn't one
+            timeout (float): seconds to wait, default forever
+
+        Returns:
+            :class:`.Frame` , or ``(timestamp, array)`` if :attr:`.copy`
+
+        Raises:
+            :class:`queue.Empty` : if there's no frame (in time), or the ring is closed
+        """
+        with self.ring._cond:
+            if block and timeout is None:
+                while not self._pending and not self.ring.closed:
+                    self.ring._cond.wait()
+            elif block:
+                end = time.monotonic() + timeout
+                while not self._pending and not self.ring.closed:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.ring._cond.wait(remaining)
+            if not self._pending:
+                raise Empty
+            frame = self._pending.popleft()
+            # make room for a blocked put
+            self.ring._cond.notify_all()
+
+        if self.copy:
+            with frame:
+                return frame.timestamp, frame.array.copy()
+        return frame
+
+    def get_nowait(self) -> typing.Union[Frame, tuple]:
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def empty(self) -> bool:
+        return len(self._pending) == 0
+
+    def full(self) -> bool:
+        return self.maxlen is not None and len(self._pending) >= self.maxlen
+
+    def __iter__(self) -> typing.Iterator[typing.Union[Frame, tuple]]:
+        while True:
+            try:
+                yield self.get()
+            except Empty:
+                if self.ring.closed:
+                    return
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _drop_oldest(self) -> bool:
+        """
+        Drop the oldest waiting frame. Call with the ring's lock held.
+        """
+        if not self._pending:
+            return False
+        self._pending.popleft().release()
+        self.dropped += 1
+        return True
+
+
+class Frame_Ring(object):
+    """
+    Preallocated frames shared between :class:`.Frame_Consumer` s.
+
+    The ring's memory is allocated by the first :meth:`.put` , with the shape and dtype
+    of its frame, and again if later frames differ.
+
+    Thread-safe, but with a single producer in mind.
+
+    Args:
+        n_slots (int): number of frames in the ring
+
+    Attributes:
+        consumers (dict): :class:`.Frame_Consumer` s by name
+        produced (int): frames put in the ring
+        dropped (int): frames that couldn't be put in the ring because
+            every slot was held by consumers
+        closed (bool): whether the ring is :meth:`.close` d
+    """
+
+    block_timeout = 1.0 # seconds to wait for a slot or a blocking consumer before dropping a frame
+
+    def __init__(self, n_slots:int=32):
+        if n_slots < 2:
+            raise ValueError('a ring needs at least 2 slots, got {}'.format(n_slots))
+        self.n_slots = n_slots
+        self.consumers = {} # type: typing.Dict[str, Frame_Consumer]
+        self.produced = 0
+        self.dropped = 0
+        self.closed = False
+
+        self.buffer = None # type: typing.Optional[np.ndarray]
+        self._gen = 0
+        self._refs = [0] * n_slots
+        self._free = deque(range(n_slots))
+        self._cond = threading.Condition()
+
+    def subscribe(self, name:str, policy:str='drop_oldest', maxlen:typing.Optional[int]=None,
+                  copy:bool=False) -> Frame_Consumer:
+        """
+        Make a :class:`.Frame_Consumer` that gets every frame put in the ring from now on.
+
+        A consumer with the same name is replaced.
+
+        Args:
+            name (str): name of the consumer
+            policy (str): one of :data:`.POLICIES`
+            maxlen (int): maximum number of frames waiting to be gotten
+            copy (bool): whether :meth:`.Frame_Consumer.get` returns copies, see :class:`.Frame_Consumer`
+
+        Returns:
+            :class:`.Frame_Consumer`
+        """
+        consumer = Frame_Consumer(self, name, policy, maxlen, copy)
+        self.unsubscribe(name)
+        with self._cond:
+            self.consumers[name] = consumer
+        return consumer
+
+    def unsubscribe(self, name:str):
+        """
+        Stop giving frames to a consumer, dropping any it hasn't gotten yet.
+        """
+        with self._cond:
+            consumer = self.consumers.pop(name, None)
+            if consumer is not None:
+                while consumer._pending:
+                    consumer._pending.popleft().release()
+                self._cond.notify_all()
+
+    def put(self, timestamp, frame:np.ndarray) -> bool:
+        """
+        Copy a frame into a free slot and give it to each consumer.
+
+        If there's no free slot, the oldest frame waiting for a non-blocking consumer is dropped,
+        otherwise waits up to :attr:`.block_timeout` for one to be released.
+        Blocking consumers that are full are waited on for the same time.
+
+        Args:
+            timestamp: timestamp of the frame
+            frame (:class:`numpy.ndarray`): the frame
+
+        Returns:
+            bool: ``False`` if the frame was dropped because there was no free slot
+        """
+        if not self.consumers:
+            return True
+
+        frame = np.asarray(frame)
+        with self._cond:
+            if self.buffer is None or self.buffer.shape[1:] != frame.shape or self.buffer.dtype != frame.dtype:
+                self._allocate(frame.shape, frame.dtype)
+
+            slot = self._claim()
+            if slot is None:
+                self.dropped += 1
+                return False
+
+        # copy without the lock held, no one else can touch an unclaimed slot
+        np.copyto(self.buffer[slot], frame)
+
+        with self._cond:
+            self._publish(slot, timestamp)
+        return True
+
+    def open(self):
+        """
+        Reopen a :meth:`.close` d ring
+        """
+        with self._cond:
+            self.closed = False
+
+    def close(self):
+        """
+        Stop iterating consumers once they're empty, and wake anything waiting on the ring
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def dropped_counts(self) -> typing.Dict[str, int]:
+        """
+        Frames dropped by the ring and by each consumer
+
+        Returns:
+            dict: ``{'ring': n, consumer_name: n, ...}``
+        """
+        with self._cond:
+            counts = {'ring': self.dropped}
+            counts.update({name: consumer.dropped for name, consumer in self.consumers.items()})
+        return counts
+
+    @property
+    def free(self) -> int:
+        """
+        Number of slots that aren't held by any consumer
+        """
+        return len(self._free)
+
+    def _allocate(self, shape:tuple, dtype:np.dtype):
+        """
+        (Re)allocate the ring's memory. Call with the lock held.
+
+        Frames held from the old memory keep it alive until they're released,
+        and releasing them doesn't touch the new slots.
+        """
+        for consumer in self.consumers.values():
+            while consumer._pending:
+                consumer._pending.popleft().release()
+        self.buffer = np.empty((self.n_slots,) + tuple(shape), dtype=dtype)
+        self._gen += 1
+        self._refs = [0] * self.n_slots
+        self._free = deque(range(self.n_slots))
+
+    def _claim(self) -> typing.Optional[int]:
+        """
+        Take a free slot, dropping or waiting for one if needed. Call with the lock held.
+        """
+        end = time.monotonic() + self.block_timeout
+        while not self._free:
+            # drop the oldest frame waiting for a consumer that doesn't block
+            droppable = [c for c in self.consumers.values() if c.policy != 'block' and c._pending]
+            if droppable:
+                min(droppable, key=lambda c: c._pending[0].frame_n)._drop_oldest()
+                continue
+
+            remaining = end - time.monotonic()
+            if remaining <= 0 or self.closed:
+                return None
+            self._cond.wait(remaining)
+        return self._free.popleft()
+
+    def _publish(self, slot:int, timestamp):
+        """
+        Give a filled slot to each consumer. Call with the lock held.
+        """
+        array = self.buffer[slot]
+        array.flags.writeable = False
+        frame_n = self.produced
+        self.produced += 1
+
+        end = time.monotonic() + self.block_timeout
+        for consumer in self.consumers.values():
+            if consumer.full():
+                if consumer.policy == 'block':
+                    while consumer.full() and not self.closed:
+                        remaining = end - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    if consumer.full():
+                        consumer.dropped += 1
+                        continue
+                else:
+                    consumer._drop_oldest()
+
+            self._refs[slot] += 1
+            consumer._pending.append(Frame(self, slot, self._gen, timestamp, array, frame_n))
+            consumer.received += 1
+
+        if self._refs[slot] == 0:
+            self._free.append(slot)
+        self._cond.notify_all()
+
+    def _release(self, slot:int, gen:int):
+        with self._cond:
+            if gen != self._gen:
+                return
+            self._refs[slot] -= 1
+            if self._refs[slot] == 0:
+                self._free.append(slot)
+                self._cond.notify_all()
+
+    def __len__(self) -> int:
+        return self.n_slots
+
+
+class Shared_Frame_Ring(object):
+    """
+    Slots for frames of a fixed shape and dtype in shared memory, with one process that
+    :meth:`.put` s frames and one that :meth:`.get` s them.
+
+    Only the slot and timestamp of each frame go through a (small) queue, and
+    slots are given back through another once the reader :meth:`.release` s them.
+    When every slot is waiting to be read, :meth:`.put` blocks, so a slow reader
+    holds up the writer rather than frames piling up in memory.
+
+    Can be passed to a :class:`multiprocessing.Process` , and the shared memory is
+    removed by the process that made it with :meth:`.close` .
+
+    Args:
+        shape (tuple): shape of each frame
+        dtype (:class:`numpy.dtype`): dtype of each frame
+        n_slots (int): number of frames that can be waiting to be read
+        mp_context (:class:`multiprocessing.context.BaseContext`): context of the reader's process,
+            default :func:`multiprocessing.get_context`
+
+    Attributes:
+        name (str): name of the shared memory block
+        dropped (int): frames that weren't :meth:`.put` because no slot was freed in time
+    """
+
+    def __init__(self, shape:tuple, dtype:typing.Union[np.dtype, str], n_slots:int=16, mp_context=None):
+        if not SHARED_MEMORY:
+            raise RuntimeError('Shared memory requires python>=3.8')
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.n_slots = n_slots
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.dropped = 0
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(self.frame_nbytes * n_slots, 1))
+        self.name = self._shm.name
+        self._owner = True
+        if mp_context is None:
+            mp_context = mp.get_context()
+        self._index = mp_context.Queue() # (slot, timestamp) of filled slots, or None to end
+        self._free = mp_context.Queue() # slots that can be filled
+        for slot in range(n_slots):
+            self._free.put(slot)
+
+    def put(self, timestamp, frame:np.ndarray, timeout:typing.Optional[float]=None) -> bool:
+        """
+        Copy a frame into a free slot and send it to the reader
+
+        Args:
+            timestamp: timestamp of the frame
+            frame (:class:`numpy.ndarray`): the frame, with :attr:`.shape` and :attr:`.dtype`
+            timeout (float): seconds to wait for a free slot, default forever. ``0`` doesn't wait.
+
+        Returns:
+            bool: ``False`` if the frame was dropped because no slot was free
+        """
+        frame = np.asarray(frame)
+        if frame.shape != self.shape:
+            raise ValueError('frames must have shape {}, got {}'.format(self.shape, frame.shape))
+
+        try:
+            if timeout == 0:
+                slot = self._free.get_nowait()
+            else:
+                slot = self._free.get(timeout=timeout)
+        except Empty:
+            self.dropped += 1
+            return False
+
+        np.copyto(self._slot(slot), frame)
+        self._index.put((slot, timestamp))
+        return True
+
+    def end(self):
+        """
+        Tell the reader there are no more frames
+        """
+        self._index.put(None)
+
+    def get(self, timeout:typing.Optional[float]=None) -> typing.Optional[typing.Tuple[int, typing.Any, np.ndarray]]:
+        """
+        Get the next frame. It must be :meth:`.release` d once used, and isn't copied,
+        so it shouldn't be kept after.
+
+        Args:
+            timeout (float): seconds to wait, default forever
+
+        Returns:
+            tuple: ``(slot, timestamp, frame)`` or ``None`` if the writer has :meth:`.end` ed
+
+        Raises:
+            :class:`queue.Empty` : if no frame came in time
+        """
+        item = self._index.get(timeout=timeout)
+        if item is None:
+            return None
+        slot, timestamp = item
+        return slot, timestamp, self._slot(slot)
+
+    def release(self, slot:int):
+        """
+        Let the writer reuse a slot
+        """
+        self._free.put(slot)
+
+    def qsize(self) -> int:
+        """
+        Approximate number of frames waiting to be read
+        """
+        return self.n_slots - self._free.qsize()
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[int, typing.Any, np.ndarray]]:
+        """
+        Iterate ``(slot, timestamp, frame)`` until the writer :meth:`.end` s
+        """
+        while True:
+            item = self.get()
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        """
+        Let go of the shared memory, and remove it if this process made it.
+
+        Frames gotten from the ring can't be used after.
+        """
+        try:
+            self._shm.close()
+        except BufferError:
+            # a frame is still referenced somewhere, it'll be unmapped when the process ends
+            pass
+        if self._owner:
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _slot(self, slot:int) -> np.ndarray:
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf,
+                          offset=slot * self.frame_nbytes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_shm']
+        state['_owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        try:
+            self._shm = shared_memory.SharedMemory(name=self.name, track=False)
+        except TypeError:
+            # python<3.13 registers every attached block to be unlinked when the process exits,
+            # but the process that made it owns it
+            self._shm = shared_memory.SharedMemory(name=self.name)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self._shm._name, 'shared_memory')
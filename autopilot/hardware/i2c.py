@@ -6,6 +6,7 @@ from autopilot import prefs
 from autopilot.networking import Net_Node
 from autopilot.hardware import Hardware
 from autopilot.hardware.cameras import Camera
+from autopilot.utils import timestamps
 from autopilot.transform.geometry import IMU_Orientation, Spheroid
 from autopilot import external
 
@@ -761,9 +762,9 @@ class MLX90640(Camera):
         Just gets Python timestamps for now...
 
         Returns:
-            str: Isoformatted timestamp from datetime
+            str, int: Isoformatted timestamp from datetime or nanoseconds, see :func:`.timestamps.timestamp`
         """
-        return datetime.now().isoformat()
+        return timestamps.timestamp()
 
     def interpolate_frame(self, frame):
         """
@@ -0,0 +1,458 @@
+"""
+Random access to recorded videos, by frame number or by timestamp, for aligning frames to trial events.
+
+:class:`.Video_Writer` leaves a video (eg. ``.mp4`` ) and a ``.csv`` of the timestamp of each frame,
+and a camera writing ``'raw'`` leaves a :mod:`.frame_store` . :class:`.Video_Reader` reads either.
+
+The first time a video is opened, its packets are listed with ``ffprobe`` (without decoding them)
+and joined with its timestamps into an index, saved next to the video with the extension
+:data:`.INDEX_EXT` , and memory-mapped from then on. Each row of the index (see :data:`.INDEX_DTYPE` )
+is a frame, in presentation order, with its timestamp, its time in the video, the byte offset of its packet,
+and whether it's a keyframe. The index is rebuilt if the video or its timestamps change.
+
+Frames are only decoded when they're asked for: ffmpeg seeks to the frame (from the keyframe before it)
+and decodes only the frames that are needed. :meth:`.Video_Reader.iter_batches` decodes upcoming batches
+in background threads while the current one is used::
+
+    reader = Video_Reader('capture.mp4')
+    reader.seek('2021-01-01T12:00:00.000000')
+    frames = reader.read(10)
+
+    # 5 frames before and after each event
+    indices, clips = reader.frames_around(event_times, before=5, after=5)
+
+    for batch_timestamps, batch in reader.iter_batches(batch_size=64):
+        ...
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import typing
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE
+
+import numpy as np
+
+from autopilot.hardware.frame_store import EXTS, Frame_Store
+from autopilot.utils import timestamps
+
+INDEX_EXT = '.vidx'
+"""
+Extension of the index saved next to a video
+"""
+
+INDEX_MAGIC = b'APVIDX01'
+"""
+First bytes of an index file, followed by the uint32 length of a json header and the header
+"""
+
+INDEX_DTYPE = np.dtype([
+    ('timestamp', '<i8'), # int64 nanoseconds, see :func:`.timestamps.to_ns`
+    ('pts', '<f8'),       # seconds from the start of the video
+    ('offset', '<i8'),    # byte offset of the frame's packet in the file
+    ('key', '?')          # whether the frame is a keyframe
+])
+"""
+dtype of the rows of a video's index, one per frame
+"""
+
+DECODE_FORMATS = {
+    'gray': ('gray', None, np.uint8),
+    'gray16': ('gray16le', None, np.uint16),
+    'rgb': ('rgb24', 3, np.uint8),
+    'rgb48': ('rgb48le', 3, np.uint16),
+}
+"""
+ffmpeg ``-pix_fmt`` , number of channels, and dtype that videos are decoded to,
+depending on the pixel format they were encoded with
+"""
+
+
+def _decode_format(src_pix_fmt:str) -> typing.Tuple[str, typing.Optional[int], type]:
+    if src_pix_fmt.startswith('gray'):
+        if '16' in src_pix_fmt or '10' in src_pix_fmt or '12' in src_pix_fmt:
+            return DECODE_FORMATS['gray16']
+        return DECODE_FORMATS['gray']
+    if '48' in src_pix_fmt or '64' in src_pix_fmt or '16' in src_pix_fmt:
+        return DECODE_FORMATS['rgb48']
+    return DECODE_FORMATS['rgb']
+
+
+def read_timestamps(path:str) -> np.ndarray:
+    """
+    Read the ``.csv`` of timestamps written by :class:`.Video_Writer` , in any format
+
+    Args:
+        path (str): path of the video or the .csv
+
+    Returns:
+        :class:`numpy.ndarray` : int64 nanosecond timestamps
+    """
+    with open(os.path.splitext(path)[0] + '.csv', 'r') as ts_file:
+        return np.array([timestamps.to_ns(line.strip()) for line in ts_file if line.strip()], dtype=np.int64)
+
+
+def probe(path:str) -> typing.Tuple[dict, np.ndarray]:
+    """
+    List the packets of a video's first video stream with ``ffprobe`` , without decoding them
+
+    Args:
+        path (str): path of the video
+
+    Returns:
+        (dict, :class:`numpy.ndarray` ): the stream's ``width`` , ``height`` , ``pix_fmt`` , and ``fps`` ,
+        and an array of :data:`.INDEX_DTYPE` in presentation order, with timestamps from ``pts``
+    """
+    if shutil.which('ffprobe') is None:
+        raise ImportError(
+            'ffprobe could not be found on the system, and it is needed in order to read videos. install it with apt (sudo apt update && sudo apt install ffmpeg)')
+
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-of', 'json',
+         '-show_entries', 'stream=width,height,pix_fmt,avg_frame_rate,r_frame_rate:packet=pts_time,pos,flags',
+         path], stdout=PIPE, stderr=PIPE, check=True)
+    probed = json.loads(result.stdout.decode('utf-8'))
+
+    stream = probed['streams'][0]
+    rate = stream.get('avg_frame_rate', '0/0')
+    if rate in ('0/0', ''):
+        rate = stream.get('r_frame_rate', '0/1')
+    num, den = (float(part) for part in rate.split('/'))
+    info = {
+        'width': int(stream['width']),
+        'height': int(stream['height']),
+        'pix_fmt': stream.get('pix_fmt', 'rgb24'),
+        'fps': num / den if den else None
+    }
+
+    packets = [p for p in probed.get('packets', []) if p.get('pts_time', 'N/A') != 'N/A']
+    index = np.zeros(len(packets), dtype=INDEX_DTYPE)
+    index['pts'] = [float(p['pts_time']) for p in packets]
+    index['offset'] = [int(p['pos']) if p.get('pos', 'N/A') != 'N/A' else -1 for p in packets]
+    index['key'] = ['K' in p.get('flags', '') for p in packets]
+    # packets are listed in decoding order
+    index = index[np.argsort(index['pts'], kind='stable')]
+    index['timestamp'] = np.round(index['pts'] * 1e9).astype(np.int64)
+    return info, index
+
+
+class Video_Reader(object):
+    """
+    Read frames from a recorded video or :mod:`.frame_store` by frame number or timestamp,
+    decoding only the frames that are asked for.
+
+    Indexing gives frames as arrays::
+
+        reader[10]           # one frame
+        reader[10:20]        # a (10,) + shape array
+        reader[[5, 50, 500]] # any frames, decoding each run of nearby frames once
+
+    Args:
+        path (str): path of the video, eg. ``.mp4`` , or any of a frame store's files
+        batch_size (int): frames per batch in :meth:`.iter_batches` , default :attr:`.batch_size`
+        prefetch (int): batches decoded ahead in :meth:`.iter_batches` , default :attr:`.prefetch`
+        rebuild (bool): rebuild the index even if it's up to date
+
+    Attributes:
+        path (str): path of the video
+        index (:class:`numpy.ndarray` ): :data:`.INDEX_DTYPE` row for each frame, memory-mapped from :attr:`.index_path`
+        index_path (str): path of the index, or ``None`` for frame stores (which have their own)
+        shape (tuple): shape of frames
+        dtype (:class:`numpy.dtype`): dtype of frames
+        fps (float): framerate of the video
+        position (int): frame that :meth:`.read` reads next, set by :meth:`.seek`
+    """
+
+    batch_size = 32 # frames per batch in iter_batches
+    prefetch = 2 # batches decoded ahead of the one being used in iter_batches
+    merge_gap = 30 # frames apart that requested frames can be and still be decoded in one run
+
+    def __init__(self, path:str, batch_size:typing.Optional[int]=None,
+                 prefetch:typing.Optional[int]=None, rebuild:bool=False):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if prefetch is not None:
+            self.prefetch = prefetch
+
+        self.position = 0
+        self._store = None # type: typing.Optional[Frame_Store]
+
+        if os.path.splitext(path)[1] in EXTS:
+            self._store = Frame_Store(path)
+            self.path = self._store.path
+            self.index_path = None
+            self.shape = self._store.shape
+            self.dtype = self._store.dtype
+            self.fps = self._store.fps
+            self.index = np.zeros(len(self._store), dtype=INDEX_DTYPE)
+            self.index['timestamp'] = self._store.timestamps
+            self.index['pts'] = np.arange(len(self._store)) / (self.fps if self.fps else 1)
+            self.index['offset'] = np.arange(len(self._store)) * self._store.frame_nbytes
+            self.index['key'] = True
+            self._pix_fmt = None
+        else:
+            self.path = path
+            self.index_path = os.path.splitext(path)[0] + INDEX_EXT
+            header = None if rebuild else self._load_index()
+            if header is None:
+                header = self.build_index()
+            self.fps = header['fps']
+            self._pix_fmt, channels, dtype = _decode_format(header['pix_fmt'])
+            self.shape = (header['height'], header['width']) + ((channels,) if channels else ())
+            self.dtype = np.dtype(dtype)
+
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        """
+        int64 nanosecond timestamp of each frame
+        """
+        return self.index['timestamp']
+
+    def _source_stat(self) -> dict:
+        stat = os.stat(self.path)
+        ts_path = os.path.splitext(self.path)[0] + '.csv'
+        return {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'ts_size': os.path.getsize(ts_path) if os.path.exists(ts_path) else None
+        }
+
+    def _load_index(self) -> typing.Optional[dict]:
+        """
+        Memory-map the index if it's up to date with the video
+
+        Returns:
+            dict: the index's header, or ``None`` if it needs to be built
+        """
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, 'rb') as index_file:
+            if index_file.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return None
+            header_len = int(np.frombuffer(index_file.read(4), dtype='<u4')[0])
+            header = json.loads(index_file.read(header_len).decode('utf-8'))
+        if header.get('source') != self._source_stat():
+            return None
+
+        offset = len(INDEX_MAGIC) + 4 + header_len
+        if header['n_frames'] > 0:
+            self.index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode='r',
+                                   offset=offset, shape=(header['n_frames'],))
+        else:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        return header
+
+    def build_index(self) -> dict:
+        """
+        :func:`.probe` the video, join its packets with its timestamps (see :func:`.read_timestamps` ),
+        and save the index to :attr:`.index_path` .
+
+        If the index can't be saved (eg. the video is in a read-only archive), it's kept in memory.
+
+        Returns:
+            dict: the index's header
+        """
+        info, index = probe(self.path)
+
+        if os.path.exists(os.path.splitext(self.path)[0] + '.csv'):
+            frame_timestamps = read_timestamps(self.path)
+            if len(frame_timestamps) != len(index):
+                warnings.warn('{} has {} frames but {} timestamps, using the first {}'.format(
+                    self.path, len(index), len(frame_timestamps), min(len(index), len(frame_timestamps))))
+                n_frames = min(len(index), len(frame_timestamps))
+                index = index[:n_frames]
+                frame_timestamps = frame_timestamps[:n_frames]
+            index['timestamp'] = frame_timestamps
+        else:
+            warnings.warn('No timestamps found for {}, using the time of frames in the video'.format(self.path))
+
+        header = dict(info, n_frames=len(index), source=self._source_stat())
+        header_bytes = json.dumps(header).encode('utf-8')
+        self.index = index
+        try:
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'wb') as index_file:
+                index_file.write(INDEX_MAGIC)
+                index_file.write(np.uint32(len(header_bytes)).tobytes())
+                index_file.write(header_bytes)
+                index_file.write(index.tobytes())
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            warnings.warn('Could not save index of {}, keeping it in memory. got exception {}'.format(self.path, e))
+        return header
+
+    def index_of(self, timestamp) -> int:
+        """
+        Index of the last frame at or before a timestamp (or the first frame, if it's before every frame)
+
+        Args:
+            timestamp: anything :func:`.timestamps.to_ns` can convert
+
+        Returns:
+            int
+        """
+        i = int(np.searchsorted(self.timestamps, timestamps.to_ns(timestamp), side='right')) - 1
+        return max(i, 0)
+
+    def seek(self, timestamp) -> int:
+        """
+        Set :attr:`.position` to the frame at a timestamp (see :meth:`.index_of` )
+
+        Args:
+            timestamp: anything :func:`.timestamps.to_ns` can convert
+
+        Returns:
+            int: the frame number
+        """
+        self.position = self.index_of(timestamp)
+        return self.position
+
+    def read(self, n_frames:int=1) -> np.ndarray:
+        """
+        Read frames from :attr:`.position` , and advance it
+
+        Args:
+            n_frames (int): number of frames to read
+
+        Returns:
+            :class:`numpy.ndarray` : ``(n,) + shape`` , fewer than ``n_frames`` at the end of the video
+        """
+        start = self.position
+        stop = min(start + n_frames, len(self))
+        self.position = stop
+        return self._decode(start, stop)
+
+    def _decode(self, start:int, stop:int) -> np.ndarray:
+        """
+        Decode frames ``start:stop`` into memory
+        """
+        if stop <= start:
+            return np.empty((0,) + self.shape, dtype=self.dtype)
+        if self._store is not None:
+            return np.array(self._store.frames[start:stop])
+
+        # seek to halfway between the previous frame and this one so rounding doesn't matter,
+        # ffmpeg decodes from the keyframe before it and drops the frames before the seek time.
+        # seek times are from the start of the video, rather than its first pts.
+        seek_to = float(self.index['pts'][start])
+        if start > 0:
+            seek_to = (seek_to + float(self.index['pts'][start - 1])) / 2
+        seek_to -= float(self.index['pts'][0])
+        command = ['ffmpeg', '-v', 'error', '-nostdin',
+                   '-ss', '{:.6f}'.format(max(seek_to, 0)), '-i', self.path,
+                   '-frames:v', str(stop - start), '-an', '-vsync', '0',
+                   '-f', 'rawvideo', '-pix_fmt', self._pix_fmt, 'pipe:1']
+        result = subprocess.run(command, stdout=PIPE, stderr=PIPE)
+        if result.returncode != 0:
+            raise RuntimeError('ffmpeg could not decode frames {}:{} of {}, got {}'.format(
+                start, stop, self.path, result.stderr.decode('utf-8', 'replace')))
+        n_decoded = len(result.stdout) // self.frame_nbytes
+        return np.frombuffer(result.stdout, dtype=self.dtype,
+                             count=n_decoded * int(np.prod(self.shape))).reshape((n_decoded,) + self.shape)
+
+    def _take(self, indices:np.ndarray) -> np.ndarray:
+        """
+        Decode any frames, in the order given, decoding runs of frames within
+        :attr:`.merge_gap` of each other once
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty(indices.shape + self.shape, dtype=self.dtype)
+        if indices.size == 0:
+            return out
+        if indices.min() < 0 or indices.max() >= len(self):
+            raise IndexError('frame index out of range for video with {} frames'.format(len(self)))
+
+        flat = indices.ravel()
+        unique = np.unique(flat)
+        breaks = np.nonzero(np.diff(unique) > self.merge_gap)[0] + 1
+        flat_out = out.reshape((-1,) + self.shape)
+        for run in np.split(unique, breaks):
+            frames = self._decode(int(run[0]), int(run[-1]) + 1)
+            in_run = (flat >= run[0]) & (flat <= run[-1])
+            flat_out[in_run] = frames[flat[in_run] - run[0]]
+        return out
+
+    def frames_around(self, events:typing.Iterable, before:int=0, after:int=0) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Frames around each of a list of events, eg. the timestamps of trials' responses
+
+        Windows near the start or end of the video repeat the first or last frame,
+        check the returned indices to tell.
+
+        Args:
+            events (list): timestamps, anything :func:`.timestamps.to_ns` can convert
+            before (int): frames before the frame at each event
+            after (int): frames after the frame at each event
+
+        Returns:
+            (:class:`numpy.ndarray` , :class:`numpy.ndarray` ): frame numbers ``(n_events, before + 1 + after)`` ,
+            and frames ``(n_events, before + 1 + after) + shape``
+        """
+        centers = np.array([self.index_of(event) for event in events], dtype=np.int64)
+        indices = centers[:, np.newaxis] + np.arange(-before, after + 1)[np.newaxis, :]
+        indices = np.clip(indices, 0, max(len(self) - 1, 0))
+        return indices, self._take(indices)
+
+    def iter_batches(self, start:int=0, stop:typing.Optional[int]=None,
+                     batch_size:typing.Optional[int]=None,
+                     prefetch:typing.Optional[int]=None) -> typing.Iterator[typing.Tuple[np.ndarray, np.ndarray]]:
+        """
+        Iterate batches of frames, decoding the next ``prefetch`` batches in threads while one is used
+
+        Args:
+            start (int): first frame
+            stop (int): frame to stop before, default the end of the video
+            batch_size (int): default :attr:`.batch_size`
+            prefetch (int): default :attr:`.prefetch`
+
+        Yields:
+            (:class:`numpy.ndarray` , :class:`numpy.ndarray` ): timestamps ``(n,)`` and frames ``(n,) + shape``
+        """
+        stop = len(self) if stop is None else min(stop, len(self))
+        batch_size = self.batch_size if batch_size is None else batch_size
+        prefetch = self.prefetch if prefetch is None else prefetch
+
+        bounds = deque((i, min(i + batch_size, stop)) for i in range(start, stop, batch_size))
+        with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as pool:
+            pending = deque()
+            try:
+                while bounds or pending:
+                    while bounds and len(pending) <= prefetch:
+                        batch_start, batch_stop = bounds.popleft()
+                        pending.append((batch_start, batch_stop, pool.submit(self._decode, batch_start, batch_stop)))
+                    batch_start, batch_stop, future = pending.popleft()
+                    yield np.array(self.timestamps[batch_start:batch_stop]), future.result()
+            finally:
+                for _, _, future in pending:
+                    future.cancel()
+
+    def __getitem__(self, item) -> np.ndarray:
+        if isinstance(item, (int, np.integer)):
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError('frame {} out of range for video with {} frames'.format(item, len(self)))
+            return self._decode(int(item), int(item) + 1)[0]
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step == 1:
+                return self._decode(start, stop)
+            return self._take(np.arange(start, stop, step))
+        return self._take(item)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[int, np.ndarray]]:
+        """
+        Iterate ``(timestamp, frame)`` , decoding in batches with :meth:`.iter_batches`
+        """
+        for batch_timestamps, frames in self.iter_batches():
+            for timestamp, frame in zip(batch_timestamps, frames):
+                yield int(timestamp), frame
@@ -11,8 +11,15 @@ There are two general types of network objects -
     wants to send or receive messages.
 
 The :class:`~autopilot.networking.Message` object is used to serialize and pass
-messages. When sent, messages are ``JSON`` serialized (with some special magic
-to compress/encode numpy arrays) and sent as ``zmq`` multipart messages.
+messages. When sent, messages are serialized either as ``JSON`` (with some special magic
+to compress/encode numpy arrays) or in a binary format (a msgpack header followed by
+the raw buffers of any arrays) and sent as ``zmq`` multipart messages. Each object
+uses the format in ``prefs.get('MSG_FORMAT')`` unless the recipient has told it
+that it can only read JSON.
+
+Objects on the same computer connect through ``ipc://`` rather than ``tcp://`` endpoints,
+and :class:`.Net_Node` s send large arrays to their upstream through shared memory
+(see :mod:`.networking.local` ).
 
 Each serialized message, when sent, can have ``n`` frames of the format::
 
@@ -0,0 +1,216 @@
+"""
+Keep messages on disk until their recipient confirms them, so they can be sent again
+after the recipient (eg. the :class:`.Terminal` ) has been unreachable or restarted.
+
+:class:`.Pilot_Station` stores every ``DATA`` message it sends in a :class:`.Backlog`
+and removes it when it's confirmed. If a message runs out of retries, it stops sending
+new messages live, and replays the backlog in batches once the terminal answers again
+(see :meth:`.Pilot_Station.replay` ).
+
+Each message is given an id, ``{token}_{n}`` , where ``token`` is made when the backlog file is created
+and ``n`` counts up and is never reused. Dict values also get the id as their ``data_id`` ,
+so whoever receives them can drop ones it has already received (see :class:`.Seen_Ids` ).
+"""
+
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import typing
+import uuid
+
+import numpy as np
+
+from autopilot.core.loggers import init_logger
+
+BACKLOG_FN = 'backlog.sqlite3'
+"""
+Filename of the :class:`.Pilot_Station` 's backlog, in ``prefs.get('DATADIR')``
+"""
+
+
+def _json_default(obj):
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    if isinstance(obj, bytes):
+        return obj.decode('utf-8')
+    return str(obj)
+
+
+class Backlog(object):
+    """
+    sqlite queue of messages waiting to be confirmed.
+
+    Thread-safe.
+
+    Args:
+        path (str): path to the database, created if it doesn't exist
+    """
+
+    id_key = 'data_id' # key that ids are added to dict values as
+
+    def __init__(self, path:str):
+        self.path = path
+        self.logger = init_logger(self)
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # WAL is durable across crashes of this process with synchronous=NORMAL,
+            # only a power cut can lose the last few messages
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS messages (
+                n INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT,
+                value TEXT
+            )""")
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+            self._conn.execute('INSERT OR IGNORE INTO meta (name, value) VALUES (?, ?)',
+                               ('token', uuid.uuid4().hex[:12]))
+            self.token = self._conn.execute("SELECT value FROM meta WHERE name = 'token'").fetchone()[0]
+
+    def add(self, key:str, value:typing.Any) -> str:
+        """
+        Store a message
+
+        Args:
+            key (str): the message's key
+            value: its value, JSON serializable. If a dict, its id is added as :attr:`.id_key`
+
+        Returns:
+            str: the message's id
+        """
+        with self._lock, self._conn:
+            n = self._conn.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', ('messages',)).fetchone()
+            id = self._id(n[0] + 1 if n is not None else 1)
+            if isinstance(value, dict):
+                value[self.id_key] = id
+            self._conn.execute('INSERT INTO messages (n, key, value) VALUES (?, ?, ?)',
+                               (self._n(id), key, json.dumps(value, default=_json_default)))
+        return id
+
+    def confirm(self, ids:typing.Iterable[str]) -> int:
+        """
+        Remove confirmed messages. Ids that aren't ours are ignored.
+
+        Args:
+            ids (list): ids of confirmed messages
+
+        Returns:
+            int: number of messages removed
+        """
+        ns = [(n,) for n in (self._n(id) for id in ids) if n is not None]
+        if not ns:
+            return 0
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany('DELETE FROM messages WHERE n = ?', ns)
+            return self._conn.total_changes - before
+
+    def pending(self, limit:typing.Optional[int]=None) -> typing.List[typing.Tuple[str, str, typing.Any]]:
+        """
+        Messages that haven't been confirmed, oldest first
+
+        Args:
+            limit (int): at most this many
+
+        Returns:
+            list: of ``(id, key, value)`` tuples
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT n, key, value FROM messages ORDER BY n LIMIT ?',
+                                      (limit if limit is not None else -1,)).fetchall()
+        return [(self._id(n), key, json.loads(value)) for n, key, value in rows]
+
+    def owns(self, id:str) -> bool:
+        """
+        Whether an id was made by this backlog
+        """
+        return self._n(id) is not None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _id(self, n:int) -> str:
+        return '{}_{}'.format(self.token, n)
+
+    def _n(self, id:str) -> typing.Optional[int]:
+        if not isinstance(id, str):
+            return None
+        token, _, n = id.rpartition('_')
+        if token != self.token or not n.isdigit():
+            return None
+        return int(n)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+
+
+class Seen_Ids(object):
+    """
+    Set of ids made by :class:`.Backlog` s, to drop messages that are received more than once.
+
+    Ids are kept as ranges of ``n`` for each ``token`` , so a long run of messages
+    takes one range, and the set can be stored (eg. as an hdf5 attribute) with :meth:`.to_json` .
+
+    Args:
+        ranges (dict, str): ``{token: [[first, last], ...]}`` , or its JSON, from :meth:`.to_json`
+
+    Attributes:
+        ranges (dict): ``{token: [[first, last], ...]}`` , sorted and not overlapping
+    """
+
+    max_ranges = 256 # ranges kept for each token, the oldest are forgotten first
+
+    def __init__(self, ranges:typing.Union[dict, str, None]=None):
+        if isinstance(ranges, str):
+            ranges = json.loads(ranges)
+        self.ranges = {token: [list(r) for r in rs] for token, rs in (ranges or {}).items()} # type: typing.Dict[str, typing.List[typing.List[int]]]
+
+    def add(self, id:str) -> bool:
+        """
+        Add an id
+
+        Args:
+            id (str): ``{token}_{n}``
+
+        Returns:
+            bool: ``True`` if it's new (or isn't a :class:`.Backlog` id), ``False`` if it was already seen
+        """
+        token, _, n = str(id).rpartition('_')
+        if not token or not n.isdigit():
+            return True
+        n = int(n)
+        ranges = self.ranges.setdefault(token, [])
+
+        # index of the first range that starts after n
+        i = bisect.bisect_right([r[0] for r in ranges], n)
+        if i > 0 and ranges[i - 1][1] >= n:
+            return False
+
+        if i > 0 and ranges[i - 1][1] == n - 1:
+            ranges[i - 1][1] = n
+            if i < len(ranges) and ranges[i][0] == n + 1:
+                ranges[i - 1][1] = ranges.pop(i)[1]
+        elif i < len(ranges) and ranges[i][0] == n + 1:
+            ranges[i][0] = n
+        else:
+            ranges.insert(i, [n, n])
+            if len(ranges) > self.max_ranges:
+                ranges.pop(0)
+        return True
+
+    def __contains__(self, id:str) -> bool:
+        token, _, n = str(id).rpartition('_')
+        if not n.isdigit():
+            return False
+        n = int(n)
+        return any(first <= n <= last for first, last in self.ranges.get(token, []))
+
+    def to_json(self) -> str:
+        return json.dumps(self.ranges)
@@ -0,0 +1,393 @@
+"""
+Headless benchmarks of networking throughput and latency.
+
+Unlike the :class:`~.gui.Bandwidth_Test` dialog, which needs a running terminal and pilot,
+these spin up their own networking objects on localhost, so they can be run anywhere
+and compared before and after a change::
+
+    python -m autopilot.networking.benchmark --out before.json
+    # ... change something ...
+    python -m autopilot.networking.benchmark --out after.json
+
+Each :class:`.Bench_Case` measures one combination of
+
+* ``scenario`` -
+
+    * ``'codec'`` - :meth:`.Message.serialize` and deserialization, no sockets
+    * ``'direct'`` - :class:`.Net_Node` to :class:`.Net_Node`
+    * ``'station'`` - :class:`.Net_Node` to a pilot-side :class:`.Station` (pushing upstream like a
+      :class:`.Pilot_Station` ) to a :class:`.Terminal_Station` to a :class:`.Net_Node` , the path data
+      takes from a pilot to the terminal.
+    * ``'stream'`` - :meth:`.Net_Node.get_stream` to a :class:`.Net_Node` , batching ``batch`` items per message
+
+* ``payload`` - one of :data:`.PAYLOADS` : ``'scalar'`` , ``'dict'`` , or ``'frame'`` (640x480 uint8)
+* ``fmt`` - wire format, see :data:`.SERIALIZERS`
+* ``confirm`` - whether messages are sent with ``repeat=True`` and confirmed (only ``'direct'`` ,
+  since confirmations don't route back through stations to nodes).
+
+and reports messages per second, MB per second, the median and 99th percentile of the one-way
+latency, and CPU time per message (of this process and any stations).
+
+Senders keep at most ``window`` messages in flight, so latencies reflect the transport rather than
+an ever-growing queue.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import typing
+from dataclasses import dataclass, asdict
+
+import numpy as np
+import zmq
+
+from autopilot.networking.message import Message, SERIALIZERS
+
+PAYLOADS = {
+    'scalar': lambda: 1,
+    'dict': lambda: {'trial_num': 1, 'response': 'L', 'correct': True, 'RQ_timestamp': '2021-01-01T00:00:00',
+                     'target': 'R', 'stim': 'sound_1', 'bailed': 0, 'type': 'stage', 'duration': 0.25},
+    'frame': lambda: np.random.randint(0, 256, (480, 640), dtype=np.uint8)
+}
+"""
+Functions to make each kind of payload
+"""
+
+SCENARIOS = ('codec', 'direct', 'station', 'stream')
+
+
+@dataclass
+class Bench_Case:
+    """
+    One benchmark to run, see the module docstring.
+    """
+    scenario: str
+    payload: str
+    fmt: str
+    n: int
+    confirm: bool = False
+    batch: int = 1
+    window: int = 16
+
+
+@dataclass
+class Bench_Result:
+    """
+    Results of a :class:`.Bench_Case`
+
+    Attributes:
+        case (dict): the :class:`.Bench_Case` as a dict
+        received (int): messages received, should equal ``case['n']``
+        msgs_per_sec (float): messages per second
+        mb_per_sec (float): serialized megabytes per second
+        msg_bytes (int): size of one serialized message
+        latency_p50_ms (float): median one-way latency in milliseconds (``None`` for ``'codec'``)
+        latency_p99_ms (float): 99th percentile latency in milliseconds
+        cpu_per_msg_us (float): CPU microseconds used per message by this process and any stations
+    """
+    case: dict
+    received: int
+    msgs_per_sec: float
+    mb_per_sec: float
+    msg_bytes: int
+    latency_p50_ms: typing.Optional[float] = None
+    latency_p99_ms: typing.Optional[float] = None
+    cpu_per_msg_us: typing.Optional[float] = None
+
+
+def _process_cpu(pid:int) -> typing.Optional[float]:
+    """
+    CPU seconds used by another process, on linux. ``None`` elsewhere.
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid), 'r') as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+        # utime and stime, fields 14 and 15 in proc(5), counting from after the command name
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _cpu(pids:typing.List[int]) -> typing.Optional[float]:
+    total = time.process_time()
+    for pid in pids:
+        cpu = _process_cpu(pid)
+        if cpu is None:
+            return None
+        total += cpu
+    return total
+
+
+def _port() -> int:
+    # ask the OS for a free port rather than guessing
+    context = zmq.Context.instance()
+    sock = context.socket(zmq.ROUTER)
+    port = sock.bind_to_random_port('tcp://*', min_port=5000, max_port=8000)
+    sock.close(linger=0)
+    return port
+
+
+class _Receiver(object):
+    """
+    Records the latency of each received value, which carry their send time in ``'t'``
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.count = 0
+        self.cond = threading.Condition()
+
+    def __call__(self, value):
+        now = time.perf_counter_ns()
+        with self.cond:
+            if value.get('warmup'):
+                self.count += 1
+            else:
+                self.latencies.append(now - value['t'])
+                self.count += 1
+            self.cond.notify_all()
+
+    def wait(self, count:int, timeout:float=10) -> bool:
+        with self.cond:
+            return self.cond.wait_for(lambda: self.count >= count, timeout)
+
+
+def _msg_bytes(case:Bench_Case, payload) -> int:
+    msg = Message(to='bench_receiver', key='BENCH', value={'t': time.perf_counter_ns(), 'payload': payload},
+                  id='bench_0', sender='bench_sender', flags={'MINPRINT': True})
+    return len(msg.serialize(case.fmt))
+
+
+def bench_codec(case:Bench_Case) -> Bench_Result:
+    """
+    Serialize and deserialize ``n`` messages
+    """
+    payload = PAYLOADS[case.payload]()
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(case.n):
+        msg = Message(to='bench_receiver', key='BENCH', value={'t': 0, 'payload': payload},
+                      id='bench_{}'.format(i), sender='bench_sender', flags={'MINPRINT': True})
+        received = Message(msg.serialize(case.fmt), expand_arrays=True)
+        received.value
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+
+    msg_bytes = _msg_bytes(case, payload)
+    return Bench_Result(case=asdict(case), received=case.n,
+                        msgs_per_sec=case.n / elapsed,
+                        mb_per_sec=case.n * msg_bytes / elapsed / 1e6,
+                        msg_bytes=msg_bytes,
+                        cpu_per_msg_us=cpu / case.n * 1e6)
+
+
+def bench_network(case:Bench_Case) -> Bench_Result:
+    """
+    Send ``n`` messages from one :class:`.Net_Node` to another, directly,
+    through stations, or as a stream depending on ``case.scenario``
+    """
+    # import here so the codec benchmark doesn't need the full networking stack
+    from autopilot.networking import Net_Node, Station, Terminal_Station
+
+    receiver = _Receiver()
+    payload = PAYLOADS[case.payload]()
+    stations = []
+    nodes = []
+
+    try:
+        if case.scenario == 'station':
+            terminal_port = _port()
+            pilot_port = _port()
+            terminal = Terminal_Station(pilots={})
+            terminal.listen_port = terminal_port
+            pilot = Station(id='bench_pilot', listen_port=pilot_port, pusher=True,
+                            push_ip='localhost', push_port=terminal_port, push_id='T')
+            for station in (terminal, pilot):
+                station.msg_format = case.fmt
+                station.start()
+                stations.append(station)
+            time.sleep(0.5)
+
+            recv_node = Net_Node('bench_receiver', upstream='T', port=terminal_port,
+                                 listens={'BENCH': receiver}, instance=False, msg_format=case.fmt)
+            send_node = Net_Node('bench_sender', upstream='bench_pilot', port=pilot_port,
+                                 listens={}, instance=False, msg_format=case.fmt)
+        else:
+            recv_port = _port()
+            recv_node = Net_Node('bench_receiver', upstream='', port=_port(), router_port=recv_port,
+                                 listens={'BENCH': receiver}, instance=False, msg_format=case.fmt)
+            send_node = Net_Node('bench_sender', upstream='bench_receiver', port=recv_port,
+                                 listens={}, instance=False, msg_format=case.fmt)
+        nodes.extend([recv_node, send_node])
+        time.sleep(0.2)
+
+        # make sure everything is connected, and the terminal station knows the receiver
+        if case.scenario == 'station':
+            recv_node.send(to='bench_receiver', key='BENCH', value={'warmup': True})
+        send_node.send(to='bench_receiver', key='BENCH', value={'warmup': True})
+        n_warmup = 2 if case.scenario == 'station' else 1
+        if not receiver.wait(n_warmup, timeout=5):
+            raise RuntimeError('Benchmark {} could not connect'.format(case))
+
+        stream = None
+        if case.scenario == 'stream':
+            stream = send_node.get_stream('bench', 'BENCH', min_size=case.batch, upstream='bench_receiver',
+                                          port=recv_port, ip='localhost', q_size=case.n + 1,
+                                          max_latency=0.01)
+
+        pids = [station.pid for station in stations]
+        start_cpu = _cpu(pids)
+        start = time.perf_counter()
+        for i in range(case.n):
+            # keep at most window messages in flight (and at least a batch for streams)
+            receiver.wait(n_warmup + i - max(case.window, case.batch), timeout=10)
+            value = {'t': time.perf_counter_ns(), 'payload': payload}
+            if stream is not None:
+                stream.append(value)
+            else:
+                send_node.send(to='bench_receiver', key='BENCH', value=value, repeat=case.confirm)
+        receiver.wait(n_warmup + case.n, timeout=10)
+        if case.confirm:
+            while len(send_node.outbox) > 0 and time.perf_counter() - start < 30:
+                time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        end_cpu = _cpu(pids)
+
+        if stream is not None:
+            stream.append('END')
+
+    finally:
+        for node in nodes:
+            node.release()
+        for station in stations:
+            station.release()
+            station.join(timeout=1)
+            if station.is_alive():
+                station.terminate()
+
+    latencies = np.array(receiver.latencies) / 1e6
+    msg_bytes = _msg_bytes(case, payload)
+    received = len(latencies)
+    return Bench_Result(case=asdict(case), received=received,
+                        msgs_per_sec=received / elapsed,
+                        mb_per_sec=received * msg_bytes / elapsed / 1e6,
+                        msg_bytes=msg_bytes,
+                        latency_p50_ms=float(np.percentile(latencies, 50)) if received else None,
+                        latency_p99_ms=float(np.percentile(latencies, 99)) if received else None,
+                        cpu_per_msg_us=(end_cpu - start_cpu) / case.n * 1e6 if start_cpu is not None else None)
+
+
+def default_cases(quick:bool=False) -> typing.List[Bench_Case]:
+    """
+    Every scenario with every payload and format, plus with and without confirmation for
+    ``'direct'`` and a few batch sizes for ``'stream'`` .
+
+    Args:
+        quick (bool): send fewer messages, eg. to check that everything runs.
+
+    Returns:
+        list: of :class:`.Bench_Case` s
+    """
+    n_msgs = {'scalar': 2000, 'dict': 2000, 'frame': 200}
+    if quick:
+        n_msgs = {k: max(v // 100, 5) for k, v in n_msgs.items()}
+
+    cases = []
+    for fmt in SERIALIZERS:
+        for payload, n in n_msgs.items():
+            cases.append(Bench_Case('codec', payload, fmt, n))
+            for confirm in (False, True):
+                cases.append(Bench_Case('direct', payload, fmt, n, confirm=confirm))
+            cases.append(Bench_Case('station', payload, fmt, n))
+            for batch in (1, 10, 50):
+                cases.append(Bench_Case('stream', payload, fmt, n, batch=batch))
+    return cases
+
+
+def run(cases:typing.Optional[typing.List[Bench_Case]]=None, out:typing.Optional[str]=None,
+        verbose:bool=True) -> dict:
+    """
+    Run benchmarks and optionally save the results
+
+    Args:
+        cases (list): :class:`.Bench_Case` s to run, default :func:`.default_cases`
+        out (str): path to write results to as JSON
+        verbose (bool): print each result as it finishes
+
+    Returns:
+        dict: ``{'meta': {...}, 'results': [...]}`` , where ``meta`` describes the machine and
+        library versions, and ``results`` is a list of :class:`.Bench_Result` dicts
+    """
+    import autopilot
+    try:
+        import msgpack
+        msgpack_version = '.'.join(str(v) for v in msgpack.version)
+    except ImportError:
+        msgpack_version = None
+
+    if cases is None:
+        cases = default_cases()
+
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.now().isoformat(),
+            'autopilot': autopilot.__version__,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'zmq': zmq.zmq_version(),
+            'pyzmq': zmq.__version__,
+            'msgpack': msgpack_version,
+            'numpy': np.__version__
+        },
+        'results': []
+    }
+
+    for case in cases:
+        if case.scenario == 'codec':
+            result = bench_codec(case)
+        else:
+            result = bench_network(case)
+        results['results'].append(asdict(result))
+        if verbose:
+            print('{scenario:8} {payload:7} {fmt:7} confirm={confirm!s:5} batch={batch:3} | '.format(**result.case) +
+                  '{:10.1f} msg/s {:8.2f} MB/s p50 {} p99 {} ms, {} us cpu/msg'.format(
+                      result.msgs_per_sec, result.mb_per_sec,
+                      *['{:.3f}'.format(v) if v is not None else '-' for v in
+                        (result.latency_p50_ms, result.latency_p99_ms, result.cpu_per_msg_us)]))
+
+    if out is not None:
+        with open(out, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark autopilot networking')
+    parser.add_argument('--out', help='path to save results as JSON', default=None)
+    parser.add_argument('--quick', help='send fewer messages', action='store_true')
+    parser.add_argument('--scenario', help='only run these scenarios', nargs='+', choices=SCENARIOS)
+    parser.add_argument('--payload', help='only use these payloads', nargs='+', choices=list(PAYLOADS.keys()))
+    parser.add_argument('--fmt', help='only use these formats', nargs='+', choices=SERIALIZERS)
+    args = parser.parse_args()
+
+    cases = default_cases(quick=args.quick)
+    if args.scenario:
+        cases = [case for case in cases if case.scenario in args.scenario]
+    if args.payload:
+        cases = [case for case in cases if case.payload in args.payload]
+    if args.fmt:
+        cases = [case for case in cases if case.fmt in args.fmt]
+
+    run(cases, out=args.out)
+
+
+if __name__ == "__main__":
+    main()
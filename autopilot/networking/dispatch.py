@@ -0,0 +1,201 @@
+"""
+Dispatch received messages to their ``listen`` methods.
+
+Rather than spawning a thread for every received message, :class:`.Dispatcher`
+keeps a fixed pool of worker threads and a queue for each message key (and,
+optionally, each sender). Messages in the same queue are handled one at a time in the
+order they were received, and messages in different queues are handled in parallel.
+
+Cheap listens (like ``CONFIRM``) can be run ``inline`` in the receiving thread,
+skipping the queue entirely.
+"""
+
+import threading
+import time
+import typing
+from collections import deque
+
+
+class Dispatcher(object):
+    """
+    A bounded pool of worker threads that calls listen methods, keeping the order of
+    messages within each queue.
+
+    Queues are identified by the message ``key`` and an optional ``order`` id (eg. the
+    sender), so ``DATA`` from one pilot is always handled in order, but ``DATA`` from
+    different pilots can be handled simultaneously.
+
+    When a queue has ``max_queue`` messages waiting, :meth:`.submit` either blocks until
+    there is room (``overflow='block'``, which stops the receiving socket from reading and
+    so pushes back on the sender) or drops the oldest waiting message (``overflow='drop'``).
+
+    Args:
+        n_workers (int): Number of worker threads
+        max_queue (int): Maximum number of messages waiting in each queue
+        inline (tuple): Message keys whose listens are called directly in the submitting thread
+        overflow (str): ``'block'`` or ``'drop'`` , what to do when a queue is full
+        logger (:class:`logging.Logger`): Logger used to report exceptions raised by listens
+        name (str): Used to name the worker threads
+
+    Attributes:
+        counters (dict): For each message key, a dict of
+
+            * ``submitted`` - number of messages submitted
+            * ``completed`` - number of messages handled
+            * ``dropped`` - number of messages dropped because their queue was full
+            * ``errors`` - number of listens that raised an exception
+            * ``depth`` - number of messages currently waiting
+            * ``max_depth`` - largest number of messages that have been waiting at once
+            * ``latency_total`` - summed time (s) from submission until the listen returned
+            * ``latency_max`` - longest time (s) from submission until the listen returned
+    """
+
+    def __init__(self, n_workers:int=4, max_queue:int=256,
+                 inline:typing.Iterable[str]=('CONFIRM',), overflow:str='block',
+                 logger=None, name:str='dispatch'):
+        if overflow not in ('block', 'drop'):
+            raise ValueError("overflow must be 'block' or 'drop', got {}".format(overflow))
+
+        self.n_workers = n_workers
+        self.max_queue = max_queue
+        self.inline = set(inline)
+        self.overflow = overflow
+        self.logger = logger
+        self.name = name
+
+        self.counters = {} # type: typing.Dict[str, typing.Dict[str, float]]
+
+        self._queues = {} # type: typing.Dict[tuple, deque]
+        self._ready = deque() # queue ids waiting for a worker
+        self._scheduled = set() # queue ids that are in _ready or being handled
+        self._lock = threading.Lock()
+        self._work_ready = threading.Condition(self._lock)
+        self._room = threading.Condition(self._lock)
+        self._closing = threading.Event()
+
+        self._workers = []
+        for i in range(self.n_workers):
+            worker = threading.Thread(target=self._work, name='{}_{}'.format(self.name, i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, key:str, fn:typing.Callable, *args, order=None):
+        """
+        Call ``fn(*args)`` in a worker thread after any previously submitted calls with the same
+        ``key`` and ``order`` have returned.
+
+        Args:
+            key (str): Message key, used to select the queue and to count stats
+            fn (callable): listen method to call
+            *args: passed to ``fn``
+            order: Additional id to keep separate queues for, eg. the message sender.
+                Calls with the same ``key`` but a different ``order`` don't wait for each other.
+        """
+        if key in self.inline:
+            with self._lock:
+                self._counters(key)['submitted'] += 1
+            self._call(key, fn, args, time.perf_counter())
+            return
+
+        queue_id = (key, order)
+        with self._lock:
+            counters = self._counters(key)
+            counters['submitted'] += 1
+            queue = self._queues.get(queue_id)
+            if queue is None:
+                queue = deque()
+                self._queues[queue_id] = queue
+
+            while len(queue) >= self.max_queue and not self._closing.is_set():
+                if self.overflow == 'drop':
+                    queue.popleft()
+                    counters['dropped'] += 1
+                    counters['depth'] -= 1
+                else:
+                    self._room.wait()
+
+            queue.append((fn, args, time.perf_counter()))
+            counters['depth'] += 1
+            counters['max_depth'] = max(counters['max_depth'], counters['depth'])
+
+            if queue_id not in self._scheduled:
+                self._scheduled.add(queue_id)
+                self._ready.append(queue_id)
+                self._work_ready.notify()
+
+    def _counters(self, key:str) -> dict:
+        counters = self.counters.get(key)
+        if counters is None:
+            counters = {'submitted': 0, 'completed': 0, 'dropped': 0, 'errors': 0,
+                        'depth': 0, 'max_depth': 0,
+                        'latency_total': 0.0, 'latency_max': 0.0}
+            self.counters[key] = counters
+        return counters
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._ready and not self._closing.is_set():
+                    self._work_ready.wait()
+                if self._closing.is_set():
+                    return
+                queue_id = self._ready.popleft()
+                fn, args, submitted = self._queues[queue_id].popleft()
+                self.counters[queue_id[0]]['depth'] -= 1
+                self._room.notify_all()
+
+            self._call(queue_id[0], fn, args, submitted)
+
+            with self._lock:
+                if self._queues[queue_id]:
+                    # more waiting in this queue, go to the back of the line
+                    self._ready.append(queue_id)
+                    self._work_ready.notify()
+                else:
+                    self._scheduled.discard(queue_id)
+                    del self._queues[queue_id]
+
+    def _call(self, key:str, fn:typing.Callable, args:tuple, submitted:float):
+        error = False
+        try:
+            fn(*args)
+        except Exception as e:
+            error = True
+            if self.logger:
+                self.logger.exception('Exception in listen for key {}: {}'.format(key, e))
+        finally:
+            latency = time.perf_counter() - submitted
+            with self._lock:
+                counters = self.counters[key]
+                counters['errors'] += error
+                counters['completed'] += 1
+                counters['latency_total'] += latency
+                counters['latency_max'] = max(counters['latency_max'], latency)
+
+    def stats(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """
+        Summarize :attr:`.counters`
+
+        Returns:
+            dict: for each key, a copy of its counters along with the ``latency_mean``
+        """
+        stats = {}
+        with self._lock:
+            counters = {key: key_counters.copy() for key, key_counters in self.counters.items()}
+        for key, key_stats in counters.items():
+            if key_stats['completed'] > 0:
+                key_stats['latency_mean'] = key_stats['latency_total'] / key_stats['completed']
+            else:
+                key_stats['latency_mean'] = 0.0
+            stats[key] = key_stats
+        return stats
+
+    def release(self):
+        """
+        Stop the worker threads. Messages still waiting are not handled.
+        """
+        self._closing.set()
+        with self._lock:
+            self._work_ready.notify_all()
+            self._room.notify_all()
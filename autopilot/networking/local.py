@@ -0,0 +1,205 @@
+"""
+Faster transport between networking objects on the same computer.
+
+* Every ``ROUTER`` socket binds an ``ipc://`` endpoint (see :func:`.ipc_endpoint` ) alongside
+  its ``tcp://`` port, and :class:`.Net_Node` s whose upstream is on the same
+  computer (see :func:`.is_local` ) connect to it instead of going through the TCP stack.
+* Rather than copying array buffers into the message, a :class:`.Net_Node` writes them to a
+  :class:`.Shm_Ring` , a ring buffer in shared memory, and sends only where to find them.
+  The recipient copies them out with :func:`.read_shm` when the message is received.
+
+Shared memory requires python>=3.8, and ipc endpoints aren't available on Windows.
+In either case everything is sent through the socket as usual.
+"""
+
+import os
+import socket
+import tempfile
+import threading
+import typing
+
+import numpy as np
+import zmq
+
+try:
+    from multiprocessing import shared_memory
+    SHARED_MEMORY = True
+except ImportError:
+    SHARED_MEMORY = False
+
+IPC = zmq.has('ipc')
+
+_HEADER_SIZE = 64
+"""
+Bytes at the start of a ring's shared memory used for its state (each a uint64): the reader's position,
+whether the writer has closed the ring, and the size of the ring
+"""
+
+_LOCAL_NAMES = ('localhost', '127.0.0.1', '::1')
+
+
+def ipc_endpoint(port:int) -> str:
+    """
+    The ``ipc://`` endpoint that a ``ROUTER`` bound to a tcp ``port`` also binds.
+
+    Args:
+        port (int): tcp port
+
+    Returns:
+        str: eg. ``'ipc:///tmp/autopilot-5560.ipc'``
+    """
+    return 'ipc://{}'.format(os.path.join(tempfile.gettempdir(), 'autopilot-{}.ipc'.format(port)))
+
+
+def is_local(ip:str) -> bool:
+    """
+    Whether an IP address or hostname refers to this computer
+
+    Args:
+        ip (str): IP address or hostname
+
+    Returns:
+        bool
+    """
+    if ip in _LOCAL_NAMES:
+        return True
+    try:
+        address = socket.gethostbyname(ip)
+        if address.startswith('127.'):
+            return True
+        return address in socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        return False
+
+
+class Shm_Ring(object):
+    """
+    A ring buffer in shared memory with one writer (this object) and one reader ( :func:`.read_shm` ).
+
+    The writer only writes into space the reader has already read past, so
+    buffers are never overwritten before they are read. If there isn't room,
+    :meth:`.write` returns ``None`` and the message should carry its buffers itself.
+
+    The reader has to read regions in the order they were written, so
+    writing and sending a message should be done while holding :attr:`.lock` .
+
+    Args:
+        size (int): size of the ring in bytes
+        min_bytes (int): messages with fewer bytes of buffers than this are sent normally
+
+    Attributes:
+        name (str): name of the shared memory block
+        lock (:class:`threading.RLock`): hold while writing to the ring and sending the message that refers to it
+    """
+
+    def __init__(self, size:int=2**26, min_bytes:int=2**16):
+        if not SHARED_MEMORY:
+            raise RuntimeError('Shared memory requires python>=3.8')
+        self.size = size
+        self.min_bytes = min_bytes
+        self.lock = threading.RLock()
+
+        self._shm = shared_memory.SharedMemory(create=True, size=size + _HEADER_SIZE)
+        self.name = self._shm.name
+        _OWNED.add(self.name)
+        self._state = np.ndarray((3,), dtype=np.uint64, buffer=self._shm.buf)
+        self._state[:] = (0, 0, size)
+        self._head = 0
+
+    def write(self, buffers:typing.List[typing.Union[bytes, memoryview, np.ndarray]],
+              nbytes:int) -> typing.Optional[typing.Tuple[str, int, int]]:
+        """
+        Copy buffers into the ring, one after another.
+
+        Args:
+            buffers (list): buffers to write
+            nbytes (int): total size of the buffers
+
+        Returns:
+            tuple: (:attr:`.name` , position, nbytes) to pass to :func:`.read_shm` , or
+            ``None`` if there wasn't room
+        """
+        with self.lock:
+            if nbytes > self.size:
+                return None
+            # positions count up forever, the place in the ring is position % size
+            pos = self._head % self.size
+            # don't wrap a region around the end of the ring
+            pad = self.size - pos if pos + nbytes > self.size else 0
+            start = self._head + pad
+            if start + nbytes - int(self._state[0]) > self.size:
+                return None
+
+            offset = _HEADER_SIZE + start % self.size
+            for buf in buffers:
+                buf = memoryview(buf).cast('B')
+                self._shm.buf[offset:offset + len(buf)] = buf
+                offset += len(buf)
+            self._head = start + nbytes
+            return self.name, start, nbytes
+
+    def close(self):
+        """
+        Mark the ring closed and remove its shared memory.
+        Readers that have already attached keep their mapping until they notice.
+        """
+        self._state[1] = 1
+        del self._state
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+        _OWNED.discard(self.name)
+
+
+_OWNED = set() # names of rings written by this process
+_ATTACHED = {} # type: typing.Dict[str, shared_memory.SharedMemory]
+_ATTACHED_LOCK = threading.Lock()
+
+
+def _attach(name:str) -> 'shared_memory.SharedMemory':
+    with _ATTACHED_LOCK:
+        shm = _ATTACHED.get(name)
+        if shm is not None:
+            return shm
+
+        # let go of rings whose writers are gone
+        for old_name, old_shm in list(_ATTACHED.items()):
+            if np.ndarray((3,), dtype=np.uint64, buffer=old_shm.buf)[1]:
+                old_shm.close()
+                del _ATTACHED[old_name]
+
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python<3.13 registers every attached block to be unlinked when we exit,
+            # but the writer owns it
+            shm = shared_memory.SharedMemory(name=name)
+            if name not in _OWNED:
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        _ATTACHED[name] = shm
+        return shm
+
+
+def read_shm(name:str, start:int, nbytes:int) -> bytes:
+    """
+    Copy a region written by :meth:`.Shm_Ring.write` out of shared memory, and
+    let the writer reuse it.
+
+    Args:
+        name (str): name of the ring's shared memory
+        start (int): position of the region
+        nbytes (int): size of the region
+
+    Returns:
+        bytes: the region
+    """
+    shm = _attach(name)
+    state = np.ndarray((3,), dtype=np.uint64, buffer=shm.buf)
+    offset = _HEADER_SIZE + start % int(state[2])
+    data = bytes(shm.buf[offset:offset + nbytes])
+    state[0] = start + nbytes
+    del state
+    return data
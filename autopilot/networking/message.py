@@ -1,8 +1,108 @@
 import base64
-import datetime
 import json
+import socket
+import struct
+import time
+import typing
 
 import blosc
+import numpy as np
+
+from autopilot.networking.local import read_shm
+from autopilot.utils import timestamps
+
+try:
+    import msgpack
+    MSGPACK = True
+except ImportError:
+    MSGPACK = False
+
+BINARY_MAGIC = b'\x00APM'
+"""
+Prefix of binary-serialized messages. JSON messages always start with ``{``,
+so the first bytes of a frame are enough to tell the two formats apart.
+"""
+
+BINARY_VERSION = 1
+"""
+Version of the binary envelope, written after :data:`.BINARY_MAGIC`
+"""
+
+_HOST = socket.gethostname()
+
+_ENVELOPE = struct.Struct('<4sBII') # magic, version, header length, body length
+_NDARRAY_EXT = 1 # msgpack ExtType code for out-of-band arrays
+
+SERIALIZERS = ('binary', 'json') if MSGPACK else ('json',)
+"""
+Wire formats this installation can read and write. Advertised to peers in the
+``formats`` field of JSON messages so they know they can switch to binary.
+"""
+
+
+
+class Peer_Formats(dict):
+    """
+    Wire formats each peer has told us it can read, ``{id: (format, ...)}`` ,
+    used by :class:`.Net_Node` and :class:`.Station` to choose how to serialize messages to them.
+
+    Peers we haven't heard from yet get JSON, which every version can read,
+    until they tell us otherwise. Peers that never tell us (older versions)
+    aren't kept.
+    """
+
+    def learn(self, msg:'Message'):
+        """
+        Remember which wire formats the sender of a message can read.
+
+        Binary messages imply the sender can read binary, JSON messages
+        list their readable formats in their ``formats`` field (and messages
+        from older versions without one can only read JSON).
+
+        Args:
+            msg (:class:`.Message`): A received message
+        """
+        if msg._format == 'binary':
+            self[msg.sender] = SERIALIZERS
+        elif hasattr(msg, 'formats'):
+            self[msg.sender] = tuple(msg.formats)
+        else:
+            self.pop(msg.sender, None)
+
+    def choose(self, to:typing.Union[str, list], preferred:str) -> str:
+        """
+        Choose the wire format for a message to ``to``
+
+        Use ``preferred`` unless we can't write it or ``to`` hasn't told us it can read it,
+        in which case use ``'json'``.
+
+        Args:
+            to (str, list): ID of the recipient, or a multihop list of them (the last is the recipient)
+            preferred (str): the format we'd rather use
+
+        Returns:
+            str: ``'binary'`` or ``'json'``
+        """
+        if isinstance(to, list):
+            to = to[-1]
+        if preferred not in SERIALIZERS:
+            return 'json'
+        if preferred not in self.get(to, ('json',)):
+            return 'json'
+        return preferred
+
+    def can_batch(self, to:str) -> bool:
+        """
+        Whether ``to`` can read a list of ids in one ``CONFIRM`` , which peers
+        that tell us their formats can, and older versions can't.
+
+        Args:
+            to (str): ID of the recipient
+
+        Returns:
+            bool
+        """
+        return to in self
 
 
 class Message(object):
@@ -13,7 +113,24 @@ class Message(object):
     Additional message behavior can be indicated by passing ``flags``
 
     Numpy arrays given in the value field are automatically serialized and deserialized
-    when sending and receiving using bas64 encoding and blosc compression.
+    when sending and receiving.
+
+    Messages can be serialized in one of two wire formats (see :data:`.SERIALIZERS`):
+
+    * ``'json'`` - the whole ``__dict__`` as JSON, with arrays blosc-compressed and
+      base64 encoded as ``{'NUMPY_ARRAY': ...}`` and bytes base64 encoded as ``{'BYTES': ...}``
+    * ``'binary'`` - a small envelope (:data:`.BINARY_MAGIC`, version, header and body length),
+      a msgpack header with every attribute except ``value``, a msgpack body with the ``value``,
+      and then the raw buffers of any numpy arrays appended after it. Arrays are decoded as
+      read-only :func:`numpy.frombuffer` views of the received frame, so copy them before
+      modifying in place. Requires ``msgpack``.
+
+    The format of a received message is detected automatically.
+
+    Only the header of a binary message is decoded on receipt, which is all that's needed to
+    route, confirm, or forward it. The body is decoded the first time :attr:`.value` is accessed.
+    JSON messages are decoded all at once, but their arrays can be left compressed
+    until :meth:`.expand` is called.
 
     `id`, `to`, `sender`, and `key` are required attributes,
     but any other key-value pair passed on init is added to the message's attributes
@@ -29,7 +146,7 @@ class Message(object):
         sender (str): ID of socket where this message originates
         key (str): Type of message, used to select a listen method to process it
         value: Body of message, can be any type but must be JSON serializable.
-        timestamp (str): Timestamp of message creation
+        timestamp (str, int): Timestamp of message creation, see :func:`.timestamps.timestamp`
         ttl (int): Time-To-Live, each message is sent this many times at max,
             each send decrements ttl.
         flags (dict): Flags determine additional message behavior. If a flag has no value associated with it,
@@ -38,6 +155,10 @@ class Message(object):
             * ``MINPRINT`` - don't print the value in logs (eg. when a large array is being sent)
             * ``NOREPEAT`` - sender will not seek, and recipients will not attempt to send message receipt confirmations
             * ``NOLOG`` - don't log this message! for streaming, or other instances where the constant printing of the logger is performance prohibitive
+            * ``COMPRESS`` - blosc-compress array buffers when using the ``'binary'`` format (they are always compressed in ``'json'``)
+            * ``TRACE`` - record when the message is sent, forwarded, received, and handled in :attr:`.trace` ,
+              see :meth:`.stamp` and :mod:`.networking.trace`
+        trace (list): if the ``TRACE`` flag is set, a list of ``[id, event, time_ns, host]`` hop stamps
     """
 
     def __init__(self, msg=None, expand_arrays = False,  **kwargs):
@@ -59,6 +180,8 @@ class Message(object):
         self.flags = {}
         self.changed = False
         self.serialized = None
+        self._format = None # format of self.serialized
+        self._body = None # undecoded value of a binary message
 
         # optional attrs should be instance attributes so they are caught by _-dict__
         self.flags = {}
@@ -72,7 +195,13 @@ class Message(object):
         #elif len(args)>0:
         if msg:
             self.serialized = msg
-            if expand_arrays:
+            self._format = self.frame_format(msg)
+            if self._format == 'binary':
+                deserialized, self._body = self._deserialize_binary(msg)
+                if deserialized.pop('_shm', None) is not None:
+                    # the frame doesn't have the buffers, so can't be forwarded as-is
+                    self.serialized = None
+            elif expand_arrays:
                 deserialized = json.loads(msg, object_pairs_hook=self._deserialize_numpy)
             else:
                 deserialized = json.loads(msg)
@@ -82,6 +211,10 @@ class Message(object):
             setattr(self, k, v)
             #self[k] = v
 
+        if self._body is not None:
+            # decode value on first access, see __getattr__
+            del self.value
+
         # if we're not a previous message being recreated, get a timestamp for our creation
         if 'timestamp' not in kwargs.keys():
             self.get_timestamp()
@@ -101,6 +234,21 @@ class Message(object):
 
         return me_string
 
+    def __getattr__(self, key):
+        """
+        Only called when ``key`` isn't found normally -- decode the body of a
+        binary message the first time its ``value`` is requested.
+
+        Args:
+            key:
+        """
+        if key == 'value' and self.__dict__.get('_body') is not None:
+            value = self._unpack_binary(*self._body)
+            self.__dict__['value'] = value
+            self._body = None
+            return value
+        raise AttributeError("'Message' object has no attribute '{}'".format(key))
+
     # enable dictionary-like behavior
     def __getitem__(self, key):
         """
@@ -108,7 +256,8 @@ class Message(object):
             key:
         """
         #value = self._check_dec(self.__dict__[key])
-        # TODO: Recursively walk looking for 'NUMPY ARRAY' and expand before giving
+        if key == 'value':
+            return self.value
         return self.__dict__[key]
 
     def __setitem__(self, key, value):
@@ -156,7 +305,7 @@ class Message(object):
 
     def _serialize_numpy(self, array):
         """
-        Serialize a numpy array for sending over the wire
+        Serialize a numpy array (or bytes) for sending over the wire
 
         Args:
             array:
@@ -164,6 +313,8 @@ class Message(object):
         Returns:
 
         """
+        if isinstance(array, (bytes, bytearray, memoryview)):
+            return {'BYTES': base64.b64encode(array).decode('ascii')}
         compressed = base64.b64encode(blosc.pack_array(array)).decode('ascii')
         return {'NUMPY_ARRAY': compressed}
 
@@ -172,16 +323,222 @@ class Message(object):
         # print(len(obj_pairs), obj_pairs)
         if (len(obj_pairs) == 1) and obj_pairs[0][0] == "NUMPY_ARRAY":
             return blosc.unpack_array(base64.b64decode(obj_pairs[0][1]))
+        elif (len(obj_pairs) == 1) and obj_pairs[0][0] == "BYTES":
+            return base64.b64decode(obj_pairs[0][1])
         else:
             return dict(obj_pairs)
 
+    def stamp(self, id:str, event:str):
+        """
+        Add a hop stamp to :attr:`.trace` if the message has the ``TRACE`` flag, otherwise do nothing.
+
+        Args:
+            id (str): ID of the node or station doing the stamping
+            event (str): what happened, eg. ``'send'`` or ``'recv'`` (see :mod:`.networking.trace`)
+        """
+        if 'TRACE' not in self.flags.keys():
+            return
+        self.__dict__.setdefault('trace', []).append([id, event, time.monotonic_ns(), _HOST])
+        self.changed = True
+
+    @staticmethod
+    def is_traced(frame) -> bool:
+        """
+        Check whether a serialized message might have the ``TRACE`` flag without deserializing it,
+        so stations can forward untraced messages untouched.
+
+        Only the header of binary messages is searched. May be ``True`` for untraced messages that
+        happen to contain the string ``'TRACE'`` , but never ``False`` for traced ones.
+
+        Args:
+            frame (bytes): serialized message
+
+        Returns:
+            bool
+        """
+        if Message.frame_format(frame) == 'binary':
+            _, _, header_len, _ = _ENVELOPE.unpack_from(frame, 0)
+            return b'TRACE' in memoryview(frame)[_ENVELOPE.size:_ENVELOPE.size + header_len].tobytes()
+        return b'"TRACE"' in frame
+
+    @staticmethod
+    def uses_shm(frame) -> bool:
+        """
+        Check whether a serialized message's arrays are in shared memory (see :meth:`._serialize_binary` )
+        without deserializing it, so stations only decode the messages they have to before forwarding them.
+
+        Like :meth:`.is_traced` , only the header of binary messages is searched, and may be ``True``
+        for messages that don't use shared memory but never ``False`` for ones that do.
+
+        Args:
+            frame (bytes): serialized message
+
+        Returns:
+            bool
+        """
+        if Message.frame_format(frame) != 'binary':
+            return False
+        _, _, header_len, _ = _ENVELOPE.unpack_from(frame, 0)
+        return b'_shm' in memoryview(frame)[_ENVELOPE.size:_ENVELOPE.size + header_len].tobytes()
+
+    @staticmethod
+    def frame_format(frame) -> str:
+        """
+        Detect the wire format of a serialized message without deserializing it
+
+        Args:
+            frame (bytes): serialized message
+
+        Returns:
+            str: ``'binary'`` or ``'json'``
+        """
+        if frame[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+            return 'binary'
+        return 'json'
+
+    def _serialize_binary(self, msg: dict, shm: typing.Optional['Shm_Ring'] = None) -> bytes:
+        """
+        Pack a message dictionary into the binary envelope.
+
+        Arrays are replaced in the msgpack header with an ExtType that describes
+        their dtype, shape and position in the buffer section, and their memory
+        is appended after the header without any intermediate encoding.
+
+        If a :class:`.Shm_Ring` is given and there are at least :attr:`.Shm_Ring.min_bytes` of
+        buffers, they are written to it instead, and the header gets a ``_shm``
+        field saying where to find them.
+
+        Args:
+            msg (dict): attributes of the message to serialize
+            shm (:class:`.Shm_Ring`): optional shared memory ring to write buffers to
+
+        Returns:
+            bytes: serialized message
+        """
+        buffers = []
+        offset = 0
+        compress = 'COMPRESS' in self.flags.keys()
+        msg = msg.copy()
+        value = msg.pop('value', None)
+
+        def _default(obj):
+            nonlocal offset
+            if isinstance(obj, np.ndarray):
+                if obj.dtype.hasobject or obj.dtype.fields is not None:
+                    # can't be described by a dtype string, fall back to pickling
+                    buf = blosc.pack_array(obj)
+                    codec = 'pack'
+                else:
+                    buf = np.ascontiguousarray(obj).reshape(-1).view(np.uint8)
+                    codec = None
+                    if compress:
+                        buf = blosc.compress(buf, typesize=obj.dtype.itemsize)
+                        codec = 'blosc'
+                nbytes = len(buf)
+                desc = msgpack.packb([obj.dtype.str, list(obj.shape), offset, nbytes, codec])
+                buffers.append(buf)
+                offset += nbytes
+                return msgpack.ExtType(_NDARRAY_EXT, desc)
+            elif isinstance(obj, np.generic):
+                return obj.item()
+            raise TypeError('Cannot serialize object of type {}'.format(type(obj)))
+
+        header = msgpack.packb(msg, default=_default, use_bin_type=True)
+        body = msgpack.packb(value, default=_default, use_bin_type=True)
+
+        if shm is not None and offset >= shm.min_bytes:
+            region = shm.write(buffers, offset)
+            if region is not None:
+                # pack the header again with where to find the buffers,
+                # arrays in the header get the same offsets as before.
+                msg['_shm'] = list(region)
+                offset = 0
+                header = msgpack.packb(msg, default=_default, use_bin_type=True)
+                buffers = []
+
+        envelope = _ENVELOPE.pack(BINARY_MAGIC, BINARY_VERSION, len(header), len(body))
+        return b''.join([envelope, header, body, *buffers])
+
+    @staticmethod
+    def _deserialize_binary(frame) -> typing.Tuple[dict, tuple]:
+        """
+        Unpack the header of a message serialized with :meth:`._serialize_binary` ,
+        leaving the body to be unpacked by :meth:`._unpack_binary` when it's needed.
+
+        If the buffers were sent through shared memory, they are copied out with :func:`.read_shm` now,
+        so the sender can reuse the space.
+
+        Args:
+            frame (bytes): serialized message
+
+        Returns:
+            tuple: (dict of header attributes, arguments to :meth:`._unpack_binary` for the body)
+        """
+        view = memoryview(frame)
+        _, version, header_len, body_len = _ENVELOPE.unpack_from(view, 0)
+        if version > BINARY_VERSION:
+            raise ValueError('Message has binary format version {}, can only read up to {}'.format(version, BINARY_VERSION))
+        body_start = _ENVELOPE.size + header_len
+        buf_start = body_start + body_len
+
+        buffers = view[buf_start:]
+        header = Message._unpack_binary(view, _ENVELOPE.size, body_start, buffers)
+        if '_shm' in header.keys():
+            buffers = memoryview(read_shm(*header['_shm']))
+            header = Message._unpack_binary(view, _ENVELOPE.size, body_start, buffers)
+        return header, (view, body_start, buf_start, buffers)
+
+    @staticmethod
+    def _unpack_binary(view:memoryview, start:int, end:int, buffers:memoryview):
+        """
+        Unpack one msgpack section of a binary message, reconstituting arrays
+        as views into the buffer section
+
+        Args:
+            view (memoryview): the serialized message
+            start (int): start of section
+            end (int): end of section
+            buffers (memoryview): the array buffer section, either the end of the
+                serialized message or copied from shared memory.
+        """
+        def _ext_hook(code, data):
+            if code != _NDARRAY_EXT:
+                return msgpack.ExtType(code, data)
+            dtype, shape, offset, nbytes, codec = msgpack.unpackb(data)
+            buf = buffers[offset:offset + nbytes]
+            if codec == 'pack':
+                return blosc.unpack_array(bytes(buf))
+            elif codec == 'blosc':
+                buf = blosc.decompress(buf)
+            return np.frombuffer(buf, dtype=dtype).reshape(shape)
+
+        return msgpack.unpackb(view[start:end], ext_hook=_ext_hook,
+                               raw=False, strict_map_key=False)
+
     def expand(self):
         """
         Don't decompress numpy arrays by default for faster IO, explicitly expand them when needed
 
-        :return:
+        Replaces any ``{'NUMPY_ARRAY': ...}`` (or ``{'BYTES': ...}`` ) left in the :attr:`.value` of a JSON message
+        that was received with ``expand_arrays = False`` with the array (or bytes) itself.
+        Binary messages are always received with their arrays, so this just decodes their body.
+
+        Returns:
+            The expanded :attr:`.value`
         """
-        pass
+        self.__dict__['value'] = self._expand_numpy(self.value)
+        return self.value
+
+    def _expand_numpy(self, value):
+        if isinstance(value, dict):
+            if len(value) == 1 and 'NUMPY_ARRAY' in value.keys():
+                return blosc.unpack_array(base64.b64decode(value['NUMPY_ARRAY']))
+            elif len(value) == 1 and 'BYTES' in value.keys():
+                return base64.b64decode(value['BYTES'])
+            return {k: self._expand_numpy(v) for k, v in value.items()}
+        elif isinstance(value, list):
+            return [self._expand_numpy(v) for v in value]
+        return value
 
 
 
@@ -201,6 +558,8 @@ class Message(object):
         Args:
             key:
         """
+        if key == 'value':
+            return True
         return key in self.__dict__
 
     def __len__(self):
@@ -211,9 +570,10 @@ class Message(object):
         Get a Python timestamp
 
         Returns:
-            str: Isoformatted timestamp from ``datetime``
+            str, int: Isoformatted timestamp from ``datetime`` , or nanoseconds since the epoch,
+            see :func:`.timestamps.timestamp`
         """
-        self.timestamp = datetime.datetime.now().isoformat()
+        self.timestamp = timestamps.timestamp()
 
     def validate(self):
         """
@@ -231,17 +591,34 @@ class Message(object):
 
 
 
-    def serialize(self):
+    def serialize(self, fmt: str = None, shm: typing.Optional['Shm_Ring'] = None):
         """
-        Serializes all attributes in `__dict__` using json.
+        Serializes all attributes in `__dict__`.
+
+        If the message hasn't changed since it was last serialized (eg. when
+        forwarding a received message), the cached serialization is reused as
+        long as it matches the requested format.
+
+        Args:
+            fmt (str): one of :data:`.SERIALIZERS` . If ``None`` (default), reuse
+                whatever format the message was last serialized in, or ``'json'``
+            shm (:class:`.Shm_Ring`): For binary messages, write array buffers to this
+                shared memory ring rather than the message (see :meth:`._serialize_binary` ).
+                Messages that use it aren't cached, since the ring will be reused.
 
         Returns:
-            str: JSON serialized message.
+            bytes: serialized message.
         """
 
-        if not self.changed and self.serialized:
+        if not self.changed and self.serialized and fmt in (None, self._format):
             return self.serialized
 
+        if fmt is None:
+            fmt = self._format or 'json'
+
+        # make sure a lazily-decoded body is in __dict__ before we re-encode
+        self.value
+
         valid = self.validate()
         if not valid:
             Exception("""Message invalid at the time of serialization!\n {}""".format(str(self)))
@@ -254,17 +631,23 @@ class Message(object):
         #     'key': self.key,
         #     'value': self.value
         # }
-        msg = self.__dict__
-        # exclude 'serialized' so it's not in there twice
-        try:
-            del msg['serialized']
-        except KeyError:
-            pass
+        # exclude 'serialized' so it's not in there twice, and private attributes
+        msg = {k: v for k, v in self.__dict__.items()
+               if k != 'serialized' and not k.startswith('_')}
 
         try:
-            msg_enc = json.dumps(msg, default=self._serialize_numpy).encode('utf-8')
+            if fmt == 'binary':
+                msg_enc = self._serialize_binary(msg, shm)
+                if shm is not None:
+                    # don't cache, the buffers may be in the ring
+                    return msg_enc
+            else:
+                # let the recipient know what else we can read
+                msg.setdefault('formats', SERIALIZERS)
+                msg_enc = json.dumps(msg, default=self._serialize_numpy).encode('utf-8')
             self.serialized = msg_enc
+            self._format = fmt
             self.changed=False
             return msg_enc
         except:
-            return False
\ No newline at end of file
+            return False
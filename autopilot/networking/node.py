@@ -2,19 +2,25 @@ import queue
 import threading
 import time
 import typing
+from contextlib import nullcontext
 from copy import copy
 from itertools import count
 from typing import Union, Optional
 from collections import deque
 import socket
 
+import numpy as np
 import zmq
 from tornado.ioloop import IOLoop
 from zmq.eventloop.zmqstream import ZMQStream
 
 from autopilot import prefs
 from autopilot.core.loggers import init_logger
-from autopilot.networking.message import Message
+from autopilot.networking.message import Message, Peer_Formats, SERIALIZERS
+from autopilot.networking.dispatch import Dispatcher
+from autopilot.networking.outbox import Outbox
+from autopilot.networking.trace import Trace_Aggregator
+from autopilot.networking.local import IPC, SHARED_MEMORY, Shm_Ring, ipc_endpoint, is_local
 
 
 class Net_Node(object):
@@ -54,6 +60,8 @@ class Net_Node(object):
         router_port (int): Typically, Net_Nodes only have a single Dealer socket and receive messages from their encapsulating :class:`.Station`, but
             if you want to take this node offroad and use it independently, an int here binds a Router to the port.
         daemon (bool): Run the IOLoop thread as a ``daemon`` (default: ``True``)
+        msg_format (str): Preferred wire format, one of :data:`.message.SERIALIZERS` .
+            If ``None`` (default), use ``prefs.get('MSG_FORMAT')``
 
     Attributes:
         context (:class:`zmq.Context`):  zeromq context
@@ -63,19 +71,38 @@ class Net_Node(object):
         upstream (str): The identity of the ROUTER socket used by our upstream :class:`.Station` object.
         port (int): The port that our upstream ROUTER socket is bound to
         listens (dict): Dictionary of functions to call for different types of messages. keys match the :attr:`.Message.key`.
-        outbox (dict): Messages that have been sent but have not been confirmed
+        outbox (:class:`.Outbox`): Messages that have been sent but have not been confirmed
         timers (dict): dict of :class:`threading.Timer` s that will check in on outbox messages
         logger (:class:`logging.Logger`): Used to log messages and network events.
         msg_counter (:class:`itertools.count`): counter to index our sent messages
         loop_thread (:class:`threading.Thread`): Thread that holds our loop. initialized with `daemon=True`
+        repeat_thread (:class:`threading.Thread`): Thread that resends unconfirmed messages, see :meth:`.Net_Node.repeat`
+        peer_formats (:class:`.Peer_Formats`): Wire formats each sender has told us it can read
+        dispatcher (:class:`.Dispatcher`): Calls listen methods in a pool of :attr:`.n_workers` threads
+        shm (:class:`.Shm_Ring`): If our upstream is on the same computer, shared memory that arrays in
+            messages to it are sent through (see :mod:`.networking.local` ), otherwise ``None``
     """
     repeat_interval = 5 # how many seconds to wait before trying to repeat a message
+    repeat_backoff = 2.0 # multiply the wait by this after each retry
+    repeat_max_interval = 60.0 # longest wait between retries
+    max_in_flight = None # unconfirmed messages to each peer before holding new ones, None for no limit
+    confirm_interval = 0 # seconds to collect confirmations before sending them together, 0 to send each immediately
+    confirm_batch = 64 # send collected confirmations early once this many are waiting for one sender
+    use_ipc = True # connect to upstreams on the same computer with ipc and send arrays through shared memory
+    shm_size = 2**26 # bytes of shared memory for arrays sent to a local upstream
+    shm_min_bytes = 2**16 # messages with fewer bytes of arrays than this aren't sent through shared memory
+    trace = False # set the TRACE flag on every message we send, see :mod:`.networking.trace`
+    stream_timeout = 1000 # ms to wait for a stream's recipient before dropping a message
+    n_workers = 4 # threads used to call listen methods
+    max_queue = 256 # messages of each key from each sender that can be waiting to be handled
+    inline_keys = ('CONFIRM',) # keys whose listens are cheap enough to call in the IOLoop thread
 
     def __init__(self, id: str, upstream: str, port: int,
                  listens: typing.Dict[str, typing.Callable],
                  instance:bool=True, upstream_ip:str='localhost',
                  router_port:Optional[int] = None,
-                 daemon:bool=True, expand_on_receive:bool=True):
+                 daemon:bool=True, expand_on_receive:bool=True,
+                 msg_format:Optional[str]=None):
 
         if instance:
             self.context = zmq.Context.instance() # type: zmq.Context
@@ -101,6 +128,8 @@ class Net_Node(object):
         self.router_port = router_port
         self.router = None # type: Optional[zmq.Socket]
         self.loop_thread = None  # type: Optional[threading.Thread]
+        self.shm = None # type: Optional[Shm_Ring]
+        self.repeat_thread = None  # type: Optional[threading.Thread]
         self.senders = {} # type: typing.Dict[bytes, str]
         self._ip = None
 
@@ -108,16 +137,28 @@ class Net_Node(object):
         self.msg_counter = count()
         self.msgs_received = 0
         self.logger = init_logger(self)
+        self.dispatcher = Dispatcher(n_workers=self.n_workers, max_queue=self.max_queue,
+                                     inline=self.inline_keys, logger=self.logger,
+                                     name='{}_dispatch'.format(id))
 
         # If we were given an explicit IP to connect to, stash it
         self.upstream_ip = upstream_ip
 
         self.daemon = daemon
         self.streams = {}
-        self.outbox = {}
+        self.outbox = Outbox(interval=self.repeat_interval*2, backoff=self.repeat_backoff,
+                             max_interval=self.repeat_max_interval,
+                             max_in_flight=self.max_in_flight) # type: Outbox
         self.timers = {}
+        self._pending_confirms = {} # type: typing.Dict[str, list]
+        self.traces = Trace_Aggregator() # type: Trace_Aggregator
         self.expand = expand_on_receive
 
+        if msg_format is None:
+            msg_format = prefs.get('MSG_FORMAT')
+        self.msg_format = msg_format # type: str
+        self.peer_formats = Peer_Formats()
+
         if prefs.get( 'SUBJECT'):
             self.subject = prefs.get('SUBJECT').encode('utf-8')
         else:
@@ -138,15 +179,25 @@ class Net_Node(object):
         #self.sock.probe_router = 1
 
         # connect our dealer socket to "push" messages upstream
-        self.sock.connect('tcp://{}:{}'.format(self.upstream_ip, self.port))
+        endpoint = self.endpoint(self.upstream_ip, self.port)
+        self.sock.connect(endpoint)
         self.sock = ZMQStream(self.sock, self.loop)
         self.sock.on_recv(self.handle_listen)
 
+        if endpoint.startswith('ipc://'):
+            # only this version binds ipc endpoints, so an upstream there can read what we can
+            self.peer_formats.setdefault(self.upstream, SERIALIZERS)
+            if SHARED_MEMORY:
+                self.shm = Shm_Ring(self.shm_size, self.shm_min_bytes)
+
         # if want to directly receive messages, bind a router port
         if self.router_port is not None:
             self.router = self.context.socket(zmq.ROUTER)
             self.router.setsockopt_string(zmq.IDENTITY, self.id)
             self.router.bind('tcp://*:{}'.format(self.router_port))
+            if IPC:
+                # and let nodes on the same computer connect without tcp
+                self.router.bind(ipc_endpoint(self.router_port))
             self.router = ZMQStream(self.router, self.loop)
             self.router.on_recv(self.handle_listen)
 
@@ -156,6 +207,27 @@ class Net_Node(object):
             self.loop_thread.daemon = True
         self.loop_thread.start()
 
+        # and the repeat thread resends messages until they're confirmed
+        self.repeat_thread = threading.Thread(target=self.repeat)
+        self.repeat_thread.daemon = True
+        self.repeat_thread.start()
+
+    def endpoint(self, ip:str, port:int) -> str:
+        """
+        Address to connect to a ``ROUTER`` at ``ip`` and ``port`` ,
+        its :func:`.ipc_endpoint` if it's on this computer, otherwise tcp.
+
+        Args:
+            ip (str): IP address or hostname
+            port (int): tcp port
+
+        Returns:
+            str: zmq endpoint
+        """
+        if self.use_ipc and IPC and is_local(ip):
+            return ipc_endpoint(port)
+        return 'tcp://{}:{}'.format(ip, port)
+
     def threaded_loop(self):
         """
         Run in a thread, either starts the IOLoop, or if it
@@ -173,7 +245,10 @@ class Net_Node(object):
     def handle_listen(self, msg: typing.List[bytes]):
         """
         Upon receiving a message, call the appropriate listen method
-        in a new thread and send confirmation it was received.
+        with the :attr:`.dispatcher` and send confirmation it was received.
+
+        Messages with the same key from the same sender are handled in order,
+        in one of the dispatcher's worker threads (or directly, for keys in :attr:`.inline_keys`)
 
         Note:
             Unlike :meth:`.Station.handle_listen` , only the :attr:`.Message.value`
@@ -193,6 +268,7 @@ class Net_Node(object):
 
         # Nodes expand arrays by default as they're expected to
         msg = Message(msg[-1], expand_arrays=self.expand)
+        msg.stamp(self.id, 'recv')
 
         # Check if our listen was sent properly
         if not msg.validate():
@@ -200,36 +276,44 @@ class Net_Node(object):
                 self.logger.error('Message failed to validate:\n{}'.format(str(msg)))
             return
 
+        self.learn_format(msg)
+
         # unnest any list if it was a multihop message
         if isinstance(msg.to, list) and len(msg.to) == 1:
             msg.to = msg.to[0]
 
-        try:
-            listen_funk = self.listens[msg.key]
-            listen_thread = threading.Thread(target=listen_funk, args=(msg.value,))
-            listen_thread.start()
-        except KeyError:
-            if msg.key=="STREAM":
-                try:
-                    listen_thread = threading.Thread(target=self.l_stream, args=(msg,))
-                    listen_thread.start()
-                except Exception as e:
-                    self.logger.exception(e)
-
+        if msg.key in self.listens.keys():
+            self.dispatcher.submit(msg.key, self._call_listen, self.listens[msg.key], msg,
+                                   order=msg.sender)
+        elif msg.key == "STREAM":
+            self.dispatcher.submit(msg.key, self.l_stream, msg, order=msg.sender)
+        else:
             self.logger.exception('MSG ID {} - No listen function found for key: {}'.format(msg.id, msg.key))
 
         if (msg.key != "CONFIRM") and ('NOREPEAT' not in msg.flags.keys()) :
             # send confirmation
-            self.send(msg.sender, 'CONFIRM', msg.id)
+            self.confirm(msg.sender, msg.id)
 
         log_this = True
         if 'NOLOG' in msg.flags.keys():
             log_this = False
 
         if self.logger and log_this:
-            self.logger.debug('RECEIVED: {}'.format(str(msg)))
+            self.logger.debug('RECEIVED: %s', msg)
 
 
+    def _call_listen(self, listen_funk:typing.Callable, msg:Message):
+        """
+        Call a listen method with the message's value, decoding it in the worker thread
+        rather than the IOLoop.
+
+        Traced messages are stamped before and after, and added to :attr:`.traces` .
+        """
+        msg.stamp(self.id, 'dispatch')
+        listen_funk(msg.value)
+        msg.stamp(self.id, 'done')
+        self.traces.add(msg)
+
     def send(self, to: Optional[Union[str, list]] = None,
              key:str=None,
              value:typing.Any=None,
@@ -302,11 +386,29 @@ class Net_Node(object):
         if 'NOLOG' in msg.flags.keys():
             log_this = False
 
+        # arrays can go through shared memory if the message is for our upstream itself (over our dealer),
+        # and it's not going to be resent from the outbox after the ring has been reused.
+        shm = None
+        if self.shm is not None and recipient == self.upstream and not isinstance(to, list) \
+                and not (self.router is not None and self.upstream.encode('utf-8') in self.senders.keys()) \
+                and not (repeat and msg.key != "CONFIRM"):
+            shm = self.shm
+
+        # messages have to be read from the ring in the order they're written
+        with shm.lock if shm is not None else nullcontext():
+            sent = self._send(to, recipient, msg, repeat, force_to, shm)
+
+        if sent and self.logger and log_this:
+            self.logger.debug("MESSAGE SENT - %s", msg)
+
+    def _send(self, to, recipient:str, msg:Message, repeat:bool, force_to:bool,
+              shm:Optional[Shm_Ring]) -> bool:
+        msg.stamp(self.id, 'send')
         # encode message
-        msg_enc = msg.serialize()
+        msg_enc = msg.serialize(self.peer_format(recipient), shm=shm)
         if not msg_enc:
             self.logger.error('Message could not be encoded:\n{}'.format(str(msg)))
-            return
+            return False
 
         if isinstance(to, list):
             multipart = [bytes(hop, encoding='utf-8') for hop in to]
@@ -322,64 +424,52 @@ class Net_Node(object):
                 multipart.insert(0, self.upstream.encode('utf-8'))
 
         if self.router is not None and multipart[0] in self.senders.keys():
-            self.router.send_multipart(multipart)
+            send = self.router.send_multipart
         else:
-            self.sock.send_multipart(multipart)
-
-        if self.logger and log_this:
-            self.logger.debug("MESSAGE SENT - {}".format(str(msg)))
+            send = self.sock.send_multipart
 
         if repeat and not msg.key == "CONFIRM":
-            # add to outbox and spawn timer to resend
-            self.outbox[msg.id] = (time.time(), msg)
+            # send, and keep until confirmed to resend
+            self.outbox.add(msg.id, recipient, multipart, send, ttl=msg.ttl, msg=msg)
+        else:
+            send(multipart)
+        return True
 
     def repeat(self):
         """
-        Periodically (according to :attr:`~.repeat_interval`) resend messages that haven't been confirmed
+        Resend messages in the :attr:`.outbox` that haven't been confirmed as they come due.
 
-        TTL is decremented, and messages are resent until their TTL is 0.
+        Messages are first resent after ``repeat_interval*2`` seconds, and then
+        after increasing intervals (see :attr:`.repeat_backoff` ) until their TTL is 0.
 
         """
         while not self.closing.is_set():
-            # try to send any outstanding messages and delete if too old
-            # make a local copy of dict
-            outbox = copy(self.outbox)
-
-            if len(outbox) > 0:
-                for id in outbox.keys():
-                    if outbox[id][1].ttl <= 0:
-                        self.logger.warning('PUBLISH FAILED {} - {}'.format(id, str(outbox[id][1])))
-                        try:
-                            del self.outbox[id]
-                        except KeyError:
-                            # fine, already deleted
-                            pass
-                    else:
-                        # if we didn't just put this message in the outbox...
-                        if (time.time() - outbox[id][0]) > (self.repeat_interval*2):
-                            self.logger.debug('REPUBLISH {} - {}'.format(id, str(outbox[id][1])))
-                            self.sock.send_multipart([self.upstream.encode('utf-8'), outbox[id][1].serialize()])
-                            self.outbox[id][1].ttl -= 1
-
-
-            # wait to do it again
-            time.sleep(self.repeat_interval)
+            resent, failed = self.outbox.resend_due()
+            for entry in failed:
+                self.logger.warning('PUBLISH FAILED %s - %s', entry.id, entry.msg)
+            for entry in resent:
+                self.logger.debug('REPUBLISH %s - %s', entry.id, entry.msg)
+
+            # wait until the next message is due, checking for new ones at least every repeat_interval
+            wait = self.outbox.next_due()
+            if wait is None or wait > self.repeat_interval:
+                wait = self.repeat_interval
+            self.closing.wait(wait)
 
     def l_confirm(self, value):
         """
         Confirm that a message was received.
 
         Args:
-            value (str): The ID of the message we are confirming.
+            value (str, list): The ID of the message we are confirming, or a list of IDs
         """
         # delete message from outbox if we still have it
         # msg.value should contain the if of the message that was confirmed
-        try:
-            if value in self.outbox.keys():
-                del self.outbox[value]
-        except KeyError:
-            # already deleted
-            pass
+        if isinstance(value, list):
+            for id in value:
+                self.outbox.confirm(id)
+        else:
+            self.outbox.confirm(value)
 
         # # stop a timer thread if we have it
         # if value in self.timers.keys():
@@ -387,7 +477,68 @@ class Net_Node(object):
         #     del self.timers[value]
 
 
-        self.logger.debug('CONFIRMED MESSAGE {}'.format(value))
+        self.logger.debug('CONFIRMED MESSAGE %s', value)
+
+    def confirm(self, sender:str, id:str):
+        """
+        Confirm that we received a message.
+
+        IDs are collected for each sender and sent together as a list in one ``CONFIRM`` after
+        :attr:`.confirm_interval` seconds, or as soon as :attr:`.confirm_batch` are waiting.
+        If :attr:`.confirm_interval` is 0 (the default), or the sender can't read a list of ids
+        (see :meth:`.Peer_Formats.can_batch` ), each confirmation is sent immediately.
+
+        Called from the IOLoop thread (by :meth:`.handle_listen` ).
+
+        Args:
+            sender (str): ID of the node that sent the message
+            id (str): ID of the message
+        """
+        if not self.confirm_interval or not self.peer_formats.can_batch(sender):
+            self.send(sender, 'CONFIRM', id)
+            return
+
+        pending = self._pending_confirms.get(sender)
+        if pending is None:
+            if not self._pending_confirms:
+                self.loop.call_later(self.confirm_interval, self.flush_confirms)
+            pending = []
+            self._pending_confirms[sender] = pending
+
+        pending.append(id)
+        if len(pending) >= self.confirm_batch:
+            del self._pending_confirms[sender]
+            self.send(sender, 'CONFIRM', pending)
+
+    def flush_confirms(self):
+        """
+        Send all confirmations collected by :meth:`.confirm`
+        """
+        pending, self._pending_confirms = self._pending_confirms, {}
+        for sender, ids in pending.items():
+            # single confirmations are sent as a bare id
+            self.send(sender, 'CONFIRM', ids[0] if len(ids) == 1 else ids)
+
+    def learn_format(self, msg:Message):
+        """
+        Remember which wire formats the sender of a message can read, see :meth:`.Peer_Formats.learn`
+
+        Args:
+            msg (:class:`.Message`): A received message
+        """
+        self.peer_formats.learn(msg)
+
+    def peer_format(self, to:str) -> str:
+        """
+        Choose the wire format for a message to ``to`` , see :meth:`.Peer_Formats.choose`
+
+        Args:
+            to (str): ID of the recipient
+
+        Returns:
+            str: ``'binary'`` or ``'json'``
+        """
+        return self.peer_formats.choose(to, self.msg_format)
 
     def l_stream(self, msg):
         """
@@ -403,8 +554,8 @@ class Net_Node(object):
         old_value = copy(msg.value)
         delattr(msg, 'value')
         for v in old_value['payload']:
-            # if isinstance(v, dict) and ('headers' in old_value.keys()):
-            #     v.update(old_value['headers'])
+            if isinstance(v, dict) and ('headers' in old_value.keys()):
+                v.update(old_value['headers'])
             #msg.value = v
             listen_fn(v)
     #
@@ -457,6 +608,8 @@ class Net_Node(object):
         if not repeat:
             msg.flags['NOREPEAT'] = True
 
+        if self.trace:
+            msg.flags['TRACE'] = True
 
         if flags:
             for k, v in flags.items():
@@ -465,13 +618,37 @@ class Net_Node(object):
 
         return msg
 
-    def get_stream(self, id, key, min_size=5, upstream=None, port = None, ip=None, subject=None, q_size:Optional[int]=None):
+    def get_stream(self, id, key, min_size=5, upstream=None, port = None, ip=None, subject=None,
+                   q_size:Optional[int]=None, batch_bytes:Optional[int]=None,
+                   max_latency:Optional[float]=None) -> 'Stream_Queue':
         """
 
         Make a queue that another object can dump data into that sends on its own socket.
         Smarter handling of continuous data than just hitting 'send' a shitload of times.
+
+        Items appended to the queue are collected into batches and sent as a single ``STREAM``
+        message when any of the batch thresholds are reached: ``min_size`` items,
+        ``batch_bytes`` bytes, or when the oldest item has waited ``max_latency`` seconds.
+        If ``min_size`` is 1, each item is sent as its own message with ``key``.
+
+        Append ``'END'`` to the queue to stop the stream.
+
+        Args:
+            id (str): ID of the stream, the stream's socket is ``{self.id}_{id}``
+            key (str): Key of the messages to send, or the ``inner_key`` of the ``STREAM`` message
+            min_size (int): Number of items to batch before sending (default: 5)
+            upstream (str): ID of the recipient, default :attr:`.upstream`
+            port (int): Port of the recipient, default :attr:`.port`
+            ip (str): IP of the recipient, default :attr:`.upstream_ip`
+            subject (str): Subject to add to the headers of each message
+            q_size (int): Maximum number of items waiting to be sent.
+                If the queue is full, the oldest item is dropped (counted in :attr:`.Stream_Queue.dropped`).
+                Default ``None`` -- unbounded.
+            batch_bytes (int): Send a batch once its items (estimated by :func:`.item_nbytes`) are at least this large
+            max_latency (float): Send a batch once its first item has been waiting this many seconds
+
         Returns:
-            Queue: Place to dump ur data
+            :class:`.Stream_Queue`: Place to dump ur data
 
         """
         if upstream is None:
@@ -490,20 +667,21 @@ class Net_Node(object):
                 subject = prefs.get('SUBJECT')
 
         # make a queue
-        q = deque(maxlen=q_size)
+        q = Stream_Queue(maxlen=q_size)
 
         stream_thread = threading.Thread(target=self._stream,
-                                         args=(id, key, min_size, upstream, port, ip, subject, q))
+                                         args=(id, key, min_size, upstream, port, ip, subject, q,
+                                               batch_bytes, max_latency))
         stream_thread.setDaemon(True)
         stream_thread.start()
         self.streams[id] = stream_thread
 
-        self.streams[id] = stream_thread
-
         self.logger.info(("Stream started with configuration:\n"+
                           "ID: {}\n".format(self.id+"_"+id)+
                           "Key: {}\n".format(key)+
                           "Min Chunk Size: {}\n".format(min_size)+
+                          "Max Chunk Bytes: {}\n".format(batch_bytes)+
+                          "Max Latency: {}\n".format(max_latency)+
                           "Upstream ID: {}\n".format(upstream) +
                           "Port: {}\n".format(port) +
                           "IP: {}\n".format(ip) +
@@ -514,21 +692,32 @@ class Net_Node(object):
         return q
 
 
-    def _stream(self, id, msg_key, min_size, upstream, port, ip, subject, q):
+    def _stream(self, id, msg_key, min_size, upstream, port, ip, subject, q:'Stream_Queue',
+                batch_bytes=None, max_latency=None):
 
-
-
-        # create a new context and socket
-        #context = zmq.Context()
-        #loop = IOLoop()
+        # the socket is only ever used from this thread, so rather than
+        # going through the IOLoop we send on it directly, blocking (up to
+        # a timeout) when the recipient can't keep up. Meanwhile items
+        # pile up in the queue, which drops the oldest when it's full
         socket = self.context.socket(zmq.DEALER)
         socket_id = "{}_{}".format(self.id, id)
         #socket.identity = socket_id
         socket.setsockopt_string(zmq.IDENTITY, socket_id)
-        socket.connect('tcp://{}:{}'.format(ip, port))
-
-        socket = ZMQStream(socket, self.loop)
-
+        socket.setsockopt(zmq.SNDTIMEO, self.stream_timeout)
+        socket.setsockopt(zmq.LINGER, 0)
+        endpoint = self.endpoint(ip, port)
+        socket.connect(endpoint)
+
+        # streams to the same computer send their arrays through their own shared memory,
+        # if they're to the station bound there (our upstream), which copies them out when it
+        # reads the message. Streams to anyone else would be forwarded with the ring's address.
+        shm = None
+        if endpoint.startswith('ipc://'):
+            self.peer_formats.setdefault(upstream, SERIALIZERS)
+            if SHARED_MEMORY and upstream == self.upstream and port == self.port:
+                shm = Shm_Ring(self.shm_size, self.shm_min_bytes)
+
+        upstream_id = upstream
         upstream = upstream.encode('utf-8')
 
         if subject is None:
@@ -547,69 +736,69 @@ class Net_Node(object):
             pilot = prefs.get('NAME')
 
         msg_counter = count()
-
-        pending_data = []
+        reported_dropped = 0 # q.dropped when queue drops were last logged
 
         if min_size > 1:
-
-            while True:
-                try:
-                    data = q.popleft()
-                except IndexError:
-                    # normal, we might iterate faster than the source
-                    continue
-                if isinstance(data, str) and data == 'END':
-                    break
-                if isinstance(data, tuple):
-                    # tuples are immutable, so can't serialize numpy arrays they contain
-                    data = list(data)
-
-                pending_data.append(data)
-
-                if not socket.sending() and len(pending_data)>=min_size:
-                    msg = Message(to=upstream.decode('utf-8'), key="STREAM",
-                                  value={'inner_key' : msg_key,
-                                         'headers'   : {'subject': subject,
-                                                        'pilot'  : pilot,
-                                                        'continuous': True},
-                                         'payload'   : pending_data},
-                                  id="{}_{}".format(id, next(msg_counter)),
-                                  flags={'NOREPEAT':True, 'MINPRINT':True},
-                                  sender=socket_id).serialize()
-                    last_msg = socket.send_multipart((upstream, upstream, msg),
-                                                     track=True, copy=True)
-
-                    self.logger.debug("STREAM {}: Sent {} items".format(self.id+'_'+id, len(pending_data)))
-                    pending_data = []
+            batch_size = min_size
         else:
-            # just send like normal messags
-            # just send like normal messags
-            while True:
+            # just send like normal messages
+            batch_size, batch_bytes, max_latency = 1, None, None
+
+        while True:
+            # blocks until there's something to send
+            pending_data, ended = q.get_batch(batch_size, batch_bytes, max_latency)
+
+            # tuples are immutable, so can't serialize numpy arrays they contain
+            pending_data = [list(data) if isinstance(data, tuple) else data for data in pending_data]
+
+            if min_size > 1 and len(pending_data) > 0:
+                # inner_key and pilot are repeated in the header so stations
+                # can route the stream without decoding the payload
+                msgs = [Message(to=upstream_id, key="STREAM",
+                                inner_key=msg_key,
+                                pilot=pilot,
+                                subject=subject,
+                                value={'inner_key' : msg_key,
+                                       'headers'   : {'subject': subject,
+                                                      'pilot'  : pilot,
+                                                      'continuous': True},
+                                       'payload'   : pending_data},
+                                id="{}_{}".format(id, next(msg_counter)),
+                                flags={'NOREPEAT':True, 'MINPRINT':True},
+                                sender=socket_id)]
+            else:
+                msgs = [Message(to=upstream_id, key=msg_key,
+                                subject=subject,
+                                pilot=pilot,
+                                continuous=True,
+                                value=data,
+                                flags={'NOREPEAT': True, 'MINPRINT': True},
+                                id="{}_{}".format(id, next(msg_counter)),
+                                sender=socket_id) for data in pending_data]
+
+            for msg in msgs:
                 try:
-                    data = q.popleft()
-                except IndexError:
-                    continue
-
-                if isinstance(data, str) and data == "END":
-                    break
-
-                if isinstance(data, tuple):
-                    # tuples are immutable, so can't serialize numpy arrays they contain
-                    data = list(data)
-
-                msg = Message(to=upstream.decode('utf-8'), key=msg_key,
-                              subject=subject,
-                              pilot=pilot,
-                              continuous=True,
-                              value=data,
-                              flags={'NOREPEAT': True, 'MINPRINT': True},
-                              id="{}_{}".format(id, next(msg_counter)),
-                              sender=socket_id).serialize()
-                socket.send_multipart((upstream, upstream, msg),
-                                       track=False, copy=False)
-
-                self.logger.debug("STREAM {}: Sent 1 item".format(self.id + '_' + id))
+                    socket.send_multipart((upstream, upstream, msg.serialize(self.peer_format(upstream_id), shm=shm)),
+                                          copy=False)
+                except zmq.Again:
+                    q.send_dropped += len(pending_data) if msg.key == 'STREAM' else 1
+                    self.logger.warning('STREAM {}: recipient not receiving, dropped message'.format(socket_id))
+
+            if len(pending_data) > 0:
+                self.logger.debug('STREAM %s: Sent %d items', socket_id, len(pending_data))
+
+            dropped = q.dropped
+            if dropped > reported_dropped:
+                self.logger.warning('STREAM %s: queue full, dropped %d items (%d total)',
+                                    socket_id, dropped - reported_dropped, dropped)
+                reported_dropped = dropped
+
+            if ended:
+                break
 
+        socket.close()
+        if shm is not None:
+            shm.close()
 
     @property
     def ip(self) -> str:
@@ -641,4 +830,129 @@ class Net_Node(object):
 
     def release(self):
         self.closing.set()
-        self.loop.stop()
\ No newline at end of file
+        self.dispatcher.release()
+        self.loop.stop()
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+
+def item_nbytes(item) -> int:
+    """
+    Estimate the size of an item put in a :class:`.Stream_Queue` ,
+    counting the buffers of any arrays, bytes, and strings within it.
+
+    Args:
+        item: An item to be streamed
+
+    Returns:
+        int: estimated size in bytes
+    """
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    elif isinstance(item, (bytes, bytearray, str)):
+        return len(item)
+    elif isinstance(item, dict):
+        return sum(item_nbytes(v) for v in item.values())
+    elif isinstance(item, (list, tuple)):
+        return sum(item_nbytes(v) for v in item)
+    return 8
+
+
+class Stream_Queue(object):
+    """
+    Queue used by :meth:`.Net_Node.get_stream` to pass items to a stream's sending thread.
+
+    Works like the :class:`collections.deque` it replaces (items are :meth:`.append` ed,
+    and when ``maxlen`` is reached the oldest item is dropped), but lets the sending thread
+    block in :meth:`.get_batch` until there's enough to send rather than polling.
+
+    Args:
+        maxlen (int): Maximum number of items to hold, default ``None`` -- unbounded
+
+    Attributes:
+        dropped (int): Number of items dropped because the queue was full
+        send_dropped (int): Number of items the sending thread dropped because the recipient
+            wasn't receiving them (see :attr:`.Net_Node.stream_timeout` )
+    """
+
+    def __init__(self, maxlen:Optional[int]=None):
+        self.maxlen = maxlen
+        self.dropped = 0
+        self.send_dropped = 0
+        self._items = deque() # (item, time appended, nbytes)
+        self._nbytes = 0
+        self._cond = threading.Condition()
+
+    def append(self, item):
+        """
+        Add an item to be sent, dropping the oldest item if the queue is full.
+
+        Args:
+            item: anything serializable by :class:`.Message` , or ``'END'`` to stop the stream
+        """
+        nbytes = item_nbytes(item)
+        with self._cond:
+            if self.maxlen is not None and len(self._items) >= self.maxlen:
+                _, _, old_nbytes = self._items.popleft()
+                self._nbytes -= old_nbytes
+                self.dropped += 1
+            self._items.append((item, time.monotonic(), nbytes))
+            self._nbytes += nbytes
+            self._cond.notify()
+
+    def get_batch(self, max_items:int=1, max_bytes:Optional[int]=None,
+                  max_latency:Optional[float]=None) -> typing.Tuple[list, bool]:
+        """
+        Block until a batch is ready and return it.
+
+        A batch is ready when there are ``max_items`` items, the items are
+        ``max_bytes`` large, or the first item has been waiting ``max_latency`` seconds,
+        whichever comes first.
+
+        Args:
+            max_items (int): Maximum number of items in a batch
+            max_bytes (int): Size of items at which to send a batch
+            max_latency (float): Seconds the first item can wait before the batch is sent
+
+        Returns:
+            tuple: (list of items, bool -- whether ``'END'`` was received)
+        """
+        with self._cond:
+            while True:
+                if self._ready(max_items, max_bytes, max_latency):
+                    break
+                if max_latency is not None and len(self._items) > 0:
+                    remaining = self._items[0][1] + max_latency - time.monotonic()
+                    self._cond.wait(max(remaining, 0))
+                else:
+                    self._cond.wait()
+
+            batch = []
+            batch_nbytes = 0
+            ended = False
+            while len(self._items) > 0 and len(batch) < max_items:
+                item, _, nbytes = self._items.popleft()
+                self._nbytes -= nbytes
+                if isinstance(item, str) and item == 'END':
+                    ended = True
+                    break
+                batch.append(item)
+                batch_nbytes += nbytes
+                if max_bytes is not None and batch_nbytes >= max_bytes:
+                    break
+            return batch, ended
+
+    def _ready(self, max_items, max_bytes, max_latency) -> bool:
+        if len(self._items) == 0:
+            return False
+        if len(self._items) >= max_items:
+            return True
+        if max_bytes is not None and self._nbytes >= max_bytes:
+            return True
+        if max_latency is not None and time.monotonic() - self._items[0][1] >= max_latency:
+            return True
+        # always send what we have before ending
+        return any(isinstance(item, str) and item == 'END' for item, _, _ in self._items)
+
+    def __len__(self):
+        return len(self._items)
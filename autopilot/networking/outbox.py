@@ -0,0 +1,237 @@
+"""
+Keep track of sent messages until they are confirmed, and resend them if they aren't.
+
+Rather than periodically scanning every unconfirmed message, an :class:`.Outbox` keeps
+its messages in a heap ordered by when they should next be resent, so checking for
+messages to resend only touches the ones that are due.
+"""
+
+import heapq
+import threading
+import time
+import typing
+from collections import deque
+from itertools import count
+
+
+class Outbox_Entry(object):
+    """
+    A message waiting in an :class:`.Outbox`
+
+    Attributes:
+        id (str): ID of the message
+        peer (str): Who the message is to, used to limit the number of unconfirmed messages per recipient
+        frames (list): The serialized multipart message, resent as-is
+        send (callable): Function to send the frames with, eg. :meth:`zmq.Socket.send_multipart`
+        ttl (int): Number of times the message can be resent
+        interval (float): Current seconds between resends, multiplied by :attr:`.Outbox.backoff` after each one
+        deadline (float): :func:`time.monotonic` time when the message should next be resent
+        first_sent (float): :func:`time.monotonic` time when the message was first sent, or ``None`` if deferred
+        attempts (int): Number of times the message has been sent
+        msg (:class:`.Message`): The message itself, used when logging
+    """
+    __slots__ = ('id', 'peer', 'frames', 'send', 'ttl', 'interval', 'deadline',
+                 'first_sent', 'attempts', 'msg')
+
+    def __init__(self, id, peer, frames, send, ttl, interval, msg):
+        self.id = id
+        self.peer = peer
+        self.frames = frames
+        self.send = send
+        self.ttl = ttl
+        self.interval = interval
+        self.deadline = None
+        self.first_sent = None
+        self.attempts = 0
+        self.msg = msg
+
+
+class Outbox(object):
+    """
+    Messages that have been sent but not yet confirmed.
+
+    Each message is first resent ``interval`` seconds after it is sent, then after
+    ``interval * backoff``, ``interval * backoff**2``, ... (up to ``max_interval``) until it
+    is confirmed or it has been resent ``ttl`` times.
+
+    If ``max_in_flight`` is set, only that many messages to each peer can be unconfirmed at once,
+    and later messages are held (in order) until earlier ones are confirmed or fail.
+
+    Thread-safe.
+
+    Args:
+        interval (float): Seconds to wait before the first resend
+        backoff (float): Factor to increase the interval by after each resend
+        max_interval (float): Longest interval between resends
+        max_in_flight (int): Maximum number of unconfirmed messages per peer, or ``None`` for no limit
+
+    Attributes:
+        counters (dict):
+
+            * ``sent`` - messages sent for the first time
+            * ``deferred`` - messages held because their peer had too many unconfirmed messages
+            * ``retransmits`` - number of resends
+            * ``confirmed`` - messages that were confirmed
+            * ``failed`` - messages that ran out of ``ttl`` without being confirmed
+            * ``ack_latency_total`` - summed seconds from first send to confirmation
+            * ``ack_latency_max`` - longest seconds from first send to confirmation
+    """
+
+    def __init__(self, interval:float=10.0, backoff:float=2.0, max_interval:float=60.0,
+                 max_in_flight:typing.Optional[int]=None):
+        self.interval = interval
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.max_in_flight = max_in_flight
+
+        self.counters = {'sent': 0, 'deferred': 0, 'retransmits': 0, 'confirmed': 0, 'failed': 0,
+                         'ack_latency_total': 0.0, 'ack_latency_max': 0.0}
+
+        self._entries = {} # type: typing.Dict[str, Outbox_Entry]
+        self._heap = [] # (deadline, tiebreak, id)
+        self._in_flight = {} # type: typing.Dict[str, int]
+        self._held = {} # type: typing.Dict[str, deque]
+        self._tiebreak = count()
+        self._lock = threading.RLock()
+
+    def add(self, id:str, peer:str, frames:list, send:typing.Callable, ttl:int=2, msg=None):
+        """
+        Send a message and keep it until it is confirmed, or hold it if its
+        peer already has :attr:`.max_in_flight` unconfirmed messages.
+
+        Args:
+            id (str): ID of the message, as confirmed by its recipient
+            peer (str): ID of the recipient
+            frames (list): serialized multipart message
+            send (callable): called with ``frames`` to send (and resend) the message
+            ttl (int): Number of times to resend the message
+            msg (:class:`.Message`): The message itself, to use in logs
+        """
+        entry = Outbox_Entry(id, peer, frames, send, ttl, self.interval, msg)
+        with self._lock:
+            if id in self._entries:
+                # sending the same message again, replace it
+                self._remove(self._entries[id])
+            self._entries[id] = entry
+            if self.max_in_flight is not None and self._in_flight.get(peer, 0) >= self.max_in_flight:
+                self._held.setdefault(peer, deque()).append(entry)
+                self.counters['deferred'] += 1
+                return
+            self._send_first(entry)
+
+    def _send_first(self, entry:Outbox_Entry):
+        # call with lock held
+        self._in_flight[entry.peer] = self._in_flight.get(entry.peer, 0) + 1
+        entry.first_sent = time.monotonic()
+        entry.deadline = entry.first_sent + entry.interval
+        entry.attempts = 1
+        heapq.heappush(self._heap, (entry.deadline, next(self._tiebreak), entry.id))
+        self.counters['sent'] += 1
+        entry.send(entry.frames)
+
+    def _remove(self, entry:Outbox_Entry):
+        # call with lock held
+        del self._entries[entry.id]
+        if entry.first_sent is None:
+            # still held, never sent
+            self._held[entry.peer].remove(entry)
+            return
+
+        self._in_flight[entry.peer] -= 1
+        held = self._held.get(entry.peer)
+        if held:
+            self._send_first(held.popleft())
+
+    def confirm(self, id:str) -> bool:
+        """
+        Remove a confirmed message, sending the next held message to its peer if there is one.
+
+        Args:
+            id (str): ID of the confirmed message
+
+        Returns:
+            bool: ``True`` if the message was in the outbox, ``False`` if not (eg. already confirmed)
+        """
+        with self._lock:
+            entry = self._entries.get(id)
+            if entry is None:
+                return False
+            if entry.first_sent is not None:
+                latency = time.monotonic() - entry.first_sent
+                self.counters['confirmed'] += 1
+                self.counters['ack_latency_total'] += latency
+                self.counters['ack_latency_max'] = max(self.counters['ack_latency_max'], latency)
+            self._remove(entry)
+            return True
+
+    def resend_due(self, now:typing.Optional[float]=None) -> typing.Tuple[typing.List[Outbox_Entry], typing.List[Outbox_Entry]]:
+        """
+        Resend messages whose deadline has passed, and drop those that are out of ``ttl``
+
+        Args:
+            now (float): current :func:`time.monotonic` time, default now.
+
+        Returns:
+            tuple: (list of resent :class:`.Outbox_Entry` s, list of failed :class:`.Outbox_Entry` s)
+        """
+        if now is None:
+            now = time.monotonic()
+
+        resent = []
+        failed = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, id = heapq.heappop(self._heap)
+                entry = self._entries.get(id)
+                if entry is None or entry.deadline != deadline:
+                    # confirmed, or rescheduled since this was pushed
+                    continue
+
+                if entry.ttl <= 0:
+                    self.counters['failed'] += 1
+                    self._remove(entry)
+                    failed.append(entry)
+                    continue
+
+                entry.ttl -= 1
+                entry.attempts += 1
+                entry.interval = min(entry.interval * self.backoff, self.max_interval)
+                entry.deadline = now + entry.interval
+                heapq.heappush(self._heap, (entry.deadline, next(self._tiebreak), entry.id))
+                self.counters['retransmits'] += 1
+                entry.send(entry.frames)
+                resent.append(entry)
+
+        return resent, failed
+
+    def next_due(self) -> typing.Optional[float]:
+        """
+        Returns:
+            float: seconds until the next message is due to be resent, or ``None`` if the outbox is empty
+        """
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - time.monotonic(), 0.0)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: a copy of :attr:`.counters` along with the number of messages ``in_flight`` , ``held`` ,
+            and the mean ``ack_latency_mean``
+        """
+        with self._lock:
+            stats = self.counters.copy()
+            stats['in_flight'] = sum(self._in_flight.values())
+            stats['held'] = sum(len(held) for held in self._held.values())
+        if stats['confirmed'] > 0:
+            stats['ack_latency_mean'] = stats['ack_latency_total'] / stats['confirmed']
+        else:
+            stats['ack_latency_mean'] = 0.0
+        return stats
+
+    def __contains__(self, id:str) -> bool:
+        return id in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
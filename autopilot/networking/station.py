@@ -22,7 +22,13 @@ from zmq.eventloop.zmqstream import ZMQStream
 
 from autopilot import prefs
 from autopilot.core.loggers import init_logger
-from autopilot.networking.message import Message
+from autopilot.networking.message import Message, Peer_Formats
+from autopilot.networking.dispatch import Dispatcher
+from autopilot.networking.outbox import Outbox, Outbox_Entry
+from autopilot.networking.backlog import Backlog, BACKLOG_FN
+from autopilot.networking.trace import Trace_Aggregator
+from autopilot.networking.local import IPC, ipc_endpoint
+from autopilot.networking.transfer import File_Source, File_Download, file_hash, install_file
 
 
 class Station(multiprocessing.Process):
@@ -79,13 +85,31 @@ class Station(multiprocessing.Process):
         ip (str): Device IP
         listens (dict): Dictionary of functions to call for different types of messages. keys match the :attr:`.Message.key`.
         senders (dict): Identities of other sockets (keys, ie. directly connected) and their state (values) if they keep one
-        push_outbox (dict): Messages that have been sent but have not been confirmed to our :attr:`Station.pusher`
-        send_outbox (dict): Messages that have been sent but have not been confirmed to our :attr:`Station.listener`
+        push_outbox (:class:`.Outbox`): Messages that have been sent but have not been confirmed to our :attr:`Station.pusher` ,
+            created in :meth:`.run`
+        send_outbox (:class:`.Outbox`): Messages that have been sent but have not been confirmed to our :attr:`Station.listener` ,
+            created in :meth:`.run`
         timers (dict): dict of :class:`threading.Timer` s that will check in on outbox messages
         msg_counter (:class:`itertools.count`): counter to index our sent messages
         file_block (:class:`threading.Event`): Event to signal when a file is being received.
+        msg_format (str): Preferred wire format, from ``prefs.get('MSG_FORMAT')``
+        peer_formats (:class:`.Peer_Formats`): Wire formats each sender has told us it can read
+        dispatcher (:class:`.Dispatcher`): Calls listen methods in a pool of :attr:`.n_workers` threads,
+            created in :meth:`.run`
+        traces (:class:`.Trace_Aggregator`): Latencies of traced messages we've handled,
+            created in :meth:`.run` , so only in the station's process. Other processes
+            can ask for them with a ``TRACES`` message (see :meth:`.l_traces` ).
     """
     repeat_interval = 5.0 # seconds to wait before retrying messages
+    repeat_backoff = 2.0 # multiply the wait by this after each retry
+    repeat_max_interval = 60.0 # longest wait between retries
+    max_in_flight = None # unconfirmed messages to each peer before holding new ones, None for no limit
+    confirm_interval = 0 # seconds to collect confirmations before sending them together, 0 to send each immediately
+    confirm_batch = 64 # send collected confirmations early once this many are waiting for one sender
+    trace = False # set the TRACE flag on every message we send, see :mod:`.networking.trace`
+    n_workers = 8 # threads used to call listen methods
+    max_queue = 256 # messages of each key from each sender that can be waiting to be handled
+    inline_keys = ('CONFIRM',) # keys whose listens are cheap enough to call in the IOLoop thread
 
     def __init__(self,
                  id: Optional[str] = None,
@@ -111,13 +135,16 @@ class Station(multiprocessing.Process):
         self.id = id
         self.repeat_thread = None
         self.senders = {}
-        self.push_outbox = {}
-        self.send_outbox = {}
+        self.push_outbox = None # type: Optional[Outbox]
+        self.send_outbox = None # type: Optional[Outbox]
         self.timers = {}
+        self._pending_confirms = {} # type: typing.Dict[tuple, list]
         self.child = False
         self.routes = {}
         self.msgs_received = multiprocessing.Value('i', lock=True)
         self.msgs_received.value = 0
+        self.msg_format = prefs.get('MSG_FORMAT')
+        self.peer_formats = Peer_Formats()
 
         try:
             self.ip = self.get_ip()
@@ -127,6 +154,8 @@ class Station(multiprocessing.Process):
 
 
         self.file_block = multiprocessing.Event() # to wait for file transfer
+        self.dispatcher = None # type: Optional[Dispatcher]
+        self.traces = None # type: Optional[Trace_Aggregator]
 
         # number messages as we send them
         self.msg_counter = count()
@@ -137,7 +166,8 @@ class Station(multiprocessing.Process):
         self.listens = listens
         self.listens.update({
             'CONFIRM': self.l_confirm,
-            'STREAM' : self.l_stream
+            'STREAM' : self.l_stream,
+            'TRACES' : self.l_traces
         })
 
         # even tthat signals when we are closing
@@ -166,6 +196,13 @@ class Station(multiprocessing.Process):
             self.context = zmq.Context()
             self.loop = IOLoop()
 
+            self.dispatcher = Dispatcher(n_workers=self.n_workers, max_queue=self.max_queue,
+                                         inline=self.inline_keys, logger=self.logger,
+                                         name='{}_dispatch'.format(self.id))
+            self.send_outbox = self._make_outbox()
+            self.push_outbox = self._make_outbox()
+            self.traces = Trace_Aggregator()
+
             # Our networking topology is treelike:
             # each Station object binds one Router to
             # send and receive messages from its descendants
@@ -174,6 +211,9 @@ class Station(multiprocessing.Process):
             self.listener  = self.context.socket(zmq.ROUTER)
             self.listener.setsockopt_string(zmq.IDENTITY, self.id)
             self.listener.bind('tcp://*:{}'.format(self.listen_port))
+            if IPC:
+                # nodes on the same computer connect through ipc, see networking.local
+                self.listener.bind(ipc_endpoint(self.listen_port))
             self.listener = ZMQStream(self.listener, self.loop)
             self.listener.on_recv(self.handle_listen)
 
@@ -234,6 +274,9 @@ class Station(multiprocessing.Process):
         if not repeat:
             msg.flags['NOREPEAT'] = True
 
+        if self.trace:
+            msg.flags['TRACE'] = True
+
         if flags:
             for k, v in flags.items():
                 msg.flags[k] = v
@@ -288,22 +331,31 @@ class Station(multiprocessing.Process):
         if not msg.validate():
             self.logger.exception('Message Invalid:\n{}'.format(str(msg)))
 
-        # encode message
-        msg_enc = msg.serialize()
+        # encode message, messages we are forwarding keep the format they came in
+        if msg.sender in (self.id, '_' + self.id):
+            msg.stamp(self.id, 'send')
+            msg_enc = msg.serialize(self.peer_format(msg.to))
+        else:
+            msg.stamp(self.id, 'forward')
+            msg_enc = msg.serialize()
 
         if not msg_enc:
             self.logger.exception('Message could not be encoded:\n{}'.format(str(msg)))
             return
 
         if manual_to:
-            self.listener.send_multipart([to.encode('utf-8'), msg_enc])
+            frames = [to.encode('utf-8'), msg_enc]
+        elif isinstance(msg.to, list):
+            frames = [*[hop.encode('utf-8') for hop in to], msg_enc]
         else:
+            frames = [msg.to.encode('utf-8'), msg_enc]
 
-            if isinstance(msg.to, list):
-
-                self.listener.send_multipart([*[hop.encode('utf-8') for hop in to], msg_enc])
-            else:
-                self.listener.send_multipart([msg.to.encode('utf-8'), msg_enc])
+        if repeat and not msg.key == "CONFIRM":
+            # send, and keep until confirmed to resend
+            self.send_outbox.add(msg.id, frames[0], frames, self.listener.send_multipart,
+                                 ttl=msg.ttl, msg=msg)
+        else:
+            self.listener.send_multipart(frames)
 
         # messages can have a flag that says not to log
         # log_this = True
@@ -312,14 +364,8 @@ class Station(multiprocessing.Process):
 
 
         #if msg.key != "CONFIRM":
-        self.logger.debug('MESSAGE SENT - {}'.format(str(msg)))
-
-        if repeat and not msg.key == "CONFIRM":
-            # add to outbox and spawn timer to resend
-            self.send_outbox[msg.id] = (time.time(), msg)
-            # self.timers[msg.id] = threading.Timer(5.0, self.repeat, args=(msg.id,'send'))
-            # self.timers[msg.id].start()
-            #self.outbox.put((msg.id))
+        # format lazily so we don't decode the body of forwarded messages unless we're logging it
+        self.logger.debug('MESSAGE SENT - %s', msg)
 
     def push(self,  to=None, key = None, value = None, msg=None, repeat=True, flags=None):
         """
@@ -373,8 +419,13 @@ class Station(multiprocessing.Process):
         if not msg.validate():
             self.logger.error('Message Invalid:\n{}'.format(str(msg)))
 
-        # encode message
-        msg_enc = msg.serialize()
+        # encode message, messages we are forwarding keep the format they came in
+        if msg.sender in (self.id, '_' + self.id):
+            msg.stamp(self.id, 'send')
+            msg_enc = msg.serialize(self.peer_format(msg.to))
+        else:
+            msg.stamp(self.id, 'forward')
+            msg_enc = msg.serialize()
 
         if not msg_enc:
             self.logger.error('Message could not be encoded:\n{}'.format(str(msg)))
@@ -382,91 +433,70 @@ class Station(multiprocessing.Process):
 
         # Even if the message is not to our upstream node, we still send it
         # upstream because presumably our target is upstream.
-        self.pusher.send_multipart([self.push_id, bytes(msg.to, encoding="utf-8"), msg_enc])
+        frames = [self.push_id, bytes(msg.to, encoding="utf-8"), msg_enc]
+        if repeat and not msg.key == 'CONFIRM':
+            # send, and keep until confirmed to resend
+            self.push_outbox.add(msg.id, self.push_id, frames, self.pusher.send_multipart,
+                                 ttl=msg.ttl, msg=msg)
+        else:
+            self.pusher.send_multipart(frames)
 
         if not (msg.key == "CONFIRM") and log_this:
-            self.logger.debug('MESSAGE PUSHED - {}'.format(str(msg)))
+            self.logger.debug('MESSAGE PUSHED - %s', msg)
 
-        if repeat and not msg.key == 'CONFIRM':
-            # add to outbox and spawn timer to resend
-            self.push_outbox[msg.id] = (time.time(), msg)
-            #self.timers[msg.id] = threading.Timer(5.0, self.repeat, args=(msg.id, 'push'))
-            #self.timers[msg.id].start()
+    def _make_outbox(self) -> Outbox:
+        return Outbox(interval=self.repeat_interval*2, backoff=self.repeat_backoff,
+                      max_interval=self.repeat_max_interval, max_in_flight=self.max_in_flight)
 
     def repeat(self):
         """
-        Periodically (according to :attr:`~.repeat_interval`) resend messages that haven't been confirmed
-
-        TTL is decremented, and messages are resent until their TTL is 0.
+        Resend messages that haven't been confirmed when they come due in
+        :attr:`.send_outbox` or :attr:`.push_outbox` .
 
+        Messages are first resent after ``repeat_interval*2`` seconds, and then
+        after increasing intervals (see :attr:`.repeat_backoff` ) until their TTL is 0.
+        Rather than checking every message every :attr:`.repeat_interval` , we sleep
+        until the next message is due.
         """
         while not self.closing.is_set():
-            # make local copies
-            push_outbox = copy(self.push_outbox)
-            send_outbox = copy(self.send_outbox)
-
-            # try to send any outstanding messages and delete if too old
-            if len(push_outbox)>0:
-                for id in push_outbox.keys():
-                    if push_outbox[id][1].ttl <= 0:
-                        self.logger.warning('PUBLISH FAILED {} - {}'.format(id, str(push_outbox[id][1])))
-                        try:
-                            del self.push_outbox[id]
-                        except KeyError:
-                            # fine, already deleted
-                            pass
-                    else:
-                        # if we didn't just put this message in our outbox
-                        if (time.time() - push_outbox[id][0]) > self.repeat_interval*2:
-
-                            self.logger.debug('REPUBLISH {} - {}'.format(id, str(push_outbox[id][1])))
-                            self.pusher.send_multipart([self.push_id, push_outbox[id][1].serialize()])
-                            self.push_outbox[id][1].ttl -= 1
-
-
-
-            if len(send_outbox)>0:
-                for id in send_outbox.keys():
-                    if send_outbox[id][1].ttl <= 0:
-                        self.logger.warning('PUBLISH FAILED {} - {}'.format(id, str(send_outbox[id][1])))
-                        try:
-                            del self.send_outbox[id]
-                        except KeyError:
-                            # fine, already deleted
-                            pass
-
-                    else:
-                        # if we didn't just put this message in our outbox
-                        if (time.time() - send_outbox[id][0]) > self.repeat_interval*2:
-
-                            self.logger.debug('REPUBLISH {} - {}'.format(id, str(send_outbox[id][1])))
-                            self.listener.send_multipart([bytes(send_outbox[id][1].to, encoding="utf-8"), send_outbox[id][1].serialize()])
-                            self.send_outbox[id][1].ttl -= 1
+            for outbox in (self.push_outbox, self.send_outbox):
+                resent, failed = outbox.resend_due()
+                for entry in failed:
+                    self.publish_failed(entry)
+                for entry in resent:
+                    self.logger.debug('REPUBLISH %s - %s', entry.id, entry.msg)
 
-            # wait to do it again
-            time.sleep(self.repeat_interval)
+            # wait until the next message is due, checking for new ones at least every repeat_interval
+            waits = [outbox.next_due() for outbox in (self.push_outbox, self.send_outbox)]
+            self.closing.wait(min([wait for wait in waits if wait is not None] + [self.repeat_interval]))
 
+    def publish_failed(self, entry:Outbox_Entry):
+        """
+        Called (from the :meth:`.repeat` thread) when a message has been resent ``ttl`` times without being confirmed.
 
+        Args:
+            entry (:class:`.Outbox_Entry`): the message that failed
+        """
+        self.logger.warning('PUBLISH FAILED %s - %s', entry.id, entry.msg)
 
     def l_confirm(self, msg):
         """
         Confirm that a message was received.
 
         Args:
-            msg (:class:`.Message`): A confirmation message - note that this message has its own unique ID, so the value of this message contains the ID of the message that is being confirmed
+            msg (:class:`.Message`): A confirmation message - note that this message has its own unique ID, so the value of this message contains the ID of the message that is being confirmed,
+                or a list of IDs if several were confirmed at once
         """
         # confirmation that a published message was received
         # value should be the message id
 
+        # value is either one message id or a list of them, see :meth:`.confirm`
+        ids = msg.value if isinstance(msg.value, list) else [msg.value]
+
         # delete message from outbox if we still have it
-        try:
-            if msg.value in self.send_outbox.keys():
-                del self.send_outbox[msg.value]
-            elif msg.value in self.push_outbox.keys():
-                del self.push_outbox[msg.value]
-        except KeyError:
-            # fine, already deleted
-            pass
+        for id in ids:
+            if not self.send_outbox.confirm(id):
+                self.push_outbox.confirm(id)
 
         # if this is a message to our internal net_node, make sure it gets the memo that shit was confirmed too
         if msg.to == "_{}".format(self.id):
@@ -475,6 +505,76 @@ class Station(multiprocessing.Process):
 
         #self.logger.info('CONFIRMED MESSAGE {}'.format(msg.value))
 
+    def confirm(self, sender:str, id:str, send_type:str='router'):
+        """
+        Confirm that we received a message.
+
+        Rather than sending a ``CONFIRM`` for every message, IDs are collected for each
+        sender and sent together as a list after :attr:`.confirm_interval` seconds, or as soon as
+        :attr:`.confirm_batch` are waiting. If :attr:`.confirm_interval` is 0 (the default),
+        or the sender can't read a list of ids (see :meth:`.Peer_Formats.can_batch` ),
+        each confirmation is sent immediately.
+
+        Called from the IOLoop thread (by :meth:`.handle_listen` ).
+
+        Args:
+            sender (str): ID of the node that sent the message
+            id (str): ID of the message
+            send_type (str): ``'router'`` to :meth:`.send` the confirmation or ``'dealer'`` to :meth:`.push` it
+        """
+        if not self.confirm_interval or not self.peer_formats.can_batch(sender):
+            self._send_confirm(sender, send_type, [id])
+            return
+
+        pending = self._pending_confirms.get((sender, send_type))
+        if pending is None:
+            if not self._pending_confirms:
+                self.loop.call_later(self.confirm_interval, self.flush_confirms)
+            pending = []
+            self._pending_confirms[(sender, send_type)] = pending
+
+        pending.append(id)
+        if len(pending) >= self.confirm_batch:
+            del self._pending_confirms[(sender, send_type)]
+            self._send_confirm(sender, send_type, pending)
+
+    def flush_confirms(self):
+        """
+        Send all confirmations collected by :meth:`.confirm`
+        """
+        pending, self._pending_confirms = self._pending_confirms, {}
+        for (sender, send_type), ids in pending.items():
+            self._send_confirm(sender, send_type, ids)
+
+    def _send_confirm(self, sender:str, send_type:str, ids:list):
+        # single confirmations are sent as a bare id
+        value = ids[0] if len(ids) == 1 else ids
+        if send_type == 'router':
+            self.send(sender, 'CONFIRM', value)
+        elif send_type == 'dealer':
+            self.push(sender, 'CONFIRM', value)
+
+    def learn_format(self, msg:Message):
+        """
+        Remember which wire formats the sender of a message can read, see :meth:`.Peer_Formats.learn`
+
+        Args:
+            msg (:class:`.Message`): A received message
+        """
+        self.peer_formats.learn(msg)
+
+    def peer_format(self, to:str) -> str:
+        """
+        Choose the wire format for a message to ``to`` , see :meth:`.Peer_Formats.choose`
+
+        Args:
+            to (str): ID of the recipient
+
+        Returns:
+            str: ``'binary'`` or ``'json'``
+        """
+        return self.peer_formats.choose(to, self.msg_format)
+
     def l_stream(self, msg):
         """
         Reconstitute the original stream of messages and call their handling methods
@@ -495,10 +595,39 @@ class Station(multiprocessing.Process):
             msg.value = v
             listen_fn(msg)
 
+    def l_traces(self, msg:Message):
+        """
+        Someone wants to know how long our traced messages took.
+
+        Send the :meth:`.Trace_Aggregator.stats` of :attr:`.traces` back to them as a ``TRACES`` message,
+        and forget them if the value is ``{'clear': True}`` .
+
+        Args:
+            msg (:class:`.Message`):
+        """
+        stats = self.traces.stats()
+        if isinstance(msg.value, dict) and msg.value.get('clear', False):
+            self.traces.clear()
+        self.send(msg.sender, 'TRACES', stats)
+
+    def _call_listen(self, listen_funk:typing.Callable, msg:Message):
+        """
+        Call a listen method with the message from the :attr:`.dispatcher` .
+
+        Traced messages are stamped before and after, and added to :attr:`.traces` .
+        """
+        msg.stamp(self.id, 'dispatch')
+        listen_funk(msg)
+        msg.stamp(self.id, 'done')
+        self.traces.add(msg)
+
     def handle_listen(self, msg:typing.List[bytes]):
         """
         Upon receiving a message, call the appropriate listen method
-        in a new thread.
+        with the :attr:`.dispatcher` .
+
+        Messages with the same key from the same sender are handled in order,
+        in one of the dispatcher's worker threads (or directly, for keys in :attr:`.inline_keys`)
 
         If the message is :attr:`~.Message.to` us, send confirmation.
 
@@ -522,6 +651,7 @@ class Station(multiprocessing.Process):
             #msg = json.loads(msg[0])
             #msg = Message(**msg)
             msg = Message(msg[0])
+            self.learn_format(msg)
 
         elif len(msg)>=2:
             # from the router
@@ -547,31 +677,41 @@ class Station(multiprocessing.Process):
             # the second to last should always be the intended recipient
             unserialized_to = msg[-2]
             if unserialized_to.decode('utf-8') not in [self.id, "_{}".format(self.id)]:
+                traced = Message.is_traced(msg[-1])
+                if traced or Message.uses_shm(msg[-1]):
+                    # only traced messages are decoded to be stamped, and messages with arrays in
+                    # shared memory, which the next hop may not be able to read, so they're copied back in
+                    forwarded = Message(msg[-1])
+                    if traced:
+                        forwarded.stamp(self.id, 'forward')
+                    msg[-1] = forwarded.serialize()
+
                 # forward it!!
                 if len(msg) > 4:
                     # multihop message, just determine whether the next hop is through
                     # our pusher or router
                     if self.pusher and msg[2] not in self.senders.keys():
                         self.pusher.send_multipart(msg[2:])
-                        self.logger.debug(f'FORWARDING (multihop dealer): {msg}')
+                        self.logger.debug('FORWARDING (multihop dealer): %s', msg[:-1])
                     else:
                         self.listener.send_multipart(msg[2:])
-                        self.logger.debug(f'FORWARDING (multihop router): {msg}')
+                        self.logger.debug('FORWARDING (multihop router): %s', msg[:-1])
                 else:
                     if unserialized_to not in self.senders.keys() and self.pusher:
                         # if we don't know who they are and we have a pusher, try to push it
                         self.pusher.send_multipart([self.push_id, *msg[2:]])
-                        self.logger.debug(f'FORWARDING (dealer): {msg}')
+                        self.logger.debug('FORWARDING (dealer): %s', msg[:-1])
                     else:
                         # if we know who they are or not, try to send it through router anyway.
                         # send everything but the first two frames, which should be the ID of
                         # the sender and us
                         self.listener.send_multipart(msg[2:])
-                        self.logger.debug(f'FORWARDING (router): {msg}')
+                        self.logger.debug('FORWARDING (router): %s', msg[:-1])
 
                 return
 
             msg = Message(msg[-1])
+            self.learn_format(msg)
 
             # if this is a new sender, add them to the list
             if msg['sender'] not in self.senders.keys():
@@ -593,12 +733,12 @@ class Station(multiprocessing.Process):
         # if this message is to us, just handle it and return
         if msg.to in [self.id, "_{}".format(self.id)]:
             if (msg.key != "CONFIRM"):
-                self.logger.debug('RECEIVED: {}'.format(str(msg)))
-            # Log and spawn thread to respond to listen
+                self.logger.debug('RECEIVED: %s', msg)
+            # Log and dispatch listen
             try:
                 listen_funk = self.listens[msg.key]
-                listen_thread = threading.Thread(target=listen_funk, args=(msg,))
-                listen_thread.start()
+                msg.stamp(self.id, 'recv')
+                self.dispatcher.submit(msg.key, self._call_listen, listen_funk, msg, order=msg.sender)
             except KeyError:
                 self.logger.exception('No function could be found for msg id {} with key: {}'.format(msg.id, msg.key))
 
@@ -606,10 +746,7 @@ class Station(multiprocessing.Process):
             # send a return message that confirms even if we except
             # don't confirm confirmations
             if (msg.key != "CONFIRM") and ('NOREPEAT' not in msg.flags.keys()):
-                if send_type == 'router':
-                    self.send(msg.sender, 'CONFIRM', msg.id)
-                elif send_type == 'dealer':
-                    self.push(msg.sender, 'CONFIRM', msg.id)
+                self.confirm(msg.sender, msg.id, send_type)
             return
         elif self.child and (msg.to == 'T'):
             # FIXME UGLY HACK
@@ -674,6 +811,8 @@ class Station(multiprocessing.Process):
     def release(self):
 
         self.closing.set()
+        if self.dispatcher is not None:
+            self.dispatcher.release()
 
         # send a message to ourselves from the parent process to this one
         ctx = zmq.Context().instance()
@@ -730,6 +869,10 @@ class Terminal_Station(Station):
     +-------------+-------------------------------------------+-----------------------------------------------+
     | 'FILE'      | :meth:`~.Terminal_Station.l_file`         | The pi needs some file from us                |
     +-------------+-------------------------------------------+-----------------------------------------------+
+    | 'FILE_CHUNK'| :meth:`~.Terminal_Station.l_file_chunk`   | The pi needs part of a file from us           |
+    +-------------+-------------------------------------------+-----------------------------------------------+
+    | 'ROWS'      | :meth:`~.Terminal_Station.l_rows`         | A Pi is sending rows of trial data we missed  |
+    +-------------+-------------------------------------------+-----------------------------------------------+
 
     """
 
@@ -738,6 +881,8 @@ class Terminal_Station(Station):
     #send_plot.clear()
     # dict of threading events that determine how frequently we send plot updates
     sent_plot = {}
+    file_chunk_size = 2**18 # bytes in each chunk of a file sent to a pilot
+    confirm_interval = 0.05 # every pilot's data is confirmed here, so collect confirmations for a bit
 
     def __init__(self, pilots):
         """
@@ -765,11 +910,16 @@ class Terminal_Station(Station):
             'STATE':     self.l_state,  # The Pi is confirming/notifying us that it has changed state
             'HANDSHAKE': self.l_handshake, # initial connection with some initial info
             'FILE':      self.l_file,  # The pi needs some file from us
+            'FILE_CHUNK': self.l_file_chunk, # The pi needs part of a file from us
+            'ROWS':      self.l_rows, # A pi is sending rows of trial data the terminal missed
         })
 
         # dictionary that keeps track of our pilots
         self.pilots = pilots
 
+        # files are sent from the sound directory in chunks
+        self.file_source = File_Source(prefs.get('SOUNDDIR'), chunk_size=self.file_chunk_size)
+
         # start a timer at the draw FPS of the terminal -- only send
         if prefs.get( 'DRAWFPS'):
             self.data_fps = float(prefs.get('DRAWFPS'))
@@ -884,6 +1034,9 @@ class Terminal_Station(Station):
         Just forward this along to the internal terminal object ('_T')
         and a copy to the relevant plot.
 
+        Batches of data replayed from a pilot's backlog (see :meth:`.Pilot_Station.replay` )
+        are only sent to the terminal, not plotted.
+
         Args:
             msg (:class:`.Message`):
         """
@@ -891,9 +1044,23 @@ class Terminal_Station(Station):
         #self.send('_T', 'DATA', msg.value, flags=msg.flags)
         self.send(to='_T', msg=msg)
 
+        if 'batch' in msg.value.keys():
+            return
+
         # Send to plot widget, which should be listening to "P_{pilot_name}"
         #self.send('P_{}'.format(msg.value['pilot']), 'DATA', msg.value, flags=msg.flags)
-        self.send(to='P_{}'.format(msg.value['pilot']), msg=msg)
+        self.send(to='P_{}'.format(self._msg_pilot(msg)), msg=msg)
+
+    def l_rows(self, msg:Message):
+        """
+        A Pilot is sending rows of trial data that the terminal asked for (see :meth:`.Terminal.l_rows` )
+
+        Just forward them along to the internal terminal object ('_T')
+
+        Args:
+            msg (:class:`.Message`):
+        """
+        self.send(to='_T', msg=msg)
 
     def l_continuous(self, msg:Message):
         """
@@ -913,7 +1080,7 @@ class Terminal_Station(Station):
         self.send(to='_T', msg=msg)
 
         # Send to plot widget, which should be listening to "P_{pilot_name}"
-        plot_id = 'P_{}'.format(msg.value['pilot'])
+        plot_id = 'P_{}'.format(self._msg_pilot(msg))
         if plot_id in self.senders.keys():
             if not self.plot_timer:
                 self.start_plot_timer()
@@ -925,6 +1092,31 @@ class Terminal_Station(Station):
                 self.sent_plot[msg.sender].clear()
 
 
+    def l_stream(self, msg:Message):
+        """
+        Forward streams of continuous data whole, rather than unpacking them
+        and forwarding each item (which would require decoding the whole stream).
+
+        Other streams are handled by :meth:`.Station.l_stream`
+
+        Args:
+            msg (:class:`.Message`): Stream sent by :meth:`.Net_Node._stream`
+        """
+        if getattr(msg, 'inner_key', None) == 'CONTINUOUS':
+            self.l_continuous(msg)
+        else:
+            super(Terminal_Station, self).l_stream(msg)
+
+    def _msg_pilot(self, msg:Message) -> str:
+        """
+        Get the pilot a message is from, preferring the header so the
+        :attr:`.Message.value` doesn't need to be decoded.
+        """
+        pilot = getattr(msg, 'pilot', None)
+        if pilot is None:
+            pilot = msg.value['pilot']
+        return pilot
+
     # def l_continuous(self, msg):
     #
     #     # Send through to terminal
@@ -981,27 +1173,55 @@ class Terminal_Station(Station):
         """
         A Pilot needs some file from us.
 
-        Send it back after :meth:`base64.b64encode` ing it.
+        Rather than sending the file itself, send back a manifest from
+        :meth:`.File_Source.manifest` with its hash, size, and number of chunks.
+        The pilot then requests the chunks it needs with ``FILE_CHUNK``
+        (see :meth:`.Terminal_Station.l_file_chunk` ), or nothing if it already has the file.
 
-        TODO:
-            Split large files into multiple messages...
+        If the file can't be read, the manifest has an ``error`` instead.
 
         Args:
             msg (:class:`.Message`): The value field of the message should contain some
-                relative path to a file contained within `prefs.get('SOUNDDIR')` . eg.
+                relative path to a file contained within `prefs.get('SOUNDDIR')` (or a dict with it as ``'path'`` ). eg.
                 `'/songs/sadone.wav'` would return `'os.path.join(prefs.get('SOUNDDIR')/songs.sadone.wav'`
         """
-        # The <target> pi has requested some file <value> from us, let's send it back
-        # This assumes the file is small, if this starts crashing we'll have to split the message...
+        path = msg.value['path'] if isinstance(msg.value, dict) else msg.value
+
+        try:
+            manifest = self.file_source.manifest(path)
+        except (OSError, ValueError) as e:
+            self.logger.exception('Could not send file {}'.format(path))
+            manifest = {'path': path, 'error': str(e)}
+
+        self.send(msg.sender, 'FILE', manifest)
+
+    def l_file_chunk(self, msg:Message):
+        """
+        A Pilot needs one chunk of a file.
 
-        full_path = os.path.join(prefs.get('SOUNDDIR'), msg.value)
-        with open(full_path, 'rb') as open_file:
-            # encode in base64 so json doesn't complain
-            file_contents = base64.b64encode(open_file.read())
+        If the file has changed since the pilot got its manifest, send the new manifest
+        instead so it starts over.
 
-        file_message = {'path':msg.value, 'file':file_contents}
+        Args:
+            msg (:class:`.Message`): value is a dict with the ``path`` , ``hash`` , ``index``
+                and ``chunk_size`` of the requested chunk.
+        """
+        value = msg.value
+        try:
+            manifest = self.file_source.manifest(value['path'])
+        except (OSError, ValueError) as e:
+            self.logger.exception('Could not send file {}'.format(value['path']))
+            self.send(msg.sender, 'FILE', {'path': value['path'], 'error': str(e)})
+            return
+
+        if manifest['hash'] != value['hash']:
+            self.logger.warning('File {} changed during transfer, restarting'.format(value['path']))
+            self.send(msg.sender, 'FILE', manifest)
+            return
 
-        self.send(msg.sender, 'FILE', file_message)
+        data = self.file_source.chunk(value['path'], value['index'], value['chunk_size'])
+        self.send(msg.sender, 'FILE_CHUNK',
+                  {'path': value['path'], 'hash': value['hash'], 'index': value['index'], 'data': data})
 
 
 class Pilot_Station(Station):
@@ -1023,10 +1243,21 @@ class Pilot_Station(Station):
     | 'START'     | :meth:`~.Pilot_Station.l_start`     | We are being sent a task to start             |
     | 'STOP'      | :meth:`~.Pilot_Station.l_stop`      | We are being told to stop the current task    |
     | 'PARAM'     | :meth:`~.Pilot_Station.l_change`    | The Terminal is changing some task parameter  |
-    | 'FILE'      | :meth:`~.Pilot_Station.l_file`      | We are receiving a file                       |
+    | 'FILE'      | :meth:`~.Pilot_Station.l_file`      | We are receiving a file's manifest            |
+    | 'FILE_CHUNK'| :meth:`~.Pilot_Station.l_file_chunk`| We are receiving part of a file               |
+    | 'DATA'      | :meth:`~.Pilot_Station.l_data`      | The pilot is sending data to the Terminal     |
+    | 'ROWS'      | :meth:`~.Pilot_Station.l_forward`   | The Terminal is asking for rows it missed     |
     +-------------+-------------------------------------+-----------------------------------------------+
 
+    Attributes:
+        backlog (:class:`.Backlog`): ``DATA`` messages that the Terminal hasn't confirmed yet,
+            made when the process starts. ``None`` for child pilots.
     """
+    file_window = 8 # chunks of a file to request at once
+    file_cache_dir = '.file_cache' # directory within SOUNDDIR to keep downloaded files, named by their hash
+    replay_batch = 256 # messages from the backlog sent in each batched DATA message
+    replay_interval = 10.0 # seconds between trying to replay the backlog while the terminal is unreachable
+
     def __init__(self):
         # Pilot has a pusher - connects back to terminal
         super(Pilot_Station, self).__init__()
@@ -1058,6 +1289,18 @@ class Pilot_Station(Station):
         self.child = False # Are we acting as a child right now?
         self.parent = False # Are we acting as a parent right now?
 
+        # files being downloaded, see fetch_files
+        self.downloads = {} # type: typing.Dict[str, File_Download]
+        self._download_paths = {} # type: typing.Dict[str, set]
+        self._files_pending = set()
+        self._file_lock = threading.Lock()
+
+        # data waiting for the terminal, see l_data
+        self.backlog = None # type: Optional[Backlog]
+        self._online = True # whether data is sent as it comes or only stored until it can be replayed
+        self._batches = {} # id of batched DATA message -> ids of the messages in it
+        self._backlog_lock = threading.RLock()
+
 
         self.listens.update({
             'STATE': self.l_state,  # Confirm or notify terminal of state change
@@ -1067,13 +1310,16 @@ class Pilot_Station(Station):
             'STOP': self.l_stop,  # We are being told to stop the current task
             'PARAM': self.l_change,  # The Terminal is changing some task parameter
             'FILE': self.l_file,  # We are receiving a file
+            'FILE_CHUNK': self.l_file_chunk, # We are receiving part of a file
             'CONTINUOUS': self.l_continuous, # we are sending continuous data to the terminal
             'CHILD': self.l_child,
             'HANDSHAKE': self.l_noop,
             'CALIBRATE_PORT': self.l_forward,
             'CALIBRATE_RESULT': self.l_forward,
             'BANDWIDTH': self.l_forward,
-            'STREAM_VIDEO': self.l_forward
+            'STREAM_VIDEO': self.l_forward,
+            'ROWS': self.l_forward, # the terminal is asking for rows of trial data it missed
+            'DATA': self.l_data # the pilot is sending data to the terminal
         })
 
         # ping back our status to the terminal every so often
@@ -1086,6 +1332,18 @@ class Pilot_Station(Station):
         self._ping_thread.setDaemon(True)
         self._ping_thread.start()
 
+    def run(self):
+        """
+        Open the :attr:`.backlog` (in this process, rather than the one that made us)
+        and start replaying it if anything is left from before, then run as a :class:`.Station` .
+        """
+        if prefs.get('LINEAGE') != 'CHILD':
+            self.backlog = Backlog(os.path.join(prefs.get('DATADIR'), BACKLOG_FN))
+            self._online = len(self.backlog) == 0
+            replay_thread = threading.Thread(target=self._replay_loop, daemon=True)
+            replay_thread.start()
+        super(Pilot_Station, self).run()
+
     def _pinger(self):
         """
         Periodically ping the terminal with our status
@@ -1189,17 +1447,8 @@ class Pilot_Station(Station):
                 f_sounds = []
 
             if len(f_sounds)>0:
-                # check to see if we have these files, if not, request them
-                for sound in f_sounds:
-                    full_path = os.path.join(prefs.get('SOUNDDIR'), sound['path'])
-                    if not os.path.exists(full_path):
-                        # We ask the terminal to send us the file and then wait.
-                        self.logger.info('REQUESTING SOUND {}'.format(sound['path']))
-                        self.push(key='FILE', value=sound['path'])
-                        # wait here to get the sound,
-                        # the receiving thread will set() when we get it.
-                        self.file_block.clear()
-                        self.file_block.wait()
+                # make sure we have the current version of these files, and request them if not
+                self.fetch_files([sound['path'] for sound in f_sounds])
 
         # If we're starting the task as a child, stash relevant params
         if 'child' in msg.value.keys():
@@ -1236,34 +1485,131 @@ class Pilot_Station(Station):
         # TODO: Changing some task parameter from the Terminal
         pass
 
+    def fetch_files(self, paths:typing.List[str]):
+        """
+        Make sure we have the same version of some files as the terminal, and wait until we do.
+
+        Asks the terminal for the manifest of each file (see :meth:`.Terminal_Station.l_file` ),
+        and then :meth:`.Pilot_Station.l_file` downloads any that are missing or different.
+
+        Args:
+            paths (list): paths relative to `prefs.get('SOUNDDIR')`
+        """
+        paths = list(dict.fromkeys(paths))
+        with self._file_lock:
+            self._files_pending = set(paths)
+            self.file_block.clear()
+
+        for path in paths:
+            self.push(key='FILE', value={'path': path})
+
+        # wait here to get the files,
+        # the receiving thread will set() when we have them all.
+        self.file_block.wait()
+
+    def _file_done(self, path:str):
+        with self._file_lock:
+            self._files_pending.discard(path)
+            if not self._files_pending:
+                self.file_block.set()
+
     def l_file(self, msg:Message):
         """
-        We are receiving a file.
+        We are receiving the manifest of a file (see :meth:`.File_Source.manifest` ).
 
-        Decode from b64 and save. Set the file_block.
+        If we already have a file with the same hash, either at its path or in our
+        cache ( :attr:`.file_cache_dir` ), use it. Otherwise start (or resume) a
+        :class:`.File_Download` and request the first :attr:`.file_window` chunks.
 
         Args:
-            msg (:class:`.Message`): value will have 'path' and 'file',
-                where the path determines where in `prefs.get('SOUNDDIR')` the
-                b64 encoded 'file' will be saved.
+            msg (:class:`.Message`): value is the file's manifest, with its
+                ``path`` within `prefs.get('SOUNDDIR')` , ``hash`` , ``size`` , ``chunk_size``
+                and ``n_chunks`` , or an ``error`` if the terminal couldn't send it.
+        """
+        manifest = msg.value
+        path = manifest['path']
+        if 'error' in manifest:
+            self.logger.error('Could not get file {}: {}'.format(path, manifest['error']))
+            self._file_done(path)
+            return
+
+        full_path = os.path.join(prefs.get('SOUNDDIR'), path)
+        if os.path.exists(full_path) and file_hash(full_path) == manifest['hash']:
+            self._file_done(path)
+            return
+
+        cache_dir = os.path.join(prefs.get('SOUNDDIR'), self.file_cache_dir)
+        cache_path = os.path.join(cache_dir, manifest['hash'])
+        if os.path.exists(cache_path) and file_hash(cache_path) == manifest['hash']:
+            install_file(cache_path, full_path)
+            self.logger.info('SOUND FROM CACHE {}'.format(path))
+            self._file_done(path)
+            return
+
+        self.logger.info('REQUESTING SOUND {}'.format(path))
+        with self._file_lock:
+            download = self.downloads.get(manifest['hash'])
+            if download is None:
+                download = File_Download(manifest, cache_dir)
+                self.downloads[manifest['hash']] = download
+            else:
+                # asked again, maybe after a dropped connection, so re-request outstanding chunks
+                download.requested.clear()
+            self._download_paths.setdefault(manifest['hash'], set()).add(path)
+            chunks = download.next_chunks(self.file_window)
+
+        for index in chunks:
+            self._request_chunk(download, index)
+
+    def _request_chunk(self, download:File_Download, index:int):
+        self.push(key='FILE_CHUNK', value={'path': download.manifest['path'], 'hash': download.hash,
+                                           'index': index, 'chunk_size': download.chunk_size})
+
+    def l_file_chunk(self, msg:Message):
         """
-        # The file should be of the structure {'path':path, 'file':contents}
+        We are receiving part of a file.
 
-        full_path = os.path.join(prefs.get('SOUNDDIR'), msg.value['path'])
-        # TODO: give Message full deserialization capabilities including this one
-        file_data = base64.b64decode(msg.value['file'])
-        try:
-            os.makedirs(os.path.dirname(full_path))
-        except:
-            # TODO: Make more specific - only if dir already exists
-            pass
-        with open(full_path, 'wb') as open_file:
-            open_file.write(file_data)
+        Write it to its :class:`.File_Download` and request the next chunk.
+        Once every chunk is received, check the file's hash and put it at each path it was requested at.
 
-        self.logger.info('SOUND RECEIVED {}'.format(msg.value['path']))
+        Args:
+            msg (:class:`.Message`): value has the ``hash`` of the file, the ``index`` of the chunk,
+                and the chunk ``data``
+        """
+        # JSON messages carry bytes base64 encoded
+        value = msg.expand()
+        with self._file_lock:
+            download = self.downloads.get(value['hash'])
+            if download is None:
+                # already finished, this is a repeat
+                return
+            download.write(value['index'], value['data'])
+            if download.complete:
+                del self.downloads[value['hash']]
+                paths = self._download_paths.pop(value['hash'])
+                chunks = []
+            else:
+                chunks = download.next_chunks(self.file_window)
+
+        for index in chunks:
+            self._request_chunk(download, index)
 
-        # If we requested a file, some poor start fn is probably waiting on us
-        self.file_block.set()
+        if not download.complete:
+            return
+
+        try:
+            cache_path = download.finish()
+        except ValueError:
+            self.logger.exception('Received file did not match its hash, requesting again')
+            for path in paths:
+                self.push(key='FILE', value={'path': path})
+            return
+
+        for path in paths:
+            install_file(cache_path, os.path.join(prefs.get('SOUNDDIR'), path))
+            self.logger.info('SOUND RECEIVED {}'.format(path))
+            # If we requested a file, some poor start fn is probably waiting on us
+            self._file_done(path)
 
     def l_continuous(self, msg:Message):
         """
@@ -1285,6 +1631,110 @@ class Pilot_Station(Station):
                                 continuous data should be streamed directly to terminal \
                                 from pilot')
 
+    def l_data(self, msg:Message):
+        """
+        Send data from the pilot to the Terminal, keeping it in the :attr:`.backlog`
+        until it's confirmed.
+
+        The value is given a ``data_id`` (see :class:`.Backlog` ) so the terminal can drop it if it's received twice.
+        While the terminal is unreachable, data is only stored, and is sent later by :meth:`.replay` .
+
+        Args:
+            msg (:class:`.Message`): data from the pilot
+        """
+        if self.backlog is None:
+            self.push(to='T', key='DATA', value=msg.value, repeat=False)
+            return
+
+        with self._backlog_lock:
+            data_id = self.backlog.add('DATA', msg.value)
+            online = self._online
+
+        if online:
+            out = self.prepare_message('T', 'DATA', msg.value)
+            # confirmed by the id it's stored with
+            out.id = data_id
+            self.push(msg=out)
+
+    def l_confirm(self, msg:Message):
+        """
+        Remove confirmed data from the :attr:`.backlog` , and if the terminal answers while
+        we're storing data, replay it (see :meth:`.Station.l_confirm` )
+        """
+        super(Pilot_Station, self).l_confirm(msg)
+        if self.backlog is None:
+            return
+
+        ids = msg.value if isinstance(msg.value, list) else [msg.value]
+        confirmed = []
+        replay = False
+        with self._backlog_lock:
+            for id in ids:
+                if id in self._batches:
+                    confirmed.extend(self._batches.pop(id))
+                    replay = True
+                elif self.backlog.owns(id):
+                    confirmed.append(id)
+            self.backlog.confirm(confirmed)
+            if not self._online and not self._batches:
+                # anything being confirmed means the terminal can be reached again
+                replay = True
+        if replay:
+            self.replay()
+
+    def publish_failed(self, entry:Outbox_Entry):
+        """
+        If data couldn't be sent, the terminal is unreachable, so stop sending data live
+        and keep it in the :attr:`.backlog` until it can be replayed.
+        """
+        super(Pilot_Station, self).publish_failed(entry)
+        if self.backlog is None:
+            return
+        with self._backlog_lock:
+            batch = self._batches.pop(entry.id, None)
+            if batch is None and not self.backlog.owns(entry.id):
+                return
+            if self._online:
+                self.logger.warning('Terminal is unreachable, storing data until it can be replayed')
+            self._online = False
+
+    def replay(self):
+        """
+        Send the oldest :attr:`.replay_batch` messages in the :attr:`.backlog` to the Terminal
+        as one ``DATA`` message with a list of their values as its ``batch`` .
+
+        When a batch is confirmed (see :meth:`.l_confirm` ), the next one is sent,
+        and once the backlog is empty, data is sent live again.
+        """
+        if self.backlog is None or isinstance(self.pusher, bool):
+            # not running yet
+            return
+
+        with self._backlog_lock:
+            if self._batches:
+                # one batch at a time
+                return
+            pending = self.backlog.pending(self.replay_batch)
+            if not pending:
+                if not self._online:
+                    self.logger.info('Backlog replayed, sending data live')
+                self._online = True
+                return
+            self._online = False
+            out = self.prepare_message('T', 'DATA', {'pilot': self.id, 'batch': [value for _, _, value in pending]})
+            self._batches[out.id] = [id for id, _, _ in pending]
+
+        self.logger.info('Replaying {} messages from backlog'.format(len(pending)))
+        self.push(msg=out)
+
+    def _replay_loop(self):
+        while not self.closing.wait(self.replay_interval):
+            if not self._online:
+                try:
+                    self.replay()
+                except Exception as e:
+                    self.logger.exception('Exception replaying backlog: {}'.format(e))
+
     def l_child(self, msg:Message):
         """
         Tell one or more children to start running a task.
@@ -0,0 +1,146 @@
+"""
+Trace where time is spent as messages travel through the network.
+
+Messages sent with the ``'TRACE'`` flag collect a list of hop stamps in :attr:`.Message.trace`
+(see :meth:`.Message.stamp` ), each ``[id, event, time_ns, host]`` , where ``event`` is one of
+
+* ``'send'`` - a :class:`.Net_Node` or :class:`.Station` serialized and sent the message
+* ``'forward'`` - a :class:`.Station` forwarded the message on to someone else
+* ``'recv'`` - the recipient deserialized the message
+* ``'dispatch'`` - the recipient's listen method was called, after waiting in its :class:`.Dispatcher`
+* ``'done'`` - the listen method returned
+
+and ``time_ns`` is from :func:`time.monotonic_ns` . Monotonic clocks can only be compared
+on the same computer, so the time between stamps from different hosts isn't counted.
+
+When a traced message has been handled, its recipient adds it to a :class:`.Trace_Aggregator` ,
+which keeps a latency histogram for each segment between stamps, for each message key.
+"""
+
+import threading
+import typing
+
+import numpy as np
+
+TRACE_BINS = np.concatenate(([0], np.logspace(3, 10, 71)))
+"""
+Edges of latency histogram bins in nanoseconds: 0, then 10 per decade from 1us to 10s.
+"""
+
+
+class Trace_Aggregator(object):
+    """
+    Latency histograms of traced messages, for each message key and segment between hop stamps.
+
+    Segments are named ``'{id}:{event}->{id}:{event}'`` , eg. ``'_pilot:send->pilot:forward'`` ,
+    plus ``'total'`` from the first stamp to the last when they're all from the same host.
+
+    Thread-safe.
+
+    Args:
+        bins (:class:`numpy.ndarray`): histogram bin edges, in nanoseconds
+
+    Attributes:
+        histograms (dict): ``{key: {segment: counts}}`` , counts of latencies in each bin
+        n_traced (dict): number of traced messages of each key
+    """
+
+    def __init__(self, bins:np.ndarray=TRACE_BINS):
+        self.bins = bins
+        self.histograms = {} # type: typing.Dict[str, typing.Dict[str, np.ndarray]]
+        self.n_traced = {} # type: typing.Dict[str, int]
+        self._max = {} # type: typing.Dict[tuple, int]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def segments(trace:list) -> typing.List[typing.Tuple[str, int]]:
+        """
+        Latencies between consecutive hop stamps
+
+        Args:
+            trace (list): :attr:`.Message.trace`
+
+        Returns:
+            list: of (segment name, latency in ns) tuples
+        """
+        segments = []
+        for (id_a, event_a, time_a, host_a), (id_b, event_b, time_b, host_b) in zip(trace[:-1], trace[1:]):
+            if host_a != host_b:
+                continue
+            segments.append(('{}:{}->{}:{}'.format(id_a, event_a, id_b, event_b), time_b - time_a))
+        if len(trace) > 1 and len(set(stamp[3] for stamp in trace)) == 1:
+            segments.append(('total', trace[-1][2] - trace[0][2]))
+        return segments
+
+    def add(self, msg:'Message'):
+        """
+        Count the latencies of a traced message
+
+        Args:
+            msg (:class:`.Message`): a message with a :attr:`.Message.trace`
+        """
+        trace = msg.__dict__.get('trace')
+        if not trace:
+            return
+        segments = self.segments(trace)
+        with self._lock:
+            self.n_traced[msg.key] = self.n_traced.get(msg.key, 0) + 1
+            key_hists = self.histograms.setdefault(msg.key, {})
+            for segment, latency in segments:
+                hist = key_hists.get(segment)
+                if hist is None:
+                    hist = np.zeros(len(self.bins) - 1, dtype=np.int64)
+                    key_hists[segment] = hist
+                hist[np.clip(np.searchsorted(self.bins, latency, side='right') - 1, 0, len(hist) - 1)] += 1
+                self._max[(msg.key, segment)] = max(self._max.get((msg.key, segment), 0), latency)
+
+    def histogram(self, key:str, segment:str='total') -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            key (str): message key
+            segment (str): segment name, see :meth:`.segments`
+
+        Returns:
+            tuple: (bin edges in ms, counts)
+        """
+        with self._lock:
+            counts = self.histograms[key][segment].copy()
+        return self.bins / 1e6, counts
+
+    def stats(self) -> typing.Dict[str, typing.Dict[str, dict]]:
+        """
+        Summarize each histogram.
+
+        Percentiles are estimated from the histogram, so they're only as precise as its bins
+        (the upper edge of the bin the percentile falls in).
+
+        Returns:
+            dict: ``{key: {segment: {'n', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'}}}``
+        """
+        stats = {}
+        with self._lock:
+            histograms = {key: {segment: hist.copy() for segment, hist in segments.items()}
+                          for key, segments in self.histograms.items()}
+            maxes = self._max.copy()
+
+        edges = self.bins[1:] / 1e6
+        for key, segments in histograms.items():
+            stats[key] = {}
+            for segment, hist in segments.items():
+                cumulative = np.cumsum(hist)
+                n = int(cumulative[-1])
+                segment_stats = {'n': n, 'max_ms': maxes[(key, segment)] / 1e6}
+                for pct in (50, 90, 99):
+                    segment_stats['p{}_ms'.format(pct)] = float(
+                        edges[np.searchsorted(cumulative, n * pct / 100)])
+                stats[key][segment] = segment_stats
+        return stats
+
+    def clear(self):
+        """
+        Forget everything
+        """
+        with self._lock:
+            self.histograms = {}
+            self.n_traced = {}
+            self._max = {}
@@ -0,0 +1,288 @@
+"""
+Send files between stations in chunks.
+
+Rather than sending a whole file in one message, the sender describes a file with a
+manifest (its content hash, size, and number of chunks), and the receiver requests
+the chunks it doesn't have yet, a few at a time.
+
+* :class:`.File_Source` makes manifests and reads chunks on the sending side
+* :class:`.File_Download` tracks which chunks have been received on the receiving side,
+  writing them to a partial file alongside a record of which chunks it contains, so
+  an interrupted download picks up where it left off.
+
+Completed files are kept in a cache directory named by their hash, so a file is only
+ever downloaded once no matter how many paths it is requested at.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import typing
+
+CHUNK_SIZE = 2**18
+"""
+Default size (bytes) of the chunks files are sent in
+"""
+
+_HASHES = {} # type: typing.Dict[tuple, str]
+_HASH_LOCK = threading.Lock()
+
+
+def file_hash(path:str) -> str:
+    """
+    sha256 hash of a file's contents.
+
+    Hashes are cached by the path, size, and modification time of the file, so
+    unchanged files are only read once.
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: hex digest of the file's contents
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _HASH_LOCK:
+        if key in _HASHES:
+            return _HASHES[key]
+
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as open_file:
+        for block in iter(lambda: open_file.read(2**20), b''):
+            hasher.update(block)
+    digest = hasher.hexdigest()
+
+    with _HASH_LOCK:
+        _HASHES[key] = digest
+    return digest
+
+
+class File_Source(object):
+    """
+    Describe files with manifests and read them a chunk at a time.
+
+    Args:
+        base_dir (str): Directory that requested paths are relative to
+        chunk_size (int): Size of each chunk in bytes
+    """
+
+    def __init__(self, base_dir:str, chunk_size:int=CHUNK_SIZE):
+        self.base_dir = base_dir
+        self.chunk_size = chunk_size
+
+    def full_path(self, path:str) -> str:
+        """
+        Args:
+            path (str): path relative to :attr:`.base_dir`
+
+        Returns:
+            str: absolute path to the file
+
+        Raises:
+            ValueError: if the path is outside of :attr:`.base_dir`
+        """
+        base_dir = os.path.abspath(self.base_dir)
+        full_path = os.path.abspath(os.path.join(base_dir, path))
+        if os.path.commonpath([base_dir, full_path]) != base_dir:
+            raise ValueError('Requested file {} is outside of {}'.format(path, base_dir))
+        return full_path
+
+    def manifest(self, path:str) -> dict:
+        """
+        Describe a file so that it can be requested in chunks
+
+        Args:
+            path (str): path relative to :attr:`.base_dir`
+
+        Returns:
+            dict: with ``path`` , ``hash`` , ``size`` , ``chunk_size`` , and ``n_chunks``
+        """
+        full_path = self.full_path(path)
+        size = os.path.getsize(full_path)
+        return {
+            'path': path,
+            'hash': file_hash(full_path),
+            'size': size,
+            'chunk_size': self.chunk_size,
+            'n_chunks': max(-(-size // self.chunk_size), 1)
+        }
+
+    def chunk(self, path:str, index:int, chunk_size:typing.Optional[int]=None) -> bytes:
+        """
+        Read one chunk of a file
+
+        Args:
+            path (str): path relative to :attr:`.base_dir`
+            index (int): index of the chunk
+            chunk_size (int): size of chunks, if different than :attr:`.chunk_size`
+
+        Returns:
+            bytes: the chunk
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        with open(self.full_path(path), 'rb') as open_file:
+            open_file.seek(index * chunk_size)
+            return open_file.read(chunk_size)
+
+
+class File_Download(object):
+    """
+    A file being received in chunks.
+
+    Chunks are written to ``<cache_dir>/<hash>.part`` as they arrive, and the indices of
+    received chunks are appended to ``<cache_dir>/<hash>.part.log`` , one per line, so that a download
+    can be resumed by making a new :class:`.File_Download` with the same manifest.
+
+    Once every chunk is received, the file is checked against its hash and moved
+    to ``<cache_dir>/<hash>`` .
+
+    Not thread-safe, chunks for a download should be handled one at a time.
+
+    Args:
+        manifest (dict): from :meth:`.File_Source.manifest`
+        cache_dir (str): Directory to store partial and completed downloads
+
+    Attributes:
+        received (set): indices of chunks that have been written
+        requested (set): indices of chunks that have been requested but not received, see :meth:`.next_chunks`
+    """
+
+    def __init__(self, manifest:dict, cache_dir:str):
+        self.manifest = manifest
+        self.cache_dir = cache_dir
+        self.hash = manifest['hash']
+        self.n_chunks = manifest['n_chunks']
+        self.chunk_size = manifest['chunk_size']
+
+        self.cache_path = os.path.join(cache_dir, self.hash)
+        self.part_path = self.cache_path + '.part'
+        self.index_path = self.part_path + '.log'
+
+        self.received = set()
+        self.requested = set()
+        self._first_missing = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.part_path) and os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as index_file:
+                for line in index_file:
+                    # the last line may have been cut off
+                    if line.endswith('\n'):
+                        self.received.add(int(line))
+        else:
+            # start fresh, make the partial file its full size so chunks can be written anywhere
+            with open(self.part_path, 'wb') as part_file:
+                part_file.truncate(manifest['size'])
+
+    @property
+    def missing(self) -> typing.List[int]:
+        """
+        Returns:
+            list: indices of chunks that haven't been received, in order
+        """
+        return [i for i in range(self.n_chunks) if i not in self.received]
+
+    def next_chunks(self, window:int) -> typing.List[int]:
+        """
+        Chunks to request so that ``window`` chunks are requested at once.
+        The returned chunks are added to :attr:`.requested` .
+
+        Args:
+            window (int): number of chunks that can be requested at a time
+
+        Returns:
+            list: indices of chunks to request
+        """
+        # everything before the first missing chunk has been received, don't look through it again
+        while self._first_missing < self.n_chunks and self._first_missing in self.received:
+            self._first_missing += 1
+
+        chunks = []
+        for i in range(self._first_missing, self.n_chunks):
+            if len(self.requested) >= window:
+                break
+            if i not in self.received and i not in self.requested:
+                self.requested.add(i)
+                chunks.append(i)
+        return chunks
+
+    def write(self, index:int, data:bytes):
+        """
+        Write a received chunk
+
+        Args:
+            index (int): index of the chunk
+            data (bytes): the chunk
+        """
+        if index in self.received:
+            return
+        with open(self.part_path, 'r+b') as part_file:
+            part_file.seek(index * self.chunk_size)
+            part_file.write(data)
+        self.received.add(index)
+        self.requested.discard(index)
+        with open(self.index_path, 'a') as index_file:
+            index_file.write('{}\n'.format(index))
+
+    @property
+    def complete(self) -> bool:
+        """
+        Returns:
+            bool: whether every chunk has been received
+        """
+        return len(self.received) >= self.n_chunks
+
+    def finish(self) -> str:
+        """
+        Check the downloaded file against its hash and move it into the cache.
+
+        If the hash doesn't match, the partial download is discarded.
+
+        Returns:
+            str: path to the cached file
+
+        Raises:
+            ValueError: if the downloaded file's hash doesn't match the manifest
+        """
+        if file_hash(self.part_path) != self.hash:
+            self.discard()
+            raise ValueError('Downloaded file {} does not match its hash {}'.format(
+                self.manifest['path'], self.hash))
+        os.replace(self.part_path, self.cache_path)
+        os.remove(self.index_path)
+        return self.cache_path
+
+    def discard(self):
+        """
+        Remove the partial download
+        """
+        for path in (self.part_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.received = set()
+        self.requested = set()
+        self._first_missing = 0
+
+
+def install_file(cache_path:str, full_path:str):
+    """
+    Put a cached file at the path where it's used, as a hard link if possible
+    and otherwise a copy.
+
+    Args:
+        cache_path (str): path of the file in the cache
+        full_path (str): where the file should be
+    """
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    tmp_path = full_path + '.tmp'
+    try:
+        os.link(cache_path, tmp_path)
+    except OSError:
+        shutil.copyfile(cache_path, tmp_path)
+    os.replace(tmp_path, full_path)
@@ -200,6 +200,20 @@ _DEFAULTS = odict({
         "scope": Scopes.COMMON
     },
     # 4 * 5MB = 20MB per module
+    'MSG_FORMAT': {
+        'type': 'choice',
+        'text': "Preferred wire format for network messages (peers that can only read json are sent json)",
+        "choices": ("binary", "json"),
+        "default": "binary",
+        "scope": Scopes.COMMON
+    },
+    'TIMESTAMP_FORMAT': {
+        'type': 'choice',
+        'text': "Format of timestamps in data and messages, isoformatted strings or int64 nanoseconds since the epoch (see autopilot.utils.timestamps)",
+        "choices": ("iso", "ns"),
+        "default": "iso",
+        "scope": Scopes.COMMON
+    },
     'CONFIG': {
         'type': 'list',
         "text": "System Configuration",
@@ -2,11 +2,11 @@ from collections import OrderedDict as odict
 import tables
 import itertools
 import random
-import datetime
 
 import autopilot.hardware.gpio
 
 from autopilot.tasks.task import Task
+from autopilot.utils import timestamps
 
 TASK = 'Free_water'
 
@@ -156,7 +156,7 @@ class Free_Water(Task):
         # Return data
         data = {
             'target': self.target,
-            'timestamp': datetime.datetime.now().isoformat(),
+            'timestamp': timestamps.timestamp(),
             'trial_num' : next(self.trial_counter)
         }
         return data
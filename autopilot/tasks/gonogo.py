@@ -4,7 +4,6 @@ Go/no-go task, demo for NCB
 
 
 
-import datetime
 import itertools
 import tables
 import threading
@@ -12,6 +11,7 @@ from random import random
 
 import autopilot.hardware.gpio
 from autopilot.tasks import Task
+from autopilot.utils import timestamps
 from autopilot.stim.visual.visuals import Grating
 from collections import OrderedDict as odict
 from autopilot.networking import Net_Node
@@ -206,7 +206,7 @@ class GoNoGo(Task):
 
         data = {
             'delay': delay,
-            'RQ_timestamp': datetime.datetime.now().isoformat(),
+            'RQ_timestamp': timestamps.timestamp(),
             'trial_num': self.current_trial
         }
 
@@ -233,7 +233,7 @@ class GoNoGo(Task):
         self.timer = None
 
         data = {
-            'DC_timestamp': datetime.datetime.now().isoformat(),
+            'DC_timestamp': timestamps.timestamp(),
             'response': self.response,
             'correct': self.correct,
             'trial_num': self.current_trial,
@@ -15,6 +15,11 @@ class Graduation(object):
     All Graduation objects need to populate PARAMS, COLS, and define an
     `update` method.
 
+    To resume between sessions without reading the subject's trial history,
+    objects can return what they've accumulated from :meth:`.state` , which is saved in
+    the subject file and passed back as keyword arguments the next time they're made.
+    Otherwise, they're given the last :meth:`.rows_needed` rows of each of the :attr:`.COLS` .
+
     """
     def __init__(self):
         self.logger = init_logger(self)
@@ -36,6 +41,30 @@ class Graduation(object):
         """
         Exception('The update method was not redefined by the subclass!')
 
+    def state(self) -> dict:
+        """
+        Keyword arguments that recreate this object's current state when
+        passed with its :attr:`.PARAMS` , must be JSON serializable.
+
+        Returns:
+            dict: by default, empty
+        """
+        return {}
+
+    @classmethod
+    def rows_needed(cls, **params):
+        """
+        How many of the most recent trials this object needs to be given from the :attr:`.COLS`
+        when it can't be restored from its :meth:`.state` .
+
+        Args:
+            **params: the object's parameters
+
+        Returns:
+            int: number of trials, or ``None`` for every trial since the subject started the step
+        """
+        return None
+
 
 class Accuracy(Graduation):
     """
@@ -92,6 +121,21 @@ class Accuracy(Graduation):
         else:
             return False
 
+    def state(self) -> dict:
+        """
+        Returns:
+            dict: the ``correct`` values in the window
+        """
+        return {'correct': [int(correct) for correct in self.corrects]}
+
+    @classmethod
+    def rows_needed(cls, window=500, **params):
+        """
+        Returns:
+            int: ``window``
+        """
+        return int(window)
+
 
 class NTrials(Graduation):
     """
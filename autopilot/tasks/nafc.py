@@ -1,5 +1,4 @@
 
-import datetime
 import itertools
 import tables
 import threading
@@ -7,6 +6,7 @@ import typing
 
 import autopilot
 from autopilot.tasks import Task
+from autopilot.utils import timestamps
 from autopilot.stim import init_manager
 from collections import OrderedDict as odict
 
@@ -325,7 +325,7 @@ class Nafc(Task):
         Returns:
             data (dict): With fields::
                 {
-                'RQ_timestamp': datetime.datetime.now().isoformat(),
+                'RQ_timestamp': timestamps.timestamp(),
                 'trial_num': self.current_trial,
                 }
 
@@ -339,7 +339,7 @@ class Nafc(Task):
         # TODO: Handle timeout
 
         # Only data is the timestamp
-        data = {'RQ_timestamp': datetime.datetime.now().isoformat(),
+        data = {'RQ_timestamp': timestamps.timestamp(),
                 'trial_num': self.current_trial}
         self.current_stage = 1
         return data
@@ -352,7 +352,7 @@ class Nafc(Task):
             data (dict): With fields::
 
                  {
-                'DC_timestamp': datetime.datetime.now().isoformat(),
+                'DC_timestamp': timestamps.timestamp(),
                 'response': self.response,
                 'correct': self.correct,
                 'bailed': self.bailed,
@@ -367,7 +367,7 @@ class Nafc(Task):
         if self.bailed:
             self.bailed = 0
             data = {
-                'DC_timestamp': datetime.datetime.now().isoformat(),
+                'DC_timestamp': timestamps.timestamp(),
                 'bailed':1,
                 'trial_num': self.current_trial,
                 'TRIAL_END':True
@@ -384,7 +384,7 @@ class Nafc(Task):
 
 
         data = {
-            'DC_timestamp': datetime.datetime.now().isoformat(),
+            'DC_timestamp': timestamps.timestamp(),
             'response':self.response,
             'correct':self.correct,
             'bailed':0,
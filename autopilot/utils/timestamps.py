@@ -0,0 +1,221 @@
+"""
+Timestamps for data and messages, either as isoformatted strings or as int64 nanoseconds.
+
+Which one :func:`.timestamp` makes is set by ``prefs.get('TIMESTAMP_FORMAT')`` :
+
+* ``'iso'`` (default) - :meth:`datetime.datetime.isoformat` strings of the local time,
+  like ``'2021-01-01T12:00:00.000000'`` , as autopilot has always used.
+* ``'ns'`` - nanoseconds since the epoch from :func:`time.time_ns` , which is faster to make,
+  a third the size to store, and doesn't need to be parsed to be compared or indexed.
+
+Independently of either, :func:`.monotonic` timestamps come from a clock that isn't changed
+when the system time is (eg. by NTP), so they're the ones to use to measure intervals,
+but they're only comparable between timestamps made on the same computer since it was booted.
+
+Tables made by :class:`.Subject` store timestamp columns in the format that's set when
+a protocol is assigned, and index them (see :meth:`.Subject.get_continuous_data` ).
+:func:`.to_ns` and :func:`.to_datetime` read either.
+"""
+
+import datetime
+import time
+import typing
+
+import numpy as np
+import pandas as pd
+import tables
+from dateutil.tz import tzlocal
+
+from autopilot import prefs
+
+FORMATS = ('iso', 'ns')
+"""
+Possible values of ``prefs.get('TIMESTAMP_FORMAT')``
+"""
+
+ISO_LEN = 26
+"""
+Length of an isoformatted timestamp with microseconds
+"""
+
+_FORMAT = None # type: typing.Optional[str]
+
+
+def get_format() -> str:
+    """
+    The format :func:`.timestamp` uses, ``prefs.get('TIMESTAMP_FORMAT')`` when first called
+    unless set with :func:`.set_format`
+
+    Returns:
+        str: one of :data:`.FORMATS`
+    """
+    global _FORMAT
+    if _FORMAT is None:
+        # prefs.get is slow relative to making a timestamp, so only get it once
+        fmt = prefs.get('TIMESTAMP_FORMAT')
+        _FORMAT = fmt if fmt in FORMATS else 'iso'
+    return _FORMAT
+
+
+def set_format(fmt:typing.Optional[str]):
+    """
+    Set the format :func:`.timestamp` uses for this process
+
+    Args:
+        fmt (str): one of :data:`.FORMATS` , or ``None`` to use the prefs again
+    """
+    global _FORMAT
+    if fmt is not None and fmt not in FORMATS:
+        raise ValueError('timestamp format must be one of {}, got {}'.format(FORMATS, fmt))
+    _FORMAT = fmt
+
+
+def timestamp(fmt:typing.Optional[str]=None) -> typing.Union[str, int]:
+    """
+    The current (wall clock) time
+
+    Args:
+        fmt (str): ``'iso'`` or ``'ns'`` , default :func:`.get_format`
+
+    Returns:
+        str, int: isoformatted local time or nanoseconds since the epoch
+    """
+    if fmt is None:
+        fmt = _FORMAT or get_format()
+    if fmt == 'ns':
+        return time.time_ns()
+    return datetime.datetime.now().isoformat()
+
+
+def monotonic() -> int:
+    """
+    Nanoseconds of a monotonic clock, see :func:`time.monotonic_ns`
+
+    Returns:
+        int
+    """
+    return time.monotonic_ns()
+
+
+def column(fmt:typing.Optional[str]=None) -> tables.Col:
+    """
+    A :mod:`tables` column to store timestamps in
+
+    Args:
+        fmt (str): ``'iso'`` or ``'ns'`` , default :func:`.get_format`
+
+    Returns:
+        :class:`tables.Int64Col` or :class:`tables.StringCol`
+    """
+    if fmt is None:
+        fmt = get_format()
+    if fmt == 'ns':
+        return tables.Int64Col()
+    return tables.StringCol(ISO_LEN)
+
+
+def to_ns(value) -> int:
+    """
+    Convert a timestamp of any format to nanoseconds since the epoch
+
+    Isoformatted timestamps are local time, like those from :func:`.timestamp` .
+
+    Args:
+        value (str, bytes, int, float, :class:`datetime.datetime`, :class:`numpy.datetime64`): the timestamp.
+            Numbers are treated as nanoseconds already.
+
+    Returns:
+        int
+    """
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return int(round(value))
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        if value.isdigit():
+            return int(value)
+        value = datetime.datetime.fromisoformat(value)
+    if isinstance(value, np.datetime64):
+        return int(value.astype('datetime64[ns]').astype(np.int64))
+    if isinstance(value, datetime.datetime):
+        # naive datetimes are local time, as the isoformatted timestamps are
+        seconds = int(value.timestamp())
+        return seconds * 1_000_000_000 + value.microsecond * 1000
+    raise TypeError('Cannot convert {} of type {} to a timestamp'.format(value, type(value)))
+
+
+def to_iso(value) -> str:
+    """
+    Convert a timestamp of any format to an isoformatted local time
+
+    Args:
+        value: see :func:`.to_ns`
+
+    Returns:
+        str
+    """
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str) and not value.isdigit():
+        return value
+    ns = to_ns(value)
+    return datetime.datetime.fromtimestamp(ns // 1_000_000_000).replace(
+        microsecond=(ns % 1_000_000_000) // 1000).isoformat()
+
+
+def to_datetime(values:typing.Union[np.ndarray, list, pd.Series]) -> pd.Series:
+    """
+    Convert a column of timestamps (eg. from a table, either int64 nanoseconds
+    or isoformatted bytes) to local-time :class:`pandas.Timestamp` s
+
+    Args:
+        values (:class:`numpy.ndarray`): timestamps
+
+    Returns:
+        :class:`pandas.Series` of ``datetime64[ns]``
+    """
+    values = pd.Series(np.asarray(values))
+    if values.dtype.kind == 'f':
+        values = values.round().astype(np.int64)
+    if values.dtype.kind in 'iu':
+        return _ns_to_local(values.astype(np.int64))
+
+    if values.dtype.kind == 'S' or (len(values) > 0 and isinstance(values.iloc[0], bytes)):
+        values = values.str.decode('utf-8')
+    # tables whose column is a string but were sent nanoseconds store them as digits
+    digits = values.str.isdigit().astype(bool)
+    if not digits.any():
+        return pd.to_datetime(values)
+
+    converted = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    if not digits.all():
+        converted[~digits] = pd.to_datetime(values[~digits])
+    converted[digits] = _ns_to_local(values[digits].astype(np.int64))
+    return converted
+
+
+def _ns_to_local(ns:pd.Series) -> pd.Series:
+    """
+    epoch nanoseconds to naive local datetimes, matching isoformatted timestamps
+    """
+    return pd.to_datetime(ns, unit='ns', utc=True).dt.tz_convert(tzlocal()).dt.tz_localize(None)
+
+
+def to_column(value, col:typing.Union[tables.Column, np.dtype]) -> typing.Union[int, bytes]:
+    """
+    Convert a timestamp to the format of a timestamp column, to store in it or
+    compare with it in a :meth:`tables.Table.read_where` condition
+
+    Args:
+        value: see :func:`.to_ns`
+        col (:class:`tables.Column`, :class:`numpy.dtype`): the column, or its dtype
+
+    Returns:
+        int, bytes: nanoseconds for integer columns, isoformatted bytes for string columns
+    """
+    dtype = col.dtype if hasattr(col, 'dtype') else np.dtype(col)
+    if dtype.kind == 'S':
+        return to_iso(value).encode('utf-8')
+    return to_ns(value)
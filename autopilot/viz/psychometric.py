@@ -1,7 +1,7 @@
 import altair as alt
 from sklearn.linear_model import LogisticRegression
 from autopilot import prefs
-from autopilot.core.subject import Subject
+from autopilot.core.loader import load_trial_data
 import numpy as np
 from autopilot.utils.common import coerce_discrete
 import pandas as pd
@@ -58,10 +58,13 @@ def plot_psychometric(subject_protocols):
         :class:`altair.Chart`
     """
 
+    # load every subject's data at once
+    all_df = load_trial_data([subject for subject, _, _, _ in subject_protocols],
+                             step={subject: step for subject, step, _, _ in subject_protocols})
+
     for subject, step, var, n_trials in subject_protocols:
-        # load subject dataframe and subset
-        asub = Subject(subject)
-        sub_df = asub.get_trial_data(step)
+        # subset to this subject
+        sub_df = all_df[all_df['subject'] == subject].reset_index(drop=True)
 
         if n_trials>0:
             sub_df = sub_df[-n_trials:]
@@ -24,8 +24,10 @@ from bokeh.transform import factor_cmap
 from bokeh.palettes import Spectral10
 from tqdm import tqdm
 from autopilot.core import subject
+from autopilot.core.loader import load_trial_data
 import colorcet as cc
 import numpy as np
+import pandas as pd
 import json
 
 
@@ -84,21 +86,21 @@ def load_subject_dir(data_dir, steps=True, grad=True, which = None):
     all_mice_steps = None
     all_mice_grad = None
 
-    for subject_name in tqdm(subject_fn):
-        subject_name = os.path.splitext(subject_name)[0]
-        step_data, grad_data = load_subject_data(data_dir, subject_name, steps, grad)
-
-        if step_data is not None:
-            if all_mice_steps is not None:
-                all_mice_steps = all_mice_steps.append(step_data)
-            else:
-                all_mice_steps = step_data
-
-        if grad_data is not None:
-            if all_mice_grad is not None:
-                all_mice_grad = all_mice_grad.append(grad_data)
-            else:
-                all_mice_grad = grad_data
+    pilot_db = autopilot.utils.common.load_pilotdb(reverse=True)
+
+    if steps:
+        # read every subject's most recent step at once
+        all_mice_steps = load_trial_data(subject_fn, dir=data_dir, step=-1)
+        all_mice_steps['pilot'] = all_mice_steps['subject'].map(pilot_db).astype('category')
+
+    if grad:
+        grad_dfs = []
+        for subject_name in tqdm(subject_fn):
+            _, grad_data = load_subject_data(data_dir, subject_name, steps=False, grad=grad)
+            if grad_data is not None:
+                grad_dfs.append(grad_data)
+        if len(grad_dfs) > 0:
+            all_mice_grad = pd.concat(grad_dfs)
 
     return all_mice_steps, all_mice_grad
 
@@ -0,0 +1,418 @@
+"""
+Camera tests, with a fake camera that makes frames rather than grabbing them
+"""
+
+import multiprocessing as mp
+import shutil
+import threading
+import time
+from queue import Empty
+
+import numpy as np
+import pytest
+
+from autopilot.hardware import encoders, video_reader
+from autopilot.hardware.cameras import Camera, Video_Writer
+from autopilot.hardware.frame_store import Frame_Store, Frame_Store_Writer, Transcoder
+from autopilot.hardware.frames import Frame_Ring, Shared_Frame_Ring
+from autopilot.hardware.video_reader import INDEX_DTYPE, Video_Reader
+
+
+class Fake_Camera(Camera):
+    """
+    A camera whose frames are filled with their frame number
+    """
+    ring_size = 4
+
+    def init_cam(self):
+        self.initialized.set()
+        return True
+
+    def _grab(self):
+        return self._timestamp(), np.full((4, 6), self.frame_n, dtype=np.uint16)
+
+    def _timestamp(self, frame=None):
+        return time.time_ns()
+
+
+def _frame(n):
+    return np.full((2, 3), n, dtype=np.uint8)
+
+
+def _read_shared(ring:Shared_Frame_Ring, out:mp.Queue):
+    for slot, timestamp, frame in ring:
+        out.put((timestamp, int(frame.sum())))
+        del frame
+        ring.release(slot)
+    out.put(None)
+
+
+def test_frame_ring_fanout():
+    """
+    Each frame is copied into the ring once and given to every consumer,
+    and a slot is reused only once every consumer has released it
+    """
+    ring = Frame_Ring(4)
+    a = ring.subscribe('a')
+    b = ring.subscribe('b')
+
+    ring.put(0, _frame(0))
+    frame_a = a.get_nowait()
+    frame_b = b.get_nowait()
+    # the same memory, read-only
+    assert np.shares_memory(frame_a.array, frame_b.array)
+    assert not frame_a.array.flags.writeable
+    assert ring.free == 3
+
+    frame_a.release()
+    assert ring.free == 3
+    frame_b.release()
+    # releasing twice does nothing
+    frame_b.release()
+    assert ring.free == 4
+
+    with pytest.raises(Empty):
+        a.get_nowait()
+
+    # copies are released as they're gotten
+    c = ring.subscribe('c', copy=True)
+    ring.put(1, _frame(1))
+    timestamp, array = c.get_nowait()
+    assert timestamp == 1
+    assert (array == 1).all()
+    assert array.flags.writeable
+
+
+def test_frame_ring_policies():
+    """
+    Consumers drop frames according to their policy, and count them
+    """
+    ring = Frame_Ring(4)
+    ring.block_timeout = 0.05
+    latest = ring.subscribe('latest', policy='latest')
+    oldest = ring.subscribe('oldest', policy='drop_oldest', maxlen=2)
+
+    for n in range(5):
+        assert ring.put(n, _frame(n))
+
+    with latest.get() as frame:
+        assert frame.timestamp == 4
+    assert latest.dropped == 4
+    assert [oldest.get_nowait().timestamp for _ in range(2)] == [3, 4]
+    assert oldest.dropped == 3
+
+    # a blocking consumer holds every slot, and the ring drops frames
+    # after waiting for one to be released
+    ring.unsubscribe('latest')
+    ring.unsubscribe('oldest')
+    block = ring.subscribe('block', policy='block')
+    held = []
+    for n in range(4):
+        assert ring.put(n, _frame(n))
+    assert not ring.put(4, _frame(4))
+    assert ring.dropped_counts() == {'ring': 1, 'block': 0}
+
+    # but waits for it to get frames
+    def _get():
+        time.sleep(0.01)
+        held.append(block.get())
+        held[-1].release()
+    getter = threading.Thread(target=_get)
+    getter.start()
+    assert ring.put(5, _frame(5))
+    getter.join()
+    assert held[0].timestamp == 0
+    assert [block.get_nowait().timestamp for _ in range(4)] == [1, 2, 3, 5]
+
+
+def test_frame_ring_reallocate():
+    """
+    Frames of a different shape reallocate the ring without disturbing frames that are held
+    """
+    ring = Frame_Ring(2)
+    consumer = ring.subscribe('a')
+    ring.put(0, _frame(7))
+    held = consumer.get()
+
+    ring.put(1, np.zeros((5, 5), dtype=np.float32))
+    assert ring.buffer.shape == (2, 5, 5)
+    assert (held.array == 7).all()
+    held.release()
+    assert ring.free == 1
+
+
+def test_camera_queue():
+    """
+    Frames are queued through the ring as ``(timestamp, frame)`` tuples,
+    and dropped frames are counted
+    """
+    cam = Fake_Camera(name='fake')
+    cam.queue(queue_size=2)
+
+    cam.capture(timed=0.1)
+    cam._capture_thread.join()
+
+    assert cam.frame_n > 2
+    timestamp, frame = cam.q.get_nowait()
+    assert frame.shape == (4, 6)
+    n = frame[0, 0]
+    timestamp, frame = cam.q.get_nowait()
+    assert frame[0, 0] == n + 1
+    with pytest.raises(Empty):
+        cam.q.get_nowait()
+
+    # every frame is either queued or dropped
+    assert cam.dropped['queue'] == cam._ring.produced - 2
+    # the q stops iterating once capture has ended
+    assert list(cam.q) == []
+
+
+@pytest.mark.parametrize('method', ['fork', 'spawn'])
+def test_shared_frame_ring(method):
+    """
+    Frames pass to another process through shared memory, and the writer
+    waits for (or drops frames, with a timeout) the reader when every slot is full
+    """
+    ctx = mp.get_context(method)
+    ring = Shared_Frame_Ring((2, 3), np.uint8, n_slots=2, mp_context=ctx)
+    try:
+        assert ring.put(0, _frame(0))
+        assert ring.put(1, _frame(1))
+        # full, and no one is reading
+        assert not ring.put(2, _frame(2), timeout=0)
+        assert ring.dropped == 1
+        assert ring.qsize() == 2
+
+        with pytest.raises(ValueError):
+            ring.put(3, np.zeros((3, 3), dtype=np.uint8))
+
+        out = ctx.Queue()
+        reader = ctx.Process(target=_read_shared, args=(ring, out))
+        reader.start()
+
+        for n in range(2, 10):
+            assert ring.put(n, _frame(n))
+        ring.end()
+
+        got = list(iter(out.get, None))
+        reader.join(5)
+        assert got == [(n, n * 6) for n in range(10)]
+    finally:
+        ring.close()
+
+
+def test_video_writer_raw(tmp_path):
+    """
+    Frames written to a :class:`.Video_Writer` come out of its encoder, with their timestamps
+    """
+    writer = Video_Writer(str(tmp_path / 'video.mp4'), fps=30, shape=(4, 6), dtype=np.uint16,
+                          encoder='raw', n_slots=2)
+    assert writer.path == str(tmp_path / 'video.frames')
+    writer.start()
+    for n in range(20):
+        assert writer.write(n, np.full((4, 6), n, dtype=np.uint16))
+    writer.close()
+    assert writer.exitcode == 0
+
+    store = Frame_Store(writer.path)
+    assert store.frames.shape == (20, 4, 6)
+    assert (store[:, 0, 0] == np.arange(20)).all()
+    assert (store.timestamps == np.arange(20)).all()
+    with open(tmp_path / 'video.csv') as ts_file:
+        assert [int(line) for line in ts_file.read().split()] == list(range(20))
+
+
+def test_encoder_selection(monkeypatch):
+    """
+    The first encoder whose benchmark keeps up with the camera is selected, otherwise raw
+    """
+    speeds = {'v4l2m2m': 0.0, 'x264': 100.0, 'ffv1': 400.0}
+    monkeypatch.setattr(encoders, 'benchmark', lambda name, *args, **kwargs: speeds[name])
+
+    assert encoders.select_encoder(30, (480, 640, 3), np.uint8) == 'x264'
+    assert encoders.select_encoder(120, (480, 640, 3), np.uint8) == 'ffv1'
+    assert encoders.select_encoder(1000, (480, 640, 3), np.uint8) == 'raw'
+
+    # encoders are tunable
+    x264 = encoders.X264_Encoder('video.avi', 30, (480, 640, 3), np.uint8, preset='fast', crf=18, threads=2)
+    command = x264.command()
+    assert command[command.index('-preset') + 1] == 'fast'
+    assert command[command.index('-crf') + 1] == '18'
+    assert command[command.index('-threads') + 1] == '2'
+    assert command[command.index('-pix_fmt') + 1] == 'rgb24'
+    assert command[-1] == 'video.mp4'
+
+
+def test_frame_store(tmp_path, monkeypatch):
+    """
+    Frames are appended to a memory-mapped file in chunks, with a timestamp index,
+    and read back by :class:`.Frame_Store` , even while they're being written
+    """
+    monkeypatch.setattr(Frame_Store_Writer, 'chunk_frames', 4)
+    path = str(tmp_path / 'capture.mp4')
+    writer = Frame_Store_Writer(path, (3, 5, 3), np.uint8, fps=60)
+    assert writer.path == str(tmp_path / 'capture.frames')
+    for n in range(10):
+        writer.write(1000 + n * 10, np.full((3, 5, 3), n, dtype=np.uint8))
+    writer.flush()
+
+    # while writing, the file has been grown past the frames written
+    store = Frame_Store(path)
+    assert len(store) == 10
+    assert (tmp_path / 'capture.frames').stat().st_size == 12 * 3 * 5 * 3
+
+    writer.close()
+    assert (tmp_path / 'capture.frames').stat().st_size == 10 * 3 * 5 * 3
+
+    store = Frame_Store(str(tmp_path / 'capture.json'))
+    assert store.fps == 60
+    assert store.shape == (3, 5, 3)
+    assert (store[7] == 7).all()
+    assert [int(frame[0, 0, 0]) for _, frame in store] == list(range(10))
+    assert store.index_of(1035) == 3
+    assert store.index_of(0) == 0
+    assert store.index_of(10 ** 6) == 9
+
+    # isoformatted timestamps are stored as nanoseconds
+    iso_writer = Frame_Store_Writer(str(tmp_path / 'iso'), (2, 2), np.uint16)
+    iso_writer.write('2021-01-01T12:00:00.000001', np.zeros((2, 2), dtype=np.uint16))
+    iso_writer.close()
+    assert Frame_Store(str(tmp_path / 'iso')).timestamps[0] % 10 ** 9 == 1000
+
+    # a frame store can't be transcoded over itself
+    transcoder = Transcoder(path, 'raw')
+    transcoder.encode()
+    transcoder.wait()
+    assert isinstance(transcoder.error, ValueError)
+
+
+def test_camera_write_raw(tmp_path):
+    """
+    Cameras can write raw frames to a frame store from their writing thread
+    """
+    cam = Fake_Camera(name='fake')
+    cam.write(str(tmp_path / 'capture.mp4'), encoder='raw')
+
+    cam.capture(timed=0.1)
+    cam._capture_thread.join()
+
+    store = Frame_Store(str(tmp_path / 'capture.frames'))
+    assert len(store) == cam._ring.produced
+    assert cam.dropped['write'] == 0
+    assert store.shape == (4, 6)
+    assert (np.diff(store.timestamps) >= 0).all()
+
+
+def test_video_reader(tmp_path):
+    """
+    Frames can be read by frame number, by timestamp, around events, and in prefetched batches
+    """
+    with Frame_Store_Writer(str(tmp_path / 'capture'), (4, 6), np.uint16, fps=30) as writer:
+        for n in range(100):
+            writer.write(1000 + n * 10, np.full((4, 6), n, dtype=np.uint16))
+
+    reader = Video_Reader(str(tmp_path / 'capture.frames'), batch_size=16, prefetch=2)
+    assert len(reader) == 100
+    assert reader.shape == (4, 6)
+    assert (reader[5] == 5).all()
+    assert (reader[-1] == 99).all()
+    assert list(reader[10:40:10][:, 0, 0]) == [10, 20, 30]
+    assert list(reader[[70, 3, 71]][:, 0, 0]) == [70, 3, 71]
+    with pytest.raises(IndexError):
+        reader[100]
+
+    assert reader.seek(1255) == 25
+    assert list(reader.read(3)[:, 0, 0]) == [25, 26, 27]
+    assert reader.read(1)[0, 0, 0] == 28
+    reader.position = 98
+    assert len(reader.read(5)) == 2
+
+    # windows at the edges repeat the first or last frame
+    indices, clips = reader.frames_around([1000, 1500, 10 ** 6], before=2, after=2)
+    assert clips.shape == (3, 5, 4, 6)
+    assert indices.tolist() == [[0, 0, 0, 1, 2], [48, 49, 50, 51, 52], [97, 98, 99, 99, 99]]
+    assert (clips[:, :, 0, 0] == indices).all()
+
+    batches = list(reader.iter_batches(start=10, stop=60))
+    assert [len(frames) for _, frames in batches] == [16, 16, 16, 2]
+    assert (np.concatenate([frames for _, frames in batches])[:, 0, 0] == np.arange(10, 60)).all()
+    assert (np.concatenate([ts for ts, _ in batches]) == 1000 + np.arange(10, 60) * 10).all()
+    assert [timestamp for timestamp, _ in reader] == list(range(1000, 2000, 10))
+
+
+def test_video_index(tmp_path, monkeypatch):
+    """
+    A video's index is built once, joined with its timestamps, and rebuilt when the video changes
+    """
+    video = tmp_path / 'capture.mp4'
+    video.write_bytes(b'0' * 100)
+    with open(tmp_path / 'capture.csv', 'w') as ts_file:
+        ts_file.write('\n'.join('2021-01-01T12:00:00.{:06d}'.format(n * 1000) for n in range(10)))
+
+    probes = []
+
+    def _probe(path):
+        probes.append(path)
+        index = np.zeros(10, dtype=INDEX_DTYPE)
+        index['pts'] = np.arange(10) / 30
+        index['offset'] = np.arange(10) * 10
+        index['key'] = np.arange(10) % 5 == 0
+        return {'width': 6, 'height': 4, 'pix_fmt': 'yuv420p', 'fps': 30.0}, index
+    monkeypatch.setattr(video_reader, 'probe', _probe)
+
+    reader = Video_Reader(str(video))
+    assert reader.shape == (4, 6, 3)
+    assert reader.dtype == np.uint8
+    assert reader.index_of('2021-01-01T12:00:00.004500') == 4
+    assert (tmp_path / 'capture.vidx').exists()
+
+    reader = Video_Reader(str(video))
+    assert isinstance(reader.index, np.memmap)
+    assert len(probes) == 1
+    assert reader.index['offset'].tolist() == list(range(0, 100, 10))
+    assert np.diff(reader.timestamps).tolist() == [1000000] * 9
+
+    video.write_bytes(b'0' * 200)
+    Video_Reader(str(video))
+    assert len(probes) == 2
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+                    reason='needs ffmpeg')
+def test_video_reader_decode(tmp_path):
+    """
+    Frames of an encoded video are decoded from any position
+    """
+    writer = Video_Writer(str(tmp_path / 'video.mkv'), fps=30, shape=(16, 16), dtype=np.uint8, encoder='ffv1')
+    writer.start()
+    for n in range(60):
+        writer.write(n * 1000, np.full((16, 16), n * 4, dtype=np.uint8))
+    writer.close()
+
+    reader = Video_Reader(writer.path)
+    assert len(reader) == 60
+    assert reader[37][0, 0] == 37 * 4
+    assert list(reader[[3, 50, 51]][:, 0, 0]) == [12, 200, 204]
+    reader.seek(45500)
+    assert list(reader.read(2)[:, 0, 0]) == [180, 184]
+
+
+def test_camera_write_while_capturing(tmp_path):
+    """
+    Writing can start while the camera is already capturing, without blocking capture
+    """
+    cam = Fake_Camera(name='fake')
+    cam._ring.block_timeout = 0.5
+    cam.capture(timed=0.3)
+    time.sleep(0.05)
+    cam.write(str(tmp_path / 'capture.mp4'), encoder='raw')
+    cam._capture_thread.join()
+
+    store = Frame_Store(str(tmp_path / 'capture.frames'))
+    assert len(store) > 0
+    assert cam.dropped['write'] == 0
+    assert cam.dropped['ring'] == 0
+    # capture wasn't slowed down to the ring's block_timeout
+    assert cam._ring.produced > 50
+    # frames from after writing started are all written
+    assert (np.diff(store[:, 0, 0].astype(np.int64)) % 2 ** 16 == 1).all()
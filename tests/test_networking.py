@@ -10,9 +10,11 @@ Networking Tests.
 import pytest
 
 from autopilot.networking import Net_Node, Station, Message
+from autopilot.networking.message import SERIALIZERS, Peer_Formats
 import numpy as np
 import zmq
 import time
+import json
 import multiprocessing as mp
 
 
@@ -120,6 +122,236 @@ def test_node_to_node(node_params):
     node_2.release()
 
 
+def test_node_confirm_batch(node_params):
+    """
+    Messages sent with ``repeat=True`` are confirmed in batches,
+    removing them from the sender's :attr:`.Net_Node.outbox` .
+    """
+    received = []
+
+    node_1_params = node_params(
+        id="a",
+        router_port=np.random.randint(*PORTRANGE),
+        listens={'GOTIT': received.append}
+    )
+    node_2_params = node_params(
+        id='b',
+        upstream='a',
+        port=node_1_params['router_port'],
+    )
+
+    node_1 = Net_Node(**node_1_params)
+    node_1.confirm_interval = 0.05
+    node_2 = Net_Node(**node_2_params)
+    time.sleep(0.1)
+    for i in range(10):
+        node_2.send(to='a', key='GOTIT', value=i, repeat=True)
+
+    start = time.time()
+    while len(node_2.outbox) > 0 and time.time() - start < 2:
+        time.sleep(0.01)
+
+    assert sorted(received) == list(range(10))
+    assert len(node_2.outbox) == 0
+    assert node_2.outbox.stats()['confirmed'] == 10
+    # fewer CONFIRM messages than confirmed messages
+    assert node_2.dispatcher.stats()['CONFIRM']['submitted'] < 10
+
+    node_1.release()
+    node_2.release()
+
+
+def test_node_trace(node_params):
+    """
+    Messages with the ``TRACE`` flag are stamped as they're sent and handled,
+    and their recipient keeps latency histograms for each segment.
+    """
+    received = []
+
+    node_1_params = node_params(
+        id="a",
+        router_port=np.random.randint(*PORTRANGE),
+        listens={'GOTIT': received.append, 'UNTRACED': received.append}
+    )
+    node_2_params = node_params(
+        id='b',
+        upstream='a',
+        port=node_1_params['router_port'],
+    )
+
+    node_1 = Net_Node(**node_1_params)
+    node_2 = Net_Node(**node_2_params)
+    time.sleep(0.1)
+    node_2.send(to='a', key='UNTRACED', value=0)
+    for i in range(5):
+        node_2.send(to='a', key='GOTIT', value=i, flags={'TRACE': True})
+
+    start = time.time()
+    while node_1.traces.n_traced.get('GOTIT', 0) < 5 and time.time() - start < 2:
+        time.sleep(0.01)
+
+    assert sorted(received) == [0, 0, 1, 2, 3, 4]
+    assert 'UNTRACED' not in node_1.traces.histograms.keys()
+    stats = node_1.traces.stats()['GOTIT']
+    assert set(stats.keys()) == {'b:send->a:recv', 'a:recv->a:dispatch', 'a:dispatch->a:done', 'total'}
+    for segment in stats.values():
+        assert segment['n'] == 5
+        assert segment['p50_ms'] <= segment['p99_ms']
+    edges, counts = node_1.traces.histogram('GOTIT')
+    assert counts.sum() == 5
+    assert len(edges) == len(counts) + 1
+
+    node_1.release()
+    node_2.release()
+
+
+def test_station_traces(node_params, station_params):
+    """
+    A :class:`.Station` 's traces are kept in its own process, and can be
+    read from outside it with a ``TRACES`` message.
+    """
+    port = np.random.randint(*PORTRANGE)
+    station = Station(**station_params(id='traced_station', listen_port=port,
+                                       listens={'GOTIT': lambda msg: None}))
+    station.start()
+    time.sleep(0.1)
+
+    traces = []
+    node = Net_Node(**node_params(id='tracer', upstream='traced_station', port=port,
+                                  listens={'TRACES': traces.append}))
+    try:
+        for i in range(5):
+            node.send(to='traced_station', key='GOTIT', value=i, flags={'TRACE': True})
+        time.sleep(0.2)
+
+        node.send(to='traced_station', key='TRACES', value={'clear': True})
+        start = time.time()
+        while not traces and time.time() - start < 2:
+            time.sleep(0.01)
+        assert traces[0]['GOTIT']['total']['n'] == 5
+        assert 'traced_station:dispatch->traced_station:done' in traces[0]['GOTIT']
+
+        # cleared after being sent
+        node.send(to='traced_station', key='TRACES')
+        start = time.time()
+        while len(traces) < 2 and time.time() - start < 2:
+            time.sleep(0.01)
+        assert traces[1] == {}
+    finally:
+        node.release()
+        station.release()
+
+
+def test_shm_ring():
+    """
+    A :class:`.Shm_Ring` only reuses space after it has been read,
+    and doesn't split a region around the end of the ring.
+    """
+    from autopilot.networking.local import Shm_Ring, read_shm
+
+    ring = Shm_Ring(size=1000, min_bytes=0)
+    first = ring.write([b'a' * 300, b'b' * 300], 600)
+    assert first == (ring.name, 0, 600)
+    # not enough room until the first region is read
+    assert ring.write([b'c' * 600], 600) is None
+    assert read_shm(*first) == b'a' * 300 + b'b' * 300
+
+    # wraps to the start rather than splitting
+    second = ring.write([b'c' * 600], 600)
+    assert second == (ring.name, 1000, 600)
+    assert read_shm(*second) == b'c' * 600
+    assert ring.write([b'd' * 2000], 2000) is None
+    ring.close()
+
+@pytest.mark.parametrize('repeat', [False, True])
+def test_node_local_shm(node_params, repeat):
+    """
+    :class:`.Net_Node` s on the same computer connect over ipc, and
+    send arrays to their upstream through shared memory unless the message may be repeated.
+    """
+    received = []
+
+    node_1_params = node_params(
+        id="a",
+        router_port=np.random.randint(*PORTRANGE),
+        listens={'ARRAY': received.append}
+    )
+    node_2_params = node_params(
+        id='b',
+        upstream='a',
+        port=node_1_params['router_port'],
+        msg_format='binary'
+    )
+
+    node_1 = Net_Node(**node_1_params)
+    node_2 = Net_Node(**node_2_params)
+    assert node_2.shm is not None
+
+    arrays = [np.random.random((200, 200)) for i in range(3)]
+    time.sleep(0.1)
+    for array in arrays:
+        node_2.send(to='a', key='ARRAY', value={'array': array}, repeat=repeat)
+
+    start = time.time()
+    while len(received) < len(arrays) and time.time() - start < 2:
+        time.sleep(0.01)
+
+    assert len(received) == len(arrays)
+    for value, array in zip(received, arrays):
+        assert np.array_equal(value['array'], array)
+
+    # the recipient has read through the ring
+    tail = int(node_2.shm._state[0])
+    if repeat:
+        assert tail == 0
+    else:
+        assert tail == sum(array.nbytes for array in arrays)
+
+    node_1.release()
+    node_2.release()
+
+
+def test_station_forward_shm(station_params):
+    """
+    A :class:`.Station` that forwards a message with its arrays in shared memory
+    copies them back into the message, so the next hop doesn't need the ring.
+    """
+    from autopilot.networking.local import SHARED_MEMORY, Shm_Ring
+    if 'binary' not in SERIALIZERS or not SHARED_MEMORY:
+        pytest.skip('shared memory needs the binary format')
+
+    ring = Shm_Ring(size=2**20, min_bytes=0)
+    array = np.random.random((100, 100))
+    frame = Message(to='far', key='ARRAY', value={'array': array}, sender='src', id='src_0',
+                    flags={'NOREPEAT': True}).serialize('binary', shm=ring)
+    assert Message.uses_shm(frame)
+
+    ctx = zmq.Context.instance()
+    port, upper_port = np.random.choice(np.arange(*PORTRANGE), 2, replace=False)
+    upper = ctx.socket(zmq.ROUTER)
+    upper.bind('tcp://*:{}'.format(upper_port))
+    station = Station(**station_params(id='middle', listen_port=int(port), pusher=True,
+                                       push_port=int(upper_port), push_id='upper'))
+    station.start()
+    time.sleep(0.2)
+
+    src = ctx.socket(zmq.DEALER)
+    src.setsockopt_string(zmq.IDENTITY, 'src')
+    src.connect('tcp://localhost:{}'.format(port))
+    try:
+        src.send_multipart([b'far', frame])
+        assert upper.poll(2000)
+        forwarded = upper.recv_multipart()[-1]
+        assert not Message.uses_shm(forwarded)
+
+        ring.close()
+        assert np.array_equal(Message(forwarded).value['array'], array)
+    finally:
+        src.close(linger=0)
+        upper.close(linger=0)
+        station.release()
+
+
 def test_multihop(node_params, station_params):
     """
     :class:`.Message` s can be routed through multiple :class:`.Station` objects
@@ -238,3 +470,446 @@ def test_multihop(node_params, station_params):
 
 
 
+def test_rows_through_stations(node_params, tmp_path):
+    """
+    The terminal's request for missed rows reaches the pilot through both stations,
+    and the pilot's reply gets back to the terminal.
+
+    .. code-block:: text
+
+        _T -> Terminal_Station -> Pilot_Station -> _pilot  (ROWS request)
+        _pilot -> Pilot_Station -> Terminal_Station -> _T  (ROWS reply)
+    """
+    from autopilot import prefs
+    from autopilot.networking.station import Terminal_Station, Pilot_Station
+
+    terminal_port, pilot_port = np.random.choice(np.arange(*PORTRANGE), 2, replace=False)
+    pilot = 'rows_pilot'
+    set_prefs = {'MSGPORT': int(terminal_port), 'PUSHPORT': int(terminal_port),
+                 'TERMINALIP': 'localhost', 'NAME': pilot, 'PING_INTERVAL': 0.1,
+                 'DATADIR': str(tmp_path), 'SOUNDDIR': str(tmp_path)}
+    old_prefs = {key: prefs._PREFS.get(key) for key in set_prefs.keys()}
+    for key, val in set_prefs.items():
+        prefs.set(key, val)
+
+    terminal_rows, pilot_rows = [], []
+    terminal_station = Terminal_Station(pilots={})
+    terminal_station.start()
+    prefs.set('MSGPORT', int(pilot_port))
+    pilot_station = Pilot_Station()
+    pilot_station.start()
+    time.sleep(0.2)
+
+    terminal_node = Net_Node(**node_params(
+        id='_T', upstream='T', port=int(terminal_port),
+        listens={'ROWS': terminal_rows.append, 'STATE': lambda value: None}))
+    pilot_node = Net_Node(**node_params(
+        id='_' + pilot, upstream=pilot, port=int(pilot_port),
+        listens={'ROWS': pilot_rows.append}))
+
+    try:
+        # introduce the nodes to their stations
+        terminal_node.send('T', 'INIT', repeat=False)
+        pilot_node.send(pilot, 'HANDSHAKE', repeat=False)
+        time.sleep(0.3)
+
+        terminal_node.send(to=pilot, key='ROWS', value={'since': 4})
+        for _ in range(20):
+            if pilot_rows:
+                break
+            time.sleep(0.1)
+        assert pilot_rows == [{'since': 4}]
+
+        pilot_node.send('T', 'ROWS', {'pilot': pilot, 'rows': [], 'more': False})
+        for _ in range(20):
+            if terminal_rows:
+                break
+            time.sleep(0.1)
+        assert terminal_rows == [{'pilot': pilot, 'rows': [], 'more': False}]
+    finally:
+        terminal_node.release()
+        pilot_node.release()
+        terminal_station.release()
+        pilot_station.release()
+        for key, val in old_prefs.items():
+            if val is None:
+                prefs._PREFS.pop(key, None)
+            else:
+                prefs.set(key, val)
+
+
+@pytest.mark.parametrize('fmt', ['json', 'binary'])
+@pytest.mark.parametrize('flags', [{}, {'COMPRESS': True}])
+def test_message_formats(fmt, flags):
+    """
+    :class:`.Message` s survive a round trip through each wire format,
+    including nested numpy arrays, and the format is detected on receipt.
+    """
+    value = {
+        'frame': np.random.randint(0, 255, (48, 64), dtype=np.uint8),
+        'nested': [np.arange(10, dtype=np.float32), {'scalar': 1}],
+        'record': np.zeros(3, dtype=[('a', 'i4'), ('b', 'f8')]),
+        'text': 'hello'
+    }
+    msg = Message(id='a_0', to='b', sender='a', key='DATA', value=value, flags=flags)
+    serialized = msg.serialize(fmt)
+    assert Message.frame_format(serialized) == fmt
+
+    received = Message(serialized, expand_arrays=True)
+    assert received._format == fmt
+    if fmt == 'json':
+        assert tuple(received.formats) == SERIALIZERS
+    assert np.array_equal(received.value['frame'], value['frame'])
+    assert np.array_equal(received.value['nested'][0], value['nested'][0])
+    assert np.array_equal(received.value['record'], value['record'])
+    assert received.value['nested'][1] == {'scalar': 1}
+    assert received.value['text'] == 'hello'
+
+    # peers are sent json until they say they can read binary
+    peers = Peer_Formats()
+    assert peers.choose('a', 'binary') == 'json'
+    peers.learn(received)
+    assert peers.choose('a', 'binary') == ('binary' if 'binary' in SERIALIZERS else 'json')
+    assert peers.choose(['station', 'a'], 'binary') == peers.choose('a', 'binary')
+    assert peers.choose('a', 'json') == 'json'
+
+    # and are sent batched confirmations once they've told us their formats,
+    # which older versions never do
+    assert peers.can_batch('a') and not peers.can_batch('b')
+    old = Message(json.dumps({'to': 'c', 'key': 'KEY', 'value': 1, 'sender': 'a', 'id': 'a_1'}).encode('utf-8'))
+    peers.learn(old)
+    assert not peers.can_batch('a')
+    assert peers.choose('a', 'binary') == 'json'
+
+    # forwarding an unchanged message reuses the serialized bytes
+    assert received.serialize() is serialized
+
+def test_message_lazy_value():
+    """
+    Binary :class:`.Message` s only decode their header on receipt,
+    the body is decoded the first time the ``value`` is accessed.
+    """
+    frame = np.random.randint(0, 255, (48, 64), dtype=np.uint8)
+    msg = Message(id='a_0', to='b', sender='a', key='CONTINUOUS',
+                  pilot='pilot_1', value={'frame': frame})
+    serialized = msg.serialize('binary')
+
+    received = Message(serialized)
+    assert received.pilot == 'pilot_1'
+    assert received.validate()
+    assert 'value' not in received.__dict__
+    # can forward without decoding
+    assert received.serialize() is serialized
+    assert 'value' not in received.__dict__
+
+    assert np.array_equal(received['value']['frame'], frame)
+    assert 'value' in received.__dict__
+
+    # re-encoding in another format decodes first
+    assert np.array_equal(Message(received.serialize('json'), expand_arrays=True).value['frame'], frame)
+
+def test_dispatcher_order():
+    """
+    The :class:`.Dispatcher` handles messages from the same queue in order,
+    calls ``inline`` keys immediately, and counts what it handled.
+    """
+    from autopilot.networking.dispatch import Dispatcher
+    import threading
+
+    received = {'a': [], 'b': []}
+    inline_thread = []
+    done = threading.Event()
+
+    def handler(sender, i):
+        received[sender].append(i)
+        time.sleep(np.random.random()*0.001)
+        if len(received['a']) == 50 and len(received['b']) == 50:
+            done.set()
+
+    dispatcher = Dispatcher(n_workers=4, max_queue=10, inline=('CONFIRM',))
+    for i in range(50):
+        for sender in ('a', 'b'):
+            dispatcher.submit('DATA', handler, sender, i, order=sender)
+    dispatcher.submit('CONFIRM', lambda: inline_thread.append(threading.current_thread()))
+
+    assert done.wait(5)
+    assert received['a'] == list(range(50))
+    assert received['b'] == list(range(50))
+    assert inline_thread == [threading.current_thread()]
+
+    stats = dispatcher.stats()
+    assert stats['DATA']['submitted'] == 100
+    assert stats['DATA']['max_depth'] <= 20
+    assert stats['CONFIRM']['completed'] == 1
+    dispatcher.release()
+
+def test_outbox_backoff():
+    """
+    The :class:`.Outbox` resends unconfirmed messages with increasing intervals,
+    holds messages past ``max_in_flight`` until earlier ones are confirmed,
+    and drops messages that run out of ttl.
+    """
+    from autopilot.networking.outbox import Outbox
+
+    sent = []
+    outbox = Outbox(interval=1.0, backoff=2.0, max_interval=3.0, max_in_flight=1)
+    outbox.add('a', 'peer', ['a'], sent.append, ttl=2)
+    outbox.add('b', 'peer', ['b'], sent.append, ttl=2)
+    outbox.add('c', 'other', ['c'], sent.append, ttl=2)
+
+    # b is held until a is confirmed
+    assert sent == [['a'], ['c']]
+    assert outbox.stats()['held'] == 1
+
+    start = time.monotonic()
+    # nothing due yet
+    assert outbox.resend_due(start) == ([], [])
+
+    # first resend after interval, then after interval*backoff
+    resent, failed = outbox.resend_due(start + 1.5)
+    assert [entry.id for entry in resent] == ['a', 'c']
+    assert outbox.resend_due(start + 2.5) == ([], [])
+    resent, failed = outbox.resend_due(start + 4)
+    assert [entry.id for entry in resent] == ['a', 'c']
+    assert resent[0].interval == 3.0
+
+    # confirming a sends b
+    assert outbox.confirm('a')
+    assert not outbox.confirm('a')
+    assert sent[-1] == ['b']
+
+    # c is out of ttl
+    resent, failed = outbox.resend_due(start + 100)
+    assert [entry.id for entry in failed] == ['c']
+    assert 'c' not in outbox
+
+    stats = outbox.stats()
+    assert stats['sent'] == 3
+    assert stats['deferred'] == 1
+    assert stats['confirmed'] == 1
+    assert stats['failed'] == 1
+    assert stats['retransmits'] == 5
+    assert stats['in_flight'] == 1
+    assert stats['ack_latency_mean'] > 0
+
+def test_backlog(tmp_path):
+    """
+    A :class:`.Backlog` keeps messages until they're confirmed, across being reopened,
+    and never reuses ids, so :class:`.Seen_Ids` can drop repeats.
+    """
+    from autopilot.networking.backlog import Backlog, Seen_Ids
+
+    path = str(tmp_path / 'backlog.sqlite3')
+    backlog = Backlog(path)
+    values = [{'trial_num': i, 'value': np.float64(i)} for i in range(5)]
+    ids = [backlog.add('DATA', value) for value in values]
+    assert [value['data_id'] for value in values] == ids
+    assert len(set(ids)) == 5
+    assert backlog.confirm(ids[:2] + ['someone_else_1', None]) == 2
+    backlog.close()
+
+    backlog = Backlog(path)
+    pending = backlog.pending()
+    assert [id for id, _, _ in pending] == ids[2:]
+    assert pending[0][2] == {'trial_num': 2, 'value': 2.0, 'data_id': ids[2]}
+    assert len(backlog.pending(limit=2)) == 2
+    assert backlog.confirm(ids[2:]) == 3
+    assert len(backlog) == 0
+    new_id = backlog.add('DATA', {'trial_num': 5})
+    assert new_id not in ids
+    assert backlog.owns(new_id)
+    assert not backlog.owns('someone_else_1')
+
+    seen = Seen_Ids()
+    assert all(seen.add(id) for id in ids + [new_id])
+    assert not seen.add(ids[3])
+    assert len(seen.ranges[backlog.token]) == 1
+    # not backlog ids, never dropped
+    assert seen.add('no-id') and seen.add('no-id')
+    restored = Seen_Ids(seen.to_json())
+    assert ids[0] in restored
+    assert not restored.add(new_id)
+
+
+def test_file_transfer(tmp_path):
+    """
+    Files can be sent in chunks with :class:`.File_Source` and :class:`.File_Download` ,
+    resuming a partial download and checking the result against its hash.
+    """
+    from autopilot.networking.transfer import File_Source, File_Download, install_file
+
+    source_dir = tmp_path / 'source'
+    cache_dir = tmp_path / 'cache'
+    (source_dir / 'songs').mkdir(parents=True)
+    contents = np.random.bytes(1000)
+    (source_dir / 'songs' / 'sadone.wav').write_bytes(contents)
+
+    source = File_Source(str(source_dir), chunk_size=100)
+    manifest = source.manifest('songs/sadone.wav')
+    assert manifest['n_chunks'] == 10
+    with pytest.raises(ValueError):
+        source.manifest('../outside.wav')
+
+    # chunks go through messages as bytes in either format
+    for fmt in SERIALIZERS:
+        msg = Message(to='a', key='FILE_CHUNK', value={'index': 0, 'data': source.chunk('songs/sadone.wav', 0)},
+                      sender='b', id='b_0')
+        received = Message(msg.serialize(fmt))
+        assert received.expand()['data'] == contents[:100]
+
+    download = File_Download(manifest, str(cache_dir))
+    assert download.next_chunks(4) == [0, 1, 2, 3]
+    for index in (0, 2):
+        download.write(index, source.chunk('songs/sadone.wav', index))
+
+    # interrupted mid-write, resume from disk
+    with open(download.index_path, 'a') as index_file:
+        index_file.write('1')
+    download = File_Download(manifest, str(cache_dir))
+    assert download.received == {0, 2}
+    assert download.next_chunks(2) == [1, 3]
+    for index in (1, 3):
+        download.write(index, source.chunk('songs/sadone.wav', index))
+    while not download.complete:
+        for index in download.next_chunks(4):
+            download.write(index, source.chunk('songs/sadone.wav', index))
+
+    cache_path = download.finish()
+    installed = tmp_path / 'pilot' / 'songs' / 'sadone.wav'
+    install_file(cache_path, str(installed))
+    assert installed.read_bytes() == contents
+
+    # corrupted downloads are discarded
+    download = File_Download(dict(manifest, hash='0'*64), str(cache_dir))
+    for index in download.next_chunks(10):
+        download.write(index, b'\x00'*100)
+    with pytest.raises(ValueError):
+        download.finish()
+    assert download.received == set()
+
+def test_benchmark(tmp_path):
+    """
+    The networking benchmarks run and write their results to JSON
+    """
+    import json
+    from autopilot.networking.benchmark import Bench_Case, run
+
+    cases = [Bench_Case('codec', 'frame', fmt, 5) for fmt in SERIALIZERS]
+    cases.append(Bench_Case('direct', 'dict', SERIALIZERS[0], 10))
+    cases.append(Bench_Case('stream', 'scalar', SERIALIZERS[0], 10, batch=5))
+
+    out = tmp_path / 'bench.json'
+    results = run(cases, out=str(out), verbose=False)
+    assert json.loads(out.read_text()) == results
+    assert len(results['results']) == len(cases)
+    for result in results['results']:
+        assert result['received'] == result['case']['n']
+        assert result['msgs_per_sec'] > 0
+    assert results['results'][-1]['latency_p99_ms'] >= results['results'][-1]['latency_p50_ms']
+
+def test_stream_queue_batching():
+    """
+    :class:`.Stream_Queue` batches by count, bytes, and latency, and counts dropped items
+    """
+    from autopilot.networking.node import Stream_Queue
+
+    q = Stream_Queue(maxlen=4)
+    for i in range(6):
+        q.append(i)
+    assert q.dropped == 2
+    assert q.get_batch(max_items=3) == ([2, 3, 4], False)
+    assert q.get_batch(max_items=1) == ([5], False)
+
+    # bytes threshold
+    for i in range(3):
+        q.append(np.zeros(100, dtype=np.uint8))
+    batch, ended = q.get_batch(max_items=10, max_bytes=150)
+    assert len(batch) == 2
+    assert len(q) == 1
+    q.get_batch()
+
+    # latency threshold
+    q.append('a')
+    start = time.monotonic()
+    batch, ended = q.get_batch(max_items=10, max_latency=0.05)
+    assert batch == ['a']
+    assert time.monotonic() - start >= 0.04
+
+    # END flushes what's left
+    q.append('b')
+    q.append('END')
+    assert q.get_batch(max_items=10) == (['b'], True)
+
+
+@pytest.mark.parametrize('min_size', [1, 5])
+def test_node_stream(node_params, min_size):
+    """
+    Items appended to a :meth:`.Net_Node.get_stream` queue arrive at the recipient,
+    either batched or one at a time.
+    """
+    received = []
+
+    def l_continuous(value):
+        received.append(value)
+
+    node_1_params = node_params(
+        id='stream_recv',
+        router_port=np.random.randint(*PORTRANGE),
+        listens={'CONTINUOUS': l_continuous}
+    )
+    node_2_params = node_params(id='stream_send', upstream='stream_recv',
+                                port=node_1_params['router_port'])
+    node_1 = Net_Node(**node_1_params)
+    node_2 = Net_Node(**node_2_params)
+
+    q = node_2.get_stream('test', 'CONTINUOUS', min_size=min_size, max_latency=0.05)
+    for i in range(12):
+        q.append({'i': i, 'frame': np.full((4, 4), i, dtype=np.uint8)})
+
+    for _ in range(20):
+        time.sleep(0.05)
+        if len(received) == 12:
+            break
+    q.append('END')
+
+    try:
+        assert [v['i'] for v in received] == list(range(12))
+        assert np.array_equal(received[-1]['frame'], np.full((4, 4), 11, dtype=np.uint8))
+        assert q.send_dropped == 0
+    finally:
+        node_1.release()
+        node_2.release()
+
+
+def test_node_stream_dropped(node_params, monkeypatch):
+    """
+    Items dropped because the recipient isn't receiving are counted separately from
+    those dropped because the queue was full
+    """
+    import zmq
+
+    node = Net_Node(**node_params(id='stream_nowhere', upstream='nobody',
+                                  port=np.random.randint(*PORTRANGE)))
+
+    def _not_receiving(to):
+        # as if the send timed out
+        time.sleep(0.05)
+        raise zmq.Again()
+    monkeypatch.setattr(node, 'peer_format', _not_receiving)
+
+    q = node.get_stream('test', 'CONTINUOUS', min_size=1, q_size=2)
+    try:
+        for i in range(10):
+            q.append({'i': i})
+            time.sleep(0.005)
+        for _ in range(100):
+            time.sleep(0.02)
+            if q.send_dropped + q.dropped == 10:
+                break
+        # while the sender waits on the recipient, the queue fills and drops the oldest
+        assert q.dropped > 0
+        assert q.send_dropped > 0
+        assert q.send_dropped + q.dropped == 10
+    finally:
+        q.append('END')
+        node.release()
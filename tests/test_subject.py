@@ -0,0 +1,652 @@
+"""
+Subject data storage tests.
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+import tables
+
+from autopilot.core.subject import Subject
+from autopilot.core.writers import Trial_Writer, Continuous_Writer
+
+
+@pytest.fixture(autouse=True)
+def subject_index(tmp_path):
+    """
+    Keep the subject index for each test in its temporary directory
+    """
+    from autopilot.core.subject_index import INDEX
+    old_path = INDEX.path
+    INDEX.path = str(tmp_path / 'subject_index.sqlite3')
+    yield INDEX
+    INDEX.path = old_path
+
+
+@pytest.fixture
+def subject(tmp_path):
+    """
+    A subject with a one-step Nafc protocol
+    """
+    protocol = tmp_path / 'protocol.json'
+    protocol.write_text(json.dumps([{'task_type': 'Nafc', 'step_name': 'one'}]))
+    sub = Subject('test_subject', dir=str(tmp_path))
+    sub.assign_protocol(str(protocol))
+    return sub
+
+
+def test_trial_writer_batches(tmp_path):
+    """
+    Trials are merged by trial_num and written in batches, and data for
+    a trial that's already written updates its row rather than adding one.
+    """
+    h5f = tables.open_file(str(tmp_path / 'trials.h5'), 'w')
+    table = h5f.create_table('/', 'trial_data', {
+        'trial_num': tables.Int32Col(), 'session': tables.Int32Col(),
+        'target': tables.StringCol(1), 'correct': tables.Int32Col()})
+    writer = Trial_Writer(table, session=1, flush_rows=3, flush_interval=60)
+
+    for i in range(2):
+        writer.add({'trial_num': i, 'target': 'L'})
+        assert writer.add({'trial_num': i, 'correct': 1, 'TRIAL_END': True})['session'] == 1
+    assert not writer.due
+    assert table.nrows == 0
+
+    writer.add({'trial_num': 2, 'target': 'R', 'TRIAL_END': True})
+    assert writer.due
+    writer.flush()
+    assert table.nrows == 3
+
+    writer.add({'trial_num': 1, 'correct': 0})
+    writer.close()
+    assert table.nrows == 3
+    assert table.col('correct').tolist() == [1, 0, 0]
+    assert table.col('target').tolist() == [b'L', b'L', b'R']
+    h5f.close()
+
+
+def test_continuous_writer_chunks(tmp_path):
+    """
+    Continuous samples are appended a chunk at a time, with chunks sized to the rate
+    they arrive at, and nothing is held longer than the flush interval.
+    """
+    h5f = tables.open_file(str(tmp_path / 'continuous.h5'), 'w')
+    group = h5f.create_group('/', 'session_1')
+    writer = Continuous_Writer(group, ('wheel', 'imu'), flush_interval=0.05, min_rows=16)
+
+    timestamp = '2021-01-01T00:00:00.000000'
+    for i in range(200):
+        writer.add({'continuous': True, 'timestamp': timestamp, 'wheel': float(i),
+                    'imu': np.full(3, i, dtype=np.float32), 'other': 0})
+        time.sleep(0.0005)
+
+    assert set(writer.buffers.keys()) == {'wheel', 'imu'}
+    wheel = group.wheel
+    assert wheel.chunkshape[0] >= 16
+    # written in whole chunks so far
+    assert wheel.nrows % wheel.chunkshape[0] == 0
+
+    time.sleep(0.06)
+    assert writer.time_to_flush() == 0
+    writer.flush()
+    assert writer.time_to_flush() is None
+    assert np.array_equal(wheel.col('wheel'), np.arange(200))
+    assert group.imu.col('imu').shape == (200, 3)
+    assert wheel.col('timestamp')[0] == timestamp.encode('utf-8')
+    h5f.close()
+
+
+def test_continuous_writer_rejects(tmp_path):
+    """
+    A stream whose values can't be stored is dropped, rather than failing every flush
+    """
+    h5f = tables.open_file(str(tmp_path / 'continuous.h5'), 'w')
+    group = h5f.create_group('/', 'session_1')
+    writer = Continuous_Writer(group, ('bad', 'wheel'))
+
+    writer.add({'continuous': True, 'timestamp': 'x', 'bad': {'a': 1}})
+    writer.flush(all=True)
+    writer.flush(all=True)
+    assert writer.rejected == {'bad'}
+    assert writer.time_to_flush() is None
+
+    writer.add({'continuous': True, 'timestamp': 'y', 'bad': {'a': 2}, 'wheel': 1.0})
+    writer.flush(all=True)
+    assert group.wheel.nrows == 1
+    assert 'bad' not in group
+    h5f.close()
+
+
+def test_trial_journal_recovery(subject):
+    """
+    Trials left in the journal when the terminal died before flushing them are
+    written the next time the subject is run, before its trial number is read.
+    """
+    with open(subject.journal, 'w') as journal:
+        journal.write(json.dumps({'table': '/data/protocol/S00_one/trial_data',
+                                  'session': 1, 'start_row': 0}) + '\n')
+        for i in range(5):
+            journal.write(json.dumps({'trial_num': i, 'target': 'L', 'TRIAL_END': True,
+                                      'DC_timestamp': datetime.datetime.now().isoformat()}) + '\n')
+        # cut off mid-write
+        journal.write('{"trial_num": 5, "tar')
+
+    task = subject.prepare_run()
+    assert task['current_trial'] == 5
+    subject.save_data({'trial_num': 5, 'target': 'R', 'TRIAL_END': True})
+    subject.stop_run()
+    assert not os.path.exists(subject.journal)
+
+    h5f = subject.open_hdf()
+    table = h5f.get_node('/data/protocol/S00_one/trial_data')
+    trial_nums, sessions = table.col('trial_num'), table.col('session')
+    subject.close_hdf(h5f)
+    assert np.array_equal(trial_nums, np.arange(6))
+    assert sessions.tolist() == [1] * 5 + [2]
+
+
+def test_handle_pool(tmp_path):
+    """
+    Handles are shared and kept open after release, and a read-only handle
+    is reopened writable once nobody is using it.
+    """
+    from autopilot.core.handles import Handle_Pool
+
+    pool = Handle_Pool(max_idle=1, timeout=0.1)
+    paths = [str(tmp_path / '{}.h5'.format(i)) for i in range(2)]
+    for path in paths:
+        pool.release(pool.open(path, 'w'))
+
+    # only max_idle stay open
+    assert paths[0] not in pool and paths[1] in pool
+
+    reader = pool.open(paths[0], 'r')
+    assert pool.open(paths[0], 'r') is reader
+    with pytest.raises(TimeoutError):
+        pool.open(paths[0], 'r+')
+    pool.release(reader)
+    pool.release(reader)
+
+    writer = pool.open(paths[0], 'r+')
+    assert writer is not reader and not reader.isopen
+    # readers share the writable handle
+    assert pool.open(paths[0], 'r') is writer
+    pool.release(writer)
+    pool.release(writer)
+    pool.close()
+    assert not writer.isopen
+
+
+def test_handle_pool_lock(tmp_path):
+    """
+    A thread that opens a file has it to itself until it releases it,
+    or until it lets others use it while it waits.
+    """
+    from autopilot.core.handles import Handle_Pool
+
+    pool = Handle_Pool()
+    path = str(tmp_path / 'locked.h5')
+    writer = pool.open(path, 'w')
+
+    opened = threading.Event()
+    def read():
+        pool.release(pool.open(path, 'r'))
+        opened.set()
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert not opened.wait(0.2)
+    with pool.unlocked(writer):
+        assert opened.wait(1)
+    reader.join()
+
+    # locked again after the block
+    opened.clear()
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert not opened.wait(0.2)
+    pool.release(writer)
+    assert opened.wait(1)
+    reader.join()
+    pool.close()
+
+
+def test_subject_lazy(subject, subject_index):
+    """
+    Making a Subject doesn't open its file until its protocol is needed
+    """
+    from autopilot.core.handles import POOL
+
+    POOL.close()
+    # not indexed, so read from the file
+    subject_index.remove(subject.file)
+    lazy = Subject(subject.name, dir=os.path.dirname(subject.file))
+    assert subject.file not in POOL
+    assert lazy.protocol_name == 'protocol'
+    assert lazy.step == 0
+    assert subject.file in POOL
+
+
+def test_subject_index(subject, subject_index):
+    """
+    Subjects' metadata is read from the index rather than their file,
+    unless the file has changed since the index was updated.
+    """
+    from autopilot.core.handles import POOL
+
+    subject.prepare_run()
+    subject.save_data({'trial_num': 0, 'TRIAL_END': True})
+    subject.stop_run()
+
+    entry = subject_index.get(subject.file)
+    assert entry['protocol_name'] == 'protocol'
+    assert entry['step'] == 0
+    assert entry['session'] == 1
+    assert entry['n_trials'] == 1
+    assert entry['current'] == subject.current
+    assert subject_index.subjects()[os.path.abspath(subject.file)]['n_trials'] == 1
+
+    POOL.close()
+    indexed = Subject(subject.name, dir=os.path.dirname(subject.file))
+    assert indexed.session == 1
+    assert indexed.current == subject.current
+    assert subject.file not in POOL
+
+    # changed by something else
+    POOL.close()
+    with tables.open_file(subject.file, 'r+') as h5f:
+        h5f.root.info._v_attrs['session'] = 5
+    assert subject_index.get(subject.file) is None
+    assert Subject(subject.name, dir=os.path.dirname(subject.file)).session == 5
+    assert subject_index.get(subject.file)['session'] == 5
+
+
+@pytest.fixture
+def two_step_subject(tmp_path):
+    """
+    A subject with a two-step protocol, with two sessions of 10 trials on each step
+    """
+    protocol = tmp_path / 'protocol.json'
+    protocol.write_text(json.dumps([{'task_type': 'Nafc', 'step_name': 'one'},
+                                    {'task_type': 'Nafc', 'step_name': 'two'}]))
+    sub = Subject('test_subject', dir=str(tmp_path))
+    sub.assign_protocol(str(protocol))
+
+    trial_num = 0
+    for step in (0, 1):
+        if step > 0:
+            sub.update_history('step', 'two', step)
+        for session in range(2):
+            sub.prepare_run()
+            for _ in range(10):
+                sub.save_data({'trial_num': trial_num, 'target': 'L', 'correct': trial_num % 2,
+                               'TRIAL_END': True})
+                trial_num += 1
+            sub.stop_run()
+    return sub
+
+
+def test_get_trial_data_steps(two_step_subject):
+    """
+    Data from several steps is concatenated, and can be narrowed by column, session, and row
+    """
+    df = two_step_subject.get_trial_data(step='all')
+    assert df.shape[0] == 40
+    assert df['trial_num'].tolist() == list(range(40))
+    assert df['step'].tolist() == [0] * 20 + [1] * 20
+    assert df['session'].tolist() == [1] * 10 + [2] * 10 + [3] * 10 + [4] * 10
+
+    df = two_step_subject.get_trial_data(step='all', columns=['trial_num', 'session'], sessions=(2, 3))
+    assert set(df.columns) == {'trial_num', 'session', 'step', 'step_name'}
+    assert df['trial_num'].tolist() == list(range(10, 30))
+
+    df = two_step_subject.get_trial_data(step=-1, rows=(5, 8))
+    assert df['trial_num'].tolist() == [25, 26, 27]
+    assert df['step_name'].unique().tolist() == ['S01_two']
+
+
+def test_iter_trial_data(two_step_subject):
+    """
+    Trial data is read in chunks of structured arrays, and the file is released when done
+    """
+    from autopilot.core.handles import POOL
+
+    batches = list(two_step_subject.iter_trial_data(step='all', columns=['trial_num', 'nonexistent'],
+                                                    sessions=4, chunk_rows=3))
+    assert set(step_key for step_key, _ in batches) == {'S01_two'}
+    # chunks are of table rows, before selecting sessions
+    assert [len(records) for _, records in batches] == [2, 3, 3, 2]
+    assert batches[0][1].dtype.names == ('trial_num',)
+    assert np.concatenate([records for _, records in batches])['trial_num'].tolist() == list(range(30, 40))
+
+    # nobody still holds the file
+    POOL.release(POOL.open(two_step_subject.file, 'r+'))
+
+
+def test_to_parquet(two_step_subject, tmp_path):
+    """
+    Trial data is exported to parquet with the same rows and columns as get_trial_data
+    """
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    path = str(tmp_path / 'trials.parquet')
+    two_step_subject.to_parquet(path, columns=['trial_num', 'target', 'session'])
+    table = pq.read_table(path)
+    assert table.num_rows == 40
+    assert table.column('trial_num').to_pylist() == list(range(40))
+    assert table.column('target').to_pylist() == ['L'] * 40
+    assert table.column('step').to_pylist() == [0] * 20 + [1] * 20
+    assert two_step_subject.to_arrow(step=0).num_rows == 20
+
+
+def test_graduation_state(tmp_path):
+    """
+    Graduation state is saved as trials are written and restored in the next session
+    without reading the trial table, and is started over when the subject changes step.
+    """
+    protocol = tmp_path / 'protocol.json'
+    graduation = {'type': 'Accuracy', 'value': {'threshold': 0.9, 'window': 5}}
+    protocol.write_text(json.dumps([{'task_type': 'Nafc', 'step_name': 'one', 'graduation': graduation},
+                                    {'task_type': 'Nafc', 'step_name': 'two', 'graduation': graduation}]))
+    sub = Subject('test_subject', dir=str(tmp_path))
+    sub.assign_protocol(str(protocol))
+
+    def run(corrects, start=0):
+        sub.prepare_run()
+        for i, correct in enumerate(corrects):
+            sub.save_data({'trial_num': start + i, 'correct': correct, 'TRIAL_END': True})
+        sub.stop_run()
+
+    run([0, 1, 1])
+    h5f = sub.open_hdf()
+    table = h5f.get_node('/data/protocol/S00_one/trial_data')
+    assert table.attrs['step_start'] == 0
+    saved = json.loads(table.attrs['graduation'])
+    assert saved['rows'] == 3 and saved['state'] == {'correct': [0, 1, 1]}
+    # restored from saved state, not the table
+    table.modify_column(column=np.zeros(3, dtype=np.int32), colname='correct')
+    sub.close_hdf(h5f)
+
+    sub.prepare_run()
+    assert list(sub.graduation.corrects) == [0, 1, 1]
+    sub.save_data({'trial_num': 3, 'correct': 1, 'TRIAL_END': True})
+    sub.save_data({'trial_num': 4, 'correct': 1, 'TRIAL_END': True})
+    sub.stop_run()
+    assert not sub.did_graduate.is_set()
+
+    # stale saved state reads only the last window of trials
+    h5f = sub.open_hdf()
+    table = h5f.get_node('/data/protocol/S00_one/trial_data')
+    table.append([tuple(table.coldflts[name] for name in table.colnames)])
+    sub.close_hdf(h5f)
+    sub.prepare_run()
+    assert list(sub.graduation.corrects) == [0, 0, 1, 1, 0]
+    sub.stop_run()
+
+    # moving back to a step with trials starts over
+    sub.update_history('step', 'two', 1)
+    sub.update_history('step', 'one', 0)
+    sub.prepare_run()
+    assert len(sub.graduation.corrects) == 0
+    assert sub.current_trial == 0
+    sub.stop_run()
+
+
+def test_time_queries(tmp_path):
+    """
+    With nanosecond timestamps, timestamp columns are int64 and indexed,
+    and trial and continuous data can be selected by time
+    """
+    from autopilot.utils import timestamps
+
+    timestamps.set_format('ns')
+    try:
+        protocol = tmp_path / 'protocol.json'
+        protocol.write_text(json.dumps([{'task_type': 'Nafc', 'step_name': 'one'},
+                                        {'task_type': 'DLC_Hand', 'step_name': 'two'}]))
+        sub = Subject('test_subject', dir=str(tmp_path))
+        sub.assign_protocol(str(protocol))
+
+        # isoformatted timestamps only have microseconds
+        base = timestamps.timestamp() // 1000 * 1000
+        second = 1_000_000_000
+        sub.prepare_run()
+        for i in range(10):
+            sub.save_data({'trial_num': i, 'RQ_timestamp': base + i * second,
+                           # pilots set to isoformat still get stored as ns
+                           'DC_timestamp': timestamps.to_iso(base + i * second),
+                           'TRIAL_END': True})
+        sub.stop_run()
+
+        h5f = sub.open_hdf()
+        table = h5f.get_node('/data/protocol/S00_one/trial_data')
+        assert table.coldtypes['DC_timestamp'] == np.int64
+        assert table.cols.DC_timestamp.is_indexed and table.cols.session.is_indexed
+        sub.close_hdf(h5f)
+
+        df = sub.get_trial_data(times=(base + 2 * second, timestamps.to_iso(base + 5 * second)))
+        assert df['trial_num'].tolist() == [2, 3, 4]
+        df = sub.get_trial_data(times=(None, base + 2 * second), time_col='DC_timestamp', sessions=1)
+        assert df['trial_num'].tolist() == [0, 1]
+
+        sub.update_history('step', 'two', 1)
+        sub.prepare_run()
+        for i in range(100):
+            sub.save_data({'continuous': True, 'timestamp': base + i * second // 10,
+                           'distance': float(i), 'angle': 0.0})
+        sub.stop_run()
+
+        wheel = sub.get_continuous_data(['distance'], times=(base + 2 * second, base + 3 * second))
+        assert list(wheel.keys()) == ['distance']
+        assert wheel['distance']['distance'].tolist() == list(range(20, 30))
+        assert len(sub.get_continuous_data(sessions=1)) == 0
+        assert len(sub.get_continuous_data()['angle']) == 100
+    finally:
+        timestamps.set_format(None)
+
+
+def test_load_trial_data(tmp_path, two_step_subject):
+    """
+    Many subjects are loaded in parallel into one frame, and cached until their files change
+    """
+    from autopilot.core.loader import load_trial_data
+
+    other = Subject('other_subject', dir=str(tmp_path))
+    other.assign_protocol(str(tmp_path / 'protocol.json'))
+    other.prepare_run()
+    other.save_data({'trial_num': 0, 'target': 'R', 'correct': 1, 'TRIAL_END': True})
+    other.stop_run()
+
+    cache_dir = str(tmp_path / 'cache')
+    kwargs = dict(dir=str(tmp_path), columns=['trial_num', 'target'], cache_dir=cache_dir)
+    df = load_trial_data(['test_subject', 'other_subject'], processes=2, **kwargs)
+    assert df.shape[0] == 41
+    assert set(df.columns) == {'trial_num', 'target', 'step', 'step_name', 'subject'}
+    assert isinstance(df['subject'].dtype, pd.CategoricalDtype)
+    assert isinstance(df['step_name'].dtype, pd.CategoricalDtype)
+    assert df['subject'].cat.categories.tolist() == ['test_subject', 'other_subject']
+    assert (df['subject'] == 'other_subject').sum() == 1
+    assert len(os.listdir(cache_dir)) == 2
+
+    # cached, so files aren't read again
+    from autopilot.core import loader
+    load_subject = loader._load_subject
+    loader._load_subject = None
+    try:
+        cached = load_trial_data(['test_subject', 'other_subject'], processes=1, **kwargs)
+    finally:
+        loader._load_subject = load_subject
+    assert cached.equals(df)
+
+    # changed files are read again
+    other.prepare_run()
+    other.save_data({'trial_num': 1, 'target': 'L', 'correct': 1, 'TRIAL_END': True})
+    other.stop_run()
+    df = load_trial_data(['other_subject'], step={'other_subject': 0}, processes=1, **kwargs)
+    assert df['trial_num'].tolist() == [0, 1]
+
+
+def test_segment_store(tmp_path):
+    """
+    Rows are batched into checksummed segments that survive a crash, are compacted into
+    each subject's file, and can be read back after any sequence number.
+    """
+    from autopilot.core.segments import Segment_Store
+    from autopilot.tasks.nafc import Nafc
+
+    store = Segment_Store(str(tmp_path), background=False)
+    store.batch_size = 4
+    store.open('test_subject', 'Nafc', Nafc.TrialData)
+    for i in range(6):
+        assert store.append({'trial_num': i, 'target': 'L', 'correct': i % 2}) == i
+    segments = os.listdir(store.segment_dir)
+    assert segments == ['000000000000.part']
+    # one batch written, the rest buffered
+    with open(os.path.join(store.segment_dir, segments[0])) as f:
+        assert len(f.readlines()) == 5
+    assert [row['seq'] for row in store.since(3)] == [4, 5]
+
+    # crash with a half-written line: the segment is sealed, the bad line skipped, and seq continues
+    store.flush()
+    with open(os.path.join(store.segment_dir, segments[0]), 'a') as f:
+        f.write('0badc0de\t{"seq": 6, "ti')
+    store = Segment_Store(str(tmp_path), background=False)
+    assert store.next_seq == 6
+    assert os.listdir(store.segment_dir) == ['000000000000.seg']
+
+    store.open('test_subject', 'Nafc', Nafc.TrialData)
+    store.append({'trial_num': 6, 'target': 'R', 'correct': 1})
+    store.close()
+    assert store.compact() == 7
+    assert os.listdir(store.segment_dir) == []
+    # compacting again doesn't duplicate rows
+    assert store.compact() == 0
+
+    store.open('test_subject', 'Nafc', Nafc.TrialData)
+    store.append({'trial_num': 7, 'target': 'L', 'correct': 0})
+
+    rows = store.since(4)
+    assert [row['seq'] for row in rows] == [5, 6, 7]
+    assert rows[0]['subject'] == 'test_subject'
+    assert rows[0]['task'] == 'Nafc'
+    assert rows[1]['data']['target'] == 'R'
+    assert rows[1]['data']['trial_num'] == 6
+    assert len(store.since(-1)) == 8
+    assert all(row['finished'] for row in store.since(-1))
+    assert [row['seq'] for row in store.since(-1, limit=2)] == [0, 1]
+    # a trial cut off by the run stopping
+    store.append({'trial_num': 8, 'target': 'L'}, finished=False)
+    assert not store.since(7)[0]['finished']
+    store.close()
+    store.compact()
+    assert [row['finished'] for row in store.since(5)] == [True, True, False]
+
+    from autopilot.core.handles import POOL
+    POOL.close(str(tmp_path / 'test_subject.h5'))
+    with tables.open_file(str(tmp_path / 'test_subject.h5'), 'r') as h5f:
+        table = h5f.get_node('/Nafc/' + datetime.date.today().isoformat())
+        assert table.col('seq').tolist() == list(range(9))
+        assert table.col('trial_num').tolist() == list(range(9))
+
+
+def test_data_dedup(subject):
+    """
+    Data with a ``data_id`` that was already received, even by an earlier run, isn't stored twice
+    """
+    subject.prepare_run()
+    for i in range(3):
+        subject.save_data({'trial_num': i, 'target': 'L', 'data_id': 'abc_{}'.format(i), 'TRIAL_END': True})
+    # resent while running
+    subject.save_data({'trial_num': 1, 'target': 'R', 'data_id': 'abc_1', 'TRIAL_END': True})
+    subject.stop_run()
+
+    # and after restarting
+    subject.prepare_run()
+    subject.save_data({'trial_num': 2, 'target': 'R', 'data_id': 'abc_2', 'TRIAL_END': True})
+    subject.save_data({'trial_num': 3, 'target': 'R', 'data_id': 'abc_3', 'TRIAL_END': True})
+    subject.stop_run()
+
+    df = subject.get_trial_data()
+    assert df['trial_num'].tolist() == [0, 1, 2, 3]
+    assert df['target'].tolist() == [b'L', b'L', b'L', b'R']
+
+
+def test_seq_dedup(subject):
+    """
+    A pilot's row that's received both live and recovered from its store is only stored once
+    """
+    subject.prepare_run()
+    subject.save_data({'trial_num': 0, 'target': 'L', 'pilot': 'pi', 'seq': 0, 'TRIAL_END': True})
+    subject.save_data({'trial_num': 1, 'target': 'L', 'pilot': 'pi', 'seq': 1})
+    subject.save_data({'trial_num': 1, 'correct': 1, 'pilot': 'pi', 'seq': 1, 'TRIAL_END': True})
+    # recovered again
+    subject.save_data({'trial_num': 0, 'target': 'R', 'pilot': 'pi', 'seq': 0, 'TRIAL_END': True})
+    subject.save_data({'trial_num': 1, 'target': 'R', 'pilot': 'pi', 'seq': 1, 'TRIAL_END': True})
+    # the same seq from another pilot is another row
+    subject.save_data({'trial_num': 2, 'target': 'R', 'pilot': 'other', 'seq': 0, 'TRIAL_END': True})
+    subject.stop_run()
+
+    df = subject.get_trial_data()
+    assert df['trial_num'].tolist() == [0, 1, 2]
+    assert df['target'].tolist() == [b'L', b'L', b'R']
+
+
+def test_journal_dedup(subject):
+    """
+    Data recovered from the journal after a crash isn't stored again when its pilot resends it,
+    and data sent after a run was stopped is saved without starting a new one.
+    """
+    assert not subject.was_running
+    with open(subject.journal, 'w') as journal:
+        journal.write(json.dumps({'table': '/data/protocol/S00_one/trial_data',
+                                  'session': 1, 'start_row': 0}) + '\n')
+        for i in range(2):
+            journal.write(json.dumps({'trial_num': i, 'target': 'L', 'data_id': 'abc_{}'.format(i),
+                                      'TRIAL_END': True}) + '\n')
+    assert subject.was_running
+
+    subject.prepare_run()
+    # replayed from the pilot's backlog
+    subject.save_data({'trial_num': 1, 'target': 'R', 'data_id': 'abc_1', 'TRIAL_END': True})
+    subject.save_data({'trial_num': 2, 'target': 'L', 'data_id': 'abc_2', 'TRIAL_END': True})
+    subject.stop_run()
+    assert not subject.was_running
+
+    subject.save_backlog([
+        {'trial_num': 2, 'target': 'R', 'data_id': 'abc_2', 'TRIAL_END': True},
+        {'trial_num': 3, 'target': 'L', 'data_id': 'abc_3', 'TRIAL_END': True},
+    ])
+    assert not subject.running
+    assert not os.path.exists(subject.journal)
+
+    df = subject.get_trial_data()
+    assert df['trial_num'].tolist() == [0, 1, 2, 3]
+    assert df['target'].tolist() == [b'L', b'L', b'L', b'L']
+    assert df['session'].tolist() == [1, 1, 2, 2]
+
+
+def test_backlog_partial_trial(subject):
+    """
+    A backlog saved after the run was stopped finishes a trial that was
+    only partly written, rather than adding it again.
+    """
+    subject.prepare_run()
+    subject.save_data({'trial_num': 0, 'target': 'L', 'data_id': 'abc_0', 'TRIAL_END': True})
+    subject.save_data({'trial_num': 1, 'target': 'R', 'data_id': 'abc_1'})
+    subject.stop_run()
+
+    subject.save_backlog([
+        {'trial_num': 1, 'correct': 1, 'data_id': 'abc_2', 'TRIAL_END': True},
+        {'trial_num': 2, 'target': 'L', 'data_id': 'abc_3', 'TRIAL_END': True},
+    ])
+
+    df = subject.get_trial_data()
+    assert df['trial_num'].tolist() == [0, 1, 2]
+    assert df['target'].tolist() == [b'L', b'R', b'L']
+    assert df['correct'].tolist()[1] == 1
@@ -0,0 +1,46 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from autopilot.utils import timestamps
+
+
+@pytest.fixture
+def ns_format():
+    timestamps.set_format('ns')
+    yield
+    timestamps.set_format(None)
+
+
+def test_timestamp_formats(ns_format):
+    """
+    Timestamps are made in the set format and convert between formats
+    """
+    ns = timestamps.timestamp()
+    assert isinstance(ns, int)
+    iso = timestamps.timestamp('iso')
+    assert isinstance(iso, str)
+
+    assert timestamps.to_ns(timestamps.to_iso(ns)) == ns // 1000 * 1000
+    assert timestamps.to_ns(iso.encode('utf-8')) == timestamps.to_ns(datetime.datetime.fromisoformat(iso))
+    assert timestamps.to_column(ns, np.dtype('S26')) == timestamps.to_iso(ns).encode('utf-8')
+    assert timestamps.to_column(iso, np.dtype(np.int64)) == timestamps.to_ns(iso)
+
+    with pytest.raises(ValueError):
+        timestamps.set_format('seconds')
+
+
+def test_timestamps_to_datetime():
+    """
+    Columns of either format, or a string column with both, become the same datetimes
+    """
+    now = datetime.datetime.now().replace(microsecond=123456)
+    ns = timestamps.to_ns(now)
+    iso = now.isoformat().encode('utf-8')
+
+    expected = np.datetime64(now, 'ns')
+    assert timestamps.to_datetime(np.array([ns], dtype=np.int64))[0] == expected
+    assert timestamps.to_datetime(np.array([iso]))[0] == expected
+    mixed = timestamps.to_datetime(np.array([iso, str(ns).encode('utf-8')]))
+    assert (mixed == expected).all()